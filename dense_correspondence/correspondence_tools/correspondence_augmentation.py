@@ -13,10 +13,11 @@ implementation.
 
 from PIL import Image, ImageOps
 import numpy as np
-import random
 import torch
 
-def random_image_and_indices_mutation(images, uv_pixel_positions):
+import dense_correspondence_manipulation.utils.utils as utils
+
+def random_image_and_indices_mutation(images, uv_pixel_positions, rng=None):
     """
     This function takes a list of images and a list of pixel positions in the image, 
     and picks some subset of available mutations.
@@ -37,6 +38,9 @@ def random_image_and_indices_mutation(images, uv_pixel_positions):
     	Note: aim is to support both torch.LongTensor and torch.FloatTensor,
     	      and return the mutated_uv_pixel_positions with same type
 
+    :param rng: generators for the random choices, None for the global generators
+    :type  rng: utils.RandomStreams
+
     :return mutated_image_list, mutated_uv_pixel_positions
     	:rtype: list of PIL.image.image, tuple of torch Tensors
 
@@ -46,7 +50,7 @@ def random_image_and_indices_mutation(images, uv_pixel_positions):
     # 50% do nothing
     # 50% rotate the image 180 degrees (by applying flip vertical then flip horizontal) 
 
-    if random.random() < 0.5:
+    if utils.get_random_streams(rng).random.random() < 0.5:
         return images, uv_pixel_positions
 
     else:
@@ -83,17 +87,18 @@ def flip_horizontal(images, uv_pixel_positions):
     mutated_uv_pixel_positions = (mutated_u_pixel_positions, uv_pixel_positions[1])
     return mutated_images, mutated_uv_pixel_positions
 
-def random_domain_randomize_background(image_rgb, image_mask):
+def random_domain_randomize_background(image_rgb, image_mask, rng=None):
     """
     Ranomly call domain_randomize_background
     """
-    if random.random() < 0.5:
+    rng = utils.get_random_streams(rng)
+    if rng.random.random() < 0.5:
         return image_rgb
     else:
-        return domain_randomize_background(image_rgb, image_mask)
+        return domain_randomize_background(image_rgb, image_mask, rng=rng)
 
 
-def domain_randomize_background(image_rgb, image_mask):
+def domain_randomize_background(image_rgb, image_mask, rng=None):
     """
     This function applies domain randomization to the non-masked part of the image.
 
@@ -104,6 +109,9 @@ def domain_randomize_background(image_rgb, image_mask):
     :param image_mask: mask of part of image to be left alone, all else will be domain randomized
     :type image_mask: PIL.image.image
 
+    :param rng: generators for the random background, None for the global generators
+    :type rng: utils.RandomStreams
+
     :return domain_randomized_image_rgb:
     :rtype: PIL.image.image
     """
@@ -116,52 +124,56 @@ def domain_randomize_background(image_rgb, image_mask):
 
     # Next, domain randomize all non-masked parts of image
     three_channel_mask_complement = np.ones_like(three_channel_mask) - three_channel_mask
-    random_rgb_image = get_random_image(image_rgb_numpy.shape)
+    random_rgb_image = get_random_image(image_rgb_numpy.shape, rng=rng)
     random_rgb_background = three_channel_mask_complement * random_rgb_image
 
     domain_randomized_image_rgb = image_rgb_numpy + random_rgb_background
     return Image.fromarray(domain_randomized_image_rgb)
 
-def get_random_image(shape):
+def get_random_image(shape, rng=None):
     """
     Expects something like shape=(480,640,3)
 
     :param shape: tuple of shape for numpy array, for example from my_array.shape
     :type shape: tuple of ints
 
+    :param rng: None for the global generators
+    :type rng: utils.RandomStreams
+
     :return random_image:
     :rtype: np.ndarray
     """
-    if random.random() < 0.5:
-        rand_image = get_random_solid_color_image(shape)
+    rng = utils.get_random_streams(rng)
+    if rng.random.random() < 0.5:
+        rand_image = get_random_solid_color_image(shape, rng=rng)
     else:
-        rgb1 = get_random_solid_color_image(shape)
-        rgb2 = get_random_solid_color_image(shape)
-        vertical = bool(np.random.uniform() > 0.5)
+        rgb1 = get_random_solid_color_image(shape, rng=rng)
+        rgb2 = get_random_solid_color_image(shape, rng=rng)
+        vertical = bool(rng.numpy.uniform() > 0.5)
         rand_image = get_gradient_image(rgb1, rgb2, vertical=vertical)
 
-    if random.random() < 0.5:
+    if rng.random.random() < 0.5:
         return rand_image
     else:
-        return add_noise(rand_image)
+        return add_noise(rand_image, rng=rng)
 
-def get_random_rgb():
+def get_random_rgb(rng=None):
     """
     :return random rgb colors, each in range 0 to 255, for example [13, 25, 255]
     :rtype: numpy array with dtype=np.uint8
     """
-    return np.array(np.random.uniform(size=3) * 255, dtype=np.uint8)
+    return np.array(utils.get_random_streams(rng).numpy.uniform(size=3) * 255, dtype=np.uint8)
 
-def get_random_solid_color_image(shape):
+def get_random_solid_color_image(shape, rng=None):
     """
     Expects something like shape=(480,640,3)
 
     :return random solid color image:
     :rtype: numpy array of specificed shape, with dtype=np.uint8
     """
-    return np.ones(shape,dtype=np.uint8)*get_random_rgb()
+    return np.ones(shape,dtype=np.uint8)*get_random_rgb(rng=rng)
 
-def get_random_entire_image(shape, max_pixel_uint8):
+def get_random_entire_image(shape, max_pixel_uint8, rng=None):
     """
     Expects something like shape=(480,640,3)
 
@@ -173,7 +185,7 @@ def get_random_entire_image(shape, max_pixel_uint8):
     :return random solid color image:
     :rtype: numpy array of specificed shape, with dtype=np.uint8
     """
-    return np.array(np.random.uniform(size=shape) * max_pixel_uint8, dtype=np.uint8)
+    return np.array(utils.get_random_streams(rng).numpy.uniform(size=shape) * max_pixel_uint8, dtype=np.uint8)
 
 # this gradient code roughly taken from: 
 # https://github.com/openai/mujoco-py/blob/master/mujoco_py/modder.py
@@ -198,7 +210,7 @@ def get_gradient_image(rgb1, rgb2, vertical):
 
     return bitmap
 
-def add_noise(rgb_image):
+def add_noise(rgb_image, rng=None):
     """
     Adds noise, and subtracts noise to the rgb_image
 
@@ -211,10 +223,10 @@ def add_noise(rgb_image):
     ## Note: do not need to clamp, since uint8 will just overflow -- not bad
     """
     max_noise_to_add_or_subtract = 50
-    return rgb_image + get_random_entire_image(rgb_image.shape, max_noise_to_add_or_subtract) - get_random_entire_image(rgb_image.shape, max_noise_to_add_or_subtract) 
+    return rgb_image + get_random_entire_image(rgb_image.shape, max_noise_to_add_or_subtract, rng=rng) - get_random_entire_image(rgb_image.shape, max_noise_to_add_or_subtract, rng=rng) 
 
 
-def merge_images_with_occlusions(image_a, image_b, mask_a, mask_b, matches_pair_a, matches_pair_b):
+def merge_images_with_occlusions(image_a, image_b, mask_a, mask_b, matches_pair_a, matches_pair_b, rng=None):
     """
     This function will take image_a and image_b and "merge" them.
 
@@ -238,12 +250,15 @@ def merge_images_with_occlusions(image_a, image_b, mask_a, mask_b, matches_pair_
 
         Note: only support torch.LongTensors
 
+    :param rng: generators for choosing the background, None for the global generators
+    :type rng: utils.RandomStreams
+
     :return: merged image, merged_mask, pruned_matches_a, pruned_associated_matches_a, pruned_matches_b, pruned_associated_matches_b
     :rtype: PIL.image.image, numpy array, rest are same types as matches_a and matches_b
 
     """
 
-    if random.random() < 0.5:
+    if utils.get_random_streams(rng).random.random() < 0.5:
         foreground = "B"
         background_image, background_mask, background_matches_pair = image_a, mask_a, matches_pair_a
         foreground_image, foreground_mask, foreground_matches_pair = image_b, mask_b, matches_pair_b
@@ -26,8 +26,8 @@ from dense_correspondence_manipulation.utils.constants import *
 dtype_float = torch.FloatTensor
 dtype_long = torch.LongTensor
 
-def pytorch_rand_select_pixel(width,height,num_samples=1):
-    two_rand_numbers = torch.rand(2,num_samples)
+def pytorch_rand_select_pixel(width,height,num_samples=1, rng=None):
+    two_rand_numbers = utils.get_random_streams(rng).rand(2,num_samples)
     two_rand_numbers[0,:] = two_rand_numbers[0,:]*width
     two_rand_numbers[1,:] = two_rand_numbers[1,:]*height
     two_rand_ints    = torch.floor(two_rand_numbers).type(dtype_long)
@@ -65,7 +65,7 @@ def apply_transform_torch(vec3, transform4):
     vec4 = transform4.mm(vec4)
     return vec4[0:3]
 
-def random_sample_from_masked_image(img_mask, num_samples):
+def random_sample_from_masked_image(img_mask, num_samples, rng=None):
     """
     Samples num_samples (row, column) convention pixel locations from the masked image
     Note this is not in (u,v) format, but in same format as img_mask
@@ -74,6 +74,7 @@ def random_sample_from_masked_image(img_mask, num_samples):
         - shape is H x W
     :param num_samples: int
         - number of random indices to return
+    :param rng: utils.RandomStreams, None for the global generators
     :return: List of np.array
     """
     idx_tuple = img_mask.nonzero()
@@ -81,7 +82,7 @@ def random_sample_from_masked_image(img_mask, num_samples):
     if num_nonzero == 0:
         empty_list = []
         return empty_list
-    rand_inds = random.sample(range(0,num_nonzero), num_samples)
+    rand_inds = utils.get_random_streams(rng).random.sample(range(0,num_nonzero), num_samples)
 
     sampled_idx_list = []
     for i, idx in enumerate(idx_tuple):
@@ -89,13 +90,15 @@ def random_sample_from_masked_image(img_mask, num_samples):
 
     return sampled_idx_list
 
-def random_sample_from_masked_image_torch(img_mask, num_samples):
+def random_sample_from_masked_image_torch(img_mask, num_samples, rng=None):
     """
 
     :param img_mask: Numpy array [H,W] or torch.Tensor with shape [H,W]
     :type img_mask:
     :param num_samples: an integer
     :type num_samples:
+    :param rng: None for the global generators
+    :type rng: utils.RandomStreams
     :return: tuple of torch.LongTensor in (u,v) format. Each torch.LongTensor has shape
     [num_samples]
     :rtype:
@@ -114,7 +117,7 @@ def random_sample_from_masked_image_torch(img_mask, num_samples):
     if len(mask_indices_flat) == 0:
         return (None, None)
 
-    rand_numbers = torch.rand(num_samples)*len(mask_indices_flat)
+    rand_numbers = utils.get_random_streams(rng).rand(num_samples)*len(mask_indices_flat)
     rand_indices = torch.floor(rand_numbers).long()
     uv_vec_flattened = torch.index_select(mask_indices_flat, 0, rand_indices).squeeze(1)
     uv_vec = utils.flattened_pixel_locations_to_u_v(uv_vec_flattened, image_width)
@@ -273,7 +276,7 @@ def where(cond, x_1, x_2):
     cond = cond.type(dtype_float)    
     return (cond * x_1) + ((1-cond) * x_2)
 
-def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_match=100, img_b_mask=None):
+def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_match=100, img_b_mask=None, rng=None):
     """
     Takes in pixel matches (uv_b_matches) that correspond to matches in another image, and generates non-matches by just sampling in image space.
 
@@ -297,6 +300,9 @@ def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_ma
     :param img_b_mask: torch.FloatTensor (can be cuda or not)
         - masked image, we will select from the non-zero entries
         - shape is H x W
+
+    (optional)
+    :param rng: utils.RandomStreams, None for the global generators
      
     :return: tuple of torch.FloatTensors, i.e. (torch.FloatTensor, torch.FloatTensor).
         - The first element of the tuple is all "u" pixel positions, and the right element of the tuple is all "v" positions
@@ -310,10 +316,11 @@ def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_ma
         return None
 
     num_matches = len(uv_b_matches[0])
+    rng = utils.get_random_streams(rng)
 
     def get_random_uv_b_non_matches():
         return pytorch_rand_select_pixel(width=image_width,height=image_height, 
-            num_samples=num_matches*num_non_matches_per_match)
+            num_samples=num_matches*num_non_matches_per_match, rng=rng)
 
     if img_b_mask is not None:
         img_b_mask_flat = img_b_mask.view(-1,1).squeeze(1)
@@ -323,7 +330,7 @@ def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_ma
             uv_b_non_matches = get_random_uv_b_non_matches()
         else:
             num_samples = num_matches*num_non_matches_per_match
-            rand_numbers_b = torch.rand(num_samples)*len(mask_b_indices_flat)
+            rand_numbers_b = rng.rand(num_samples)*len(mask_b_indices_flat)
             rand_indices_b = torch.floor(rand_numbers_b).long()
             randomized_mask_b_indices_flat = torch.index_select(mask_b_indices_flat, 0, rand_indices_b).squeeze(1)
             uv_b_non_matches = (randomized_mask_b_indices_flat%image_width, randomized_mask_b_indices_flat/image_width)
@@ -360,9 +367,9 @@ def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_ma
     need_to_be_perturbed = where(diffs_1_flattened < threshold, ones, need_to_be_perturbed)
 
     minimal_perturb        = num_pixels_too_close/2
-    minimal_perturb_vector = (torch.rand(len(need_to_be_perturbed))*2).floor()*(minimal_perturb*2)-minimal_perturb
+    minimal_perturb_vector = (rng.rand(len(need_to_be_perturbed))*2).floor()*(minimal_perturb*2)-minimal_perturb
     std_dev = 10
-    random_vector = torch.randn(len(need_to_be_perturbed))*std_dev + minimal_perturb_vector
+    random_vector = rng.randn(len(need_to_be_perturbed))*std_dev + minimal_perturb_vector
     perturb_vector = need_to_be_perturbed*random_vector
 
     uv_b_non_matches_0_flat = uv_b_non_matches[0].view(-1,1).type(dtype_float).squeeze(1)
@@ -407,7 +414,8 @@ def create_non_correspondences(uv_b_matches, img_b_shape, num_non_matches_per_ma
 # Optionally, uv_a specifies the pixels in img_a for which to find matches
 # If uv_a is not set, then random correspondences are attempted to be found
 def batch_find_pixel_correspondences(img_a_depth, img_a_pose, img_b_depth, img_b_pose, 
-                                        uv_a=None, num_attempts=20, device='CPU', img_a_mask=None, K=None):
+                                        uv_a=None, num_attempts=20, device='CPU', img_a_mask=None, K=None,
+                                        rng=None):
     """
     Computes pixel correspondences in batch
 
@@ -440,6 +448,9 @@ def batch_find_pixel_correspondences(img_a_depth, img_a_pose, img_b_depth, img_b
     :param K:           optional arg, an image where each nonzero pixel will be used as a mask
     :type  K:           ndarray, of shape (H, W)
     --
+    :param rng:         optional arg, generators for the random sampling, None for the global generators
+    :type  rng:         utils.RandomStreams
+    --
     :return:            "Tuple of tuples", i.e. pixel position tuples for image a and image b (uv_a, uv_b). 
                         Each of these is a tuple of pixel positions
     :rtype:             Each of uv_a is a tuple of torch.FloatTensors
@@ -458,7 +469,7 @@ def batch_find_pixel_correspondences(img_a_depth, img_a_pose, img_b_depth, img_b
         dtype_long = torch.cuda.LongTensor
 
     if uv_a is None:
-        uv_a = pytorch_rand_select_pixel(width=image_width,height=image_height, num_samples=num_attempts)
+        uv_a = pytorch_rand_select_pixel(width=image_width,height=image_height, num_samples=num_attempts, rng=rng)
     else:
         uv_a = (torch.LongTensor([uv_a[0]]).type(dtype_long), torch.LongTensor([uv_a[1]]).type(dtype_long))
         num_attempts = 1
@@ -470,7 +481,7 @@ def batch_find_pixel_correspondences(img_a_depth, img_a_pose, img_b_depth, img_b
         img_a_mask = torch.from_numpy(img_a_mask).type(dtype_float)  
         
         # Option A: This next line samples from img mask
-        uv_a_vec = random_sample_from_masked_image_torch(img_a_mask, num_samples=num_attempts)
+        uv_a_vec = random_sample_from_masked_image_torch(img_a_mask, num_samples=num_attempts, rng=rng)
         if uv_a_vec[0] is None:
             return (None, None)
         
@@ -0,0 +1,156 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import sys
+import argparse
+import hashlib
+
+import numpy as np
+import torch
+
+from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+
+"""
+Checks that the training samples of a SpartanDataset with a random seed only depend on
+(seed, epoch, index), see SpartanDataset.set_random_seed().
+
+The first num_samples samples of an epoch are drawn
+
+    - in the main process, in reverse order, after scrambling the global random state
+    - with a DataLoader for each of the given numbers of workers
+
+and every sample is hashed. All runs must give the same hashes. The same indices are
+also drawn for the next epoch, which must give different samples.
+
+Usage:
+    python check_sampling_determinism.py --dataset_config <path to dataset config .yaml> \
+        --num_workers 0 1 4
+"""
+
+DEFAULT_TRAINING_CONFIG = os.path.join('config', 'dense_correspondence', 'training', 'training.yaml')
+
+
+def hash_sample(sample):
+    """
+    :param sample: the return value of SpartanDataset.__getitem__()
+    :type sample: tuple
+    :return: hex digest over the tensors, data type and metadata of the sample
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for x in sample:
+        if torch.is_tensor(x):
+            x = x.cpu().numpy()
+        if isinstance(x, np.ndarray):
+            h.update("%s %s" %(x.dtype, x.shape))
+            h.update(np.ascontiguousarray(x).tobytes())
+        elif isinstance(x, dict):
+            h.update(repr(sorted(x.items())))
+        else:
+            h.update(repr(x))
+    return h.hexdigest()
+
+
+def _first(batch):
+    """
+    collate_fn for batches of one sample, keeps the sample as __getitem__ returns it
+    """
+    return batch[0]
+
+
+def sample_hashes_in_main_process(dataset, num_samples, epoch=0):
+    """
+    Draws the samples in reverse order, with the global random state scrambled
+    :return: hash of each sample, in order of the index
+    :rtype: list of str
+    """
+    dataset.set_epoch(epoch)
+    utils.reset_random_seed(int(np.random.randint(2 ** 31)))
+
+    hashes = dict()
+    for index in reversed(xrange(num_samples)):
+        hashes[index] = hash_sample(dataset[index])
+    return [hashes[index] for index in xrange(num_samples)]
+
+
+def sample_hashes_with_data_loader(dataset, num_samples, num_workers, epoch=0):
+    """
+    :return: hash of each sample, in order of the index
+    :rtype: list of str
+    """
+    dataset.set_epoch(epoch)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=1, sampler=range(num_samples),
+                                              num_workers=num_workers, collate_fn=_first)
+    return [hash_sample(sample) for sample in data_loader]
+
+
+def check_sampling_determinism(dataset, num_samples=50, num_workers_list=(0, 1, 4), epoch=0):
+    """
+    :param dataset: dataset with a random seed
+    :type dataset: SpartanDataset
+    :return: dict of results, deterministic is True if all runs agree
+    :rtype: dict
+    """
+    if dataset.random_seed is None:
+        raise ValueError("the dataset has no random seed, see SpartanDataset.set_random_seed()")
+
+    reference = sample_hashes_in_main_process(dataset, num_samples, epoch=epoch)
+
+    num_mismatches = dict()
+    for num_workers in num_workers_list:
+        hashes = sample_hashes_with_data_loader(dataset, num_samples, num_workers, epoch=epoch)
+        num_mismatches[int(num_workers)] = int(sum(a != b for a, b in zip(reference, hashes)))
+
+    next_epoch = sample_hashes_in_main_process(dataset, num_samples, epoch=epoch + 1)
+
+    d = dict()
+    d['seed'] = dataset.random_seed
+    d['epoch'] = epoch
+    d['num_samples'] = num_samples
+    d['num_mismatches'] = num_mismatches
+    d['num_repeated_in_next_epoch'] = int(sum(a == b for a, b in zip(reference, next_epoch)))
+    d['deterministic'] = all(n == 0 for n in num_mismatches.values())
+    return d
+
+
+def print_results(d):
+    print "seed %d, epoch %d, %d samples" %(d['seed'], d['epoch'], d['num_samples'])
+    print "   - reference: main process, reverse order"
+    for num_workers in sorted(d['num_mismatches']):
+        print "   - %d workers: %d mismatches" %(num_workers, d['num_mismatches'][num_workers])
+    print "   - samples repeated in the next epoch: %d" %(d['num_repeated_in_next_epoch'])
+    print "deterministic:", d['deterministic']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_config", type=str, required=True,
+                        help="full path or path relative to the dense correspondence source dir")
+    parser.add_argument("--training_config", type=str, default=DEFAULT_TRAINING_CONFIG,
+                        help="full path or path relative to the dense correspondence source dir")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--epoch", type=int, default=0)
+    parser.add_argument("--num_samples", type=int, default=50)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 1, 4])
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    def get_config(filename):
+        if not os.path.isabs(filename):
+            filename = os.path.join(utils.getDenseCorrespondenceSourceDir(), filename)
+        return utils.getDictFromYamlFilename(filename)
+
+    dataset = SpartanDataset(mode="train", config=get_config(args.dataset_config))
+    dataset.load_all_pose_data()
+    dataset.set_parameters_from_training_config(get_config(args.training_config))
+    dataset.set_random_seed(args.seed)
+
+    results = check_sampling_determinism(dataset, num_samples=args.num_samples, num_workers_list=args.num_workers,
+                                         epoch=args.epoch)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
+
+    if not results['deterministic']:
+        sys.exit(1)
@@ -48,6 +48,13 @@ class DenseCorrespondenceDataset(data.Dataset):
                 [transforms.ToTensor(), transforms.ToTensor()]
             ])
 
+        # optional read-only cache of the image files, see frame_cache.py
+        self._frame_cache = None
+
+        # see set_random_seed()
+        self._random_seed = None
+        self._epoch = 0
+
       
     def __len__(self):
         return self.num_images_total
@@ -257,7 +264,8 @@ class DenseCorrespondenceDataset(data.Dataset):
         return self.get_rgbd_mask_pose(scene_name, img_idx)
 
 
-    def get_img_idx_with_different_pose(self, scene_name, pose_a, threshold=0.2, angle_threshold=20, num_attempts=10):
+    def get_img_idx_with_different_pose(self, scene_name, pose_a, threshold=0.2, angle_threshold=20, num_attempts=10,
+                                        rng=None):
         """
         Try to get an image with a different pose to the one passed in. If one can't be found
         then return None
@@ -269,13 +277,15 @@ class DenseCorrespondenceDataset(data.Dataset):
         :type threshold:
         :param num_attempts:
         :type num_attempts:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return: an index with a different-enough pose
         :rtype: int or None
         """
 
         counter = 0
         while counter < num_attempts:
-            img_idx = self.get_random_image_index(scene_name)
+            img_idx = self.get_random_image_index(scene_name, rng=rng)
             pose = self.get_pose_from_scene_name_and_idx(scene_name, img_idx)
 
             diff = utils.compute_distance_between_poses(pose_a, pose)
@@ -321,12 +331,36 @@ class DenseCorrespondenceDataset(data.Dataset):
         """
         return Image.open(mask_filename)
 
+    @property
+    def frame_cache(self):
+        return self._frame_cache
+
+    @frame_cache.setter
+    def frame_cache(self, value):
+        """
+        :param value: FrameCache or None
+        :type value: FrameCache
+        """
+        self._frame_cache = value
+
+    def _open_image(self, filename):
+        """
+        Opens an image, from the frame cache if there is one
+        :param filename: full path to the image
+        :type filename: str
+        :return:
+        :rtype: PIL.Image.Image
+        """
+        if self._frame_cache is None:
+            return Image.open(filename)
+        return self._frame_cache.open_image(filename)
+
     def get_rgb_image(self, rgb_filename):
         """
         :param depth_filename: string of full path to depth image
         :return: PIL.Image.Image, in particular an 'RGB' PIL image
         """
-        return Image.open(rgb_filename).convert('RGB')
+        return self._open_image(rgb_filename).convert('RGB')
 
     def get_rgb_image_from_scene_name_and_idx(self, scene_name, img_idx):
         """
@@ -343,7 +377,7 @@ class DenseCorrespondenceDataset(data.Dataset):
         :param depth_filename: string of full path to depth image
         :return: PIL.Image.Image
         """
-        return Image.open(depth_filename)
+        return self._open_image(depth_filename)
 
     def get_depth_image_from_scene_name_and_idx(self, scene_name, img_idx):
         """
@@ -360,7 +394,7 @@ class DenseCorrespondenceDataset(data.Dataset):
         :param mask_filename: string of full path to mask image
         :return: PIL.Image.Image
         """
-        return Image.open(mask_filename)
+        return self._open_image(mask_filename)
 
     def get_mask_image_from_scene_name_and_idx(self, scene_name, img_idx):
         """
@@ -426,20 +460,24 @@ class DenseCorrespondenceDataset(data.Dataset):
     def get_full_path_for_scene(self, scene_name):
         raise NotImplementedError("subclass must implement this method")
 
-    def get_random_scene_name(self):
+    def get_random_scene_name(self, rng=None):
         """
         Returns a random scene_name
         The result will depend on whether we are in test or train mode
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
-        return random.choice(self.scenes)
+        return utils.get_random_streams(rng).random.choice(self.scenes)
 
-    def get_random_image_index(self, scene_name):
+    def get_random_image_index(self, scene_name, rng=None):
         """
         Returns a random image index from a given scene
         :param scene_name:
         :type scene_name:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
@@ -535,6 +573,8 @@ class DenseCorrespondenceDataset(data.Dataset):
 
         # self._training_config = copy.deepcopy(training_config["training"])
 
+        self.set_random_seed(training_config['training'].get('random_seed', None))
+
         self.num_matching_attempts = int(training_config['training']['num_matching_attempts'])
         self.sample_matches_only_off_mask = training_config['training']['sample_matches_only_off_mask']
 
@@ -588,6 +628,40 @@ class DenseCorrespondenceDataset(data.Dataset):
         self._data_load_type_probabilities = np.array(self._data_load_type_probabilities)
         self._data_load_type_probabilities /= np.sum(self._data_load_type_probabilities)
 
+    @property
+    def random_seed(self):
+        return self._random_seed
+
+    def set_random_seed(self, seed):
+        """
+        With a seed, the index-th sample of an epoch is drawn from its own generators,
+        utils.sample_random_streams(seed, epoch, index). It then doesn't depend on the
+        global random state, on which samples were drawn before it or on the number of
+        DataLoader workers. With None samples are drawn from the global generators.
+        :param seed:
+        :type seed: int or None
+        """
+        self._random_seed = seed
+
+    def set_epoch(self, epoch):
+        """
+        Set before iterating over an epoch, so that every epoch draws new samples.
+        DataLoader workers are started for every epoch and copy the epoch
+        :param epoch:
+        :type epoch: int
+        """
+        self._epoch = epoch
+
+    def get_sample_random_streams(self, index):
+        """
+        :return: generators of the index-th sample of the current epoch, None if there is
+        no random seed
+        :rtype: utils.RandomStreams
+        """
+        if self._random_seed is None:
+            return None
+        return utils.sample_random_streams(self._random_seed, self._epoch, index)
+
     def set_train_mode(self):
         self.mode = "train"
 
@@ -0,0 +1,128 @@
+import os
+import io
+import logging
+
+import numpy as np
+from PIL import Image
+
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+
+"""
+A read-only cache of the encoded image files of a dataset.
+
+All the files are stored in a single numpy byte buffer. The cache is meant to be
+built once in a parent process and then shared with forked child processes, e.g.
+the runs of a parameter sweep. Since the buffer is a single object, reading from it
+doesn't touch the reference counts of the cached data, so the pages stay shared
+copy-on-write between all the processes.
+"""
+
+BYTES_PER_MB = 1024.0 * 1024.0
+
+IMAGE_TYPES = [ImageType.RGB, ImageType.DEPTH, ImageType.MASK]
+
+
+class FrameCache(object):
+
+    def __init__(self, buffer, index):
+        """
+        Use FrameCache.build() to construct a FrameCache
+        :param buffer: all the cached files, concatenated
+        :type buffer: numpy.ndarray of dtype uint8
+        :param index: dict of filename --> (offset, num_bytes) into buffer
+        :type index: dict
+        """
+        self._buffer = buffer
+        self._index = index
+
+    @staticmethod
+    def build(dataset, scene_names=None, image_types=IMAGE_TYPES, max_size_mb=4096):
+        """
+        Reads the image files of the given scenes into a FrameCache. Stops adding
+        files once max_size_mb is reached, files that are not in the cache are read
+        from disk as usual.
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param scene_names: defaults to all the scenes of the dataset in its current mode
+        :type scene_names: list of str
+        :param image_types: which of ImageType.RGB, ImageType.DEPTH, ImageType.MASK to cache
+        :type image_types: list
+        :param max_size_mb: maximum size of the cache
+        :type max_size_mb: float
+        :return:
+        :rtype: FrameCache
+        """
+        if scene_names is None:
+            scene_names = dataset.get_scene_list()
+
+        max_num_bytes = int(max_size_mb * BYTES_PER_MB)
+
+        filenames = []
+        num_bytes_total = 0
+        for scene_name in scene_names:
+            for img_idx in sorted(dataset.get_pose_data(scene_name).keys()):
+                for image_type in image_types:
+                    filename = dataset.get_image_filename(scene_name, img_idx, image_type)
+                    if not os.path.isfile(filename):
+                        continue
+
+                    num_bytes = os.path.getsize(filename)
+                    if num_bytes_total + num_bytes > max_num_bytes:
+                        logging.info("frame cache is full, caching %d files" %(len(filenames)))
+                        return FrameCache._read_files(filenames, num_bytes_total)
+
+                    filenames.append((filename, num_bytes))
+                    num_bytes_total += num_bytes
+
+        return FrameCache._read_files(filenames, num_bytes_total)
+
+    @staticmethod
+    def _read_files(filenames, num_bytes_total):
+        """
+        :param filenames: list of (filename, num_bytes)
+        :type filenames: list
+        :return:
+        :rtype: FrameCache
+        """
+        buffer = np.empty(num_bytes_total, dtype=np.uint8)
+        index = dict()
+
+        offset = 0
+        for filename, num_bytes in filenames:
+            with open(filename, 'rb') as f:
+                data = f.read()
+
+            # the file could have changed since we got its size
+            num_bytes = min(num_bytes, len(data))
+            buffer[offset:offset + num_bytes] = np.frombuffer(data[:num_bytes], dtype=np.uint8)
+            index[filename] = (offset, num_bytes)
+            offset += num_bytes
+
+        logging.info("frame cache has %d files, %.1f MB" %(len(index), offset / BYTES_PER_MB))
+        return FrameCache(buffer, index)
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def size_mb(self):
+        return self._buffer.nbytes / BYTES_PER_MB
+
+    def open_image(self, filename):
+        """
+        Opens an image from the cache, or from disk if it isn't cached
+        :param filename: full path to the image
+        :type filename: str
+        :return:
+        :rtype: PIL.Image.Image
+        """
+        if filename not in self._index:
+            return Image.open(filename)
+
+        offset, num_bytes = self._index[filename]
+        return Image.open(io.BytesIO(self._buffer[offset:offset + num_bytes].tobytes()))
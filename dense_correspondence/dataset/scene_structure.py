@@ -68,6 +68,17 @@ class SceneStructure(object):
         """
         return os.path.join(self._processed_folder_dir, 'mesh_descriptors', network_name)
 
+    def descriptor_store_dir(self, network_name):
+        """
+        Directory of the DescriptorStore with the descriptor images of a particular
+        network, see descriptor_pipeline.py
+        :param network_name:
+        :type network_name: str
+        :return:
+        :rtype: str
+        """
+        return os.path.join(self._processed_folder_dir, 'descriptor_store', network_name)
+
     def mesh_cells_image_filename(self, img_idx):
         """
         Returns the full filename for the cell labels image
@@ -94,6 +94,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
         self._pose_data = dict()
         self._initialize_rgb_image_to_tensor()
 
+        # reused across calls to get_within_scene_data, see mask_image_from_uv_flat_tensor
+        self._mask_buffer = None
+
         if mode == "test":
             self.set_test_mode()
         elif mode == "train":
@@ -115,40 +118,44 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         This small function randomly chooses one of our different
         img pair types, then returns that type of data.
-        """
 
+        With a random seed, see set_random_seed(), everything is drawn from the
+        generators of this index, so dataset[index] only depends on the seed,
+        the epoch and the index.
+        """
 
-        data_load_type = self._get_data_load_type()
+        rng = self.get_sample_random_streams(index)
+        data_load_type = self._get_data_load_type(rng=rng)
 
         # Case 0: Same scene, same object
         if data_load_type == SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE:
             if self._verbose:
                 print "Same scene, same object"
-            return self.get_single_object_within_scene_data()
+            return self.get_single_object_within_scene_data(rng=rng)
 
         # Case 1: Same object, different scene
         if data_load_type == SpartanDatasetDataType.SINGLE_OBJECT_ACROSS_SCENE:
             if self._verbose:
                 print "Same object, different scene"
-            return self.get_single_object_across_scene_data()
+            return self.get_single_object_across_scene_data(rng=rng)
 
         # Case 2: Different object
         if data_load_type == SpartanDatasetDataType.DIFFERENT_OBJECT:
             if self._verbose:
                 print "Different object"
-            return self.get_different_object_data()
+            return self.get_different_object_data(rng=rng)
 
         # Case 3: Multi object
         if data_load_type == SpartanDatasetDataType.MULTI_OBJECT:
             if self._verbose:
                 print "Multi object"
-            return self.get_multi_object_within_scene_data()
+            return self.get_multi_object_within_scene_data(rng=rng)
 
         # Case 4: Synthetic multi object
         if data_load_type == SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT:
             if self._verbose:
                 print "Synthetic multi object"
-            return self.get_synthetic_multi_object_within_scene_data()
+            return self.get_synthetic_multi_object_within_scene_data(rng=rng)
 
 
     def _setup_scene_data(self, config):
@@ -233,13 +240,15 @@ class SpartanDataset(DenseCorrespondenceDataset):
             self._data_load_types.append(SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT)
             self._data_load_type_probabilities.append(1)
 
-    def _get_data_load_type(self):
+    def _get_data_load_type(self, rng=None):
         """
         Gets a random data load type from the allowable types
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return: SpartanDatasetDataType
         :rtype:
         """
-        return np.random.choice(self._data_load_types, 1, p=self._data_load_type_probabilities)[0]
+        return utils.get_random_streams(rng).numpy.choice(self._data_load_types, 1, p=self._data_load_type_probabilities)[0]
 
     def scene_generator(self, mode=None):
         """
@@ -270,6 +279,42 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         return scene_list
     
+    def shard_scenes(self, rank, world_size):
+        """
+        Restricts the scenes of the current mode to a subset for data-parallel training,
+        so that each rank samples from different scenes.
+
+        Scenes are assigned round robin. The scenes of an object (and the multi object
+        scenes) are only sharded if each rank gets at least two of them, otherwise
+        every rank keeps all of them so that across scene sampling still works.
+
+        Does not modify self.config, which still has all the scenes.
+
+        :param rank:
+        :type rank: int
+        :param world_size:
+        :type world_size: int
+        :return:
+        :rtype: None
+        """
+        if world_size == 1:
+            return
+
+        def shard(scene_list):
+            if len(scene_list) < 2 * world_size:
+                return copy.copy(scene_list)
+            return scene_list[rank::world_size]
+
+        self._single_object_scene_dict = copy.deepcopy(self._single_object_scene_dict)
+        for object_id, single_object_scene_dict in self._single_object_scene_dict.iteritems():
+            single_object_scene_dict[self.mode] = shard(single_object_scene_dict[self.mode])
+
+        self._multi_object_scene_dict = copy.deepcopy(self._multi_object_scene_dict)
+        self._multi_object_scene_dict[self.mode] = shard(self._multi_object_scene_dict[self.mode])
+
+        self.init_length()
+        logging.info("rank %d of %d has %d scenes" %(rank, world_size, self._num_scenes))
+
     def get_list_of_objects(self):
         """
         Returns a list of object ids
@@ -405,56 +450,67 @@ class SpartanDataset(DenseCorrespondenceDataset):
         camera_info_file = os.path.join(scene_directory, 'processed', 'images', 'camera_info.yaml')
         return CameraIntrinsics.from_yaml_file(camera_info_file)
 
-    def get_random_image_index(self, scene_name):
+    def get_random_image_index(self, scene_name, rng=None):
         """
         Returns a random image index from a given scene
         :param scene_name:
         :type scene_name:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
+        rng = utils.get_random_streams(rng)
         pose_data = self.get_pose_data(scene_name)
         image_idxs = pose_data.keys() # list of integers
-        random.choice(image_idxs)
-        random_idx = random.choice(image_idxs)
+        rng.random.choice(image_idxs)
+        random_idx = rng.random.choice(image_idxs)
         return random_idx
 
-    def get_random_object_id(self):
+    def get_random_object_id(self, rng=None):
         """
         Returns a random object_id
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
         object_id_list = self._single_object_scene_dict.keys()
-        return random.choice(object_id_list)
+        return utils.get_random_streams(rng).random.choice(object_id_list)
 
-    def get_random_object_id_and_int(self):
+    def get_random_object_id_and_int(self, rng=None):
         """
         Returns a random object_id (a string) and its "int" (i.e. numerical unique id)
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
         object_id_list = self._single_object_scene_dict.keys()
-        random_object_id = random.choice(object_id_list)
+        random_object_id = utils.get_random_streams(rng).random.choice(object_id_list)
         object_id_int = sorted(self._single_object_scene_dict.keys()).index(random_object_id)
         return random_object_id, object_id_int
 
-    def get_random_single_object_scene_name(self, object_id):
+    def get_random_single_object_scene_name(self, object_id, rng=None):
         """
         Returns a random scene name for that object
         :param object_id: str
         :type object_id:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return: str
         :rtype:
         """
         scene_list = self._single_object_scene_dict[object_id][self.mode]
-        return random.choice(scene_list)
+        return utils.get_random_streams(rng).random.choice(scene_list)
 
-    def get_different_scene_for_object(self, object_id, scene_name):
+    def get_different_scene_for_object(self, object_id, scene_name, rng=None):
         """
         Return a different scene name
         :param object_id:
         :type object_id:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
@@ -464,7 +520,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
             raise ValueError("There is only one scene of this object, can't sample a different one")
 
         idx_array = np.arange(0, len(scene_list))
-        rand_idxs = np.random.choice(idx_array, 2, replace=False)
+        rand_idxs = utils.get_random_streams(rng).numpy.choice(idx_array, 2, replace=False)
 
         for idx in rand_idxs:
             scene_name_b = scene_list[idx]
@@ -473,9 +529,11 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         raise ValueError("It (should) be impossible to get here!!!!")
 
-    def get_two_different_object_ids(self):
+    def get_two_different_object_ids(self, rng=None):
         """
         Returns two different random object ids
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return: two object ids
         :rtype: two strings separated by commas
         """
@@ -485,7 +543,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
             raise ValueError("There is only one object, can't sample a different one")
 
         idx_array = np.arange(0, len(object_id_list))
-        rand_idxs = np.random.choice(idx_array, 2, replace=False)
+        rand_idxs = utils.get_random_streams(rng).numpy.choice(idx_array, 2, replace=False)
 
         object_1_id = object_id_list[rand_idxs[0]]
         object_2_id = object_id_list[rand_idxs[1]]
@@ -493,13 +551,15 @@ class SpartanDataset(DenseCorrespondenceDataset):
         assert object_1_id != object_2_id
         return object_1_id, object_2_id
 
-    def get_random_multi_object_scene_name(self):
+    def get_random_multi_object_scene_name(self, rng=None):
         """
         Returns a random multi object scene name
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
-        return random.choice(self._multi_object_scene_dict[self.mode])
+        return utils.get_random_streams(rng).random.choice(self._multi_object_scene_dict[self.mode])
 
 
     def get_number_of_unique_single_objects(self):
@@ -518,9 +578,11 @@ class SpartanDataset(DenseCorrespondenceDataset):
         """
         return len(self._multi_object_scene_dict["train"]) > 0
 
-    def get_random_scene_name(self):
+    def get_random_scene_name(self, rng=None):
         """
         Gets a random scene name across both single and multi object
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         """
         types = []
         if self.has_multi_object_scenes():
@@ -532,23 +594,23 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         if len(types) == 0:
             raise ValueError("I don't think you have any scenes?")
-        scene_type = random.choice(types)
+        scene_type = utils.get_random_streams(rng).random.choice(types)
 
         if scene_type == "multi":
-            return self.get_random_multi_object_scene_name()
+            return self.get_random_multi_object_scene_name(rng=rng)
         if scene_type == "single":
-            object_id = self.get_random_object_id()
-            return self.get_random_single_object_scene_name(object_id)
+            object_id = self.get_random_object_id(rng=rng)
+            return self.get_random_single_object_scene_name(object_id, rng=rng)
 
-    def get_single_object_within_scene_data(self):
+    def get_single_object_within_scene_data(self, rng=None):
         """
         Simple wrapper around get_within_scene_data(), for the single object case
         """
         if self.get_number_of_unique_single_objects() == 0:
             raise ValueError("There are no single object scenes in this dataset")
 
-        object_id = self.get_random_object_id()
-        scene_name = self.get_random_single_object_scene_name(object_id)
+        object_id = self.get_random_object_id(rng=rng)
+        scene_name = self.get_random_single_object_scene_name(object_id, rng=rng)
 
         metadata = dict()
         metadata["object_id"] = object_id
@@ -556,9 +618,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
         metadata["scene_name"] = scene_name
         metadata["type"] = SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE
 
-        return self.get_within_scene_data(scene_name, metadata)
+        return self.get_within_scene_data(scene_name, metadata, rng=rng)
 
-    def get_multi_object_within_scene_data(self):
+    def get_multi_object_within_scene_data(self, rng=None):
         """
         Simple wrapper around get_within_scene_data(), for the multi object case
         """
@@ -566,15 +628,15 @@ class SpartanDataset(DenseCorrespondenceDataset):
         if not self.has_multi_object_scenes():
             raise ValueError("There are no multi object scenes in this dataset")
 
-        scene_name = self.get_random_multi_object_scene_name()
+        scene_name = self.get_random_multi_object_scene_name(rng=rng)
 
         metadata = dict()
         metadata["scene_name"] = scene_name
         metadata["type"] = SpartanDatasetDataType.MULTI_OBJECT
 
-        return self.get_within_scene_data(scene_name, metadata)
+        return self.get_within_scene_data(scene_name, metadata, rng=rng)
 
-    def get_within_scene_data(self, scene_name, metadata, for_synthetic_multi_object=False):
+    def get_within_scene_data(self, scene_name, metadata, for_synthetic_multi_object=False, rng=None):
         """
         The method through which the dataset is accessed for training.
 
@@ -585,6 +647,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
         - random rgbd frame (different enough pose) from that scene
         - various randomization in the match generation and non-match generation procedure
 
+        all drawn from rng, or from the global generators if rng is None.
+
         returns a large amount of variables, separated by commas.
 
         0th return arg: the type of data sampled (this can be used as a flag for different loss functions)
@@ -624,13 +688,13 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         SD = SpartanDataset
 
-        image_a_idx = self.get_random_image_index(scene_name)
+        image_a_idx = self.get_random_image_index(scene_name, rng=rng)
         image_a_rgb, image_a_depth, image_a_mask, image_a_pose = self.get_rgbd_mask_pose(scene_name, image_a_idx)
 
         metadata['image_a_idx'] = image_a_idx
 
         # image b
-        image_b_idx = self.get_img_idx_with_different_pose(scene_name, image_a_pose, num_attempts=50)
+        image_b_idx = self.get_img_idx_with_different_pose(scene_name, image_a_pose, num_attempts=50, rng=rng)
         metadata['image_b_idx'] = image_b_idx
         if image_b_idx is None:
             logging.info("no frame with sufficiently different pose found, returning")
@@ -652,7 +716,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
         uv_a, uv_b = correspondence_finder.batch_find_pixel_correspondences(image_a_depth_numpy, image_a_pose,
                                                                             image_b_depth_numpy, image_b_pose,
                                                                             img_a_mask=correspondence_mask,
-                                                                            num_attempts=self.num_matching_attempts)
+                                                                            num_attempts=self.num_matching_attempts,
+                                                                            rng=rng)
 
         if for_synthetic_multi_object:
             return image_a_rgb, image_b_rgb, image_a_depth, image_b_depth, image_a_mask, image_b_mask, uv_a, uv_b
@@ -666,18 +731,18 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         # data augmentation
         if self._domain_randomize:
-            image_a_rgb = correspondence_augmentation.random_domain_randomize_background(image_a_rgb, image_a_mask)
-            image_b_rgb = correspondence_augmentation.random_domain_randomize_background(image_b_rgb, image_b_mask)
+            image_a_rgb = correspondence_augmentation.random_domain_randomize_background(image_a_rgb, image_a_mask, rng=rng)
+            image_b_rgb = correspondence_augmentation.random_domain_randomize_background(image_b_rgb, image_b_mask, rng=rng)
 
         if not self.debug:
-            [image_a_rgb, image_a_mask], uv_a = correspondence_augmentation.random_image_and_indices_mutation([image_a_rgb, image_a_mask], uv_a)
+            [image_a_rgb, image_a_mask], uv_a = correspondence_augmentation.random_image_and_indices_mutation([image_a_rgb, image_a_mask], uv_a, rng=rng)
             [image_b_rgb, image_b_mask], uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_mask], uv_b)
+                [image_b_rgb, image_b_mask], uv_b, rng=rng)
         else:  # also mutate depth just for plotting
             [image_a_rgb, image_a_depth, image_a_mask], uv_a = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_a_rgb, image_a_depth, image_a_mask], uv_a)
+                [image_a_rgb, image_a_depth, image_a_mask], uv_a, rng=rng)
             [image_b_rgb, image_b_depth, image_b_mask], uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_depth, image_b_mask], uv_b)
+                [image_b_rgb, image_b_depth, image_b_mask], uv_b, rng=rng)
 
         image_a_depth_numpy = np.asarray(image_a_depth)
         image_b_depth_numpy = np.asarray(image_b_depth)
@@ -693,7 +758,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
             correspondence_finder.create_non_correspondences(uv_b,
                                                              image_b_shape,
                                                              num_non_matches_per_match=self.num_masked_non_matches_per_match,
-                                                                            img_b_mask=image_b_mask_torch)
+                                                                            img_b_mask=image_b_mask_torch,
+                                                                            rng=rng)
 
 
         if self._use_image_b_mask_inv:
@@ -704,7 +770,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
         uv_b_background_non_matches = correspondence_finder.create_non_correspondences(uv_b,
                                                                             image_b_shape,
                                                                             num_non_matches_per_match=self.num_background_non_matches_per_match,
-                                                                            img_b_mask=image_b_mask_inv)
+                                                                            img_b_mask=image_b_mask_inv,
+                                                                            rng=rng)
 
 
 
@@ -733,7 +800,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
 
         # make blind non matches
-        matches_a_mask = SD.mask_image_from_uv_flat_tensor(matches_a, image_width, image_height)
+        matches_a_mask = SD.mask_image_from_uv_flat_tensor(matches_a, image_width, image_height,
+                                                           out=self._mask_buffer)
+        self._mask_buffer = matches_a_mask
         image_a_mask_torch = torch.from_numpy(np.asarray(image_a_mask)).long()
         mask_a_flat = image_a_mask_torch.view(-1,1).squeeze(1)
         blind_non_matches_a = (mask_a_flat - matches_a_mask).nonzero()
@@ -751,7 +820,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
                 # make sure we check that blind_uv_b is not None and that it is non-empty
 
 
-                blind_uv_b = correspondence_finder.random_sample_from_masked_image_torch(image_b_mask_torch, num_blind_samples)
+                blind_uv_b = correspondence_finder.random_sample_from_masked_image_torch(image_b_mask_torch, num_blind_samples,
+                                                                                         rng=rng)
 
                 if blind_uv_b[0] is None:
                     no_blind_matches_found = True
@@ -857,44 +927,44 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         return uv_a_long, uv_b_non_matches_long
 
-    def get_single_object_across_scene_data(self):
+    def get_single_object_across_scene_data(self, rng=None):
         """
         Simple wrapper for get_across_scene_data(), for the single object case
         """
         metadata = dict()
-        object_id = self.get_random_object_id()
-        scene_name_a = self.get_random_single_object_scene_name(object_id)
-        scene_name_b = self.get_different_scene_for_object(object_id, scene_name_a)
+        object_id = self.get_random_object_id(rng=rng)
+        scene_name_a = self.get_random_single_object_scene_name(object_id, rng=rng)
+        scene_name_b = self.get_different_scene_for_object(object_id, scene_name_a, rng=rng)
         metadata["object_id"] = object_id
         metadata["scene_name_a"] = scene_name_a
         metadata["scene_name_b"] = scene_name_b
         metadata["type"] = SpartanDatasetDataType.SINGLE_OBJECT_ACROSS_SCENE
-        return self.get_across_scene_data(scene_name_a, scene_name_b, metadata)
+        return self.get_across_scene_data(scene_name_a, scene_name_b, metadata, rng=rng)
 
-    def get_different_object_data(self):
+    def get_different_object_data(self, rng=None):
         """
         Simple wrapper for get_across_scene_data(), for the different object case
         """
         metadata = dict()
-        object_id_a, object_id_b = self.get_two_different_object_ids()
-        scene_name_a = self.get_random_single_object_scene_name(object_id_a)
-        scene_name_b = self.get_random_single_object_scene_name(object_id_b)
+        object_id_a, object_id_b = self.get_two_different_object_ids(rng=rng)
+        scene_name_a = self.get_random_single_object_scene_name(object_id_a, rng=rng)
+        scene_name_b = self.get_random_single_object_scene_name(object_id_b, rng=rng)
 
         metadata["object_id_a"]  = object_id_a
         metadata["scene_name_a"] = scene_name_a
         metadata["object_id_b"]  = object_id_b
         metadata["scene_name_b"] = scene_name_b
         metadata["type"] = SpartanDatasetDataType.DIFFERENT_OBJECT
-        return self.get_across_scene_data(scene_name_a, scene_name_b, metadata)
+        return self.get_across_scene_data(scene_name_a, scene_name_b, metadata, rng=rng)
 
-    def get_synthetic_multi_object_within_scene_data(self):
+    def get_synthetic_multi_object_within_scene_data(self, rng=None):
         """
         Synthetic case
         """
 
-        object_id_a, object_id_b = self.get_two_different_object_ids()
-        scene_name_a = self.get_random_single_object_scene_name(object_id_a)
-        scene_name_b = self.get_random_single_object_scene_name(object_id_b)
+        object_id_a, object_id_b = self.get_two_different_object_ids(rng=rng)
+        scene_name_a = self.get_random_single_object_scene_name(object_id_a, rng=rng)
+        scene_name_b = self.get_random_single_object_scene_name(object_id_b, rng=rng)
 
         metadata = dict()
         metadata["object_id_a"]  = object_id_a
@@ -905,7 +975,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         image_a1_rgb, image_a2_rgb, image_a1_depth, image_a2_depth,\
         image_a1_mask, image_a2_mask, uv_a1, uv_a2 =\
-         self.get_within_scene_data(scene_name_a, metadata, for_synthetic_multi_object=True)
+         self.get_within_scene_data(scene_name_a, metadata, for_synthetic_multi_object=True, rng=rng)
 
         if uv_a1 is None:
             logging.info("no matches found, returning")
@@ -914,7 +984,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         image_b1_rgb, image_b2_rgb, image_b1_depth, image_b2_depth,\
         image_b1_mask, image_b2_mask, uv_b1, uv_b2 =\
-         self.get_within_scene_data(scene_name_b, metadata, for_synthetic_multi_object=True)
+         self.get_within_scene_data(scene_name_b, metadata, for_synthetic_multi_object=True, rng=rng)
 
         if uv_b1 is None:
             logging.info("no matches found, returning")
@@ -931,7 +1001,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         merged_rgb_1, merged_mask_1, uv_a1, uv_a2, uv_b1, uv_b2 =\
          correspondence_augmentation.merge_images_with_occlusions(image_a1_rgb, image_b1_rgb,
                                                                   image_a1_mask, image_b1_mask,
-                                                                  matches_pair_a, matches_pair_b)
+                                                                  matches_pair_a, matches_pair_b, rng=rng)
 
         if (uv_a1 is None) or (uv_a2 is None) or (uv_b1 is None) or (uv_b2 is None):
             logging.info("something got fully occluded, returning")
@@ -943,7 +1013,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         merged_rgb_2, merged_mask_2, uv_a2, uv_a1, uv_b2, uv_b1 =\
          correspondence_augmentation.merge_images_with_occlusions(image_a2_rgb, image_b2_rgb,
                                                                   image_a2_mask, image_b2_mask,
-                                                                  matches_pair_a, matches_pair_b)
+                                                                  matches_pair_a, matches_pair_b, rng=rng)
 
         if (uv_a1 is None) or (uv_a2 is None) or (uv_b1 is None) or (uv_b2 is None):
             logging.info("something got fully occluded, returning")
@@ -964,7 +1034,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
             correspondence_finder.create_non_correspondences(matches_2,
                                                              image_b_shape,
                                                              num_non_matches_per_match=self.num_masked_non_matches_per_match,
-                                                                            img_b_mask=merged_mask_2_torch)
+                                                                            img_b_mask=merged_mask_2_torch,
+                                                                            rng=rng)
         if self._use_image_b_mask_inv:
             merged_mask_2_torch_inv = 1 - merged_mask_2_torch
         else:
@@ -973,7 +1044,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
         matches_2_background_non_matches = correspondence_finder.create_non_correspondences(matches_2,
                                                                             image_b_shape,
                                                                             num_non_matches_per_match=self.num_background_non_matches_per_match,
-                                                                            img_b_mask=merged_mask_2_torch_inv)
+                                                                            img_b_mask=merged_mask_2_torch_inv,
+                                                                            rng=rng)
 
 
         SD = SpartanDataset
@@ -1053,7 +1125,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         return metadata["type"], merged_rgb_1, merged_rgb_2, matches_a, matches_b, masked_non_matches_a, masked_non_matches_b, background_non_matches_a, background_non_matches_b, SD.empty_tensor(), SD.empty_tensor(), metadata
 
 
-    def get_across_scene_data(self, scene_name_a, scene_name_b, metadata):
+    def get_across_scene_data(self, scene_name_a, scene_name_b, metadata, rng=None):
         """
         Essentially just returns a bunch of samples off the masks from scene_name_a, and scene_name_b.
 
@@ -1067,6 +1139,8 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :type scene_name_a, scene_name_b: strings
         :param metadata: a dict() holding metadata of the image pair, both for logging and for different downstream loss functions
         :type metadata: dict()
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         """
 
         SD = SpartanDataset
@@ -1074,21 +1148,23 @@ class SpartanDataset(DenseCorrespondenceDataset):
         if self.get_number_of_unique_single_objects() == 0:
             raise ValueError("There are no single object scenes in this dataset")
 
-        image_a_idx = self.get_random_image_index(scene_name_a)
+        image_a_idx = self.get_random_image_index(scene_name_a, rng=rng)
         image_a_rgb, image_a_depth, image_a_mask, image_a_pose = self.get_rgbd_mask_pose(scene_name_a, image_a_idx)
 
         metadata['image_a_idx'] = image_a_idx
 
         # image b
-        image_b_idx = self.get_random_image_index(scene_name_b)
+        image_b_idx = self.get_random_image_index(scene_name_b, rng=rng)
         image_b_rgb, image_b_depth, image_b_mask, image_b_pose = self.get_rgbd_mask_pose(scene_name_b, image_b_idx)
         metadata['image_b_idx'] = image_b_idx
 
         # sample random indices from mask in image a
         num_samples = self.cross_scene_num_samples
-        blind_uv_a = correspondence_finder.random_sample_from_masked_image_torch(np.asarray(image_a_mask), num_samples)
+        blind_uv_a = correspondence_finder.random_sample_from_masked_image_torch(np.asarray(image_a_mask), num_samples,
+                                                                                 rng=rng)
         # sample random indices from mask in image b
-        blind_uv_b = correspondence_finder.random_sample_from_masked_image_torch(np.asarray(image_b_mask), num_samples)
+        blind_uv_b = correspondence_finder.random_sample_from_masked_image_torch(np.asarray(image_b_mask), num_samples,
+                                                                                 rng=rng)
 
         if (blind_uv_a[0] is None) or (blind_uv_b[0] is None):
             image_a_rgb_tensor = self.rgb_image_to_tensor(image_a_rgb)
@@ -1096,18 +1172,18 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         # data augmentation
         if self._domain_randomize:
-            image_a_rgb = correspondence_augmentation.random_domain_randomize_background(image_a_rgb, image_a_mask)
-            image_b_rgb = correspondence_augmentation.random_domain_randomize_background(image_b_rgb, image_b_mask)
+            image_a_rgb = correspondence_augmentation.random_domain_randomize_background(image_a_rgb, image_a_mask, rng=rng)
+            image_b_rgb = correspondence_augmentation.random_domain_randomize_background(image_b_rgb, image_b_mask, rng=rng)
 
         if not self.debug:
-            [image_a_rgb, image_a_mask], blind_uv_a = correspondence_augmentation.random_image_and_indices_mutation([image_a_rgb, image_a_mask], blind_uv_a)
+            [image_a_rgb, image_a_mask], blind_uv_a = correspondence_augmentation.random_image_and_indices_mutation([image_a_rgb, image_a_mask], blind_uv_a, rng=rng)
             [image_b_rgb, image_b_mask], blind_uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_mask], blind_uv_b)
+                [image_b_rgb, image_b_mask], blind_uv_b, rng=rng)
         else:  # also mutate depth just for plotting
             [image_a_rgb, image_a_depth, image_a_mask], blind_uv_a = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_a_rgb, image_a_depth, image_a_mask], blind_uv_a)
+                [image_a_rgb, image_a_depth, image_a_mask], blind_uv_a, rng=rng)
             [image_b_rgb, image_b_depth, image_b_mask], blind_uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_depth, image_b_mask], blind_uv_b)
+                [image_b_rgb, image_b_depth, image_b_mask], blind_uv_b, rng=rng)
 
         image_a_depth_numpy = np.asarray(image_a_depth)
         image_b_depth_numpy = np.asarray(image_b_depth)
@@ -1264,7 +1340,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         return uv_tensor[1].long() * image_width + uv_tensor[0].long()
 
     @staticmethod
-    def mask_image_from_uv_flat_tensor(uv_flat_tensor, image_width, image_height):
+    def mask_image_from_uv_flat_tensor(uv_flat_tensor, image_width, image_height, out=None):
         """
         Returns a torch.LongTensor with shape [image_width*image_height]. It has a 1 exactly
         at the indices specified by uv_flat_tensor
@@ -1274,10 +1350,17 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :type image_width:
         :param image_height:
         :type image_height:
+        :param out: (optional) previously returned mask to reuse instead of allocating a
+        new one. It is only reused if it has the right size.
+        :type out: torch.LongTensor
         :return:
         :rtype:
         """
-        image_flat = torch.zeros(image_width*image_height).long()
+        if out is not None and out.numel() == image_width*image_height:
+            image_flat = out.zero_()
+        else:
+            image_flat = torch.zeros(image_width*image_height).long()
+
         image_flat[uv_flat_tensor] = 1
         return image_flat
 
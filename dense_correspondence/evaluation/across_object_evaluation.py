@@ -0,0 +1,262 @@
+import logging
+
+import numpy as np
+
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+from dense_correspondence.evaluation.descriptor_pipeline import DescriptorPipeline
+from dense_correspondence.evaluation.evaluation_store import pair_seed
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
+
+"""
+Batched across object evaluation.
+
+evaluate_network_across_objects() samples pairs of objects and, one pixel at a time,
+finds the best match of the pixel over the whole descriptor image of the other
+object. Going through all pairs of objects that way is too slow to run routinely.
+Instead, compute_across_object_statistics()
+
+    1. samples num_images_per_object frames of each object and runs the network on
+       them with DescriptorPipeline, keeping num_samples_per_image descriptors from the
+       mask of each frame
+    2. finds, for every sample, its nearest neighbor among the samples of every object,
+       blockwise, so that at most block_size x block_size distances are in memory
+    3. assigns every sample to the object of its overall nearest neighbor, which gives
+       the object by object confusion matrix
+
+Samples are never matched against samples of their own frame, so the diagonal of the
+confusion matrix is the fraction of samples that find their own object in other frames.
+"""
+
+
+def sample_object_frames(dataset, num_images_per_object=10, seed=0):
+    """
+    Frames of the single object scenes of each object, the scenes of an object take turns
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_images_per_object:
+    :type num_images_per_object: int
+    :param seed:
+    :type seed: int
+    :return: sorted object ids, and a list of (scene_name, img_idx) per object
+    :rtype: list, list
+    """
+    rng = np.random.RandomState(seed)
+    object_ids = sorted(dataset.get_list_of_objects())
+    object_frames = []
+    for object_id in object_ids:
+        scene_frames = []
+        for scene_name in sorted(dataset.get_scene_list_for_object(object_id)):
+            image_idxs = sorted(dataset.get_pose_data(scene_name).keys())
+            rng.shuffle(image_idxs)
+            scene_frames.append([(scene_name, img_idx) for img_idx in image_idxs])
+
+        frames = []
+        for i in xrange(max([len(x) for x in scene_frames] + [0])):
+            frames.extend(x[i] for x in scene_frames if i < len(x))
+        object_frames.append(frames[:num_images_per_object])
+
+    return object_ids, object_frames
+
+
+class ObjectDescriptorSampler(object):
+    """
+    Store for DescriptorPipeline that keeps num_samples_per_image descriptors from the
+    mask of each descriptor image
+    """
+
+    def __init__(self, dataset, frames, num_samples_per_image=100, seed=0):
+        """
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param frames: the frames that will be appended, in order
+        :type frames: list of (scene_name, img_idx)
+        :param num_samples_per_image:
+        :type num_samples_per_image: int
+        :param seed: the pixels of the i-th frame are sampled with pair_seed(seed, i), so they
+        don't depend on the order in which the pipeline appends the frames
+        :type seed: int
+        """
+        self._dataset = dataset
+        self._frame_position = {frame: i for i, frame in enumerate(frames)}
+        self._num_samples_per_image = num_samples_per_image
+        self._seed = seed
+        self._samples = dict()
+
+    def append(self, frame, res):
+        """
+        :param frame: (scene_name, img_idx)
+        :type frame: tuple
+        :param res: descriptor image [H, W, D]
+        :type res: numpy.ndarray
+        """
+        position = self._frame_position[frame]
+        mask = np.asarray(self._dataset.get_mask_image_from_scene_name_and_idx(frame[0], frame[1]))
+        v, u = np.nonzero(mask)
+        if len(v) == 0:
+            logging.info("empty mask, skipping %s %d" %(frame[0], frame[1]))
+            return
+
+        rng = np.random.RandomState(pair_seed(self._seed, position))
+        idx = rng.choice(len(v), size=min(self._num_samples_per_image, len(v)), replace=False)
+        self._samples[position] = (res[v[idx], u[idx]].astype(np.float32), np.stack([u[idx], v[idx]], axis=1))
+
+    def close(self):
+        pass
+
+    def result(self):
+        """
+        :return: frame position, descriptor [D] and pixel (u, v) of each sample, in order of the frames
+        :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+        """
+        positions = sorted(self._samples.keys())
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros([0, 0], dtype=np.float32), np.zeros([0, 2], dtype=np.int64)
+
+        frame_positions = np.concatenate([np.full(len(self._samples[p][0]), p, dtype=np.int64) for p in positions])
+        descriptors = np.concatenate([self._samples[p][0] for p in positions])
+        uv = np.concatenate([self._samples[p][1] for p in positions])
+        return frame_positions, descriptors, uv
+
+
+def nearest_neighbors_by_object(descriptors, object_labels, frame_labels, num_objects, block_size=1024):
+    """
+    Nearest neighbor of every sample among the samples of each object, excluding
+    the samples of its own frame
+    :param descriptors: [M, D]
+    :type descriptors: numpy.ndarray
+    :param object_labels: [M] object of each sample, sorted
+    :type object_labels: numpy.ndarray
+    :param frame_labels: [M] frame of each sample
+    :type frame_labels: numpy.ndarray
+    :param num_objects:
+    :type num_objects: int
+    :param block_size: number of query and database samples per distance computation
+    :type block_size: int
+    :return: [M, num_objects] distance to, and index of, the nearest neighbor in each
+    object, inf and -1 if the object has no other samples
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    num_samples = len(descriptors)
+    best_squared_distance = np.full([num_samples, num_objects], np.inf)
+    best_idx = np.full([num_samples, num_objects], -1, dtype=np.int64)
+
+    for q_start in xrange(0, num_samples, block_size):
+        q_end = min(q_start + block_size, num_samples)
+        rows = np.arange(q_end - q_start)
+
+        for c_start in xrange(0, num_samples, block_size):
+            c_end = min(c_start + block_size, num_samples)
+            # float64, the expansion of the squared distance cancels badly for near matches in float32
+            squared_diffs = squared_distances(descriptors[q_start:q_end].astype(np.float64),
+                                              descriptors[c_start:c_end].astype(np.float64))
+            squared_diffs[frame_labels[q_start:q_end, None] == frame_labels[None, c_start:c_end]] = np.inf
+
+            # the samples of an object are contiguous
+            block_objects, object_starts = np.unique(object_labels[c_start:c_end], return_index=True)
+            object_ends = np.append(object_starts[1:], c_end - c_start)
+            for object_label, start, end in zip(block_objects, object_starts, object_ends):
+                idx = start + np.argmin(squared_diffs[:, start:end], axis=1)
+                squared_distance = squared_diffs[rows, idx]
+                better = squared_distance < best_squared_distance[q_start:q_end, object_label]
+                best_squared_distance[q_start:q_end, object_label][better] = squared_distance[better]
+                best_idx[q_start:q_end, object_label][better] = c_start + idx[better]
+
+    return np.sqrt(best_squared_distance), best_idx
+
+
+def compute_confusion_matrix(distances, object_labels, num_objects):
+    """
+    :param distances: [M, num_objects], see nearest_neighbors_by_object()
+    :type distances: numpy.ndarray
+    :return: [num_objects, num_objects], entry (a, b) is the fraction of samples of object a
+    whose nearest neighbor is a sample of object b
+    :rtype: numpy.ndarray
+    """
+    predicted = np.argmin(distances, axis=1)
+    counts = np.zeros([num_objects, num_objects])
+    np.add.at(counts, (object_labels, predicted), 1)
+    return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+
+def compute_across_object_statistics(dcn, dataset, num_images_per_object=10, num_samples_per_image=100, seed=0,
+                                     block_size=1024, **kwargs):
+    """
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_images_per_object:
+    :type num_images_per_object: int
+    :param num_samples_per_image: number of descriptors sampled from the mask of each frame
+    :type num_samples_per_image: int
+    :param seed:
+    :type seed: int
+    :param block_size: see nearest_neighbors_by_object()
+    :type block_size: int
+    :param kwargs: passed to DescriptorPipeline
+    :return: dict with
+        object_ids: sorted object ids
+        frames: list of (scene_name, img_idx)
+        frame_labels, object_labels, uv, descriptors: frame, object, pixel and descriptor of each sample
+        distances, nearest_neighbors: see nearest_neighbors_by_object()
+        confusion_matrix: see compute_confusion_matrix()
+    :rtype: dict
+    """
+    object_ids, object_frames = sample_object_frames(dataset, num_images_per_object=num_images_per_object, seed=seed)
+    if len(object_ids) < 2:
+        raise ValueError("need at least two objects, the dataset has %d" %(len(object_ids)))
+
+    frames = []
+    frame_objects = []
+    for object_label, object_frame_list in enumerate(object_frames):
+        frames.extend(object_frame_list)
+        frame_objects.extend([object_label] * len(object_frame_list))
+
+    sampler = ObjectDescriptorSampler(dataset, frames, num_samples_per_image=num_samples_per_image, seed=seed)
+    pipeline = DescriptorPipeline(dcn, dataset.rgb_image_to_tensor, open_image=dataset.get_rgb_image, **kwargs)
+    sources = [(frame, dataset.get_image_filename(frame[0], frame[1], ImageType.RGB)) for frame in frames]
+    pipeline.run(sources, sampler)
+
+    # frames are ordered by object, so the samples are too
+    frame_labels, descriptors, uv = sampler.result()
+    object_labels = np.asarray(frame_objects, dtype=np.int64)[frame_labels]
+
+    distances, nearest_neighbors = nearest_neighbors_by_object(descriptors, object_labels, frame_labels,
+                                                               len(object_ids), block_size=block_size)
+
+    d = dict()
+    d['object_ids'] = object_ids
+    d['frames'] = frames
+    d['frame_labels'] = frame_labels
+    d['object_labels'] = object_labels
+    d['uv'] = uv
+    d['descriptors'] = descriptors
+    d['distances'] = distances
+    d['nearest_neighbors'] = nearest_neighbors
+    d['confusion_matrix'] = compute_confusion_matrix(distances, object_labels, len(object_ids))
+    return d
+
+
+def summarize_across_object_statistics(d):
+    """
+    :param d: see compute_across_object_statistics()
+    :type d: dict
+    :return: yaml friendly summary: confusion matrix, median nearest neighbor distance
+    between each pair of objects and number of samples per object
+    :rtype: dict
+    """
+    num_objects = len(d['object_ids'])
+    median_distance = np.full([num_objects, num_objects], np.nan)
+    for a in xrange(num_objects):
+        distances = d['distances'][d['object_labels'] == a]
+        for b in xrange(num_objects):
+            finite = distances[:, b][np.isfinite(distances[:, b])]
+            if len(finite) > 0:
+                median_distance[a, b] = np.median(finite)
+
+    summary = dict()
+    summary['object_ids'] = list(d['object_ids'])
+    summary['num_samples'] = [int(np.sum(d['object_labels'] == a)) for a in xrange(num_objects)]
+    summary['confusion_matrix'] = d['confusion_matrix'].tolist()
+    summary['median_nearest_neighbor_distance'] = median_distance.tolist()
+    return summary
@@ -0,0 +1,347 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import sys
+import time
+import Queue
+import logging
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+
+from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation, \
+    DenseCorrespondenceEvaluationPlotter
+from dense_correspondence.evaluation.evaluation_store import pair_seed
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+"""
+Evaluation that samples image pairs until the metrics are known to a target precision.
+
+DenseCorrespondenceEvaluation.evaluate_network() evaluates a fixed number of image pairs.
+Here image pairs are evaluated in batches of batch_size, and after each batch a bootstrap
+confidence interval is computed for every metric. Sampling stops once every interval is
+narrower than its target width, or after max_image_pairs. The bootstrap resamples image
+pairs rather than matches, since the matches of one image pair are correlated.
+
+The image pairs and their ground truth matches are sampled and loaded on a background
+thread, ahead of the forward passes on the calling thread. Image pair i is sampled with
+its own seed, see evaluation_store.pair_seed(), so runs with the same seed see the same
+image pairs no matter when they stop.
+
+In paired mode two networks are evaluated on the same image pairs and matches, and the
+intervals are those of the difference of the metrics (network b minus network a). The
+noise of the image pair sampling cancels out, so a difference is resolved with far fewer
+image pairs than two independent evaluations would need.
+
+Usage:
+    python adaptive_evaluation.py --model_folder trained_models/caterpillar_3
+    python adaptive_evaluation.py --model_folder trained_models/caterpillar_3 --model_folder_b trained_models/caterpillar_4
+"""
+
+
+def median_of_field(field):
+    def metric(df):
+        data = df[field].dropna()
+        return np.median(data) if len(data) > 0 else np.nan
+    return metric
+
+
+def mean_of_field(field):
+    def metric(df):
+        data = df[field].dropna()
+        return np.mean(data) if len(data) > 0 else np.nan
+    return metric
+
+
+def area_above_curve_of_field(field):
+    def metric(df):
+        if df[field].count() == 0:
+            return np.nan
+        return DenseCorrespondenceEvaluationPlotter.compute_area_above_curve(df, field)
+    return metric
+
+
+# metric name --> function of the evaluate_network() DataFrame
+METRICS = {'median_pixel_match_error_l2_masked': median_of_field('pixel_match_error_l2_masked'),
+           'aoc_pixel_match_error_l2_masked': area_above_curve_of_field('pixel_match_error_l2_masked'),
+           'mean_fraction_pixels_closer_than_ground_truth': mean_of_field('fraction_pixels_closer_than_ground_truth')}
+
+# metric name --> width of the confidence interval at which sampling can stop
+TARGET_CI_WIDTH = {'median_pixel_match_error_l2_masked': 1.0,
+                   'aoc_pixel_match_error_l2_masked': 2.0,
+                   'mean_fraction_pixels_closer_than_ground_truth': 0.005}
+
+
+class ImagePairPrefetcher(object):
+    """
+    Samples image pairs and their matches on a background thread, see
+    DenseCorrespondenceEvaluation.sample_same_scene_image_pair_matches()
+    """
+
+    def __init__(self, dataset, num_matches_per_image_pair=100, seed=0, max_image_pairs=1000, queue_size=10):
+        self._dataset = dataset
+        self._num_matches_per_image_pair = num_matches_per_image_pair
+        self._seed = seed
+        self._max_image_pairs = max_image_pairs
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._errors = []
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _sample(self):
+        DCE = DenseCorrespondenceEvaluation
+        try:
+            for i in xrange(self._max_image_pairs):
+                # own generators, the main thread keeps drawing from the global ones
+                rng = utils.RandomStreams(pair_seed(self._seed, i))
+                scene_name = self._dataset.get_random_scene_name(rng=rng)
+                idx_pair = DCE.get_image_pair_with_poses_diff_above_threshold(self._dataset, scene_name, rng=rng)
+
+                pair_data = None
+                if idx_pair is not None:
+                    img_idx_a, img_idx_b = idx_pair
+                    pair_data = DCE.sample_same_scene_image_pair_matches(self._dataset, scene_name, img_idx_a,
+                        img_idx_b, num_matches=self._num_matches_per_image_pair, rng=rng)
+
+                if not self._put((i, pair_data)):
+                    return
+        except Exception:
+            self._errors.append(sys.exc_info())
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        """
+        Yields the pair data in order, None for image pairs without matches
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            yield item[1]
+
+        if len(self._errors) > 0:
+            exc_type, exc_value, exc_traceback = self._errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+def bootstrap_rows(pair_num_rows, rng):
+    """
+    Resamples image pairs with replacement
+    :param pair_num_rows: number of rows of each image pair, the rows of pair i come
+    right after those of pair i - 1
+    :type pair_num_rows: numpy.ndarray
+    :return: row indices of the resampled image pairs
+    :rtype: numpy.ndarray
+    """
+    pair_start = np.cumsum(pair_num_rows) - pair_num_rows
+    pairs = rng.randint(len(pair_num_rows), size=len(pair_num_rows))
+    lengths = pair_num_rows[pairs]
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(pair_start[pairs] - offsets, lengths) + np.arange(np.sum(lengths))
+
+
+def compute_confidence_intervals(dfs, pair_num_rows, metrics, confidence=0.95, num_bootstrap_samples=200, seed=0):
+    """
+    Bootstrap confidence intervals of the metrics, over image pairs
+    :param dfs: one evaluate_network() DataFrame, or two with the same rows for the
+    paired mode, in which case the intervals are of the difference b - a
+    :type dfs: list of pandas.DataFrame
+    :param pair_num_rows: see bootstrap_rows()
+    :type pair_num_rows: numpy.ndarray
+    :param metrics: metric name --> function of a DataFrame
+    :type metrics: dict
+    :return: metric name --> dict with estimate, ci_low, ci_high, ci_width
+    :rtype: dict
+    """
+    def evaluate(metric, rows=None):
+        values = [metric(df if rows is None else df.iloc[rows]) for df in dfs]
+        return values[0] if len(values) == 1 else values[1] - values[0]
+
+    rng = np.random.RandomState(seed)
+    samples = {name: [] for name in metrics}
+    for i in xrange(num_bootstrap_samples):
+        rows = bootstrap_rows(pair_num_rows, rng)
+        for name, metric in metrics.iteritems():
+            samples[name].append(evaluate(metric, rows))
+
+    alpha = (1.0 - confidence) / 2.0
+    intervals = dict()
+    for name, metric in metrics.iteritems():
+        values = np.array(samples[name], dtype=np.float64)
+        values = values[np.isfinite(values)]
+        ci_low, ci_high = np.percentile(values, [100 * alpha, 100 * (1 - alpha)]) if len(values) > 0 \
+            else (np.nan, np.nan)
+
+        d = dict()
+        d['estimate'] = float(evaluate(metric))
+        d['ci_low'] = float(ci_low)
+        d['ci_high'] = float(ci_high)
+        d['ci_width'] = float(ci_high - ci_low)
+        intervals[name] = d
+
+    return intervals
+
+
+def evaluate_network_adaptive(dcn, dataset, dcn_b=None, metrics=None, target_ci_width=None, confidence=0.95,
+                              batch_size=10, min_image_pairs=20, max_image_pairs=1000,
+                              num_matches_per_image_pair=100, num_bootstrap_samples=200, seed=0):
+    """
+    Evaluates a network, or the difference between two networks, on image pairs of the
+    current mode of the dataset until the confidence intervals of the metrics are narrow enough
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param dcn_b: (optional) second network for the paired mode
+    :type dcn_b: DenseCorrespondenceNetwork
+    :param metrics: metric name --> function of the evaluate_network() DataFrame, defaults to METRICS
+    :type metrics: dict
+    :param target_ci_width: metric name --> target width, defaults to TARGET_CI_WIDTH. Needs
+    a target for every metric
+    :type target_ci_width: dict
+    :param confidence: confidence level of the intervals
+    :type confidence: float
+    :param batch_size: number of image pairs between checks of the intervals
+    :type batch_size: int
+    :return: dict with the intervals, the number of image pairs and matches used and the
+    wall clock time. The intervals are empty if none of the image pairs had matches
+    :rtype: dict
+    """
+    DCE = DenseCorrespondenceEvaluation
+
+    if metrics is None:
+        metrics = METRICS
+    if target_ci_width is None:
+        target_ci_width = TARGET_CI_WIDTH
+
+    missing_targets = [name for name in metrics if name not in target_ci_width]
+    if len(missing_targets) > 0:
+        raise ValueError("no target_ci_width for the metrics %s" %(sorted(missing_targets)))
+    target_ci_width = {name: target_ci_width[name] for name in metrics}
+
+    dcns = [dcn] if dcn_b is None else [dcn, dcn_b]
+    for network in dcns:
+        network.eval()
+
+    start_time = time.time()
+    prefetcher = ImagePairPrefetcher(dataset, num_matches_per_image_pair=num_matches_per_image_pair, seed=seed,
+                                     max_image_pairs=max_image_pairs, queue_size=2 * batch_size)
+    prefetcher.start()
+
+    df_lists = [[] for network in dcns]
+    pair_num_rows = []
+    intervals = dict()
+    converged = False
+    num_image_pairs = 0
+
+    try:
+        for pair_data in prefetcher:
+            num_image_pairs += 1
+            if pair_data is not None:
+                for network, df_list in zip(dcns, df_lists):
+                    df_list.append(DCE.same_scene_image_pair_match_statistics(network, dataset, pair_data).to_dataframe())
+                pair_num_rows.append(len(df_lists[0][-1]))
+
+            if (num_image_pairs % batch_size != 0) or (num_image_pairs < min_image_pairs) or (len(pair_num_rows) == 0):
+                continue
+
+            dfs = [pd.concat(df_list, ignore_index=True) for df_list in df_lists]
+            intervals = compute_confidence_intervals(dfs, np.array(pair_num_rows), metrics, confidence=confidence,
+                                                     num_bootstrap_samples=num_bootstrap_samples, seed=seed)
+
+            logging.info("%d image pairs: %s" %(num_image_pairs, ", ".join(
+                "%s %.4f +- %.4f" %(name, d['estimate'], d['ci_width'] / 2.0) for name, d in intervals.iteritems())))
+
+            converged = all(intervals[name]['ci_width'] <= width for name, width in target_ci_width.iteritems())
+            if converged:
+                break
+    finally:
+        prefetcher.stop()
+
+    # ran out of image pairs in the middle of a batch
+    if not converged and len(pair_num_rows) > 0:
+        dfs = [pd.concat(df_list, ignore_index=True) for df_list in df_lists]
+        intervals = compute_confidence_intervals(dfs, np.array(pair_num_rows), metrics, confidence=confidence,
+                                                 num_bootstrap_samples=num_bootstrap_samples, seed=seed)
+
+    result = dict()
+    result['paired'] = dcn_b is not None
+    result['converged'] = converged
+    result['confidence'] = confidence
+    result['num_image_pairs'] = num_image_pairs
+    result['num_image_pairs_with_matches'] = len(pair_num_rows)
+    result['num_matches'] = int(np.sum(pair_num_rows))
+    result['wall_clock_time'] = time.time() - start_time
+    result['target_ci_width'] = target_ci_width
+    result['metrics'] = intervals
+    return result
+
+
+def print_result(result):
+    print "%d image pairs, %d matches, %.1f seconds, %s" %(result['num_image_pairs'], result['num_matches'],
+        result['wall_clock_time'], "converged" if result['converged'] else "did not converge")
+    if result['paired']:
+        print "differences are network b - network a"
+    if len(result['metrics']) == 0:
+        print "no image pair had matches, nothing to report"
+        return
+    print "%-48s%12s%12s%12s%12s" %("metric", "estimate", "ci low", "ci high", "target")
+    for name, d in sorted(result['metrics'].iteritems()):
+        print "%-48s%12.4f%12.4f%12.4f%12.4f" %(name, d['estimate'], d['ci_low'], d['ci_high'],
+                                                result['target_ci_width'][name])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--model_folder_b", type=str, default=None, help="(optional) network b of the paired mode")
+    parser.add_argument("--mode", type=str, default="test", choices=["train", "test"])
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--batch_size", type=int, default=10)
+    parser.add_argument("--min_image_pairs", type=int, default=20)
+    parser.add_argument("--max_image_pairs", type=int, default=1000)
+    parser.add_argument("--num_matches_per_image_pair", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn_b = None
+    if args.model_folder_b is not None:
+        dcn_b = DenseCorrespondenceNetwork.from_model_folder(args.model_folder_b)
+
+    dataset = dcn.load_training_dataset()
+    if args.mode == "train":
+        dataset.set_train_mode()
+    else:
+        dataset.set_test_mode()
+
+    result = evaluate_network_adaptive(dcn, dataset, dcn_b=dcn_b, confidence=args.confidence,
+                                       batch_size=args.batch_size, min_image_pairs=args.min_image_pairs,
+                                       max_image_pairs=args.max_image_pairs,
+                                       num_matches_per_image_pair=args.num_matches_per_image_pair, seed=args.seed)
+    print_result(result)
+
+    if args.output_file is not None:
+        utils.saveToYaml(result, args.output_file)
@@ -0,0 +1,175 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import time
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from dense_correspondence.correspondence_tools.correspondence_finder import random_sample_from_masked_image
+from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.network.coarse_to_fine_matcher import CoarseToFineMatcher, squared_distances
+
+"""
+Recall and speed of CoarseToFineMatcher against exhaustive search.
+
+Image pairs are drawn from the test scenes of the dataset the network was trained on,
+the same way as DenseCorrespondenceEvaluation.evaluate_network(). The queries are the
+descriptors of pixels sampled on the object in image a. Recall is the fraction of
+queries whose coarse-to-fine match is within pixel_threshold of the exhaustive match.
+
+Writes coarse_to_fine_matching.csv and a plot of recall against speedup, one curve per
+number of pyramid levels, to the output directory.
+
+Usage:
+    python benchmark_coarse_to_fine_matching.py --model_folder trained_models/caterpillar_3 --output_dir /tmp/c2f
+"""
+
+NUM_LEVELS = [2, 3, 4]
+NUM_CANDIDATES = [1, 2, 4, 8, 16]
+
+
+def exhaustive_search(descriptors, res_b):
+    """
+    Batched version of DenseCorrespondenceNetwork.find_best_match_for_descriptor()
+    :return: best_match_uv [Q, 2]
+    :rtype: numpy.ndarray
+    """
+    height, width, descriptor_dimension = res_b.shape
+    best_idx = np.argmin(squared_distances(descriptors, res_b.reshape(-1, descriptor_dimension)), axis=1)
+    rows, cols = np.unravel_index(best_idx, (height, width))
+    return np.stack([cols, rows], axis=1)
+
+
+def sample_image_pairs(dcn, dataset, num_image_pairs, num_queries_per_image_pair):
+    """
+    :return: list of (descriptors [Q, D], res_b)
+    :rtype: list
+    """
+    utils.reset_random_seed()
+    DCE = DenseCorrespondenceEvaluation
+
+    image_pairs = []
+    while len(image_pairs) < num_image_pairs:
+        scene_name = dataset.get_random_scene_name()
+        idx_pair = DCE.get_image_pair_with_poses_diff_above_threshold(dataset, scene_name)
+        if idx_pair is None:
+            continue
+
+        img_idx_a, img_idx_b = idx_pair
+        rgb_a, _, mask_a, _ = dataset.get_rgbd_mask_pose(scene_name, img_idx_a)
+        rgb_b = dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_idx_b)
+
+        res_a = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb_a)).data.cpu().numpy()
+        res_b = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb_b)).data.cpu().numpy()
+
+        mask_a = np.asarray(mask_a)
+        num_queries = min(num_queries_per_image_pair, np.count_nonzero(mask_a))
+        if num_queries == 0:
+            continue
+
+        rows, cols = random_sample_from_masked_image(mask_a, num_queries)
+        image_pairs.append((res_a[rows, cols], res_b))
+
+    return image_pairs
+
+
+def run_benchmark(dcn, dataset, num_image_pairs=10, num_queries_per_image_pair=500, pixel_threshold=1,
+                  num_levels_list=NUM_LEVELS, num_candidates_list=NUM_CANDIDATES):
+    """
+    :return: one row per (num_levels, num_candidates)
+    :rtype: pandas.DataFrame
+    """
+    image_pairs = sample_image_pairs(dcn, dataset, num_image_pairs, num_queries_per_image_pair)
+    normalize = dcn._normalize
+
+    exhaustive_uv = []
+    exhaustive_time = 0.0
+    for descriptors, res_b in image_pairs:
+        start = time.time()
+        exhaustive_uv.append(exhaustive_search(descriptors, res_b))
+        exhaustive_time += time.time() - start
+
+    num_queries = sum(len(descriptors) for descriptors, _ in image_pairs)
+
+    rows = []
+    for num_levels, num_candidates in itertools.product(num_levels_list, num_candidates_list):
+        num_correct = 0
+        build_time = 0.0
+        match_time = 0.0
+        for (descriptors, res_b), uv in zip(image_pairs, exhaustive_uv):
+            start = time.time()
+            matcher = CoarseToFineMatcher(res_b, num_levels=num_levels, num_candidates=num_candidates,
+                                          normalize=normalize)
+            build_time += time.time() - start
+
+            start = time.time()
+            best_match_uv, _ = matcher.find_best_match_for_descriptors(descriptors)
+            match_time += time.time() - start
+
+            num_correct += np.sum(np.max(np.abs(best_match_uv - uv), axis=1) <= pixel_threshold)
+
+        d = dict()
+        d['num_levels'] = num_levels
+        d['num_candidates'] = num_candidates
+        d['recall'] = num_correct / float(num_queries)
+        d['query_time'] = match_time / num_queries
+        d['build_time'] = build_time / len(image_pairs)
+        d['speedup'] = exhaustive_time / match_time
+        d['speedup_including_build'] = exhaustive_time / (match_time + build_time)
+        rows.append(d)
+
+        print "levels %d, candidates %2d: recall %.3f, speedup %.1fx" %(num_levels, num_candidates,
+                                                                         d['recall'], d['speedup'])
+
+    return pd.DataFrame(rows)
+
+
+def plot_results(df, filename):
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for num_levels, group in df.groupby('num_levels'):
+        group = group.sort_values('num_candidates')
+        axes[0].plot(group['num_candidates'], group['recall'], marker='o', label="%d levels" %(num_levels))
+        axes[1].plot(group['speedup_including_build'], group['recall'], marker='o', label="%d levels" %(num_levels))
+
+    axes[0].set_xlabel("num candidates")
+    axes[0].set_xscale('log', basex=2)
+    axes[0].set_ylabel("recall")
+    axes[1].set_xlabel("speedup over exhaustive search")
+    axes[1].set_ylabel("recall")
+    for ax in axes:
+        ax.grid(True)
+        ax.legend()
+
+    fig.savefig(filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_image_pairs", type=int, default=10)
+    parser.add_argument("--num_queries_per_image_pair", type=int, default=500)
+    parser.add_argument("--pixel_threshold", type=int, default=1)
+    args = parser.parse_args()
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+    dataset.set_test_mode()
+
+    df = run_benchmark(dcn, dataset, num_image_pairs=args.num_image_pairs,
+                       num_queries_per_image_pair=args.num_queries_per_image_pair,
+                       pixel_threshold=args.pixel_threshold)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    df.to_csv(os.path.join(args.output_dir, "coarse_to_fine_matching.csv"))
+    plot_results(df, os.path.join(args.output_dir, "coarse_to_fine_matching.png"))
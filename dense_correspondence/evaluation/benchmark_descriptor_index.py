@@ -0,0 +1,182 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from dense_correspondence.evaluation.descriptor_index import DescriptorIndex
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
+
+"""
+Query latency and recall of DescriptorIndex at up to 10^8 indexed descriptors.
+
+No dataset holds 10^8 foreground descriptors, so they are synthetic: unit norm
+descriptors drawn around num_clusters random centers, which is roughly what the
+descriptors of a few objects look like. They are generated chunk by chunk from a
+seed, each chunk is added to the index as one scene, and the chunks are generated
+again for the exhaustive ground truth search, so neither step needs them all in memory.
+
+recall@k is the fraction of queries whose true nearest neighbor is in the top k
+results of the index.
+
+Usage:
+    python benchmark_descriptor_index.py --num_descriptors 100000000 --descriptor_dimension 16
+"""
+
+NPROBE = [1, 4, 16, 64]
+RECALL_AT = [1, 10, 100]
+
+# postings of the synthetic descriptors encode their position as img_idx * U_RANGE + u
+U_RANGE = 65536
+
+
+class SyntheticDescriptors(object):
+
+    def __init__(self, descriptor_dimension, num_clusters=1000, noise=0.05, seed=0):
+        self._descriptor_dimension = descriptor_dimension
+        self._noise = noise
+        self._seed = seed
+        self._centers = self._normalize(np.random.RandomState(seed).randn(num_clusters, descriptor_dimension))
+
+    @staticmethod
+    def _normalize(x):
+        return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+    def generate(self, num_descriptors, chunk_idx):
+        rng = np.random.RandomState(self._seed + 2 + chunk_idx)
+        labels = rng.randint(len(self._centers), size=num_descriptors)
+        x = self._centers[labels] + self._noise * rng.randn(num_descriptors, self._descriptor_dimension)
+        return self._normalize(x)
+
+
+def exhaustive_nearest_neighbors(queries, synthetic, num_chunks, chunk_size):
+    """
+    :return: chunk and position in the chunk of the nearest neighbor of each query
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    best_distance = np.full(len(queries), np.inf)
+    best_chunk = np.zeros(len(queries), dtype=np.int64)
+    best_position = np.zeros(len(queries), dtype=np.int64)
+
+    for chunk_idx in xrange(num_chunks):
+        squared_diffs = squared_distances(queries, synthetic.generate(chunk_size, chunk_idx))
+        position = np.argmin(squared_diffs, axis=1)
+        distance = squared_diffs[np.arange(len(queries)), position]
+        better = distance < best_distance
+        best_distance[better] = distance[better]
+        best_chunk[better] = chunk_idx
+        best_position[better] = position[better]
+
+    return best_chunk, best_position
+
+
+def get_directory_size_mb(path):
+    num_bytes = 0
+    for root, dirs, files in os.walk(path):
+        num_bytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return num_bytes / (1024.0 * 1024.0)
+
+
+def run_benchmark(index_dir, num_descriptors=10**8, chunk_size=10**6, descriptor_dimension=16, num_lists=4096,
+                  num_training_descriptors=200000, num_queries=100, nprobe_list=NPROBE, compact=True):
+    """
+    :return: dict of results
+    :rtype: dict
+    """
+    synthetic = SyntheticDescriptors(descriptor_dimension)
+    num_chunks = max(num_descriptors // chunk_size, 1)
+
+    start = time.time()
+    index = DescriptorIndex.train(index_dir, synthetic.generate(num_training_descriptors, -1),
+                                  num_lists=num_lists, overwrite=True)
+    train_time = time.time() - start
+
+    start = time.time()
+    position = np.arange(chunk_size)
+    img_idxs = position // U_RANGE
+    uv = np.stack([position % U_RANGE, np.zeros(chunk_size, dtype=np.int64)], axis=1)
+    for chunk_idx in xrange(num_chunks):
+        index.add("synthetic_%06d" %(chunk_idx), img_idxs, uv, synthetic.generate(chunk_size, chunk_idx))
+        if (chunk_idx % 10) == 0:
+            print "added chunk %d of %d" %(chunk_idx, num_chunks)
+    add_time = time.time() - start
+
+    compact_time = 0.0
+    if compact:
+        start = time.time()
+        index.compact()
+        compact_time = time.time() - start
+
+    # queries come from the same distribution as the indexed descriptors
+    queries = synthetic.generate(num_queries, num_chunks + 1)
+    print "computing exhaustive nearest neighbors"
+    true_chunk, true_position = exhaustive_nearest_neighbors(queries, synthetic, num_chunks, chunk_size)
+
+    d = dict()
+    d['num_descriptors'] = index.num_descriptors
+    d['descriptor_dimension'] = descriptor_dimension
+    d['num_lists'] = num_lists
+    d['train_time'] = train_time
+    d['add_descriptors_per_second'] = index.num_descriptors / add_time
+    d['compact_time'] = compact_time
+    d['index_size_mb'] = get_directory_size_mb(index_dir)
+    d['nprobe'] = dict()
+
+    max_k = max(RECALL_AT)
+    for nprobe in nprobe_list:
+        latencies = []
+        found = np.zeros([num_queries, max_k], dtype=bool)
+        for q in xrange(num_queries):
+            start = time.time()
+            result = index.search(queries[q:q + 1], k=max_k, nprobe=nprobe)
+            latencies.append(time.time() - start)
+
+            result_position = result['img_idx'][0] * U_RANGE + result['uv'][0, :, 0]
+            found[q] = (result['scene_id'][0] == true_chunk[q]) & (result_position == true_position[q])
+
+        stats = dict()
+        stats['latency_median'] = float(np.median(latencies))
+        stats['latency_95th_percentile'] = float(np.percentile(latencies, 95))
+        for k in RECALL_AT:
+            stats['recall_at_%d' %(k)] = float(np.mean(np.any(found[:, :k], axis=1)))
+        d['nprobe'][nprobe] = stats
+
+    return d
+
+
+def print_results(d):
+    print "%d descriptors, D = %d, %d lists, index %.0f MB, adding %.0f descriptors/s" \
+          %(d['num_descriptors'], d['descriptor_dimension'], d['num_lists'], d['index_size_mb'],
+            d['add_descriptors_per_second'])
+    print "%-8s%14s%14s" %("nprobe", "latency ms", "p95 ms") + "".join("%14s" %("recall@%d" %(k)) for k in RECALL_AT)
+    for nprobe, stats in sorted(d['nprobe'].iteritems()):
+        print "%-8d%14.2f%14.2f" %(nprobe, 1000 * stats['latency_median'], 1000 * stats['latency_95th_percentile']) \
+              + "".join("%14.3f" %(stats['recall_at_%d' %(k)]) for k in RECALL_AT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_descriptors", type=int, default=10**8)
+    parser.add_argument("--chunk_size", type=int, default=10**6, help="descriptors per synthetic scene")
+    parser.add_argument("--descriptor_dimension", type=int, default=16)
+    parser.add_argument("--num_lists", type=int, default=4096)
+    parser.add_argument("--num_queries", type=int, default=100)
+    parser.add_argument("--index_dir", type=str, default=None, help="defaults to a temporary directory")
+    parser.add_argument("--no_compact", action='store_true', help="query the index without merging its parts")
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    index_dir = args.index_dir
+    if index_dir is None:
+        index_dir = os.path.join(tempfile.mkdtemp(prefix="descriptor_index_benchmark_"), "index")
+
+    results = run_benchmark(index_dir, num_descriptors=args.num_descriptors, chunk_size=args.chunk_size,
+                            descriptor_dimension=args.descriptor_dimension, num_lists=args.num_lists,
+                            num_queries=args.num_queries, compact=not args.no_compact)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
@@ -0,0 +1,152 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import time
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation, DCNEvaluationPandaTemplate
+from dense_correspondence.evaluation.match_plan import MatchPlan, FLOAT_COLUMNS
+from dense_correspondence.evaluation.result_table import ResultTable
+
+"""
+Cross instance keypoint evaluation on a full label file, per image pair with
+compute_descriptor_match_statistics() one match at a time (how frames were loaded,
+run through the network and matched before MatchPlan) against a single MatchPlan
+for the whole file.
+
+Both give the same rows, the benchmark checks that the metrics of the plan agree
+with the per match reference.
+
+Usage:
+    python benchmark_keypoint_evaluation.py --model_folder <model_folder> \
+        --cross_instance_labels <path to cross instance labels .yaml>
+"""
+
+
+def evaluate_per_pair(dcn, dataset, keypoint_labels, schema):
+    """
+    Reference rows, computed with DenseCorrespondenceEvaluation.compute_descriptor_match_statistics()
+    in the same order as add_cross_scene_keypoint_matches() adds the matches
+
+    :return: rows, number of frames loaded, number of frames run through the network
+    :rtype: pandas.DataFrame, int, int
+    """
+    DCE = DenseCorrespondenceEvaluation
+    image_height, image_width = dcn.image_shape
+    results = ResultTable(schema)
+    num_frames_loaded = 0
+    num_frames_inferred = 0
+    for keypoint_data_a, keypoint_data_b in itertools.combinations(keypoint_labels, 2):
+        keypoint_data = [keypoint_data_a, keypoint_data_b]
+        frames = []
+        for data in keypoint_data:
+            rgb, depth, mask, pose = dataset.get_rgbd_mask_pose(data['scene_name'], data['image_idx'])
+            res = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb)).data.cpu().numpy()
+            frames.append((np.asarray(depth), np.asarray(mask), pose, res))
+        num_frames_loaded += 2
+        num_frames_inferred += 2
+
+        camera_matrix = dataset.get_camera_intrinsics(keypoint_data_a['scene_name']).K
+
+        for kp_name, data_a in keypoint_data_a['keypoints'].iteritems():
+            data = [data_a, keypoint_data_b['keypoints'][kp_name]]
+            for idx_1, idx_2 in [(0, 1), (1, 0)]:
+                uv_1 = DCE.clip_pixel_to_image_size_and_round((data[idx_1]['u'], data[idx_1]['v']), image_width,
+                                                              image_height)
+                uv_2 = DCE.clip_pixel_to_image_size_and_round((data[idx_2]['u'], data[idx_2]['v']), image_width,
+                                                              image_height)
+                depth_1, mask_1, pose_1, res_1 = frames[idx_1]
+                depth_2, mask_2, pose_2, res_2 = frames[idx_2]
+
+                pd_template = DCE.compute_descriptor_match_statistics(depth_1, depth_2, mask_1, mask_2, uv_1, uv_2,
+                                                                      pose_1, pose_2, res_1, res_2, camera_matrix)
+                pd_template.set_value('img_a_idx', keypoint_data[idx_1]['image_idx'])
+                pd_template.set_value('img_b_idx', keypoint_data[idx_2]['image_idx'])
+                pd_template.set_value('scene_name_a', keypoint_data[idx_1]['scene_name'])
+                pd_template.set_value('scene_name_b', keypoint_data[idx_2]['scene_name'])
+                pd_template.set_value('object_id_a', keypoint_data[idx_1]['object_id'])
+                pd_template.set_value('object_id_b', keypoint_data[idx_2]['object_id'])
+                pd_template.set_value('keypoint_name', kp_name)
+                results.append_row(pd_template.row)
+
+    return results.to_dataframe(), num_frames_loaded, num_frames_inferred
+
+
+def run_benchmark(dcn, dataset, keypoint_labels, batch_size=8):
+    """
+    :return: dict of results
+    :rtype: dict
+    """
+    schema = DCNEvaluationPandaTemplate.schema()
+
+    start = time.time()
+    df_per_pair, num_frames_loaded, num_frames_inferred = evaluate_per_pair(dcn, dataset, keypoint_labels, schema)
+    per_pair_time = time.time() - start
+
+    start = time.time()
+    plan = MatchPlan()
+    for keypoint_data_a, keypoint_data_b in itertools.combinations(keypoint_labels, 2):
+        DenseCorrespondenceEvaluation.add_cross_scene_keypoint_matches(plan, dcn, keypoint_data_a, keypoint_data_b)
+    df_plan = plan.evaluate(dcn, dataset, schema, batch_size=batch_size).to_dataframe()
+    plan_time = time.time() - start
+
+    # both have the matches in the same order
+    max_difference = 0.0
+    for column in FLOAT_COLUMNS:
+        a = df_per_pair[column].values
+        b = df_plan[column].values
+        both_valid = ~(np.isnan(a) | np.isnan(b))
+        if np.any(np.isnan(a) != np.isnan(b)):
+            max_difference = np.inf
+        elif np.any(both_valid):
+            max_difference = max(max_difference, float(np.max(np.abs(a[both_valid] - b[both_valid]))))
+
+    d = dict()
+    d['num_labels'] = len(keypoint_labels)
+    d['num_matches'] = len(df_plan)
+    d['per_pair'] = {'seconds': per_pair_time,
+                     'num_frames_loaded': num_frames_loaded,
+                     'num_frames_inferred': num_frames_inferred}
+    d['plan'] = {'seconds': plan_time,
+                 'num_frames_loaded': plan.summary()['num_frames_loaded'],
+                 'num_frames_inferred': plan.summary()['num_frames_inferred']}
+    d['max_metric_difference'] = max_difference
+    return d
+
+
+def print_results(d):
+    print "%d labeled images, %d matches" %(d['num_labels'], d['num_matches'])
+    print "%-10s%12s%16s%18s" %("", "seconds", "frames loaded", "frames inferred")
+    for name in ['per_pair', 'plan']:
+        print "%-10s%12.2f%16d%18d" %(name, d[name]['seconds'], d[name]['num_frames_loaded'],
+                                      d[name]['num_frames_inferred'])
+    print "speedup %.1fx, max metric difference %g" %(d['per_pair']['seconds'] / d['plan']['seconds'],
+                                                      d['max_metric_difference'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--cross_instance_labels", type=str, required=True,
+                        help="full path or path relative to the data directory")
+    parser.add_argument("--batch_size", type=int, default=8, help="frames per forward pass of the plan")
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    model_folder = utils.convert_data_relative_path_to_absolute_path(args.model_folder, assert_path_exists=True)
+    dcn = DenseCorrespondenceNetwork.from_model_folder(model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+
+    labels_file = utils.convert_data_relative_path_to_absolute_path(args.cross_instance_labels, assert_path_exists=True)
+    keypoint_labels = utils.getDictFromYamlFilename(labels_file)
+
+    results = run_benchmark(dcn, dataset, keypoint_labels, batch_size=args.batch_size)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
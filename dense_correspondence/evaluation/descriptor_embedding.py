@@ -0,0 +1,417 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import logging
+import argparse
+
+import numpy as np
+
+try:
+    from sklearn.manifold import TSNE
+except ImportError:
+    TSNE = None
+
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+from dense_correspondence.evaluation.descriptor_pipeline import DescriptorPipeline
+from dense_correspondence.evaluation.evaluation_store import pair_seed
+from dense_correspondence.evaluation.across_object_evaluation import sample_object_frames, nearest_neighbors_by_object
+
+"""
+Descriptor space cluster visualization for descriptors of any dimension.
+
+DenseCorrespondenceEvaluation.make_2d_cluster_plot() can only plot 2 and 3 dimensional
+descriptors. Here
+
+    1. frames of every object are run through the network with DescriptorPipeline,
+       and a fixed number of foreground and background descriptors is sampled from
+       each frame into preallocated arrays, see DescriptorSampler
+    2. the descriptors are projected to 2 or 3 dimensions with PCA, computed from
+       streaming covariance sums so it never needs all the descriptors at once, or
+       with a random projection. t-SNE (needs sklearn) is run on a subsample
+    3. the points go into a compact .npz point file for plotting, see plot_point_file(),
+       and the separability of each object from the other objects and the background
+       is measured in the full descriptor space, see compute_separability_metrics()
+
+Usage:
+    python descriptor_embedding.py --model_folder trained_models/shoes_16 --output_dir /tmp/shoes_16_embedding \
+        --method pca
+"""
+
+POINT_FILENAME = "points.npz"
+SEPARABILITY_FILENAME = "separability.yaml"
+BACKGROUND_LABEL_NAME = "background"
+PROJECTION_METHODS = ["pca", "random", "tsne"]
+
+
+class DescriptorSampler(object):
+    """
+    Store for DescriptorPipeline that samples foreground and background descriptors of
+    each descriptor image into arrays preallocated for all frames
+    """
+
+    def __init__(self, dataset, frames, num_foreground_samples_per_image=100, num_background_samples_per_image=20,
+                 seed=0):
+        """
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param frames: the frames that will be appended
+        :type frames: list of (scene_name, img_idx)
+        :param seed: the pixels of the i-th frame are sampled with pair_seed(seed, i)
+        :type seed: int
+        """
+        self._dataset = dataset
+        self._frame_position = {frame: i for i, frame in enumerate(frames)}
+        self._num_foreground = num_foreground_samples_per_image
+        self._num_background = num_background_samples_per_image
+        self._seed = seed
+
+        num_samples_per_image = num_foreground_samples_per_image + num_background_samples_per_image
+        self._descriptors = None
+        self._uv = np.zeros([len(frames), num_samples_per_image, 2], dtype=np.int32)
+        self._is_foreground = np.zeros([len(frames), num_samples_per_image], dtype=bool)
+        self._is_valid = np.zeros([len(frames), num_samples_per_image], dtype=bool)
+
+    def append(self, frame, res):
+        """
+        :param frame: (scene_name, img_idx)
+        :type frame: tuple
+        :param res: descriptor image [H, W, D]
+        :type res: numpy.ndarray
+        """
+        position = self._frame_position[frame]
+        if self._descriptors is None:
+            self._descriptors = np.zeros(self._is_valid.shape + (res.shape[2],), dtype=np.float32)
+
+        mask = np.asarray(self._dataset.get_mask_image_from_scene_name_and_idx(frame[0], frame[1])) > 0
+        rng = np.random.RandomState(pair_seed(self._seed, position))
+
+        start = 0
+        for is_foreground, num_samples in [(True, self._num_foreground), (False, self._num_background)]:
+            v, u = np.nonzero(mask == is_foreground)
+            n = min(num_samples, len(v))
+            idx = rng.choice(len(v), size=n, replace=False)
+            self._descriptors[position, start:start + n] = res[v[idx], u[idx]]
+            self._uv[position, start:start + n, 0] = u[idx]
+            self._uv[position, start:start + n, 1] = v[idx]
+            self._is_foreground[position, start:start + n] = is_foreground
+            self._is_valid[position, start:start + n] = True
+            start += num_samples
+
+    def close(self):
+        pass
+
+    def result(self):
+        """
+        :return: frame position, descriptor [D], pixel (u, v) and whether it is on the
+        object for each sample, in order of the frames
+        :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray
+        """
+        frame_positions = np.nonzero(self._is_valid)[0]
+        return (frame_positions, self._descriptors[self._is_valid], self._uv[self._is_valid],
+                self._is_foreground[self._is_valid])
+
+
+class StreamingPCA(object):
+    """
+    PCA from the count, sum and sum of outer products of the descriptors, which
+    can be accumulated chunk by chunk. D is small, so the D x D covariance is cheap
+    """
+
+    def __init__(self, descriptor_dimension):
+        self._count = 0
+        self._sum = np.zeros(descriptor_dimension)
+        self._outer_sum = np.zeros([descriptor_dimension, descriptor_dimension])
+        self._components = None
+
+    def partial_fit(self, x):
+        """
+        :param x: [N, D]
+        :type x: numpy.ndarray
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self._count += len(x)
+        self._sum += x.sum(axis=0)
+        self._outer_sum += x.T.dot(x)
+        self._components = None
+
+    @property
+    def mean(self):
+        return self._sum / max(self._count, 1)
+
+    def _eig(self):
+        covariance = self._outer_sum / max(self._count, 1) - np.outer(self.mean, self.mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1]
+        return np.maximum(eigenvalues[order], 0), eigenvectors[:, order]
+
+    def explained_variance_ratio(self):
+        eigenvalues, _ = self._eig()
+        return eigenvalues / max(eigenvalues.sum(), 1e-12)
+
+    def transform(self, x, num_components=2):
+        """
+        :return: [N, num_components]
+        :rtype: numpy.ndarray
+        """
+        if self._components is None:
+            self._components = self._eig()[1]
+        return (np.asarray(x, dtype=np.float64) - self.mean).dot(self._components[:, :num_components])
+
+
+def random_projection(x, num_components=2, seed=0):
+    """
+    Gaussian random projection, preserves distances in expectation
+    :rtype: numpy.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    projection = rng.randn(x.shape[1], num_components) / np.sqrt(num_components)
+    return x.dot(projection)
+
+
+def project_descriptors(descriptors, method="pca", num_components=2, max_tsne_samples=5000, seed=0,
+                        chunk_size=100000):
+    """
+    :param descriptors: [N, D]
+    :type descriptors: numpy.ndarray
+    :param method: one of PROJECTION_METHODS
+    :type method: str
+    :param max_tsne_samples: t-SNE is run on a random subsample of this many descriptors
+    :type max_tsne_samples: int
+    :return: indices of the projected descriptors, and their projections [M, num_components]
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    num_descriptors, descriptor_dimension = descriptors.shape
+    idx = np.arange(num_descriptors)
+
+    if descriptor_dimension <= num_components:
+        return idx, descriptors[:, :num_components].astype(np.float64)
+
+    if method == "pca":
+        pca = StreamingPCA(descriptor_dimension)
+        for start in xrange(0, num_descriptors, chunk_size):
+            pca.partial_fit(descriptors[start:start + chunk_size])
+        logging.info("PCA explained variance ratio %s" %(pca.explained_variance_ratio()[:num_components]))
+        return idx, pca.transform(descriptors, num_components=num_components)
+    elif method == "random":
+        return idx, random_projection(descriptors, num_components=num_components, seed=seed)
+    elif method == "tsne":
+        if TSNE is None:
+            raise ValueError("tsne needs sklearn, use pca or random instead")
+        if num_descriptors > max_tsne_samples:
+            idx = np.sort(np.random.RandomState(seed).choice(num_descriptors, max_tsne_samples, replace=False))
+        return idx, TSNE(n_components=num_components, random_state=seed).fit_transform(descriptors[idx])
+    else:
+        raise ValueError("method must be one of %s, not %s" %(PROJECTION_METHODS, method))
+
+
+def compute_separability_metrics(descriptors, labels, frame_labels, label_names, block_size=1024):
+    """
+    How well the descriptors of each label are separated from the other labels, in the
+    full descriptor space
+    :param descriptors: [N, D]
+    :type descriptors: numpy.ndarray
+    :param labels: [N] index into label_names
+    :type labels: numpy.ndarray
+    :param frame_labels: [N] frame of each descriptor, nearest neighbors in the same frame are skipped
+    :type frame_labels: numpy.ndarray
+    :param label_names:
+    :type label_names: list of str
+    :return: label name --> dict of
+        nearest_neighbor_accuracy: fraction of descriptors whose nearest neighbor in the other
+            frames has the same label
+        confused_with: label that is most often the nearest neighbor instead
+        spread: root mean squared distance to the centroid of the label
+        nearest_centroid_distance: distance from the centroid to the closest other centroid
+        separation_ratio: nearest_centroid_distance / spread
+    :rtype: dict
+    """
+    num_labels = len(label_names)
+    order = np.argsort(labels, kind='mergesort')
+    descriptors = descriptors[order]
+    labels = labels[order]
+    frame_labels = frame_labels[order]
+
+    distances, _ = nearest_neighbors_by_object(descriptors, labels, frame_labels, num_labels, block_size=block_size)
+    predicted = np.argmin(distances, axis=1)
+
+    centroids = np.zeros([num_labels, descriptors.shape[1]])
+    spread = np.zeros(num_labels)
+    for label in xrange(num_labels):
+        x = descriptors[labels == label]
+        if len(x) > 0:
+            centroids[label] = x.mean(axis=0)
+            spread[label] = np.sqrt(np.mean(np.sum(np.square(x - centroids[label]), axis=1)))
+
+    metrics = dict()
+    for label, name in enumerate(label_names):
+        is_label = labels == label
+        if not np.any(is_label):
+            continue
+
+        other_predictions = predicted[is_label & (predicted != label)]
+        centroid_distances = np.linalg.norm(centroids - centroids[label], axis=1)
+        centroid_distances[label] = np.inf
+        nearest_centroid_distance = float(np.min(centroid_distances)) if num_labels > 1 else float('nan')
+
+        d = dict()
+        d['num_samples'] = int(np.sum(is_label))
+        d['nearest_neighbor_accuracy'] = float(np.mean(predicted[is_label] == label))
+        d['confused_with'] = label_names[np.bincount(other_predictions).argmax()] \
+            if len(other_predictions) > 0 else None
+        d['spread'] = float(spread[label])
+        d['nearest_centroid_distance'] = nearest_centroid_distance
+        d['separation_ratio'] = nearest_centroid_distance / max(spread[label], 1e-12)
+        metrics[name] = d
+
+    return metrics
+
+
+def write_point_file(filename, points, labels, label_names, **arrays):
+    """
+    :param points: [N, 2] or [N, 3]
+    :type points: numpy.ndarray
+    :param labels: [N] index into label_names
+    :type labels: numpy.ndarray
+    :param arrays: further per point arrays, e.g. uv
+    """
+    np.savez_compressed(filename, points=np.asarray(points, dtype=np.float32),
+                        labels=np.asarray(labels, dtype=np.int16), label_names=np.array(label_names), **arrays)
+
+
+def read_point_file(filename):
+    """
+    :return: points, labels, label names
+    :rtype: numpy.ndarray, numpy.ndarray, list of str
+    """
+    data = np.load(filename)
+    return data['points'], data['labels'], list(data['label_names'])
+
+
+def plot_point_file(filename, plot_background=False, ax=None):
+    """
+    Object labeled scatter plot of a point file, the first two dimensions of the points
+    """
+    import matplotlib.pyplot as plt
+
+    points, labels, label_names = read_point_file(filename)
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(10, 10))
+
+    for label, name in enumerate(label_names):
+        if name == BACKGROUND_LABEL_NAME and not plot_background:
+            continue
+        x = points[labels == label]
+        ax.scatter(x[:, 0], x[:, 1], s=2, alpha=0.5, label=name)
+    ax.legend(markerscale=5)
+    return ax
+
+
+def sample_descriptors(dcn, dataset, num_images_per_object=20, num_foreground_samples_per_image=100,
+                       num_background_samples_per_image=None, seed=0, **kwargs):
+    """
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_background_samples_per_image: defaults to num_foreground_samples_per_image / number of objects,
+    so that the background has about as many samples as each object
+    :type num_background_samples_per_image: int
+    :param kwargs: passed to DescriptorPipeline
+    :return: dict with label_names (the object ids and BACKGROUND_LABEL_NAME), frames, and
+    descriptors, labels, frame_labels, uv per sample
+    :rtype: dict
+    """
+    object_ids, object_frames = sample_object_frames(dataset, num_images_per_object=num_images_per_object, seed=seed)
+    if num_background_samples_per_image is None:
+        num_background_samples_per_image = max(num_foreground_samples_per_image // max(len(object_ids), 1), 1)
+
+    frames = []
+    frame_objects = []
+    for object_label, object_frame_list in enumerate(object_frames):
+        frames.extend(object_frame_list)
+        frame_objects.extend([object_label] * len(object_frame_list))
+
+    sampler = DescriptorSampler(dataset, frames, num_foreground_samples_per_image=num_foreground_samples_per_image,
+                                num_background_samples_per_image=num_background_samples_per_image, seed=seed)
+    pipeline = DescriptorPipeline(dcn, dataset.rgb_image_to_tensor, open_image=dataset.get_rgb_image, **kwargs)
+    sources = [(frame, dataset.get_image_filename(frame[0], frame[1], ImageType.RGB)) for frame in frames]
+    pipeline.run(sources, sampler)
+
+    frame_labels, descriptors, uv, is_foreground = sampler.result()
+    background_label = len(object_ids)
+    labels = np.where(is_foreground, np.asarray(frame_objects, dtype=np.int64)[frame_labels], background_label)
+
+    d = dict()
+    d['label_names'] = list(object_ids) + [BACKGROUND_LABEL_NAME]
+    d['frames'] = frames
+    d['descriptors'] = descriptors
+    d['labels'] = labels
+    d['frame_labels'] = frame_labels
+    d['uv'] = uv
+    return d
+
+
+def run_embedding_analysis(dcn, dataset, output_dir, method="pca", num_components=2, max_tsne_samples=5000,
+                           seed=0, **kwargs):
+    """
+    Samples descriptors, writes the projected points to output_dir/points.npz and the
+    separability metrics to output_dir/separability.yaml
+    :param kwargs: passed to sample_descriptors()
+    :return: the separability metrics, see compute_separability_metrics()
+    :rtype: dict
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    samples = sample_descriptors(dcn, dataset, seed=seed, **kwargs)
+    idx, points = project_descriptors(samples['descriptors'], method=method, num_components=num_components,
+                                      max_tsne_samples=max_tsne_samples, seed=seed)
+
+    scene_names = np.array([frame[0] for frame in samples['frames']])
+    img_idxs = np.array([frame[1] for frame in samples['frames']])
+    frame_labels = samples['frame_labels'][idx]
+    write_point_file(os.path.join(output_dir, POINT_FILENAME), points, samples['labels'][idx],
+                     samples['label_names'], uv=samples['uv'][idx], scene_name=scene_names[frame_labels],
+                     img_idx=img_idxs[frame_labels])
+
+    metrics = compute_separability_metrics(samples['descriptors'], samples['labels'], samples['frame_labels'],
+                                           samples['label_names'])
+    utils.saveToYaml(metrics, os.path.join(output_dir, SEPARABILITY_FILENAME))
+    return metrics
+
+
+def print_metrics(metrics):
+    print "%-30s%10s%12s%10s%12s   %s" %("", "samples", "nn accuracy", "spread", "separation", "confused with")
+    for name, d in sorted(metrics.iteritems()):
+        print "%-30s%10d%12.3f%10.3f%12.2f   %s" %(name, d['num_samples'], d['nearest_neighbor_accuracy'], d['spread'],
+                                                  d['separation_ratio'], d['confused_with'])
+
+
+if __name__ == "__main__":
+    from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--method", type=str, default="pca", choices=PROJECTION_METHODS)
+    parser.add_argument("--num_components", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--num_images_per_object", type=int, default=20)
+    parser.add_argument("--num_foreground_samples_per_image", type=int, default=100)
+    parser.add_argument("--max_tsne_samples", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=8)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    model_folder = utils.convert_data_relative_path_to_absolute_path(args.model_folder, assert_path_exists=True)
+    dcn = DenseCorrespondenceNetwork.from_model_folder(model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+
+    metrics = run_embedding_analysis(dcn, dataset, args.output_dir, method=args.method,
+                                     num_components=args.num_components, max_tsne_samples=args.max_tsne_samples,
+                                     seed=args.seed, num_images_per_object=args.num_images_per_object,
+                                     num_foreground_samples_per_image=args.num_foreground_samples_per_image,
+                                     batch_size=args.batch_size)
+    print_metrics(metrics)
@@ -0,0 +1,559 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import time
+import shutil
+import logging
+import argparse
+
+import numpy as np
+
+from dense_correspondence.correspondence_tools.correspondence_finder import random_sample_from_masked_image
+from dense_correspondence.dataset.scene_structure import SceneStructure
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
+
+"""
+A persistent index over the foreground pixel descriptors of every frame of a dataset,
+for finding a query descriptor across all logged frames without looping over them
+with find_best_match.
+
+The index is an inverted file with product quantization (IVF-PQ):
+    - a coarse k-means quantizer partitions descriptor space into num_lists cells
+    - the residual of each descriptor to its cell centroid is product quantized into
+      num_subquantizers uint8 codes
+    - each cell has a posting list of (code, scene, image index, u, v)
+
+A query only visits the nprobe cells closest to it, and approximates the distance to
+each posting from its code with a lookup table.
+
+The index is a directory. The quantizer is trained once, then each scene is added as
+a separate part, so new scenes can be added without touching the existing ones. The
+posting lists of each part are sorted by cell and memory mapped at query time.
+compact() merges all parts into one, which makes queries over many scenes faster.
+
+Usage:
+    python descriptor_index.py --model_folder trained_models/caterpillar_3 --index_dir /tmp/caterpillar_index
+"""
+
+INDEX_METADATA_FILENAME = "index.yaml"
+QUANTIZER_FILENAME = "quantizer.npz"
+PARTS_DIRNAME = "parts"
+PART_ARRAYS = ["list_offsets", "codes", "scene_ids", "img_idxs", "uv"]
+
+
+def assign_to_centroids(x, centroids, chunk_size=65536):
+    """
+    :return: index of the nearest centroid of each row of x
+    :rtype: numpy.ndarray of dtype int64
+    """
+    assignment = np.zeros(len(x), dtype=np.int64)
+    for start in xrange(0, len(x), chunk_size):
+        assignment[start:start + chunk_size] = np.argmin(squared_distances(x[start:start + chunk_size], centroids),
+                                                         axis=1)
+    return assignment
+
+
+def kmeans(x, num_clusters, num_iterations=20, seed=0):
+    """
+    Lloyd's algorithm, empty clusters are reseeded with random points
+    :param x: [N, D]
+    :type x: numpy.ndarray
+    :return: centroids [num_clusters, D]
+    :rtype: numpy.ndarray
+    """
+    if len(x) < num_clusters:
+        raise ValueError("need at least %d training points, got %d" %(num_clusters, len(x)))
+
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), num_clusters, replace=False)].astype(np.float32)
+
+    for i in xrange(num_iterations):
+        assignment = assign_to_centroids(x, centroids)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        for d in xrange(x.shape[1]):
+            sums = np.bincount(assignment, weights=x[:, d], minlength=num_clusters)
+            centroids[counts > 0, d] = sums[counts > 0] / counts[counts > 0]
+
+        empty = np.nonzero(counts == 0)[0]
+        if len(empty) > 0:
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+
+    return centroids
+
+
+def default_num_subquantizers(descriptor_dimension, max_num_subquantizers=8):
+    """
+    :return: the largest divisor of descriptor_dimension that is at most max_num_subquantizers
+    :rtype: int
+    """
+    for m in xrange(min(descriptor_dimension, max_num_subquantizers), 0, -1):
+        if descriptor_dimension % m == 0:
+            return m
+
+
+class DescriptorIndex(object):
+
+    def __init__(self, index_dir, metadata, centroids, codebooks):
+        """
+        Use DescriptorIndex.train() or DescriptorIndex.open()
+        :param index_dir:
+        :type index_dir: str
+        :param metadata: contents of index.yaml
+        :type metadata: dict
+        :param centroids: coarse quantizer, [num_lists, D]
+        :type centroids: numpy.ndarray
+        :param codebooks: product quantizer, [num_subquantizers, num_codes, D / num_subquantizers]
+        :type codebooks: numpy.ndarray
+        """
+        self._index_dir = index_dir
+        self._metadata = metadata
+        self._centroids = centroids
+        self._codebooks = codebooks
+        self._parts = dict() # part number --> dict of memory mapped arrays
+
+    @staticmethod
+    def train(index_dir, training_descriptors, num_lists=1024, num_subquantizers=None, num_codes=256,
+              num_iterations=20, overwrite=False):
+        """
+        Trains the quantizers and creates an empty index
+        :param index_dir:
+        :type index_dir: str
+        :param training_descriptors: a representative sample of descriptors, [N, D]
+        :type training_descriptors: numpy.ndarray
+        :param num_lists: number of cells of the coarse quantizer
+        :type num_lists: int
+        :param num_subquantizers: number of uint8 codes per descriptor, must divide D
+        :type num_subquantizers: int
+        :param num_codes: size of the codebook of each subquantizer, at most 256
+        :type num_codes: int
+        :return:
+        :rtype: DescriptorIndex
+        """
+        training_descriptors = np.asarray(training_descriptors, dtype=np.float32)
+        descriptor_dimension = training_descriptors.shape[1]
+
+        if num_subquantizers is None:
+            num_subquantizers = default_num_subquantizers(descriptor_dimension)
+
+        if descriptor_dimension % num_subquantizers != 0:
+            raise ValueError("num_subquantizers %d must divide the descriptor dimension %d"
+                             %(num_subquantizers, descriptor_dimension))
+
+        if num_codes > 256:
+            raise ValueError("num_codes must be at most 256 for uint8 codes, not %d" %(num_codes))
+
+        if os.path.exists(index_dir):
+            if not overwrite:
+                raise ValueError("index_dir %s already exists and overwrite is False" %(index_dir))
+            shutil.rmtree(index_dir)
+
+        os.makedirs(os.path.join(index_dir, PARTS_DIRNAME))
+
+        logging.info("training coarse quantizer with %d lists on %d descriptors" %(num_lists, len(training_descriptors)))
+        centroids = kmeans(training_descriptors, num_lists, num_iterations=num_iterations)
+        residuals = training_descriptors - centroids[assign_to_centroids(training_descriptors, centroids)]
+
+        logging.info("training product quantizer with %d subquantizers" %(num_subquantizers))
+        subvector_dimension = descriptor_dimension / num_subquantizers
+        codebooks = np.zeros([num_subquantizers, num_codes, subvector_dimension], dtype=np.float32)
+        for j in xrange(num_subquantizers):
+            subvectors = residuals[:, j * subvector_dimension:(j + 1) * subvector_dimension]
+            codebooks[j] = kmeans(subvectors, num_codes, num_iterations=num_iterations, seed=j + 1)
+
+        np.savez(os.path.join(index_dir, QUANTIZER_FILENAME), centroids=centroids, codebooks=codebooks)
+
+        metadata = dict()
+        metadata['descriptor_dimension'] = descriptor_dimension
+        metadata['num_lists'] = num_lists
+        metadata['num_subquantizers'] = num_subquantizers
+        metadata['num_codes'] = num_codes
+        metadata['scene_names'] = []
+        metadata['parts'] = [] # list of dicts with part number and num_descriptors
+        metadata['next_part'] = 0
+
+        index = DescriptorIndex(index_dir, metadata, centroids, codebooks)
+        index._save_metadata()
+        return index
+
+    @staticmethod
+    def open(index_dir):
+        """
+        :param index_dir: directory written by DescriptorIndex.train()
+        :type index_dir: str
+        :return:
+        :rtype: DescriptorIndex
+        """
+        metadata_file = os.path.join(index_dir, INDEX_METADATA_FILENAME)
+        if not os.path.exists(metadata_file):
+            raise ValueError("%s doesn't exist, is %s a descriptor index?" %(metadata_file, index_dir))
+
+        quantizer = np.load(os.path.join(index_dir, QUANTIZER_FILENAME))
+        return DescriptorIndex(index_dir, utils.getDictFromYamlFilename(metadata_file),
+                               quantizer['centroids'], quantizer['codebooks'])
+
+    def _save_metadata(self):
+        # written to a temporary file and renamed, so index.yaml is never half written
+        metadata_file = os.path.join(self._index_dir, INDEX_METADATA_FILENAME)
+        utils.saveToYaml(self._metadata, metadata_file + ".tmp")
+        os.rename(metadata_file + ".tmp", metadata_file)
+
+    @property
+    def descriptor_dimension(self):
+        return self._metadata['descriptor_dimension']
+
+    @property
+    def scene_names(self):
+        return self._metadata['scene_names']
+
+    @property
+    def num_descriptors(self):
+        return sum(part['num_descriptors'] for part in self._metadata['parts'])
+
+    def _part_dir(self, part_num):
+        return os.path.join(self._index_dir, PARTS_DIRNAME, "%06d" %(part_num))
+
+    def _make_part_dir(self, part_num):
+        """
+        Creates the temporary directory a new part is written to, see _commit_part_dir().
+        A process that died while adding a part can have left the temporary directory,
+        or the renamed one without the metadata that lists it, behind. Neither is in
+        the metadata, so they are removed
+        :return: the temporary directory
+        :rtype: str
+        """
+        part_dir = self._part_dir(part_num)
+        for d in [part_dir + ".tmp", part_dir]:
+            if os.path.exists(d):
+                logging.warning("removing %s, left behind by an interrupted add" %(d))
+                shutil.rmtree(d)
+
+        os.makedirs(part_dir + ".tmp")
+        return part_dir + ".tmp"
+
+    def _commit_part_dir(self, part_num):
+        """
+        Moves a completely written part into place, the metadata is saved after this
+        """
+        part_dir = self._part_dir(part_num)
+        os.rename(part_dir + ".tmp", part_dir)
+
+    def _load_part(self, part_num):
+        if part_num not in self._parts:
+            part_dir = self._part_dir(part_num)
+            self._parts[part_num] = {name: np.load(os.path.join(part_dir, name + ".npy"), mmap_mode='r')
+                                     for name in PART_ARRAYS}
+        return self._parts[part_num]
+
+    def encode(self, descriptors):
+        """
+        :param descriptors: [N, D]
+        :type descriptors: numpy.ndarray
+        :return: list_ids [N], codes [N, num_subquantizers] uint8
+        :rtype: tuple
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        list_ids = assign_to_centroids(descriptors, self._centroids)
+        residuals = descriptors - self._centroids[list_ids]
+
+        num_subquantizers, _, subvector_dimension = self._codebooks.shape
+        codes = np.zeros([len(descriptors), num_subquantizers], dtype=np.uint8)
+        for j in xrange(num_subquantizers):
+            subvectors = residuals[:, j * subvector_dimension:(j + 1) * subvector_dimension]
+            codes[:, j] = assign_to_centroids(subvectors, self._codebooks[j])
+
+        return list_ids, codes
+
+    def _write_part(self, arrays):
+        """
+        Writes a part and adds it to the metadata, arrays must be sorted by list
+        """
+        part_num = self._metadata['next_part']
+        part_dir = self._make_part_dir(part_num)
+        for name in PART_ARRAYS:
+            np.save(os.path.join(part_dir, name + ".npy"), arrays[name])
+        self._commit_part_dir(part_num)
+
+        self._metadata['parts'].append({'part': part_num, 'num_descriptors': int(len(arrays['codes']))})
+        self._metadata['next_part'] += 1
+        return part_num
+
+    def add(self, scene_name, img_idxs, uv, descriptors):
+        """
+        Adds the descriptors of a scene as a new part
+        :param scene_name:
+        :type scene_name: str
+        :param img_idxs: image index of each descriptor, [N]
+        :type img_idxs: numpy.ndarray
+        :param uv: pixel of each descriptor, (u,v) = (right, down), [N, 2]
+        :type uv: numpy.ndarray
+        :param descriptors: [N, D]
+        :type descriptors: numpy.ndarray
+        :return:
+        :rtype: None
+        """
+        if scene_name in self.scene_names:
+            raise ValueError("scene %s is already in the index" %(scene_name))
+
+        list_ids, codes = self.encode(descriptors)
+        order = np.argsort(list_ids, kind='mergesort')
+
+        arrays = dict()
+        arrays['list_offsets'] = np.searchsorted(list_ids[order], np.arange(self._metadata['num_lists'] + 1))
+        arrays['codes'] = codes[order]
+        arrays['scene_ids'] = np.full(len(order), len(self.scene_names), dtype=np.int32)
+        arrays['img_idxs'] = np.asarray(img_idxs, dtype=np.int32)[order]
+        arrays['uv'] = np.asarray(uv, dtype=np.uint16)[order]
+
+        self._write_part(arrays)
+        self._metadata['scene_names'].append(scene_name)
+        self._save_metadata()
+
+    def add_scene(self, dataset, scene_name, dcn=None, descriptor_store=None, num_samples_per_frame=100,
+                  frame_stride=1):
+        """
+        Samples foreground pixels of every frame_stride-th frame of a scene and adds
+        their descriptors. Descriptor images are read from descriptor_store if it has
+        them, otherwise they are computed with dcn
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param scene_name:
+        :type scene_name: str
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param descriptor_store: see descriptor_pipeline.py
+        :type descriptor_store: DescriptorStore
+        :return: number of descriptors added
+        :rtype: int
+        """
+        image_idxs = sorted(dataset.get_pose_data(scene_name).keys())[::frame_stride]
+
+        all_img_idxs, all_uv, all_descriptors = [], [], []
+        for img_idx in image_idxs:
+            if (descriptor_store is not None) and (img_idx in descriptor_store):
+                res = descriptor_store.get_descriptor_image(img_idx)
+            elif dcn is not None:
+                rgb = dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_idx)
+                res = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb)).data.cpu().numpy()
+            else:
+                raise ValueError("image %d of scene %s isn't in the descriptor store and dcn is None"
+                                 %(img_idx, scene_name))
+
+            mask = np.asarray(dataset.get_mask_image_from_scene_name_and_idx(scene_name, img_idx))
+            num_samples = min(num_samples_per_frame, np.count_nonzero(mask))
+            if num_samples == 0:
+                continue
+
+            rows, cols = random_sample_from_masked_image(mask, num_samples)
+            all_img_idxs.append(np.full(num_samples, img_idx))
+            all_uv.append(np.stack([cols, rows], axis=1))
+            all_descriptors.append(res[rows, cols])
+
+        if len(all_descriptors) == 0:
+            logging.info("scene %s has no foreground pixels, skipping" %(scene_name))
+            return 0
+
+        self.add(scene_name, np.concatenate(all_img_idxs), np.concatenate(all_uv), np.concatenate(all_descriptors))
+        return sum(len(x) for x in all_img_idxs)
+
+    def compact(self):
+        """
+        Merges all parts into a single one, list by list, without loading them into memory
+        """
+        if len(self._metadata['parts']) < 2:
+            return
+
+        part_nums = [part['part'] for part in self._metadata['parts']]
+        parts = [self._load_part(part_num) for part_num in part_nums]
+        num_descriptors = self.num_descriptors
+        num_lists = self._metadata['num_lists']
+
+        part_num = self._metadata['next_part']
+        part_dir = self._make_part_dir(part_num)
+
+        def open_output(name, dtype, shape):
+            return np.lib.format.open_memmap(os.path.join(part_dir, name + ".npy"), mode='w+', dtype=dtype, shape=shape)
+
+        outputs = {name: open_output(name, parts[0][name].dtype, (num_descriptors,) + parts[0][name].shape[1:])
+                   for name in PART_ARRAYS if name != "list_offsets"}
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+
+        offset = 0
+        for list_id in xrange(num_lists):
+            list_offsets[list_id] = offset
+            for part in parts:
+                start, end = part['list_offsets'][list_id], part['list_offsets'][list_id + 1]
+                for name, output in outputs.iteritems():
+                    output[offset:offset + end - start] = part[name][start:end]
+                offset += end - start
+        list_offsets[num_lists] = offset
+
+        np.save(os.path.join(part_dir, "list_offsets.npy"), list_offsets)
+        for output in outputs.values():
+            output.flush()
+        del outputs
+        self._commit_part_dir(part_num)
+
+        self._parts = dict()
+        self._metadata['parts'] = [{'part': part_num, 'num_descriptors': int(num_descriptors)}]
+        self._metadata['next_part'] += 1
+        self._save_metadata()
+
+        for old_part_num in part_nums:
+            shutil.rmtree(self._part_dir(old_part_num))
+
+    def search(self, descriptors, k=10, nprobe=16):
+        """
+        Finds the approximate k nearest neighbors of each query
+        :param descriptors: queries, [Q, D]
+        :type descriptors: numpy.ndarray
+        :param k: number of neighbors
+        :type k: int
+        :param nprobe: number of cells searched per query, trades speed for recall
+        :type nprobe: int
+        :return: dict of arrays, for each query sorted by distance. Missing neighbors
+        have scene_id -1 and distance inf
+            scene_id: [Q, k], index into scene_names
+            img_idx: [Q, k]
+            uv: [Q, k, 2]
+            distance: [Q, k] approximate descriptor distance
+        :rtype: dict
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32).reshape(-1, self.descriptor_dimension)
+        num_queries = len(descriptors)
+        nprobe = min(nprobe, self._metadata['num_lists'])
+        parts = [self._load_part(part['part']) for part in self._metadata['parts']]
+
+        coarse = squared_distances(descriptors, self._centroids)
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        num_subquantizers, num_codes, subvector_dimension = self._codebooks.shape
+        subquantizer_idxs = np.arange(num_subquantizers)
+
+        d = dict()
+        d['scene_id'] = np.full([num_queries, k], -1, dtype=np.int32)
+        d['img_idx'] = np.full([num_queries, k], -1, dtype=np.int32)
+        d['uv'] = np.zeros([num_queries, k, 2], dtype=np.int32)
+        d['distance'] = np.full([num_queries, k], np.inf, dtype=np.float32)
+
+        for q in xrange(num_queries):
+            candidate_distances, candidate_parts, candidate_positions = [], [], []
+            for list_id in probes[q]:
+                residual = (descriptors[q] - self._centroids[list_id]).reshape(num_subquantizers, 1, subvector_dimension)
+                table = np.sum(np.square(self._codebooks - residual), axis=2) # [num_subquantizers, num_codes]
+
+                for part_idx, part in enumerate(parts):
+                    start, end = part['list_offsets'][list_id], part['list_offsets'][list_id + 1]
+                    if end == start:
+                        continue
+                    codes = part['codes'][start:end]
+                    candidate_distances.append(np.sum(table[subquantizer_idxs, codes], axis=1))
+                    candidate_parts.append(np.full(end - start, part_idx))
+                    candidate_positions.append(np.arange(start, end))
+
+            if len(candidate_distances) == 0:
+                continue
+
+            distances = np.concatenate(candidate_distances)
+            num_found = min(k, len(distances))
+            top = np.argpartition(distances, num_found - 1)[:num_found] if num_found < len(distances) \
+                else np.arange(len(distances))
+            top = top[np.argsort(distances[top])]
+
+            part_idxs = np.concatenate(candidate_parts)[top]
+            positions = np.concatenate(candidate_positions)[top]
+            for i, (part_idx, position) in enumerate(zip(part_idxs, positions)):
+                part = parts[part_idx]
+                d['scene_id'][q, i] = part['scene_ids'][position]
+                d['img_idx'][q, i] = part['img_idxs'][position]
+                d['uv'][q, i] = part['uv'][position]
+
+            d['distance'][q, :num_found] = np.sqrt(distances[top])
+
+        return d
+
+
+def sample_training_descriptors(dcn, dataset, num_frames=100, num_samples_per_frame=1000):
+    """
+    Samples foreground descriptors from random frames to train the quantizers on
+    :return: [N, D]
+    :rtype: numpy.ndarray
+    """
+    utils.reset_random_seed()
+    descriptors = []
+    for i in xrange(num_frames):
+        scene_name = dataset.get_random_scene_name()
+        img_idx = dataset.get_random_image_index(scene_name)
+        rgb, _, mask, _ = dataset.get_rgbd_mask_pose(scene_name, img_idx)
+        res = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb)).data.cpu().numpy()
+
+        mask = np.asarray(mask)
+        num_samples = min(num_samples_per_frame, np.count_nonzero(mask))
+        if num_samples == 0:
+            continue
+        rows, cols = random_sample_from_masked_image(mask, num_samples)
+        descriptors.append(res[rows, cols])
+
+    return np.concatenate(descriptors)
+
+
+def build_index_for_dataset(dcn, dataset, network_name, index_dir, num_lists=1024, num_samples_per_frame=100,
+                            frame_stride=1, num_training_frames=100):
+    """
+    Builds an index over all train and test scenes of the dataset, or adds the scenes that aren't in
+    it yet if index_dir already exists. Uses the descriptor store of a scene if there
+    is one, see SceneStructure.descriptor_store_dir()
+    :return:
+    :rtype: DescriptorIndex
+    """
+    from dense_correspondence.evaluation.descriptor_pipeline import DescriptorStore
+
+    if os.path.exists(os.path.join(index_dir, INDEX_METADATA_FILENAME)):
+        index = DescriptorIndex.open(index_dir)
+    else:
+        training_descriptors = sample_training_descriptors(dcn, dataset, num_frames=num_training_frames)
+        index = DescriptorIndex.train(index_dir, training_descriptors, num_lists=num_lists)
+
+    utils.reset_random_seed()
+    scene_names = list(dataset.scene_generator(mode="train")) + list(dataset.scene_generator(mode="test"))
+    for scene_name in scene_names:
+        if scene_name in index.scene_names:
+            continue
+
+        store_dir = SceneStructure(dataset.get_full_path_for_scene(scene_name)).descriptor_store_dir(network_name)
+        descriptor_store = DescriptorStore.open(store_dir) if os.path.isdir(store_dir) else None
+
+        start_time = time.time()
+        num_added = index.add_scene(dataset, scene_name, dcn=dcn, descriptor_store=descriptor_store,
+                                    num_samples_per_frame=num_samples_per_frame, frame_stride=frame_stride)
+        logging.info("added %d descriptors of scene %s in %.1f seconds" %(num_added, scene_name,
+                                                                         time.time() - start_time))
+
+    return index
+
+
+if __name__ == "__main__":
+    from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--index_dir", type=str, required=True, help="existing indices get the missing scenes added")
+    parser.add_argument("--num_lists", type=int, default=1024)
+    parser.add_argument("--num_samples_per_frame", type=int, default=100)
+    parser.add_argument("--frame_stride", type=int, default=1)
+    parser.add_argument("--compact", action='store_true', help="merge the parts of the index")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+    network_name = os.path.basename(os.path.normpath(args.model_folder))
+
+    index = build_index_for_dataset(dcn, dataset, network_name, args.index_dir, num_lists=args.num_lists,
+                                    num_samples_per_frame=args.num_samples_per_frame,
+                                    frame_stride=args.frame_stride)
+    if args.compact:
+        index.compact()
+
+    print "index has %d descriptors from %d scenes" %(index.num_descriptors, len(index.scene_names))
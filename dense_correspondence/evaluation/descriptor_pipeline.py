@@ -0,0 +1,563 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import sys
+import time
+import Queue
+import shutil
+import logging
+import argparse
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+
+"""
+Streaming descriptor pipeline for whole scenes or live frame streams.
+
+extract_descriptor_images_for_scene() decodes, runs the network and saves each frame
+one after another, so a scene takes the sum of the time of all of these. The pipeline
+runs them as separate stages connected by bounded queues:
+
+    frames --> decode (thread pool) --> batched inference --> writer --> DescriptorStore
+
+All stages run at the same time, so a scene is processed at the speed of the slowest
+stage. The bounded queues provide backpressure: a slow stage blocks the stages in
+front of it instead of letting decoded images pile up in memory. Each stage counts
+its frames and busy time, see DescriptorPipeline.summary().
+
+The descriptors are written to a single DescriptorStore: a directory of chunk files,
+each holding up to max_chunk_mb of descriptor images, and an index mapping image index
+to chunk. The index is rewritten after every chunk, so a crashed run leaves a readable
+store of the chunks written so far.
+
+Usage:
+    python descriptor_pipeline.py --model_folder trained_models/caterpillar_3 --scene_name 2018-04-16-14-25-19 \
+        --store_dir /tmp/caterpillar_descriptors
+"""
+
+STORE_INDEX_FILENAME = "index.yaml"
+DEFAULT_MAX_CHUNK_MB = 128
+CHUNK_FILENAME_FORMAT = "chunk_%06d.npy"
+
+
+class DescriptorStore(object):
+    """
+    Descriptor images of a scene, stored in chunks of chunk_size images
+    """
+
+    def __init__(self, store_dir, index):
+        """
+        Use DescriptorStore.create() or DescriptorStore.open()
+        :param store_dir:
+        :type store_dir: str
+        :param index: contents of index.yaml
+        :type index: dict
+        """
+        self._store_dir = store_dir
+        self._index = index
+        self._chunk_size = index['chunk_size']
+        self._dtype = np.dtype(index['dtype'])
+
+        # write side
+        self._chunk = None
+        self._chunk_image_idxs = []
+
+        # read side, chunk number --> memory mapped array
+        self._open_chunks = dict()
+
+    @staticmethod
+    def create(store_dir, descriptor_image_shape, chunk_size=None, dtype="float32", overwrite=False,
+               max_chunk_mb=DEFAULT_MAX_CHUNK_MB):
+        """
+        Creates an empty store
+        :param store_dir:
+        :type store_dir: str
+        :param descriptor_image_shape: [H, W, D]
+        :type descriptor_image_shape: list
+        :param chunk_size: number of descriptor images per chunk file, defaults to as
+        many as fit in max_chunk_mb. A chunk is held in memory until it is written
+        :type chunk_size: int
+        :param dtype: dtype the descriptors are stored as, float16 halves the size on disk
+        :type dtype: str
+        :param max_chunk_mb: size of a chunk if chunk_size isn't given
+        :type max_chunk_mb: float
+        :return:
+        :rtype: DescriptorStore
+        """
+        if chunk_size is None:
+            image_bytes = np.dtype(dtype).itemsize * int(np.prod(descriptor_image_shape))
+            chunk_size = max(int(max_chunk_mb * 1024 ** 2) // image_bytes, 1)
+
+        if os.path.exists(store_dir):
+            if not overwrite:
+                raise ValueError("store_dir %s already exists and overwrite is False" %(store_dir))
+            shutil.rmtree(store_dir)
+
+        os.makedirs(store_dir)
+
+        index = dict()
+        index['descriptor_image_shape'] = [int(x) for x in descriptor_image_shape]
+        index['chunk_size'] = int(chunk_size)
+        index['dtype'] = str(np.dtype(dtype))
+        index['num_chunks'] = 0
+        index['frames'] = dict() # img_idx --> [chunk, offset]
+        index['closed'] = False
+        store = DescriptorStore(store_dir, index)
+        store._save_index()
+        return store
+
+    @staticmethod
+    def open(store_dir):
+        """
+        Opens a store for reading
+        :param store_dir:
+        :type store_dir: str
+        :return:
+        :rtype: DescriptorStore
+        """
+        index_file = os.path.join(store_dir, STORE_INDEX_FILENAME)
+        if not os.path.exists(index_file):
+            raise ValueError("%s doesn't exist, is %s a descriptor store?" %(index_file, store_dir))
+
+        index = utils.getDictFromYamlFilename(index_file)
+        if not index.get('closed', True):
+            logging.warning("the descriptor store %s wasn't closed, it only has the %d images of its complete chunks"
+                            %(store_dir, len(index['frames'])))
+
+        return DescriptorStore(store_dir, index)
+
+    @property
+    def store_dir(self):
+        return self._store_dir
+
+    @property
+    def descriptor_image_shape(self):
+        return self._index['descriptor_image_shape']
+
+    @property
+    def image_idxs(self):
+        return sorted(self._index['frames'].keys())
+
+    def __len__(self):
+        return len(self._index['frames'])
+
+    def __contains__(self, img_idx):
+        return img_idx in self._index['frames']
+
+    def append(self, img_idx, res):
+        """
+        Adds a descriptor image, it is written once its chunk is full
+        :param img_idx:
+        :type img_idx: int
+        :param res: descriptor image, shape [H, W, D]
+        :type res: numpy.ndarray
+        :return:
+        :rtype: None
+        """
+        if list(res.shape) != self.descriptor_image_shape:
+            raise ValueError("descriptor image has shape %s, the store expects %s"
+                             %(list(res.shape), self.descriptor_image_shape))
+
+        if self._chunk is None:
+            self._chunk = np.empty([self._chunk_size] + self.descriptor_image_shape, dtype=self._dtype)
+
+        self._chunk[len(self._chunk_image_idxs)] = res
+        self._chunk_image_idxs.append(int(img_idx))
+
+        if len(self._chunk_image_idxs) == self._chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        num_images = len(self._chunk_image_idxs)
+        if num_images == 0:
+            return
+
+        chunk_num = self._index['num_chunks']
+        np.save(os.path.join(self._store_dir, CHUNK_FILENAME_FORMAT %(chunk_num)), self._chunk[:num_images])
+
+        for offset, img_idx in enumerate(self._chunk_image_idxs):
+            self._index['frames'][img_idx] = [chunk_num, offset]
+
+        self._index['num_chunks'] += 1
+        self._chunk_image_idxs = []
+        self._save_index()
+
+    def _save_index(self):
+        """
+        Writes the index to a temporary file and renames it, so that the index on disk
+        is always complete
+        """
+        index_file = os.path.join(self._store_dir, STORE_INDEX_FILENAME)
+        utils.saveToYaml(self._index, index_file + ".tmp")
+        os.rename(index_file + ".tmp", index_file)
+
+    def close(self):
+        """
+        Writes the last, possibly partial, chunk and the index
+        :return:
+        :rtype: None
+        """
+        self._flush_chunk()
+        self._chunk = None
+        self._index['closed'] = True
+        self._save_index()
+
+    def get_descriptor_image(self, img_idx):
+        """
+        :param img_idx:
+        :type img_idx: int
+        :return: descriptor image, shape [H, W, D]
+        :rtype: numpy.ndarray of dtype float32
+        """
+        if img_idx not in self._index['frames']:
+            raise ValueError("image %d is not in the store %s" %(img_idx, self._store_dir))
+
+        chunk_num, offset = self._index['frames'][img_idx]
+        if chunk_num not in self._open_chunks:
+            filename = os.path.join(self._store_dir, CHUNK_FILENAME_FORMAT %(chunk_num))
+            self._open_chunks[chunk_num] = np.load(filename, mmap_mode='r')
+
+        return np.asarray(self._open_chunks[chunk_num][offset], dtype=np.float32)
+
+
+class StageCounter(object):
+    """
+    Number of frames and busy time of a single pipeline stage
+    """
+
+    def __init__(self, num_workers=1):
+        self._lock = threading.Lock()
+        self._num_workers = num_workers
+        self._start_time = time.time()
+        self._num_frames = 0
+        self._busy_time = 0.0
+
+    def record(self, num_frames, busy_time):
+        with self._lock:
+            self._num_frames += num_frames
+            self._busy_time += busy_time
+
+    def summary(self):
+        """
+        frames_per_second is the actual throughput, capacity is the throughput the
+        stage would have if it never waited on the other stages. The stage with the
+        lowest capacity is the bottleneck.
+        :return: dict of metric name --> value
+        :rtype: dict
+        """
+        with self._lock:
+            d = dict()
+            elapsed = time.time() - self._start_time
+            d['num_frames'] = self._num_frames
+            d['num_workers'] = self._num_workers
+            d['busy_time'] = self._busy_time
+            d['frames_per_second'] = self._num_frames / max(elapsed, 1e-6)
+            d['capacity'] = self._num_workers * self._num_frames / max(self._busy_time, 1e-6)
+            d['utilization'] = self._busy_time / max(self._num_workers * elapsed, 1e-6)
+            return d
+
+
+class DescriptorPipeline(object):
+    """
+    Computes the descriptor images of a stream of frames and writes them to a DescriptorStore
+    """
+
+    def __init__(self, dcn, image_to_tensor, open_image=None, num_decode_threads=4, batch_size=8,
+                 queue_size=32, max_batch_wait_ms=5.0):
+        """
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param image_to_tensor: normalizes an RGB image, e.g. dataset.rgb_image_to_tensor
+        :type image_to_tensor: function
+        :param open_image: opens an RGB image from a filename, defaults to PIL,
+        pass dataset.get_rgb_image to go through the frame cache
+        :type open_image: function
+        :param num_decode_threads:
+        :type num_decode_threads: int
+        :param batch_size: max number of frames per forward pass
+        :type batch_size: int
+        :param queue_size: max number of frames waiting between two stages
+        :type queue_size: int
+        :param max_batch_wait_ms: how long inference waits for a batch to fill up
+        :type max_batch_wait_ms: float
+        """
+        self._dcn = dcn
+        self._image_to_tensor = image_to_tensor
+        self._open_image = open_image
+        self._num_decode_threads = num_decode_threads
+        self._batch_size = batch_size
+        self._queue_size = queue_size
+        self._max_batch_wait = max_batch_wait_ms / 1000.0
+
+        self._stop = threading.Event()
+        self._errors = []
+        self._counters = dict()
+
+    def summary(self):
+        """
+        :return: dict of stage name --> StageCounter.summary()
+        :rtype: dict
+        """
+        return {stage: counter.summary() for stage, counter in self._counters.iteritems()}
+
+    def _put(self, queue, item):
+        """
+        Blocks until there is room in the queue, returns False if the pipeline was stopped
+        """
+        while True:
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                if self._stop.is_set():
+                    return False
+
+    def _get(self, queue, timeout=None):
+        """
+        Blocks until there is an item in the queue, or the timeout expires.
+        Raises Queue.Empty on timeout or if the pipeline was stopped
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 0.1 if deadline is None else min(0.1, max(deadline - time.time(), 0))
+            try:
+                return queue.get(timeout=wait)
+            except Queue.Empty:
+                if self._stop.is_set() or ((deadline is not None) and time.time() >= deadline):
+                    raise
+
+    def _record_error(self):
+        self._errors.append(sys.exc_info())
+        self._stop.set()
+
+    def _feed(self, frames, decode_queue):
+        try:
+            for img_idx, source in frames:
+                if not self._put(decode_queue, (img_idx, source)):
+                    return
+        except Exception:
+            self._record_error()
+        finally:
+            for i in xrange(self._num_decode_threads):
+                self._put(decode_queue, None)
+
+    def _decode(self, decode_queue, inference_queue):
+        counter = self._counters['decode']
+        try:
+            while True:
+                item = self._get(decode_queue)
+                if item is None:
+                    break
+
+                start = time.time()
+                img_idx, source = item
+                if isinstance(source, basestring):
+                    rgb = self._open_image(source) if self._open_image is not None else Image.open(source).convert('RGB')
+                else:
+                    rgb = source
+
+                img_tensor = self._image_to_tensor(rgb)
+                counter.record(1, time.time() - start)
+
+                if not self._put(inference_queue, (img_idx, img_tensor)):
+                    return
+        except Queue.Empty:
+            pass # stopped
+        except Exception:
+            self._record_error()
+        finally:
+            self._put(inference_queue, None)
+
+    def _forward_batch(self, batch, write_queue):
+        counter = self._counters['inference']
+        start = time.time()
+        img_idxs = [img_idx for img_idx, _ in batch]
+        img_tensor = torch.stack([x for _, x in batch]).to(self._dcn.device)
+
+        with torch.no_grad():
+            res = self._dcn.forward(img_tensor)
+
+        # [N, D, H, W] --> [N, H, W, D]
+        res = res.permute(0, 2, 3, 1).cpu().numpy()
+        counter.record(len(batch), time.time() - start)
+        return self._put(write_queue, (img_idxs, res))
+
+    def _inference(self, inference_queue, write_queue):
+        num_finished_decoders = 0
+        try:
+            while num_finished_decoders < self._num_decode_threads:
+                batch = []
+                item = self._get(inference_queue)
+                deadline = time.time() + self._max_batch_wait
+
+                while True:
+                    if item is None:
+                        num_finished_decoders += 1
+                        if num_finished_decoders == self._num_decode_threads:
+                            break
+                    else:
+                        batch.append(item)
+
+                    if len(batch) == self._batch_size:
+                        break
+
+                    try:
+                        item = self._get(inference_queue, timeout=max(deadline - time.time(), 0))
+                    except Queue.Empty:
+                        break
+
+                if (len(batch) > 0) and not self._forward_batch(batch, write_queue):
+                    return
+        except Queue.Empty:
+            pass # stopped
+        except Exception:
+            self._record_error()
+        finally:
+            self._put(write_queue, None)
+
+    def _write(self, write_queue, store):
+        counter = self._counters['write']
+        try:
+            while True:
+                item = self._get(write_queue)
+                if item is None:
+                    break
+
+                start = time.time()
+                img_idxs, res = item
+                for i, img_idx in enumerate(img_idxs):
+                    store.append(img_idx, res[i])
+                counter.record(len(img_idxs), time.time() - start)
+        except Queue.Empty:
+            pass # stopped
+        except Exception:
+            self._record_error()
+
+    def run(self, frames, store):
+        """
+        Runs the pipeline until frames is exhausted, then closes the store, also if the
+        pipeline raises. Frames are
+        written in the order they finish decoding, the store index keeps track of them.
+        :param frames: iterable of (img_idx, source). source is either the filename
+        of an RGB image or a decoded PIL.Image. Can be a generator over a live stream
+        :type frames: iterable
+        :param store: an empty store, see DescriptorStore.create()
+        :type store: DescriptorStore
+        :return: the summary, see summary()
+        :rtype: dict
+        """
+        self._stop.clear()
+        self._errors = []
+        self._counters = {'decode': StageCounter(num_workers=self._num_decode_threads),
+                          'inference': StageCounter(),
+                          'write': StageCounter()}
+
+        decode_queue = Queue.Queue(maxsize=self._queue_size)
+        inference_queue = Queue.Queue(maxsize=self._queue_size)
+        write_queue = Queue.Queue(maxsize=self._queue_size)
+
+        threads = [threading.Thread(target=self._feed, args=(frames, decode_queue))]
+        for i in xrange(self._num_decode_threads):
+            threads.append(threading.Thread(target=self._decode, args=(decode_queue, inference_queue)))
+        threads.append(threading.Thread(target=self._write, args=(write_queue, store)))
+
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            # the forward passes run on the calling thread
+            self._inference(inference_queue, write_queue)
+
+            for thread in threads:
+                thread.join()
+
+            if len(self._errors) > 0:
+                exc_type, exc_value, exc_traceback = self._errors[0]
+                raise exc_type, exc_value, exc_traceback
+        finally:
+            # stops the stages if the calling thread was interrupted, and closes the
+            # store even if the pipeline failed, e.g. to join the threads of a
+            # StatisticsAccumulator
+            self._stop.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            store.close()
+
+        return self.summary()
+
+
+def compute_descriptor_store_for_scene(dcn, dataset, scene_name, store_dir, overwrite=False, chunk_size=None,
+                                       dtype="float32", max_chunk_mb=DEFAULT_MAX_CHUNK_MB, **kwargs):
+    """
+    Computes the descriptor images of all frames of a scene with DescriptorPipeline
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param scene_name:
+    :type scene_name: str
+    :param store_dir:
+    :type store_dir: str
+    :param kwargs: passed to DescriptorPipeline
+    :return: the store, and the pipeline summary
+    :rtype: DescriptorStore, dict
+    """
+    image_idxs = sorted(dataset.get_pose_data(scene_name).keys())
+    frames = [(img_idx, dataset.get_image_filename(scene_name, img_idx, ImageType.RGB)) for img_idx in image_idxs]
+
+    image_height, image_width = dcn.image_shape
+    store = DescriptorStore.create(store_dir, [image_height, image_width, dcn.descriptor_dimension],
+                                   chunk_size=chunk_size, dtype=dtype, overwrite=overwrite,
+                                   max_chunk_mb=max_chunk_mb)
+
+    pipeline = DescriptorPipeline(dcn, dataset.rgb_image_to_tensor, open_image=dataset.get_rgb_image, **kwargs)
+
+    start_time = time.time()
+    summary = pipeline.run(frames, store)
+    summary['elapsed'] = time.time() - start_time
+    logging.info("computed %d descriptor images in %.1f seconds" %(len(frames), summary['elapsed']))
+    return store, summary
+
+
+def print_summary(summary):
+    print "%-12s%10s%16s%16s%14s" %("stage", "frames", "frames/s", "capacity/s", "utilization")
+    for stage in ['decode', 'inference', 'write']:
+        d = summary[stage]
+        print "%-12s%10d%16.2f%16.2f%14.2f" %(stage, d['num_frames'], d['frames_per_second'], d['capacity'],
+                                              d['utilization'])
+
+
+if __name__ == "__main__":
+    from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--scene_name", type=str, required=True)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--overwrite", action='store_true')
+    parser.add_argument("--num_decode_threads", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--queue_size", type=int, default=32)
+    parser.add_argument("--chunk_size", type=int, default=None, help="images per chunk, defaults to --max_chunk_mb")
+    parser.add_argument("--max_chunk_mb", type=float, default=DEFAULT_MAX_CHUNK_MB)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+
+    store, summary = compute_descriptor_store_for_scene(dcn, dataset, args.scene_name, args.store_dir,
+                                                        overwrite=args.overwrite, chunk_size=args.chunk_size,
+                                                        dtype=args.dtype, max_chunk_mb=args.max_chunk_mb,
+                                                        num_decode_threads=args.num_decode_threads,
+                                                        batch_size=args.batch_size, queue_size=args.queue_size)
+    print_summary(summary)
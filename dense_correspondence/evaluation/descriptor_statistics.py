@@ -0,0 +1,521 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import sys
+import time
+import Queue
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+from dense_correspondence.evaluation.descriptor_pipeline import DescriptorPipeline
+
+"""
+Streaming descriptor statistics over a whole dataset, or a stratified sample of it.
+
+DenseCorrespondenceEvaluation.compute_descriptor_statistics_on_dataset() used to run
+one forward pass per image and average the per-image means of 100 random images.
+Here the descriptor images come out of a DescriptorPipeline (decode threads, batched
+inference) and go to num_workers accumulator threads. Each worker has its own
+ImageDescriptorStatistics, which are merged when the frames run out:
+
+    - count, mean and variance per channel, with Welford/Chan updates that can be merged
+    - min and max per channel
+    - a histogram per channel, for quantiles
+
+each once over the entire image and once over the object mask.
+
+The frames are processed in shards of shard_size frames. After each shard the merged
+statistics are written to checkpoint_file, and a run with the same frames picks up
+after the last finished shard.
+
+The histograms have fixed bin edges so that they can be merged. Values outside of
+histogram_range are counted in the first or last bin, the quantiles are clamped to
+the exact min and max.
+
+Usage:
+    python descriptor_statistics.py --model_folder trained_models/caterpillar_3 \
+        --output_file /tmp/descriptor_statistics.yaml --checkpoint_file /tmp/descriptor_statistics.npz
+"""
+
+DEFAULT_NUM_BINS = 512
+DEFAULT_HISTOGRAM_RANGE = (-4.0, 4.0)
+QUANTILE_LEVELS = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+STATE_FIELDS = ['count', 'mean', 'm2', 'min', 'max', 'histogram']
+
+
+class DescriptorStatistics(object):
+    """
+    Mergeable per-channel statistics of a set of descriptors
+    """
+
+    def __init__(self, descriptor_dimension, num_bins=DEFAULT_NUM_BINS, histogram_range=DEFAULT_HISTOGRAM_RANGE):
+        """
+        :param descriptor_dimension:
+        :type descriptor_dimension: int
+        :param num_bins: number of histogram bins per channel
+        :type num_bins: int
+        :param histogram_range: (low, high) of the histogram bins
+        :type histogram_range: tuple
+        """
+        if histogram_range[1] <= histogram_range[0]:
+            raise ValueError("histogram_range must be (low, high), not %s" %(histogram_range,))
+
+        self._descriptor_dimension = descriptor_dimension
+        self._num_bins = num_bins
+        self._histogram_range = (float(histogram_range[0]), float(histogram_range[1]))
+
+        self.count = 0
+        self.mean = np.zeros(descriptor_dimension)
+        self.m2 = np.zeros(descriptor_dimension)
+        self.min = np.full(descriptor_dimension, np.inf)
+        self.max = np.full(descriptor_dimension, -np.inf)
+        self.histogram = np.zeros([descriptor_dimension, num_bins], dtype=np.int64)
+
+    @property
+    def descriptor_dimension(self):
+        return self._descriptor_dimension
+
+    @property
+    def num_bins(self):
+        return self._num_bins
+
+    @property
+    def histogram_range(self):
+        return self._histogram_range
+
+    def _combine(self, count, mean, m2):
+        """
+        Chan et al. update of the running mean and sum of squared deviations
+        """
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / float(total))
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / float(total))
+        self.count = total
+
+    def update(self, descriptors):
+        """
+        :param descriptors: [N, D]
+        :type descriptors: numpy.ndarray
+        :return:
+        :rtype: None
+        """
+        num_descriptors = len(descriptors)
+        if num_descriptors == 0:
+            return
+
+        x = np.asarray(descriptors, dtype=np.float64)
+        batch_mean = x.mean(axis=0)
+        self._combine(num_descriptors, batch_mean, ((x - batch_mean) ** 2).sum(axis=0))
+
+        self.min = np.minimum(self.min, x.min(axis=0))
+        self.max = np.maximum(self.max, x.max(axis=0))
+
+        # bin of each value, offset by its channel so that a single bincount does all channels
+        low, high = self._histogram_range
+        bins = ((x - low) * (self._num_bins / (high - low))).astype(np.int64)
+        np.clip(bins, 0, self._num_bins - 1, out=bins)
+        bins += np.arange(self._descriptor_dimension) * self._num_bins
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def merge(self, other):
+        """
+        Adds the statistics of other, which must have the same histogram bins
+        :type other: DescriptorStatistics
+        :return:
+        :rtype: None
+        """
+        if (other.descriptor_dimension != self._descriptor_dimension) or (other.num_bins != self._num_bins) \
+                or (other.histogram_range != self._histogram_range):
+            raise ValueError("can only merge statistics with the same descriptor dimension and histogram bins")
+
+        if other.count == 0:
+            return
+
+        self._combine(other.count, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.histogram += other.histogram
+
+    @property
+    def std(self):
+        """
+        :return: unbiased standard deviation per channel, like torch.std
+        :rtype: numpy.ndarray
+        """
+        if self.count < 2:
+            return np.full(self._descriptor_dimension, np.nan)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def quantiles(self, levels):
+        """
+        Quantiles per channel, interpolated linearly within the histogram bins
+        :param levels: in [0, 1]
+        :type levels: list of float
+        :return: [len(levels), D]
+        :rtype: numpy.ndarray
+        """
+        result = np.full([len(levels), self._descriptor_dimension], np.nan)
+        if self.count == 0:
+            return result
+
+        low, high = self._histogram_range
+        bin_width = (high - low) / self._num_bins
+        cdf = np.cumsum(self.histogram, axis=1)
+
+        for d in xrange(self._descriptor_dimension):
+            for i, level in enumerate(levels):
+                rank = level * self.count
+                b = min(np.searchsorted(cdf[d], rank), self._num_bins - 1)
+                below = cdf[d, b - 1] if b > 0 else 0
+                fraction = (rank - below) / float(max(self.histogram[d, b], 1))
+                result[i, d] = low + (b + fraction) * bin_width
+
+        return np.clip(result, self.min, self.max)
+
+    def to_dict(self, quantile_levels=QUANTILE_LEVELS):
+        """
+        :return: dict of lists, the 'min', 'max' and 'mean' fields are what
+        plotting.normalize_descriptor() uses
+        :rtype: dict
+        """
+        d = dict()
+        d['count'] = int(self.count)
+        d['mean'] = self.mean.tolist()
+        d['std'] = self.std.tolist()
+        d['min'] = self.min.tolist()
+        d['max'] = self.max.tolist()
+        d['quantile_levels'] = list(quantile_levels)
+        d['quantiles'] = self.quantiles(quantile_levels).tolist()
+        return d
+
+    def get_state(self, prefix=""):
+        """
+        :return: field name --> array, see from_state()
+        :rtype: dict
+        """
+        state = {prefix + field: np.asarray(getattr(self, field)) for field in STATE_FIELDS}
+        state[prefix + 'histogram_range'] = np.array(self._histogram_range)
+        return state
+
+    @staticmethod
+    def from_state(state, prefix=""):
+        """
+        :param state: see get_state(), can be a numpy.lib.npyio.NpzFile
+        :type state: dict
+        :rtype: DescriptorStatistics
+        """
+        histogram = state[prefix + 'histogram']
+        stats = DescriptorStatistics(histogram.shape[0], num_bins=histogram.shape[1],
+                                     histogram_range=tuple(state[prefix + 'histogram_range']))
+        for field in STATE_FIELDS:
+            setattr(stats, field, np.array(state[prefix + field]))
+        stats.count = int(stats.count)
+        return stats
+
+
+class ImageDescriptorStatistics(object):
+    """
+    DescriptorStatistics of the entire descriptor images and of the masked part of them
+    """
+
+    REGIONS = ['entire_image', 'mask_image']
+
+    def __init__(self, descriptor_dimension, num_bins=DEFAULT_NUM_BINS, histogram_range=DEFAULT_HISTOGRAM_RANGE):
+        self.num_images = 0
+        self.regions = {region: DescriptorStatistics(descriptor_dimension, num_bins=num_bins,
+                                                     histogram_range=histogram_range)
+                        for region in ImageDescriptorStatistics.REGIONS}
+
+    def update(self, res, mask):
+        """
+        :param res: descriptor image [H, W, D]
+        :type res: numpy.ndarray
+        :param mask: [H, W], nonzero on the object
+        :type mask: numpy.ndarray
+        :return:
+        :rtype: None
+        """
+        descriptor_dimension = res.shape[2]
+        self.regions['entire_image'].update(res.reshape(-1, descriptor_dimension))
+        self.regions['mask_image'].update(res[np.asarray(mask) > 0])
+        self.num_images += 1
+
+    def merge(self, other):
+        """
+        :type other: ImageDescriptorStatistics
+        """
+        for region in ImageDescriptorStatistics.REGIONS:
+            self.regions[region].merge(other.regions[region])
+        self.num_images += other.num_images
+
+    def to_dict(self, quantile_levels=QUANTILE_LEVELS):
+        """
+        :return: same layout as descriptor_statistics.yaml, with a dict per region
+        :rtype: dict
+        """
+        d = {region: stats.to_dict(quantile_levels) for region, stats in self.regions.iteritems()}
+        d['num_images'] = self.num_images
+        return d
+
+    def get_state(self):
+        state = dict()
+        for region, stats in self.regions.iteritems():
+            state.update(stats.get_state(prefix=region + "_"))
+        state['num_images'] = np.array(self.num_images)
+        return state
+
+    @staticmethod
+    def from_state(state):
+        entire_image = DescriptorStatistics.from_state(state, prefix="entire_image_")
+        stats = ImageDescriptorStatistics(entire_image.descriptor_dimension, num_bins=entire_image.num_bins,
+                                          histogram_range=entire_image.histogram_range)
+        for region in ImageDescriptorStatistics.REGIONS:
+            stats.regions[region] = DescriptorStatistics.from_state(state, prefix=region + "_")
+        stats.num_images = int(state['num_images'])
+        return stats
+
+
+def reduce_statistics(stats_list):
+    """
+    Merges a list of ImageDescriptorStatistics pairwise, as a tree. Merging
+    statistics of similar counts keeps the mean and variance updates accurate
+    :param stats_list:
+    :type stats_list: list of ImageDescriptorStatistics
+    :return:
+    :rtype: ImageDescriptorStatistics
+    """
+    if len(stats_list) == 0:
+        raise ValueError("nothing to reduce")
+
+    while len(stats_list) > 1:
+        merged = []
+        for i in xrange(0, len(stats_list) - 1, 2):
+            stats_list[i].merge(stats_list[i + 1])
+            merged.append(stats_list[i])
+        if len(stats_list) % 2 == 1:
+            merged.append(stats_list[-1])
+        stats_list = merged
+
+    return stats_list[0]
+
+
+class StatisticsAccumulator(object):
+    """
+    Store for DescriptorPipeline that accumulates the statistics of the descriptor
+    images in num_workers threads, each with its own ImageDescriptorStatistics.
+    The masks are loaded by the workers
+    """
+
+    def __init__(self, dataset, make_statistics, num_workers=4, queue_size=32):
+        """
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param make_statistics: returns an empty ImageDescriptorStatistics
+        :type make_statistics: function
+        :param num_workers:
+        :type num_workers: int
+        :param queue_size:
+        :type queue_size: int
+        """
+        self._dataset = dataset
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._errors = []
+        self._statistics = [make_statistics() for i in xrange(num_workers)]
+        self._threads = [threading.Thread(target=self._work, args=(stats,)) for stats in self._statistics]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, stats):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if len(self._errors) > 0:
+                continue # drain the queue
+
+            try:
+                (scene_name, img_idx), res = item
+                mask = self._dataset.get_mask_image_from_scene_name_and_idx(scene_name, img_idx)
+                stats.update(res, np.asarray(mask))
+            except Exception:
+                self._errors.append(sys.exc_info())
+
+    def append(self, frame, res):
+        """
+        :param frame: (scene_name, img_idx)
+        :type frame: tuple
+        :param res: descriptor image [H, W, D]
+        :type res: numpy.ndarray
+        """
+        self._queue.put((frame, res))
+
+    def close(self):
+        """
+        Waits for the workers, see result()
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def result(self):
+        """
+        :return: the merged statistics of all workers
+        :rtype: ImageDescriptorStatistics
+        """
+        if len(self._errors) > 0:
+            exc_type, exc_value, exc_traceback = self._errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return reduce_statistics(self._statistics)
+
+
+def sample_frames(dataset, num_images=None, seed=0):
+    """
+    Frames of the scenes of the current mode of the dataset, stratified by scene:
+    the scenes take turns, so every prefix of the list, and so every shard, has about
+    the same number of frames from each scene
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_images: number of frames, None for all of them
+    :type num_images: int
+    :param seed:
+    :type seed: int
+    :return: list of (scene_name, img_idx)
+    :rtype: list
+    """
+    rng = np.random.RandomState(seed)
+
+    scene_frames = []
+    for scene_name in sorted(dataset.get_scene_list()):
+        image_idxs = sorted(dataset.get_pose_data(scene_name).keys())
+        rng.shuffle(image_idxs)
+        scene_frames.append([(scene_name, img_idx) for img_idx in image_idxs])
+
+    frames = []
+    for i in xrange(max([len(x) for x in scene_frames] + [0])):
+        frames.extend(x[i] for x in scene_frames if i < len(x))
+
+    if num_images is not None:
+        frames = frames[:num_images]
+    return frames
+
+
+def save_checkpoint(filename, stats, num_frames, shard_size, num_shards_done):
+    state = stats.get_state()
+    state['num_frames'] = np.array(num_frames)
+    state['shard_size'] = np.array(shard_size)
+    state['num_shards_done'] = np.array(num_shards_done)
+
+    # written next to the checkpoint first, so that a crash doesn't leave a partial file
+    tmp_filename = filename + ".tmp.npz"
+    np.savez(tmp_filename, **state)
+    os.rename(tmp_filename, filename)
+
+
+def load_checkpoint(filename, num_frames, shard_size):
+    """
+    :return: the statistics and the number of finished shards
+    :rtype: ImageDescriptorStatistics, int
+    """
+    state = np.load(filename)
+    if (int(state['num_frames']) != num_frames) or (int(state['shard_size']) != shard_size):
+        raise ValueError("checkpoint %s is for %d frames in shards of %d, not %d frames in shards of %d"
+                         %(filename, int(state['num_frames']), int(state['shard_size']), num_frames, shard_size))
+    return ImageDescriptorStatistics.from_state(state), int(state['num_shards_done'])
+
+
+def compute_descriptor_statistics(dcn, dataset, num_images=None, seed=0, num_bins=DEFAULT_NUM_BINS,
+                                  histogram_range=None, num_workers=4, shard_size=1000, checkpoint_file=None,
+                                  **kwargs):
+    """
+    Computes the descriptor statistics of the frames given by sample_frames()
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_images: None for all frames of the current mode of the dataset
+    :type num_images: int
+    :param histogram_range: defaults to (-1, 1) for normalized descriptors,
+    DEFAULT_HISTOGRAM_RANGE otherwise
+    :type histogram_range: tuple
+    :param num_workers: number of accumulator threads
+    :type num_workers: int
+    :param shard_size: number of frames between checkpoints
+    :type shard_size: int
+    :param checkpoint_file: (optional) .npz file, resumed from if it exists
+    :type checkpoint_file: str
+    :param kwargs: passed to DescriptorPipeline
+    :return:
+    :rtype: ImageDescriptorStatistics
+    """
+    if histogram_range is None:
+        histogram_range = (-1.0, 1.0) if dcn._normalize else DEFAULT_HISTOGRAM_RANGE
+
+    def make_statistics():
+        return ImageDescriptorStatistics(dcn.descriptor_dimension, num_bins=num_bins,
+                                         histogram_range=histogram_range)
+
+    frames = sample_frames(dataset, num_images=num_images, seed=seed)
+    num_shards = (len(frames) + shard_size - 1) // shard_size
+
+    stats = make_statistics()
+    num_shards_done = 0
+    if (checkpoint_file is not None) and os.path.isfile(checkpoint_file):
+        stats, num_shards_done = load_checkpoint(checkpoint_file, len(frames), shard_size)
+        logging.info("resuming from %s after %d of %d shards" %(checkpoint_file, num_shards_done, num_shards))
+
+    pipeline = DescriptorPipeline(dcn, dataset.rgb_image_to_tensor, open_image=dataset.get_rgb_image, **kwargs)
+
+    for shard_idx in xrange(num_shards_done, num_shards):
+        start_time = time.time()
+        shard = frames[shard_idx * shard_size:(shard_idx + 1) * shard_size]
+        sources = [(frame, dataset.get_image_filename(frame[0], frame[1], ImageType.RGB)) for frame in shard]
+
+        accumulator = StatisticsAccumulator(dataset, make_statistics, num_workers=num_workers)
+        pipeline.run(sources, accumulator)
+        stats.merge(accumulator.result())
+
+        if checkpoint_file is not None:
+            save_checkpoint(checkpoint_file, stats, len(frames), shard_size, shard_idx + 1)
+
+        logging.info("shard %d of %d, %d frames in %.1f seconds" %(shard_idx + 1, num_shards, len(shard),
+                                                                   time.time() - start_time))
+
+    return stats
+
+
+if __name__ == "__main__":
+    from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--output_file", type=str, required=True, help="yaml file to save the statistics to")
+    parser.add_argument("--mode", type=str, default="train", choices=["train", "test"])
+    parser.add_argument("--num_images", type=int, default=None, help="defaults to all frames")
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--checkpoint_file", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+    if args.mode == "train":
+        dataset.set_train_mode()
+    else:
+        dataset.set_test_mode()
+
+    stats = compute_descriptor_statistics(dcn, dataset, num_images=args.num_images, num_workers=args.num_workers,
+                                          shard_size=args.shard_size, checkpoint_file=args.checkpoint_file,
+                                          batch_size=args.batch_size)
+    utils.saveToYaml(stats.to_dict(), args.output_file)
@@ -24,7 +24,10 @@ from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
 import dense_correspondence.correspondence_tools.correspondence_plotter as correspondence_plotter
 import dense_correspondence.correspondence_tools.correspondence_finder as correspondence_finder
 from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+import dense_correspondence.network.mixed_precision as mixed_precision_utils
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
 from dense_correspondence.loss_functions.pixelwise_contrastive_loss import PixelwiseContrastiveLoss
+import dense_correspondence.loss_functions.loss_composer as loss_composer
 import dense_correspondence_manipulation.utils.visualization as vis_utils
 
 import dense_correspondence.evaluation.plotting as dc_plotting
@@ -32,6 +35,14 @@ import dense_correspondence.evaluation.plotting as dc_plotting
 from dense_correspondence.correspondence_tools.correspondence_finder import random_sample_from_masked_image
 
 from dense_correspondence.evaluation.utils import PandaDataFrameWrapper
+from dense_correspondence.evaluation.result_table import ResultTable, open_result_writer, read_result_table
+from dense_correspondence.evaluation.descriptor_statistics import compute_descriptor_statistics
+from dense_correspondence.evaluation.evaluation_store import EvaluationStore, make_key, get_model_identifier, pair_seed
+from dense_correspondence.evaluation.match_plan import MatchPlan
+from dense_correspondence.evaluation.across_object_evaluation import compute_across_object_statistics, summarize_across_object_statistics
+from dense_correspondence.evaluation.descriptor_embedding import sample_descriptors, project_descriptors, BACKGROUND_LABEL_NAME
+from dense_correspondence.evaluation.metric_summary import write_result_summary, cdf, make_statistics_table
+from dense_correspondence.evaluation.sift_baseline import compute_sift_features, keypoints_to_cv2, match_features, sift_match_statistics, extract_scene_features
 
 # why don't we have scene_name
 class DCNEvaluationPandaTemplate(PandaDataFrameWrapper):
@@ -60,6 +71,17 @@ class DCNEvaluationPandaTemplate(PandaDataFrameWrapper):
                'keypoint_name' # (optional) name of the keypoint
                ]
 
+    dtypes = {'scene_name': 'str',
+              'scene_name_a': 'str',
+              'scene_name_b': 'str',
+              'object_id_a': 'str',
+              'object_id_b': 'str',
+              'img_a_idx': 'int64',
+              'img_b_idx': 'int64',
+              'is_valid': 'bool',
+              'is_valid_masked': 'bool',
+              'keypoint_name': 'str'}
+
     def __init__(self):
         PandaDataFrameWrapper.__init__(self, DCNEvaluationPandaTemplate.columns)
 
@@ -72,6 +94,13 @@ class DCNEvaluationPandaTemplateAcrossObject(PandaDataFrameWrapper):
             'object_id_b',
             'norm_diff_descriptor_best_match']
 
+    dtypes = {'scene_name_a': 'str',
+              'scene_name_b': 'str',
+              'img_a_idx': 'int64',
+              'img_b_idx': 'int64',
+              'object_id_a': 'str',
+              'object_id_b': 'str'}
+
     def __init__(self):
         PandaDataFrameWrapper.__init__(self, DCNEvaluationPandaTemplateAcrossObject.columns)
 
@@ -82,6 +111,9 @@ class SIFTKeypointMatchPandaTemplate(PandaDataFrameWrapper):
                'is_valid',
                'norm_diff_pred_3d']
 
+    dtypes = {'scene_name': 'str',
+              'is_valid': 'bool'}
+
     def __init__(self):
         PandaDataFrameWrapper.__init__(self, SIFTKeypointMatchPandaTemplate.columns)
 
@@ -120,6 +152,14 @@ class DenseCorrespondenceEvaluation(object):
 
         dcn = DenseCorrespondenceNetwork.from_model_folder(model_folder, model_param_file=path_to_network_params)
         dcn.eval()
+
+        params = dict()
+        if "params" in self._config:
+            params = self._config["params"]
+
+        use_mixed_precision = ('mixed_precision' in params) and params['mixed_precision']
+        channels_last = ('channels_last' in params) and params['channels_last']
+        dcn.set_precision(mixed_precision=use_mixed_precision, channels_last=channels_last)
         return dcn
 
     def load_dataset_for_network(self, network_name):
@@ -173,7 +213,7 @@ class DenseCorrespondenceEvaluation(object):
 
     @staticmethod
     def get_image_pair_with_poses_diff_above_threshold(dataset, scene_name, threshold=0.05,
-                                                       max_num_attempts=100):
+                                                       max_num_attempts=100, rng=None):
         """
         Given a dataset and scene name find a random pair of images with
         poses that are different above a threshold
@@ -185,15 +225,17 @@ class DenseCorrespondenceEvaluation(object):
         :type threshold:
         :param max_num_attempts:
         :type max_num_attempts:
+        :param rng: None for the global generators
+        :type rng: utils.RandomStreams
         :return:
         :rtype:
         """
-        img_a_idx = dataset.get_random_image_index(scene_name)
+        img_a_idx = dataset.get_random_image_index(scene_name, rng=rng)
         pose_a = dataset.get_pose_from_scene_name_and_idx(scene_name, img_a_idx)
         pos_a = pose_a[0:3, 3]
 
         for i in xrange(0, max_num_attempts):
-            img_b_idx = dataset.get_random_image_index(scene_name)
+            img_b_idx = dataset.get_random_image_index(scene_name, rng=rng)
             pose_b = dataset.get_pose_from_scene_name_and_idx(scene_name, img_b_idx)
             pos_b = pose_b[0:3, 3]
 
@@ -225,8 +267,8 @@ class DenseCorrespondenceEvaluation(object):
         num_image_pairs = self._config['params']['num_image_pairs']
         num_matches_per_image_pair = self._config['params']['num_matches_per_image_pair']
 
-        pd_dataframe_list, df = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
-                                                     num_matches_per_image_pair=num_matches_per_image_pair)
+        results, df = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
+                                           num_matches_per_image_pair=num_matches_per_image_pair)
 
 
         # save pandas.DataFrame to csv
@@ -237,6 +279,7 @@ class DenseCorrespondenceEvaluation(object):
                 os.makedirs(output_dir)
 
             df.to_csv(data_file)
+            write_result_summary(df, data_file)
 
 
 
@@ -250,17 +293,19 @@ class DenseCorrespondenceEvaluation(object):
         DenseCorrespondenceEvaluation.evaluate_network_cross_scene(dcn, dataset, save=save)
 
     @staticmethod
-    def evaluate_network_cross_scene(dcn=None, dataset=None, save=True):
+    def evaluate_network_cross_scene(dcn=None, dataset=None, save=True, seed=1):
         """
         This will search for the "evaluation_labeled_data_path" in the dataset.yaml,
         and use pairs of images that have been human-labeled across scenes.
         """
 
-        utils.reset_random_seed()
+        utils.reset_random_seed(seed)
 
         cross_scene_data = DenseCorrespondenceEvaluation.parse_cross_scene_data(dataset)
 
-        pd_dataframe_list = []
+        # all annotated pairs go into one plan, so that every frame is loaded
+        # and run through the network once
+        plan = MatchPlan()
         for annotated_pair in cross_scene_data:
 
             scene_name_a = annotated_pair["image_a"]["scene_name"]
@@ -271,25 +316,19 @@ class DenseCorrespondenceEvaluation(object):
                 print("at least one of these scene names does not exist:", scene_name_a, scene_name_b)
                 continue
 
-            
             image_a_idx = annotated_pair["image_a"]["image_idx"]
             image_b_idx = annotated_pair["image_b"]["image_idx"]
 
             img_a_pixels = annotated_pair["image_a"]["pixels"]
             img_b_pixels = annotated_pair["image_b"]["pixels"]
 
+            DenseCorrespondenceEvaluation.add_cross_scene_image_pair_matches(plan, dcn, dataset,
+                scene_name_a, image_a_idx, scene_name_b, image_b_idx, img_a_pixels, img_b_pixels)
 
-            dataframe_list_temp =\
-                DenseCorrespondenceEvaluation.single_cross_scene_image_pair_quantitative_analysis(dcn,
-                dataset, scene_name_a, image_a_idx, scene_name_b, image_b_idx,
-                img_a_pixels, img_b_pixels)
-
-            assert dataframe_list_temp is not None
+        results = plan.evaluate(dcn, dataset, DCNEvaluationPandaTemplate.schema())
+        logging.info("cross scene evaluation: %s" %(plan.summary()))
 
-            pd_dataframe_list += dataframe_list_temp
-
-
-        df = pd.concat(pd_dataframe_list)
+        df = results.to_dataframe()
         # save pandas.DataFrame to csv
         if save:
             output_dir = os.path.join(self.get_output_dir(), network_name, "cross-scene")
@@ -298,18 +337,19 @@ class DenseCorrespondenceEvaluation(object):
                 os.makedirs(output_dir)
 
             df.to_csv(data_file)
+            write_result_summary(df, data_file)
         return df
 
 
     @staticmethod
-    def evaluate_network_across_objects(dcn=None, dataset=None, num_image_pairs=25):
+    def evaluate_network_across_objects(dcn=None, dataset=None, num_image_pairs=25, seed=1):
         """
         This grabs different objects and computes a small set of statistics on their distribution.
         """
 
-        utils.reset_random_seed()
+        utils.reset_random_seed(seed)
 
-        pd_dataframe_list = []
+        results = ResultTable(DCNEvaluationPandaTemplateAcrossObject.schema())
         for i in xrange(num_image_pairs):
 
             object_id_a, object_id_b = dataset.get_two_different_object_ids()
@@ -319,24 +359,71 @@ class DenseCorrespondenceEvaluation(object):
             image_a_idx = dataset.get_random_image_index(scene_name_a)
             image_b_idx = dataset.get_random_image_index(scene_name_b)
 
-            dataframe_list_temp =\
+            results_temp =\
                 DenseCorrespondenceEvaluation.single_across_object_image_pair_quantitative_analysis(dcn,
                 dataset, scene_name_a, scene_name_b, image_a_idx, image_b_idx, object_id_a, object_id_b)
 
-            # if the list is empty, don't bother +=ing it, just continue
-            if len(dataframe_list_temp) == 0:
+            # if the table is empty, don't bother extending with it, just continue
+            if len(results_temp) == 0:
                 continue
 
-            assert dataframe_list_temp is not None
+            assert results_temp is not None
 
-            pd_dataframe_list += dataframe_list_temp
+            results.extend(results_temp)
 
 
-        df = pd.concat(pd_dataframe_list)
+        df = results.to_dataframe()
 
         return df
 
 
+    @staticmethod
+    def evaluate_network_across_objects_batched(dcn, dataset, num_images_per_object=10, num_samples_per_image=100,
+                                                seed=0, **kwargs):
+        """
+        Compares every object against every other object in one pass, see
+        compute_across_object_statistics().
+
+        Each sample gets a row per other object, with the distance to its nearest
+        neighbor among the samples of that object in norm_diff_descriptor_best_match.
+        Unlike evaluate_network_across_objects() the nearest neighbor is searched among
+        masked samples of the other object, not the whole image.
+
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param kwargs: passed to compute_across_object_statistics()
+        :return: a row per sample and other object, and the summary with the confusion matrix,
+        see summarize_across_object_statistics()
+        :rtype: pandas.DataFrame, dict
+        """
+        d = compute_across_object_statistics(dcn, dataset, num_images_per_object=num_images_per_object,
+                                             num_samples_per_image=num_samples_per_image, seed=seed, **kwargs)
+
+        object_ids = np.asarray(d['object_ids'], dtype=object)
+        scene_names = np.asarray([frame[0] for frame in d['frames']], dtype=object)
+        img_idxs = np.asarray([frame[1] for frame in d['frames']], dtype=np.int64)
+        frame_labels = d['frame_labels']
+
+        results = ResultTable(DCNEvaluationPandaTemplateAcrossObject.schema())
+        for object_label_b in xrange(len(object_ids)):
+            samples = np.nonzero((d['object_labels'] != object_label_b)
+                                 & (d['nearest_neighbors'][:, object_label_b] >= 0))[0]
+            nearest_neighbors = d['nearest_neighbors'][samples, object_label_b]
+
+            columns = dict()
+            columns['scene_name_a'] = scene_names[frame_labels[samples]]
+            columns['scene_name_b'] = scene_names[frame_labels[nearest_neighbors]]
+            columns['img_a_idx'] = img_idxs[frame_labels[samples]]
+            columns['img_b_idx'] = img_idxs[frame_labels[nearest_neighbors]]
+            columns['object_id_a'] = object_ids[d['object_labels'][samples]]
+            columns['object_id_b'] = np.full(len(samples), object_ids[object_label_b], dtype=object)
+            columns['norm_diff_descriptor_best_match'] = d['distances'][samples, object_label_b]
+            results.append(columns)
+
+        return results.to_dataframe(), summarize_across_object_statistics(d)
+
     def evaluate_single_network_cross_instance(self, network_name, full_path_cross_instance_labels, save=False):
         """
         Simple wrapper that uses class config and then calls static method
@@ -366,10 +453,9 @@ class DenseCorrespondenceEvaluation(object):
         #             print "Found new keypoint:", keypoint_label['keypoint']
 
 
-        pd_dataframe_list = []
-
-        # generate all pairs of images
-        import itertools
+        # generate all pairs of images, all of them go into one plan so that every
+        # frame is loaded and run through the network once
+        plan = MatchPlan()
         for subset in itertools.combinations(cross_instance_keypoint_labels, 2):
             print(subset)
 
@@ -382,17 +468,13 @@ class DenseCorrespondenceEvaluation(object):
             img_a_pixels = subset[0]["image"]["pixels"]
             img_b_pixels = subset[1]["image"]["pixels"]
 
-            dataframe_list_temp =\
-                DenseCorrespondenceEvaluation.single_cross_scene_image_pair_quantitative_analysis(dcn,
-                dataset, scene_name_a, image_a_idx, scene_name_b, image_b_idx,
-                img_a_pixels, img_b_pixels)
+            DenseCorrespondenceEvaluation.add_cross_scene_image_pair_matches(plan, dcn, dataset,
+                scene_name_a, image_a_idx, scene_name_b, image_b_idx, img_a_pixels, img_b_pixels)
 
-            assert dataframe_list_temp is not None
+        results = plan.evaluate(dcn, dataset, DCNEvaluationPandaTemplate.schema())
+        logging.info("cross instance evaluation: %s" %(plan.summary()))
 
-            pd_dataframe_list += dataframe_list_temp
-
-
-        df = pd.concat(pd_dataframe_list)
+        df = results.to_dataframe()
         # save pandas.DataFrame to csv
         if save:
             output_dir = os.path.join(self.get_output_dir(), network_name, "cross-instance")
@@ -401,6 +483,7 @@ class DenseCorrespondenceEvaluation(object):
                 os.makedirs(output_dir)
 
             df.to_csv(data_file)
+            write_result_summary(df, data_file)
         return df
 
     @staticmethod
@@ -423,62 +506,35 @@ class DenseCorrespondenceEvaluation(object):
 
         print "num cross instance labels", len(cross_instance_keypoint_labels)
 
-        # Two-layer dict with:
-        # - key:   the scene_name
-        # - key:   the image_idx
-        # - value: the descriptor image 
-        descriptor_images = dict()
-
-        # generate all descriptor images
-        for keypoint_label in cross_instance_keypoint_labels:
-            scene_name = keypoint_label["scene_name"]
-            image_idx = keypoint_label["image_idx"]
-            if scene_name not in descriptor_images:
-                descriptor_images[scene_name] = dict()
-            if image_idx in descriptor_images[scene_name]:
-                continue
-            rgb, _, _, _ = dataset.get_rgbd_mask_pose(scene_name, image_idx)
-            rgb_tensor = dataset.rgb_image_to_tensor(rgb)
-            res = dcn.forward_single_image_tensor(rgb_tensor).data.cpu().numpy()
-            
-            descriptor_images[scene_name][image_idx] = res
-
-
-        pd_dataframe_list = []
-
-        # generate all pairs of images
+        # generate all pairs of images, all of them go into one plan so that every
+        # frame is loaded and run through the network once
+        plan = MatchPlan()
         counter = 0
         for subset in itertools.combinations(cross_instance_keypoint_labels, 2):
             counter += 1
-            keypoint_data_a = subset[0]
-            keypoint_data_b = subset[1]
-            
-            res_a = descriptor_images[keypoint_data_a["scene_name"]][keypoint_data_a["image_idx"]]
-            res_b = descriptor_images[keypoint_data_b["scene_name"]][keypoint_data_b["image_idx"]]
-
-            dataframe_list_temp = \
-                DenseCorrespondenceEvaluation.single_image_pair_cross_scene_keypoints_quantitative_analysis(dcn, dataset, keypoint_data_a, keypoint_data_b, res_a, res_b)
-
-            if dataframe_list_temp is None:
-                print "no matches found, skipping"
-                continue
-
-            pd_dataframe_list += dataframe_list_temp
+            DenseCorrespondenceEvaluation.add_cross_scene_keypoint_matches(plan, dcn, subset[0], subset[1])
 
+        results = plan.evaluate(dcn, dataset, DCNEvaluationPandaTemplate.schema())
+        logging.info("cross scene keypoint evaluation: %s" %(plan.summary()))
 
         print "num_pairs considered", counter
-        df = pd.concat(pd_dataframe_list)
+        df = results.to_dataframe()
 
         return df
 
     @staticmethod
-    def evaluate_network(dcn, dataset, num_image_pairs=25, num_matches_per_image_pair=100):
+    def evaluate_network(dcn, dataset, num_image_pairs=25, num_matches_per_image_pair=100, output_file=None):
         """
 
         :param nn: A neural network DenseCorrespondenceNetwork
         :param test_dataset: DenseCorrespondenceDataset
             the dataset to draw samples from
-        :return:
+        :param output_file: (optional) .csv, .parquet or .arrow file the rows are streamed to
+        after every image pair instead of being kept in memory. Their summary is written
+        next to it, see metric_summary.write_result_summary()
+        :type output_file: str
+        :return: the ResultTable and the rows as a DataFrame
+        :rtype: ResultTable, pandas.DataFrame
         """
         utils.reset_random_seed()
 
@@ -488,7 +544,12 @@ class DenseCorrespondenceEvaluation(object):
         logging_rate = 5
 
 
-        pd_dataframe_list = []
+        schema = DCNEvaluationPandaTemplate.schema()
+        if output_file is None:
+            results = ResultTable(schema)
+        else:
+            results = ResultTable(schema, writer=open_result_writer(output_file, schema), flush_rows=1)
+
         for i in xrange(0, num_image_pairs):
 
 
@@ -508,23 +569,95 @@ class DenseCorrespondenceEvaluation(object):
 
             img_idx_a, img_idx_b = idx_pair
 
-            dataframe_list_temp =\
+            results_temp =\
                 DCE.single_same_scene_image_pair_quantitative_analysis(dcn, dataset, scene_name,
                                                             img_idx_a,
                                                             img_idx_b,
                                                             num_matches=num_matches_per_image_pair,
                                                             debug=False)
 
-            if dataframe_list_temp is None:
+            if results_temp is None:
                 print "no matches found, skipping"
                 continue
 
-            pd_dataframe_list += dataframe_list_temp
+            results.extend(results_temp)
             # pd_series_list.append(series_list_temp)
 
 
-        df = pd.concat(pd_dataframe_list)
-        return pd_dataframe_list, df
+        if output_file is None:
+            df = results.to_dataframe()
+        else:
+            results.close()
+            df = read_result_table(output_file)
+            write_result_summary(df, output_file)
+
+        return results, df
+
+    @staticmethod
+    def evaluate_network_checkpoints(dcns, dataset, store, keys, num_image_pairs=25, num_matches_per_image_pair=100,
+                                     seed=0):
+        """
+        Same as evaluate_network(), for several checkpoints at once and cached in an
+        EvaluationStore. The image pairs and matches are sampled and loaded once and
+        evaluated with every network that doesn't have them in the store yet.
+
+        Each image pair is sampled from its own generators, seeded with
+        evaluation_store.pair_seed(), so an interrupted evaluation resumes at the first
+        missing image pair and the global random state is left alone.
+
+        :param dcns: iteration --> DenseCorrespondenceNetwork
+        :type dcns: dict
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param store:
+        :type store: EvaluationStore
+        :param keys: iteration --> key of the evaluation, see evaluation_store.make_key()
+        :type keys: dict
+        :return: iteration --> DataFrame, same columns as evaluate_network()
+        :rtype: dict
+        """
+        DCE = DenseCorrespondenceEvaluation
+
+        finished_pairs = {iteration: store.finished_pairs(keys[iteration]) for iteration in dcns
+                          if not store.is_complete(keys[iteration])}
+
+        logging_rate = 5
+
+        for i in xrange(0, num_image_pairs):
+            iterations = [iteration for iteration in finished_pairs if i not in finished_pairs[iteration]]
+            if len(iterations) == 0:
+                continue
+
+            rng = utils.RandomStreams(pair_seed(seed, i))
+            scene_name = dataset.get_random_scene_name(rng=rng)
+
+            if i % logging_rate == 0:
+                print "computing statistics for image %d of %d, scene_name %s" %(i, num_image_pairs, scene_name)
+
+            pair_data = None
+            idx_pair = DCE.get_image_pair_with_poses_diff_above_threshold(dataset, scene_name, rng=rng)
+            if idx_pair is None:
+                logging.info("no satisfactory image pair found, continuing")
+            else:
+                img_idx_a, img_idx_b = idx_pair
+                pair_data = DCE.sample_same_scene_image_pair_matches(dataset, scene_name, img_idx_a, img_idx_b,
+                                                                     num_matches=num_matches_per_image_pair,
+                                                                     rng=rng)
+
+            for iteration in iterations:
+                # pairs without matches are stored empty, so that they aren't sampled again
+                if pair_data is None:
+                    results = ResultTable(DCNEvaluationPandaTemplate.schema())
+                else:
+                    dcns[iteration].eval()
+                    results = DCE.same_scene_image_pair_match_statistics(dcns[iteration], dataset, pair_data)
+
+                store.write_pair(keys[iteration], i, results)
+
+        for iteration in finished_pairs:
+            store.finish_pairs(keys[iteration])
+
+        return {iteration: store.read_dataframe(keys[iteration]) for iteration in dcns}
 
     @staticmethod
     def plot_descriptor_colormaps(res_a, res_b, descriptor_image_stats=None,
@@ -613,9 +746,9 @@ class DenseCorrespondenceEvaluation(object):
         """
         Quantitative analsys of a dcn on a pair of images from different scenes (requires human labeling).
 
-        There is a bit of code copy from single_same_scene_image_pair_quantitative_analysis, but
-        it's a bit of a different structure, since matches are passed in and we need to try to generate more
-        views of these sparse human labeled pixel matches.
+        Evaluates a plan with only the matches of this pair, see add_cross_scene_image_pair_matches().
+        When evaluating many pairs, add them all to one MatchPlan instead, so that frames
+        shared between pairs are only loaded and run through the network once.
 
         :param dcn:
         :type dcn: DenseCorrespondenceNetwork
@@ -629,156 +762,115 @@ class DenseCorrespondenceEvaluation(object):
         :type img_b_idx: int
         :param img_a_pixels, img_b_pixels: lists of dicts, where each dict contains keys for "u" and "v"
                 the lists should be the same length and index i from each list constitutes a match pair
-        :return: Dict with relevant data
-        :rtype:
+        :return: a row per match
+        :rtype: ResultTable
         """
+        plan = MatchPlan()
+        DenseCorrespondenceEvaluation.add_cross_scene_image_pair_matches(plan, dcn, dataset, scene_name_a,
+                                                                         img_a_idx, scene_name_b, img_b_idx,
+                                                                         img_a_pixels, img_b_pixels)
 
-        rgb_a, depth_a, mask_a, pose_a = dataset.get_rgbd_mask_pose(scene_name_a, img_a_idx)
+        return plan.evaluate(dcn, dataset, DCNEvaluationPandaTemplate.schema())
 
-        rgb_b, depth_b, mask_b, pose_b = dataset.get_rgbd_mask_pose(scene_name_b, img_b_idx)
-
-        depth_a = np.asarray(depth_a)
-        depth_b = np.asarray(depth_b)
-        mask_a = np.asarray(mask_a)
-        mask_b = np.asarray(mask_b)
+    @staticmethod
+    def add_cross_scene_image_pair_matches(plan, dcn, dataset, scene_name_a, img_a_idx, scene_name_b, img_b_idx,
+                                           img_a_pixels, img_b_pixels):
+        """
+        Adds the human labeled matches of a pair of images from different scenes to the plan.
 
-        # compute dense descriptors
-        rgb_a_tensor = dataset.rgb_image_to_tensor(rgb_a)
-        rgb_b_tensor = dataset.rgb_image_to_tensor(rgb_b)
+        Since the labeled matches are sparse, more views of them are generated: for each
+        labeled match, J different views of image a are matched against image b and
+        K different views of image b against image a, using the depth images and poses.
+        This will lead to I*J+I*K attempts at new pairs for I labeled matches.
 
-        # these are Variables holding torch.FloatTensors, first grab the data, then convert to numpy
-        res_a = dcn.forward_single_image_tensor(rgb_a_tensor).data.cpu().numpy()
-        res_b = dcn.forward_single_image_tensor(rgb_b_tensor).data.cpu().numpy()
+        :param plan:
+        :type plan: MatchPlan
+        :param img_a_pixels, img_b_pixels: lists of dicts, where each dict contains keys for "u" and "v"
+                the lists should be the same length and index i from each list constitutes a match pair
+        :return:
+        :rtype: None
+        """
+        DCE = DenseCorrespondenceEvaluation
 
         camera_intrinsics_a = dataset.get_camera_intrinsics(scene_name_a)
         camera_intrinsics_b = dataset.get_camera_intrinsics(scene_name_b)
         if not np.allclose(camera_intrinsics_a.K, camera_intrinsics_b.K):
             print "Currently cannot handle two different camera K matrices in different scenes!"
             print "But you could add this..."
-        camera_intrinsics_matrix = camera_intrinsics_a.K
 
         assert len(img_a_pixels) == len(img_b_pixels)
 
-        print "Expanding amount of matches between:"
-        print "scene_name_a", scene_name_a
-        print "scene_name_b", scene_name_b
-        print "originally had", len(img_a_pixels), "matches"
+        logging.info("Expanding %d matches between %s and %s" %(len(img_a_pixels), scene_name_a, scene_name_b))
 
         image_height, image_width = dcn.image_shape
-        DCE = DenseCorrespondenceEvaluation
+        frame_a = (scene_name_a, img_a_idx)
+        frame_b = (scene_name_b, img_b_idx)
+        scene_name = scene_name_a + "+" + scene_name_b
 
-        dataframe_list = []
+        def columns(img_a_idx, img_b_idx):
+            return {'scene_name': scene_name, 'img_a_idx': int(img_a_idx), 'img_b_idx': int(img_b_idx)}
 
-        # Loop over the labeled pixel matches once, before using different views
-        # This lets us keep depth_a, depth_b, res_a, res_b without reloading
+        uv_a_list = []
+        uv_b_list = []
         for i in range(len(img_a_pixels)):
-            print "now, index of pixel match:", i
             uv_a = (img_a_pixels[i]["u"], img_a_pixels[i]["v"])
             uv_b = (img_b_pixels[i]["u"], img_b_pixels[i]["v"])
-            uv_a = DCE.clip_pixel_to_image_size_and_round(uv_a, image_width, image_height)
-            uv_b = DCE.clip_pixel_to_image_size_and_round(uv_b, image_width, image_height)
-            print uv_a
-            print uv_b
-
-            # Reminder: this function wants only a single uv_a, uv_b
-            pd_template = DenseCorrespondenceEvaluation.compute_descriptor_match_statistics(depth_a,
-                                                        depth_b, mask_a, mask_b, uv_a, uv_b, pose_a,pose_b, res_a,
-                                                        res_b, camera_intrinsics_matrix,
-                                                        rgb_a=rgb_a, rgb_b=rgb_b, debug=False)
-
-            pd_template.set_value('scene_name', scene_name_a+"+"+scene_name_b)
-            pd_template.set_value('img_a_idx', int(img_a_idx))
-            pd_template.set_value('img_b_idx', int(img_b_idx))
-
-            dataframe_list.append(pd_template.dataframe)
-
-        # Loop a second time over the labeled pixel matches
-        # But this time try,
-        #  for each I labeled pixel match pairs,
-        #       for each J different views for image a, and
-        #       for each K different views for image b
-        # This will lead to I*J+I*K attempts at new pairs!
-        # Could also do the cubic version...
+            uv_a_list.append(DCE.clip_pixel_to_image_size_and_round(uv_a, image_width, image_height))
+            uv_b_list.append(DCE.clip_pixel_to_image_size_and_round(uv_b, image_width, image_height))
+
+        # the labeled matches, before using different views
+        for uv_a, uv_b in zip(uv_a_list, uv_b_list):
+            plan.add_match(frame_a, uv_a, frame_b, uv_b, columns(img_a_idx, img_b_idx))
+
         J = 10
         K = 10
 
-        # Loop over labeled pixel matches
-        for i in range(len(img_a_pixels)):
-            uv_a = (img_a_pixels[i]["u"], img_a_pixels[i]["v"])
-            uv_b = (img_b_pixels[i]["u"], img_b_pixels[i]["v"])
-            uv_a = DCE.clip_pixel_to_image_size_and_round(uv_a, image_width, image_height)
-            uv_b = DCE.clip_pixel_to_image_size_and_round(uv_b, image_width, image_height)
-
-            # Loop over J different views for image a
-            for j in range(J):
-                different_view_a_idx = dataset.get_img_idx_with_different_pose(scene_name_a, pose_a, num_attempts=50)
-                if different_view_a_idx is None:
-                    logging.info("no frame with sufficiently different pose found, continuing")
-                    continue
-                diff_rgb_a, diff_depth_a, diff_mask_a, diff_pose_a = dataset.get_rgbd_mask_pose(scene_name_a, different_view_a_idx)
-                diff_depth_a = np.asarray(diff_depth_a)
-                diff_mask_a = np.asarray(diff_mask_a)
-                (uv_a_vec, diff_uv_a_vec) = correspondence_finder.batch_find_pixel_correspondences(depth_a, pose_a, diff_depth_a, diff_pose_a,
-                                                               uv_a=uv_a)
-                if uv_a_vec is None:
-                    logging.info("no matches found, continuing")
-                    continue
-                elif uv_a_vec[0].numel() == 0:
-                    logging.info("no matches found, continuing")
-                    continue
+        # only the depth images and poses are needed to find the matches in other views,
+        # the frames are loaded and run through the network when the plan is evaluated
+        depth_a = np.asarray(dataset.get_depth_image_from_scene_name_and_idx(scene_name_a, img_a_idx))
+        depth_b = np.asarray(dataset.get_depth_image_from_scene_name_and_idx(scene_name_b, img_b_idx))
+        pose_a = dataset.get_pose_from_scene_name_and_idx(scene_name_a, img_a_idx)
+        pose_b = dataset.get_pose_from_scene_name_and_idx(scene_name_b, img_b_idx)
 
-                diff_rgb_a_tensor = dataset.rgb_image_to_tensor(diff_rgb_a)
-                diff_res_a = dcn.forward_single_image_tensor(diff_rgb_a_tensor).data.cpu().numpy()
+        def find_match_in_different_view(scene_name, depth, pose, uv):
+            """
+            :return: (different view idx, pixel of uv in it), or None
+            """
+            different_view_idx = dataset.get_img_idx_with_different_pose(scene_name, pose, num_attempts=50)
+            if different_view_idx is None:
+                logging.info("no frame with sufficiently different pose found, continuing")
+                return None
 
+            diff_depth = np.asarray(dataset.get_depth_image_from_scene_name_and_idx(scene_name, different_view_idx))
+            diff_pose = dataset.get_pose_from_scene_name_and_idx(scene_name, different_view_idx)
+            (uv_vec, diff_uv_vec) = correspondence_finder.batch_find_pixel_correspondences(depth, pose, diff_depth,
+                                                                                            diff_pose, uv_a=uv)
+            if uv_vec is None or uv_vec[0].numel() == 0:
+                logging.info("no matches found, continuing")
+                return None
 
-                diff_uv_a = (diff_uv_a_vec[0][0], diff_uv_a_vec[1][0])
-                diff_uv_a = DCE.clip_pixel_to_image_size_and_round(diff_uv_a, image_width, image_height)
+            diff_uv = (diff_uv_vec[0][0], diff_uv_vec[1][0])
+            return different_view_idx, DCE.clip_pixel_to_image_size_and_round(diff_uv, image_width, image_height)
 
-                pd_template = DenseCorrespondenceEvaluation.compute_descriptor_match_statistics(diff_depth_a,
-                                                        depth_b, diff_mask_a, mask_b, diff_uv_a, uv_b, diff_pose_a, pose_b,
-                                                        diff_res_a, res_b, camera_intrinsics_matrix,
-                                                        rgb_a=diff_rgb_a, rgb_b=rgb_b, debug=False)
-                pd_template.set_value('scene_name', scene_name_a+"+"+scene_name_b)
-                pd_template.set_value('img_a_idx', int(different_view_a_idx))
-                pd_template.set_value('img_b_idx', int(img_b_idx))
+        for uv_a, uv_b in zip(uv_a_list, uv_b_list):
 
-                dataframe_list.append(pd_template.dataframe)
+            # J different views for image a
+            for j in range(J):
+                match = find_match_in_different_view(scene_name_a, depth_a, pose_a, uv_a)
+                if match is None:
+                    continue
+                different_view_a_idx, diff_uv_a = match
+                plan.add_match((scene_name_a, different_view_a_idx), diff_uv_a, frame_b, uv_b,
+                               columns(different_view_a_idx, img_b_idx))
 
-            # Loop over K different views for image b
+            # K different views for image b
             for k in range(K):
-                different_view_b_idx = dataset.get_img_idx_with_different_pose(scene_name_b, pose_b, num_attempts=50)
-                if different_view_b_idx is None:
-                    logging.info("no frame with sufficiently different pose found, continuing")
-                    continue
-                diff_rgb_b, diff_depth_b, diff_mask_b, diff_pose_b = dataset.get_rgbd_mask_pose(scene_name_b, different_view_b_idx)
-                diff_depth_b = np.asarray(diff_depth_b)
-                diff_mask_b = np.asarray(diff_mask_b)
-                (uv_b_vec, diff_uv_b_vec) = correspondence_finder.batch_find_pixel_correspondences(depth_b, pose_b, diff_depth_b, diff_pose_b,
-                                                               uv_a=uv_b)
-                if uv_b_vec is None:
-                    logging.info("no matches found, continuing")
-                    continue
-                elif uv_b_vec[0].numel() == 0:
-                    logging.info("no matches found, continuing")
+                match = find_match_in_different_view(scene_name_b, depth_b, pose_b, uv_b)
+                if match is None:
                     continue
-
-                diff_rgb_b_tensor = dataset.rgb_image_to_tensor(diff_rgb_b)
-                diff_res_b = dcn.forward_single_image_tensor(diff_rgb_b_tensor).data.cpu().numpy()
-
-                diff_uv_b = (diff_uv_b_vec[0][0], diff_uv_b_vec[1][0])
-                diff_uv_b = DCE.clip_pixel_to_image_size_and_round(diff_uv_b, image_width, image_height)
-
-                pd_template = DenseCorrespondenceEvaluation.compute_descriptor_match_statistics(depth_a,
-                                                        diff_depth_b, mask_a, diff_mask_b, uv_a, diff_uv_b, pose_a, diff_pose_b,
-                                                        res_a, diff_res_b, camera_intrinsics_matrix,
-                                                        rgb_a=rgb_a, rgb_b=diff_rgb_b, debug=False)
-                pd_template.set_value('scene_name', scene_name_a+"+"+scene_name_b)
-                pd_template.set_value('img_a_idx', int(img_a_idx))
-                pd_template.set_value('img_b_idx', int(different_view_b_idx))
-
-                dataframe_list.append(pd_template.dataframe)
-
-        return dataframe_list
+                different_view_b_idx, diff_uv_b = match
+                plan.add_match(frame_a, uv_a, (scene_name_b, different_view_b_idx), diff_uv_b,
+                               columns(img_a_idx, different_view_b_idx))
 
     @staticmethod
     def single_across_object_image_pair_quantitative_analysis(dcn, dataset, scene_name_a, scene_name_b,
@@ -799,8 +891,8 @@ class DenseCorrespondenceEvaluation(object):
         :type img_b_idx: int
         :param camera_intrinsics_matrix: Optionally set camera intrinsics, otherwise will get it from the dataset
         :type camera_intrinsics_matrix: 3 x 3 numpy array
-        :return: Dict with relevant data
-        :rtype:
+        :return: a row per sampled pixel
+        :rtype: ResultTable
         """
 
 
@@ -820,43 +912,41 @@ class DenseCorrespondenceEvaluation(object):
         res_a = dcn.forward_single_image_tensor(rgb_a_tensor).data.cpu().numpy()
         res_b = dcn.forward_single_image_tensor(rgb_b_tensor).data.cpu().numpy()
 
-        # container to hold a list of pandas dataframe
-        # will eventually combine them all with concat
-        dataframe_list = []
-
-        logging_rate = 100
+        # a row per sampled pixel
+        results = ResultTable(DCNEvaluationPandaTemplateAcrossObject.schema())
 
         image_height, image_width = dcn.image_shape
 
-        DCE = DenseCorrespondenceEvaluation
-
         sampled_idx_list = random_sample_from_masked_image(mask_a, num_uv_a_samples)
-        # If the list is empty, return an empty list
+        # If the list is empty, return an empty table
         if len(sampled_idx_list) == 0:
-            return dataframe_list
-
-        for i in range(num_uv_a_samples):
-
-            uv_a = [sampled_idx_list[1][i], sampled_idx_list[0][i]]
-
-            pd_template = DCE.compute_descriptor_match_statistics_no_ground_truth(uv_a, res_a,
-                                                                  res_b,
-                                                                  rgb_a=rgb_a,
-                                                                  rgb_b=rgb_b,
-                                                                  depth_a=depth_a,
-                                                                  depth_b=depth_b,
-                                                                  debug=debug)
-
-            pd_template.set_value('scene_name_a', scene_name_a)
-            pd_template.set_value('scene_name_b', scene_name_b)
-            pd_template.set_value('object_id_a', object_id_a)
-            pd_template.set_value('object_id_b', object_id_b)
-            pd_template.set_value('img_a_idx', int(img_a_idx))
-            pd_template.set_value('img_b_idx', int(img_b_idx))
+            return results
 
-            dataframe_list.append(pd_template.dataframe)
+        # best matches of all sampled pixels at once
+        uv_a = np.stack([sampled_idx_list[1], sampled_idx_list[0]], axis=1)
+        descriptors_a = res_a[uv_a[:, 1], uv_a[:, 0]].astype(np.float64)
+        squared_diffs = squared_distances(descriptors_a, res_b.reshape(-1, res_b.shape[2]).astype(np.float64))
+        best_match_idx = np.argmin(squared_diffs, axis=1)
+        best_match_diff = np.sqrt(squared_diffs[np.arange(len(uv_a)), best_match_idx])
 
-        return dataframe_list
+        if debug:
+            for i in range(len(uv_a)):
+                uv_b = (best_match_idx[i] % image_width, best_match_idx[i] // image_width)
+                correspondence_plotter.plot_correspondences_direct(rgb_a, depth_a, rgb_b, depth_b,
+                                                                   uv_a[i], uv_b, show=True)
+
+        num_samples = len(uv_a)
+        columns = dict()
+        columns['scene_name_a'] = [scene_name_a] * num_samples
+        columns['scene_name_b'] = [scene_name_b] * num_samples
+        columns['object_id_a'] = [object_id_a] * num_samples
+        columns['object_id_b'] = [object_id_b] * num_samples
+        columns['img_a_idx'] = np.full(num_samples, int(img_a_idx), dtype=np.int64)
+        columns['img_b_idx'] = np.full(num_samples, int(img_b_idx), dtype=np.int64)
+        columns['norm_diff_descriptor_best_match'] = best_match_diff
+        results.append(columns)
+
+        return results
 
     @staticmethod
     def single_same_scene_image_pair_quantitative_analysis(dcn, dataset, scene_name,
@@ -879,10 +969,35 @@ class DenseCorrespondenceEvaluation(object):
         :type img_b_idx: int
         :param camera_intrinsics_matrix: Optionally set camera intrinsics, otherwise will get it from the dataset
         :type camera_intrinsics_matrix: 3 x 3 numpy array
-        :return: List of pandas DataFrame objects
-        :rtype:
+        :return: a row per match, None if there are no matches
+        :rtype: ResultTable
         """
+        DCE = DenseCorrespondenceEvaluation
+
+        pair_data = DCE.sample_same_scene_image_pair_matches(dataset, scene_name, img_a_idx, img_b_idx,
+                                                             camera_intrinsics_matrix=camera_intrinsics_matrix,
+                                                             num_matches=num_matches, debug=debug)
+        if pair_data is None:
+            return None
 
+        return DCE.same_scene_image_pair_match_statistics(dcn, dataset, pair_data, debug=debug)
+
+    @staticmethod
+    def sample_same_scene_image_pair_matches(dataset, scene_name, img_a_idx, img_b_idx,
+                                             camera_intrinsics_matrix=None, num_matches=100, debug=False,
+                                             rng=None):
+        """
+        The part of single_same_scene_image_pair_quantitative_analysis() that doesn't
+        depend on the network: loads the images and samples the ground truth matches.
+        The result can be evaluated with several networks, see
+        same_scene_image_pair_match_statistics()
+
+        :param rng: generators for sampling the matches, None for the global generators
+        :type rng: utils.RandomStreams
+        :return: dict with the images, poses, camera matrix and the sampled matches,
+        None if there are no matches
+        :rtype: dict
+        """
         rgb_a, depth_a, mask_a, pose_a = dataset.get_rgbd_mask_pose(scene_name, img_a_idx)
 
         rgb_b, depth_b, mask_b, pose_b = dataset.get_rgbd_mask_pose(scene_name, img_b_idx)
@@ -892,70 +1007,96 @@ class DenseCorrespondenceEvaluation(object):
         mask_a = np.asarray(mask_a)
         mask_b = np.asarray(mask_b)
 
-        # compute dense descriptors
-        rgb_a_tensor = dataset.rgb_image_to_tensor(rgb_a)
-        rgb_b_tensor = dataset.rgb_image_to_tensor(rgb_b)
-
-        # these are Variables holding torch.FloatTensors, first grab the data, then convert to numpy
-        res_a = dcn.forward_single_image_tensor(rgb_a_tensor).data.cpu().numpy()
-        res_b = dcn.forward_single_image_tensor(rgb_b_tensor).data.cpu().numpy()
-
         if camera_intrinsics_matrix is None:
             camera_intrinsics = dataset.get_camera_intrinsics(scene_name)
             camera_intrinsics_matrix = camera_intrinsics.K
 
         # find correspondences
         (uv_a_vec, uv_b_vec) = correspondence_finder.batch_find_pixel_correspondences(depth_a, pose_a, depth_b, pose_b,
-                                                               device='CPU', img_a_mask=mask_a)
+                                                               device='CPU', img_a_mask=mask_a, rng=rng)
 
         if uv_a_vec is None:
             print "no matches found, returning"
             return None
 
-        # container to hold a list of pandas dataframe
-        # will eventually combine them all with concat
-        dataframe_list = []
-
         total_num_matches = len(uv_a_vec[0])
         num_matches = min(num_matches, total_num_matches)
-        match_list = random.sample(range(0, total_num_matches), num_matches)
+        match_list = utils.get_random_streams(rng).random.sample(range(0, total_num_matches), num_matches)
 
         if debug:
             match_list = [50]
 
-        logging_rate = 100
+        pair_data = dict()
+        pair_data['scene_name'] = scene_name
+        pair_data['img_a_idx'] = img_a_idx
+        pair_data['img_b_idx'] = img_b_idx
+        pair_data['rgb_a'] = rgb_a
+        pair_data['rgb_b'] = rgb_b
+        pair_data['depth_a'] = depth_a
+        pair_data['depth_b'] = depth_b
+        pair_data['mask_a'] = mask_a
+        pair_data['mask_b'] = mask_b
+        pair_data['pose_a'] = pose_a
+        pair_data['pose_b'] = pose_b
+        pair_data['camera_intrinsics_matrix'] = camera_intrinsics_matrix
+        pair_data['uv_a'] = [(uv_a_vec[0][i], uv_a_vec[1][i]) for i in match_list]
+        pair_data['uv_b'] = [(uv_b_vec[0][i], uv_b_vec[1][i]) for i in match_list]
+        return pair_data
 
-        image_height, image_width = dcn.image_shape
+    @staticmethod
+    def same_scene_image_pair_match_statistics(dcn, dataset, pair_data, debug=False):
+        """
+        Evaluates a network on the matches sampled by sample_same_scene_image_pair_matches()
 
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param pair_data: see sample_same_scene_image_pair_matches()
+        :type pair_data: dict
+        :return: a row per match
+        :rtype: ResultTable
+        """
         DCE = DenseCorrespondenceEvaluation
 
-        for i in match_list:
-            uv_a = (uv_a_vec[0][i], uv_a_vec[1][i])
-            uv_b_raw = (uv_b_vec[0][i], uv_b_vec[1][i])
+        # compute dense descriptors
+        rgb_a_tensor = dataset.rgb_image_to_tensor(pair_data['rgb_a'])
+        rgb_b_tensor = dataset.rgb_image_to_tensor(pair_data['rgb_b'])
+
+        # these are Variables holding torch.FloatTensors, first grab the data, then convert to numpy
+        res_a = dcn.forward_single_image_tensor(rgb_a_tensor).data.cpu().numpy()
+        res_b = dcn.forward_single_image_tensor(rgb_b_tensor).data.cpu().numpy()
+
+        # a row per match
+        results = ResultTable(DCNEvaluationPandaTemplate.schema())
+
+        image_height, image_width = dcn.image_shape
+
+        for uv_a, uv_b_raw in zip(pair_data['uv_a'], pair_data['uv_b']):
             uv_b = DCE.clip_pixel_to_image_size_and_round(uv_b_raw, image_width, image_height)
 
-            pd_template = DCE.compute_descriptor_match_statistics(depth_a,
-                                                                  depth_b,
-                                                                  mask_a,
-                                                                  mask_b,
+            pd_template = DCE.compute_descriptor_match_statistics(pair_data['depth_a'],
+                                                                  pair_data['depth_b'],
+                                                                  pair_data['mask_a'],
+                                                                  pair_data['mask_b'],
                                                                   uv_a,
                                                                   uv_b,
-                                                                  pose_a,
-                                                                  pose_b,
+                                                                  pair_data['pose_a'],
+                                                                  pair_data['pose_b'],
                                                                   res_a,
                                                                   res_b,
-                                                                  camera_intrinsics_matrix,
-                                                                  rgb_a=rgb_a,
-                                                                  rgb_b=rgb_b,
+                                                                  pair_data['camera_intrinsics_matrix'],
+                                                                  rgb_a=pair_data['rgb_a'],
+                                                                  rgb_b=pair_data['rgb_b'],
                                                                   debug=debug)
 
-            pd_template.set_value('scene_name', scene_name)
-            pd_template.set_value('img_a_idx', int(img_a_idx))
-            pd_template.set_value('img_b_idx', int(img_b_idx))
+            pd_template.set_value('scene_name', pair_data['scene_name'])
+            pd_template.set_value('img_a_idx', int(pair_data['img_a_idx']))
+            pd_template.set_value('img_b_idx', int(pair_data['img_b_idx']))
 
-            dataframe_list.append(pd_template.dataframe)
+            results.append_row(pd_template.row)
 
-        return dataframe_list
+        return results
 
     @staticmethod
     def is_depth_valid(depth):
@@ -1444,61 +1585,44 @@ class DenseCorrespondenceEvaluation(object):
         :type keypoint_data_a:
         :param keypoint_data_b:
         :type keypoint_data_b:
-        :return: List of pandas DataFrame objects
-        :rtype:
+        :param res_a, res_b: (optional) precomputed descriptor images
+        :type res_a, res_b: numpy.ndarray
+        :return: a row per keypoint
+        :rtype: ResultTable
         """
+        plan = MatchPlan()
+        DenseCorrespondenceEvaluation.add_cross_scene_keypoint_matches(plan, dcn, keypoint_data_a, keypoint_data_b)
 
-        DCE = DenseCorrespondenceEvaluation
-
-        scene_name_a = keypoint_data_a['scene_name']
-        object_id_a = keypoint_data_a['object_id']
-        img_a_idx = keypoint_data_a['image_idx']
-
-        scene_name_b = keypoint_data_b['scene_name']
-        object_id_b = keypoint_data_b['object_id']
-        img_b_idx = keypoint_data_b['image_idx']
-
-        rgb_a, depth_a, mask_a, pose_a = dataset.get_rgbd_mask_pose(scene_name_a, img_a_idx)
-
-        rgb_b, depth_b, mask_b, pose_b = dataset.get_rgbd_mask_pose(scene_name_b, img_b_idx)
-
-        depth_a = np.asarray(depth_a)
-        depth_b = np.asarray(depth_b)
-        mask_a = np.asarray(mask_a)
-        mask_b = np.asarray(mask_b)
+        descriptor_images = dict()
+        if res_a is not None and res_b is not None:
+            descriptor_images[(keypoint_data_a['scene_name'], keypoint_data_a['image_idx'])] = res_a
+            descriptor_images[(keypoint_data_b['scene_name'], keypoint_data_b['image_idx'])] = res_b
 
-        if res_a is None and res_b is None:
-            # compute dense descriptors
-            rgb_a_tensor = dataset.rgb_image_to_tensor(rgb_a)
-            rgb_b_tensor = dataset.rgb_image_to_tensor(rgb_b)
+        return plan.evaluate(dcn, dataset, DCNEvaluationPandaTemplate.schema(),
+                             descriptor_images=descriptor_images)
 
-            # these are Variables holding torch.FloatTensors, first grab the data, then convert to numpy
-            res_a = dcn.forward_single_image_tensor(rgb_a_tensor).data.cpu().numpy()
-            res_b = dcn.forward_single_image_tensor(rgb_b_tensor).data.cpu().numpy()
+    @staticmethod
+    def add_cross_scene_keypoint_matches(plan, dcn, keypoint_data_a, keypoint_data_b):
+        """
+        Adds a match per keypoint annotated in both images to the plan, in both orderings
 
+        :param plan:
+        :type plan: MatchPlan
+        :param keypoint_data_a: dict with scene_name, object_id, image_idx and keypoints,
+        a dict keypoint name --> dict with keys "u" and "v"
+        :type keypoint_data_a: dict
+        :param keypoint_data_b: same as keypoint_data_a
+        :type keypoint_data_b: dict
+        :return:
+        :rtype: None
+        """
+        DCE = DenseCorrespondenceEvaluation
+        image_height, image_width = dcn.image_shape
 
         # vectors to allow re-ordering
-        rgb = [rgb_a, rgb_b]
-        depth = [depth_a, depth_b]
-        mask = [mask_a, mask_b]
-        scene_name = [scene_name_a, scene_name_b]
-        img_idx = [img_a_idx, img_b_idx]
-        pose = [pose_a, pose_b]
-        res = [res_a, res_b]
-        object_id = [object_id_a, object_id_b]
+        keypoint_data = [keypoint_data_a, keypoint_data_b]
 
-        camera_intrinsics_a = dataset.get_camera_intrinsics(scene_name_a)
-        camera_intrinsics_b = dataset.get_camera_intrinsics(scene_name_b)
-        if not np.allclose(camera_intrinsics_a.K, camera_intrinsics_b.K):
-            print "Currently cannot handle two different camera K matrices in different scenes!"
-            print "But you could add this..."
-        camera_intrinsics_matrix = camera_intrinsics_a.K
-
-        image_height, image_width = dcn.image_shape
-        DCE = DenseCorrespondenceEvaluation
-        dataframe_list = []
-
-        ordering = ["standard", "reverse"]
+        ordering = [(0, 1), (1, 0)]
 
         for kp_name, data_a in keypoint_data_a['keypoints'].iteritems():
             if kp_name not in keypoint_data_b['keypoints']:
@@ -1509,47 +1633,23 @@ class DenseCorrespondenceEvaluation(object):
 
             data = [data_a, data_b]
 
-            for order in ordering:
-                if order == "standard":
-                    idx_1 = 0
-                    idx_2 = 1
-                elif order == "reverse":
-                    idx_1 = 1
-                    idx_2 = 0
-                else:
-                    raise ValueError("you should never get here")
-
-
-                uv_1 = DCE.clip_pixel_to_image_size_and_round((data[idx_1]['u'], data[idx_2]['v']), image_width, image_height)
+            for idx_1, idx_2 in ordering:
+                uv_1 = DCE.clip_pixel_to_image_size_and_round((data[idx_1]['u'], data[idx_1]['v']), image_width,
+                                                              image_height)
                 uv_2 = DCE.clip_pixel_to_image_size_and_round((data[idx_2]['u'], data[idx_2]['v']), image_width,
                                                               image_height)
 
-                pd_template = DenseCorrespondenceEvaluation.compute_descriptor_match_statistics(depth[idx_1],
-                                                                                                depth[idx_2],
-                                                                                                mask[idx_1],
-                                                                                                mask[idx_2],
-                                                                                                uv_1,
-                                                                                                uv_2,
-                                                                                                pose[idx_1],
-                                                                                                pose[idx_2],
-                                                                                                res[idx_1],
-                                                                                                res[idx_2],
-                                                                                                camera_intrinsics_matrix,
-                                                                                                rgb_a=rgb[idx_1], rgb_b=rgb[idx_2],
-                                                                                                debug=False)
-
-                pd_template.set_value('img_a_idx', img_idx[idx_1])
-                pd_template.set_value('img_b_idx', img_idx[idx_2])
-                pd_template.set_value('scene_name_a', scene_name[idx_1])
-                pd_template.set_value('scene_name_b', scene_name[idx_2])
-                pd_template.set_value('object_id_a', object_id[idx_1])
-                pd_template.set_value('object_id_b', object_id[idx_2])
-                pd_template.set_value('keypoint_name', kp_name)
-
-
-                dataframe_list.append(pd_template.dataframe)
-
-        return dataframe_list
+                columns = dict()
+                columns['img_a_idx'] = keypoint_data[idx_1]['image_idx']
+                columns['img_b_idx'] = keypoint_data[idx_2]['image_idx']
+                columns['scene_name_a'] = keypoint_data[idx_1]['scene_name']
+                columns['scene_name_b'] = keypoint_data[idx_2]['scene_name']
+                columns['object_id_a'] = keypoint_data[idx_1]['object_id']
+                columns['object_id_b'] = keypoint_data[idx_2]['object_id']
+                columns['keypoint_name'] = kp_name
+
+                plan.add_match((columns['scene_name_a'], columns['img_a_idx']), uv_1,
+                               (columns['scene_name_b'], columns['img_b_idx']), uv_2, columns)
 
     @staticmethod
     def compute_sift_keypoints(img, mask=None):
@@ -1583,7 +1683,8 @@ class DenseCorrespondenceEvaluation(object):
                                         cross_match_threshold=0.75,
                                         num_matches=10,
                                         visualize=True,
-                                        camera_intrinsics_matrix=None):
+                                        camera_intrinsics_matrix=None,
+                                        feature_store=None):
         """
         Computes SIFT features and does statistics
         :param dcn:
@@ -1598,26 +1699,48 @@ class DenseCorrespondenceEvaluation(object):
         :type img_b_idx:
         :param num_matches:
         :type num_matches:
+        :param feature_store: (optional) the SIFT features are read from it instead of being
+        computed for this pair. It must already hold both frames, see evaluate_sift_baseline()
+        :type feature_store: SiftFeatureStore
         :return:
         :rtype:
         """
 
         DCE = DenseCorrespondenceEvaluation
 
-        rgb_a, depth_a, mask_a, pose_a = dataset.get_rgbd_mask_pose(scene_name, img_a_idx)
-        rgb_a = np.array(rgb_a) # converts PIL image to rgb
-
-        rgb_b, depth_b, mask_b, pose_b = dataset.get_rgbd_mask_pose(scene_name, img_b_idx)
-        rgb_b = np.array(rgb_b) # converts PIL image to rgb
+        _, depth_a, mask_a, pose_a = dataset.get_rgbd_mask_pose(scene_name, img_a_idx)
+        _, depth_b, mask_b, pose_b = dataset.get_rgbd_mask_pose(scene_name, img_b_idx)
+        depth_a = np.asarray(depth_a)
+        depth_b = np.asarray(depth_b)
 
-        kp1, des1, gray1, img_1_kp = DCE.compute_sift_keypoints(rgb_a, mask_a)
-        kp2, des2, gray2, img_2_kp = DCE.compute_sift_keypoints(rgb_b, mask_b)
+        if feature_store is not None:
+            keypoints_a, des1 = feature_store.get_features(scene_name, img_a_idx)
+            keypoints_b, des2 = feature_store.get_features(scene_name, img_b_idx)
+        else:
+            keypoints_a, des1 = compute_sift_features(np.array(dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_a_idx)),
+                                                      mask_a)
+            keypoints_b, des2 = compute_sift_features(np.array(dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_b_idx)),
+                                                      mask_b)
 
+        kp1 = keypoints_to_cv2(keypoints_a)
+        kp2 = keypoints_to_cv2(keypoints_b)
 
-        img1 = gray1
-        img2 = gray2
+        # compute matches, with the ratio test
+        # m is the best match, n is the second best match, m.distance < 0.75 * n.distance
+        idx_a, idx_b, distances = match_features(des1, des2, ratio=cross_match_threshold)
+        good = [[cv2.DMatch(int(i), int(j), float(d))] for i, j, d in zip(idx_a, idx_b, distances)]
 
         if visualize:
+            rgb_a = np.array(dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_a_idx))
+            rgb_b = np.array(dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_b_idx))
+            img1 = cv2.cvtColor(rgb_a, cv2.COLOR_BGR2GRAY)
+            img2 = cv2.cvtColor(rgb_b, cv2.COLOR_BGR2GRAY)
+
+            img_1_kp = 0 * rgb_a
+            img_2_kp = 0 * rgb_b
+            cv2.drawKeypoints(img1, kp1, img_1_kp)
+            cv2.drawKeypoints(img2, kp2, img_2_kp)
+
             fig, axes = plt.subplots(nrows=1, ncols=2)
             fig.set_figheight(10)
             fig.set_figwidth(15)
@@ -1626,25 +1749,7 @@ class DenseCorrespondenceEvaluation(object):
             plt.title("SIFT Keypoints")
             plt.show()
 
-        # compute matches
-        # Match descriptors.
-        # BFMatcher with default params
-        bf = cv2.BFMatcher()
-        matches = bf.knnMatch(des1, des2, k=2)  # Sort them in the order of their distance.
-        total_num_matches = len(matches)
-
-        # Apply ratio test
-        good = []
-        for m, n in matches:
-            # m is the best match
-            # n is the second best match
-
-            if m.distance < 0.75 * n.distance:
-                good.append([m])
-
-
-        if visualize:
-            good_vis = random.sample(good, 5)
+            good_vis = random.sample(good, min(5, len(good)))
             outImg = 0 * img1 # placeholder
             fig, axes = plt.subplots(nrows=1, ncols=1)
             fig.set_figheight(10)
@@ -1659,31 +1764,56 @@ class DenseCorrespondenceEvaluation(object):
             camera_intrinsics = dataset.get_camera_intrinsics(scene_name)
             camera_intrinsics_matrix = camera_intrinsics.K
 
-        dataframe_list = []
-
-        for idx, val in enumerate(good):
-            match = val[0]
-            kp_a = kp1[match.queryIdx]
-            kp_b = kp2[match.trainIdx]
-            df = DCE.compute_single_sift_match_statistics(depth_a, depth_b, kp_a, kp_b,
-                                                     pose_a, pose_b, camera_intrinsics_matrix)
-
-            dataframe_list.append(df)
-
+        columns = sift_match_statistics(keypoints_a[idx_a, :2], keypoints_b[idx_b, :2], depth_a, depth_b,
+                                        pose_a, pose_b, camera_intrinsics_matrix)
+        columns['scene_name'] = [scene_name] * len(idx_a)
+        columns['img_a_idx'] = np.full(len(idx_a), img_a_idx)
+        columns['img_b_idx'] = np.full(len(idx_a), img_b_idx)
 
+        results = ResultTable(SIFTKeypointMatchPandaTemplate.schema())
+        results.append(columns)
 
         returnData = dict()
         returnData['kp1'] = kp1
         returnData['kp2'] = kp2
-        returnData['matches'] = matches
+        returnData['des1'] = des1
+        returnData['des2'] = des2
+        returnData['total_num_matches'] = len(kp1)
         returnData['good'] = good
-        returnData['dataframe_list'] = dataframe_list
+        returnData['results'] = results
 
         return returnData
 
+    @staticmethod
+    def evaluate_sift_baseline(dataset, feature_store, image_pairs, cross_match_threshold=0.75, num_workers=None):
+        """
+        SIFT baseline on a list of image pairs. The store is filled for every scene of the
+        pairs first, with a process pool per scene, then the pairs only read from it
+
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param feature_store:
+        :type feature_store: SiftFeatureStore
+        :param image_pairs: list of (scene_name, img_a_idx, img_b_idx)
+        :type image_pairs: list of tuple
+        :param num_workers: processes per scene, see extract_scene_features()
+        :type num_workers: int
+        :return: a row per SIFT match
+        :rtype: ResultTable
+        """
+        DCE = DenseCorrespondenceEvaluation
 
+        for scene_name in sorted(set(pair[0] for pair in image_pairs)):
+            extract_scene_features(dataset, feature_store, scene_name, num_workers=num_workers)
 
+        results = ResultTable(SIFTKeypointMatchPandaTemplate.schema())
+        for scene_name, img_a_idx, img_b_idx in image_pairs:
+            sift_data = DCE.single_image_pair_sift_analysis(dataset, scene_name, img_a_idx, img_b_idx,
+                                                            cross_match_threshold=cross_match_threshold,
+                                                            visualize=False, feature_store=feature_store)
+            results.extend(sift_data['results'])
 
+        return results
 
     @staticmethod
     def compute_single_sift_match_statistics(depth_a, depth_b, kp_a, kp_b, pose_a, pose_b,
@@ -1841,10 +1971,11 @@ class DenseCorrespondenceEvaluation(object):
 
 
     @staticmethod
-    def parse_cross_scene_data(dataset):
+    def get_cross_scene_data_paths(dataset):
         """
-        This takes a dataset.config, and concatenates together
-        a list of all of the cross scene data annotated pairs.
+        The "evaluation_labeled_data_path" entries of the dataset.config
+        :return: list of paths, relative to the data dir
+        :rtype: list
         """
         evaluation_labeled_data_paths = []
 
@@ -1858,6 +1989,16 @@ class DenseCorrespondenceEvaluation(object):
             if "evaluation_labeled_data_path" in val:
                 evaluation_labeled_data_paths += val["evaluation_labeled_data_path"]
 
+        return evaluation_labeled_data_paths
+
+    @staticmethod
+    def parse_cross_scene_data(dataset):
+        """
+        This takes a dataset.config, and concatenates together
+        a list of all of the cross scene data annotated pairs.
+        """
+        evaluation_labeled_data_paths = DenseCorrespondenceEvaluation.get_cross_scene_data_paths(dataset)
+
         if len(evaluation_labeled_data_paths) == 0:
             print "Could not find labeled cross scene data for this dataset."
             print "It needs to be set in the dataset.yaml of the folder from which"
@@ -2069,6 +2210,129 @@ class DenseCorrespondenceEvaluation(object):
                                                                                  img_pair[1])
 
 
+    @staticmethod
+    def check_mixed_precision_regression(dcn, dataset, num_image_pairs=25, num_matches_per_image_pair=100,
+                                         channels_last=False, ks_tolerance=0.05, median_tolerance=None):
+        """
+        Checks that running the network in mixed precision doesn't change the
+        pixel_match_error_l2 and fraction_pixels_closer_than_ground_truth distributions.
+
+        Runs evaluate_network once in float32 and once in mixed precision. evaluate_network
+        resets the random seed so both runs use the same image pairs and matches. The
+        distributions are compared with a two sample Kolmogorov-Smirnov test and by
+        their medians.
+
+        Raises a ValueError if this version of pytorch can't run the network in mixed
+        precision (or channels last, if requested) on its device, since both runs would
+        be float32 and the check wouldn't test anything.
+
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param ks_tolerance: max allowed KS statistic
+        :type ks_tolerance: float
+        :param median_tolerance: dict of field --> max allowed absolute difference of the medians
+        :type median_tolerance: dict
+        :return: passed, stats
+        :rtype: bool, dict
+        """
+        DCE = DenseCorrespondenceEvaluation
+
+        cuda = (dcn.device.type == "cuda")
+        if not mixed_precision_utils.autocast_available(cuda=cuda):
+            raise ValueError("mixed precision is not available on the %s in torch %s, nothing to check"
+                             %("GPU" if cuda else "CPU", torch.__version__))
+
+        if channels_last and not mixed_precision_utils.channels_last_available():
+            raise ValueError("channels last is not available in torch %s, nothing to check" %(torch.__version__))
+
+        if median_tolerance is None:
+            median_tolerance = {'pixel_match_error_l2': 2.0,
+                                'fraction_pixels_closer_than_ground_truth': 0.01}
+
+        previous_mixed_precision = dcn.mixed_precision
+        previous_channels_last = dcn.channels_last
+
+        dcn.set_precision(mixed_precision=False, channels_last=False)
+        _, df_fp32 = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
+                                          num_matches_per_image_pair=num_matches_per_image_pair)
+
+        dcn.set_precision(mixed_precision=True, channels_last=channels_last)
+        _, df_mixed = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
+                                           num_matches_per_image_pair=num_matches_per_image_pair)
+
+        dcn.set_precision(mixed_precision=previous_mixed_precision, channels_last=previous_channels_last)
+
+        passed = True
+        stats = dict()
+        for field, tolerance in median_tolerance.iteritems():
+            data_fp32 = df_fp32[field].dropna()
+            data_mixed = df_mixed[field].dropna()
+
+            ks_statistic, p_value = ss.ks_2samp(data_fp32, data_mixed)
+            median_diff = abs(np.median(data_fp32) - np.median(data_mixed))
+            field_passed = (ks_statistic <= ks_tolerance) and (median_diff <= tolerance)
+
+            stats[field] = {'ks_statistic': float(ks_statistic),
+                            'p_value': float(p_value),
+                            'median_float32': float(np.median(data_fp32)),
+                            'median_mixed_precision': float(np.median(data_mixed)),
+                            'passed': bool(field_passed)}
+
+            if not field_passed:
+                logging.warning("mixed precision regression on %s: KS statistic %.4f, median diff %.4f"
+                                %(field, ks_statistic, median_diff))
+            passed = passed and field_passed
+
+        return passed, stats
+
+    @staticmethod
+    def compare_quantized_network(dcn_float, dcn_quantized, dataset, num_image_pairs=25,
+                                  num_matches_per_image_pair=100,
+                                  fields=('pixel_match_error_l2', 'fraction_pixels_closer_than_ground_truth',
+                                          'norm_diff_pred_3d')):
+        """
+        Compares the evaluate_network metrics of an int8 quantized network with
+        those of the float32 network it was made from.
+
+        evaluate_network resets the random seed so both networks are evaluated on the
+        same image pairs and matches.
+
+        :param dcn_float:
+        :type dcn_float: DenseCorrespondenceNetwork
+        :param dcn_quantized: see DenseCorrespondenceNetwork.from_model_folder(quantized=True)
+        :type dcn_quantized: DenseCorrespondenceNetwork
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param fields: columns of the evaluate_network dataframe to compare
+        :type fields: tuple of str
+        :return: dict of field --> stats
+        :rtype: dict
+        """
+        DCE = DenseCorrespondenceEvaluation
+
+        _, df_float = DCE.evaluate_network(dcn_float, dataset, num_image_pairs=num_image_pairs,
+                                           num_matches_per_image_pair=num_matches_per_image_pair)
+
+        _, df_quantized = DCE.evaluate_network(dcn_quantized, dataset, num_image_pairs=num_image_pairs,
+                                               num_matches_per_image_pair=num_matches_per_image_pair)
+
+        stats = dict()
+        for field in fields:
+            data_float = df_float[field].dropna()
+            data_quantized = df_quantized[field].dropna()
+
+            ks_statistic, p_value = ss.ks_2samp(data_float, data_quantized)
+            stats[field] = {'ks_statistic': float(ks_statistic),
+                            'p_value': float(p_value),
+                            'mean_float32': float(np.mean(data_float)),
+                            'mean_int8': float(np.mean(data_quantized)),
+                            'median_float32': float(np.median(data_float)),
+                            'median_int8': float(np.median(data_quantized))}
+
+        return stats
+
     @staticmethod
     def compute_loss_on_dataset(dcn, data_loader, loss_config, num_iterations=500,):
         """
@@ -2077,11 +2341,12 @@ class DenseCorrespondenceEvaluation(object):
 
         :param dcn:
         :type dcn:
-        :param data_loader:
+        :param data_loader: DataLoader wrapping a SpartanDataset
         :type data_loader:
         :param num_iterations:
         :type num_iterations:
-        :return:
+        :return: loss, match_loss, non_match_loss averaged over the samples. non_match_loss
+        is the sum of the masked, background and blind non match losses
         :rtype:
         """
         dcn.eval()
@@ -2093,52 +2358,62 @@ class DenseCorrespondenceEvaluation(object):
         counter = 0
         pixelwise_contrastive_loss = PixelwiseContrastiveLoss(dcn.image_shape, config=loss_config)
 
-        batch_size = 1
+        batch_size = data_loader.batch_size
 
         for i, data in enumerate(data_loader, 0):
 
             # get the inputs
-            data_type, img_a, img_b, matches_a, matches_b, non_matches_a, non_matches_b, metadata = data
-            data_type = data_type[0]
-
-            if len(matches_a[0]) == 0:
-                print "didn't have any matches, continuing"
+            match_type, \
+            img_a, img_b, \
+            matches_a, matches_b, \
+            masked_non_matches_a, masked_non_matches_b, \
+            background_non_matches_a, background_non_matches_b, \
+            blind_non_matches_a, blind_non_matches_b, \
+            metadata = data
+
+            if (match_type == -1).all():
+                print "empty data, continuing"
                 continue
 
             img_a = Variable(img_a.cuda(), requires_grad=False)
             img_b = Variable(img_b.cuda(), requires_grad=False)
 
-            if data_type == "matches":
-                matches_a = Variable(matches_a.cuda().squeeze(0), requires_grad=False)
-                matches_b = Variable(matches_b.cuda().squeeze(0), requires_grad=False)
-                non_matches_a = Variable(non_matches_a.cuda().squeeze(0), requires_grad=False)
-                non_matches_b = Variable(non_matches_b.cuda().squeeze(0), requires_grad=False)
+            matches_a = Variable(matches_a.cuda().squeeze(0), requires_grad=False)
+            matches_b = Variable(matches_b.cuda().squeeze(0), requires_grad=False)
+            masked_non_matches_a = Variable(masked_non_matches_a.cuda().squeeze(0), requires_grad=False)
+            masked_non_matches_b = Variable(masked_non_matches_b.cuda().squeeze(0), requires_grad=False)
 
-            # run both images through the network
-            image_a_pred = dcn.forward(img_a)
-            image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
+            background_non_matches_a = Variable(background_non_matches_a.cuda().squeeze(0), requires_grad=False)
+            background_non_matches_b = Variable(background_non_matches_b.cuda().squeeze(0), requires_grad=False)
 
-            image_b_pred = dcn.forward(img_b)
-            image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
+            blind_non_matches_a = Variable(blind_non_matches_a.cuda().squeeze(0), requires_grad=False)
+            blind_non_matches_b = Variable(blind_non_matches_b.cuda().squeeze(0), requires_grad=False)
 
-            # get loss
-            if data_type == "matches":
-                loss, match_loss, non_match_loss = \
-                    pixelwise_contrastive_loss.get_loss(image_a_pred,
-                                                        image_b_pred,
-                                                        matches_a,
-                                                        matches_b,
-                                                        non_matches_a,
-                                                        non_matches_b)
+            with torch.no_grad():
+                # run both images through the network
+                image_a_pred = dcn.forward(img_a)
+                image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
 
+                image_b_pred = dcn.forward(img_b)
+                image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
 
+                # get loss
+                loss, match_loss, masked_non_match_loss, \
+                background_non_match_loss, blind_non_match_loss = loss_composer.get_loss(pixelwise_contrastive_loss, match_type,
+                                                                                image_a_pred, image_b_pred,
+                                                                                matches_a,     matches_b,
+                                                                                masked_non_matches_a, masked_non_matches_b,
+                                                                                background_non_matches_a, background_non_matches_b,
+                                                                                blind_non_matches_a, blind_non_matches_b)
 
-                loss_vec.append(loss.data[0])
-                non_match_loss_vec.append(non_match_loss.data[0])
-                match_loss_vec.append(match_loss.data[0])
+                non_match_loss = masked_non_match_loss + background_non_match_loss + blind_non_match_loss
 
+            loss_vec.append(loss.item())
+            non_match_loss_vec.append(non_match_loss.item())
+            match_loss_vec.append(match_loss.item())
 
-            if i > num_iterations:
+            counter += 1
+            if counter >= num_iterations:
                 break
 
         loss_vec = np.array(loss_vec)
@@ -2155,15 +2430,19 @@ class DenseCorrespondenceEvaluation(object):
 
     @staticmethod
     def compute_descriptor_statistics_on_dataset(dcn, dataset, num_images=100,
-                                                 save_to_file=True, filename=None):
+                                                 save_to_file=True, filename=None, **kwargs):
         """
-        Computes the statistics of the descriptors on the dataset
+        Computes the statistics of the descriptors on the dataset, see
+        descriptor_statistics.compute_descriptor_statistics()
         :param dcn:
         :type dcn:
         :param dataset:
         :type dataset:
+        :param num_images: number of images, stratified by scene. None for all images
+        :type num_images: int
         :param save_to_file:
         :type save_to_file:
+        :param kwargs: passed to compute_descriptor_statistics(), e.g. num_workers, checkpoint_file
         :return:
         :rtype:
         """
@@ -2171,125 +2450,8 @@ class DenseCorrespondenceEvaluation(object):
         utils.reset_random_seed()
 
         dcn.eval()
-        to_tensor = transforms.ToTensor()
-
-        # compute the per-channel mean
-        def compute_descriptor_statistics(res, mask_tensor):
-            """
-            Computes
-            :param res: The output of the DCN
-            :type res: torch.FloatTensor with shape [H,W,D]
-            :return: min, max, mean
-            :rtype: each is torch.FloatTensor of shape [D]
-            """
-            # convert to [W*H, D]
-            D = res.shape[2]
-
-            # convert to torch.FloatTensor instead of variable
-            if isinstance(res, torch.autograd.Variable):
-                res = res.data
-
-            res_reshape = res.contiguous().view(-1,D)
-            channel_mean = res_reshape.mean(0) # shape [D]
-            channel_min, _ = res_reshape.min(0) # shape [D]
-            channel_max, _ = res_reshape.max(0) # shape [D]
-
-            
-            mask_flat = mask_tensor.view(-1,1).squeeze(1)
-
-            # now do the same for the masked image
-            # gracefully handle the case where the mask is all zeros
-            mask_indices_flat = torch.nonzero(mask_flat)
-            if len(mask_indices_flat) == 0:
-                return None, None     
-
-            mask_indices_flat = mask_indices_flat.squeeze(1)
-            
-                
-            # print "mask_flat.shape", mask_flat.shape
-
-            res_masked_flat = res_reshape.index_select(0, mask_indices_flat) # shape [mask_size, D]
-            mask_channel_mean = res_masked_flat.mean(0)
-            mask_channel_min, _ = res_masked_flat.min(0)
-            mask_channel_max, _ = res_masked_flat.max(0)
-
-
-            entire_image_stats = (channel_min, channel_max, channel_mean)
-            mask_image_stats = (mask_channel_min, mask_channel_max, mask_channel_mean)
-            return entire_image_stats, mask_image_stats
-
-        def compute_descriptor_std_dev(res, channel_mean):
-            """
-            Computes the std deviation of a descriptor image, given a channel mean
-            :param res:
-            :type res:
-            :param channel_mean:
-            :type channel_mean:
-            :return:
-            :rtype:
-            """
-            D = res.shape[2]
-            res_reshape = res.view(-1, D) # shape [W*H,D]
-            v = res - channel_mean
-            std_dev = torch.std(v, 0) # shape [D]
-            return std_dev
-
-        def update_stats(stats_dict, single_img_stats):
-            """
-            Update the running mean, min and max
-            :param stats_dict:
-            :type stats_dict:
-            :param single_img_stats:
-            :type single_img_stats:
-            :return:
-            :rtype:
-            """
-
-            min_temp, max_temp, mean_temp = single_img_stats
-
-            if stats_dict['min'] is None:
-                stats_dict['min'] = min_temp
-            else:
-                stats_dict['min'] = torch.min(stats_dict['min'], min_temp)
-
-            if stats_dict['max'] is None:
-                stats_dict['max'] = max_temp
-            else:
-                stats_dict['max'] = torch.max(stats_dict['max'], max_temp)
-
-            if stats_dict['mean'] is None:
-                stats_dict['mean'] = mean_temp
-            else:
-                stats_dict['mean'] += mean_temp
-
-
-        stats = dict()
-        stats['entire_image'] = {'mean': None, 'max': None, 'min': None}
-        stats['mask_image'] = {'mean': None, 'max': None, 'min': None}
 
-        for i in xrange(0,num_images):
-            rgb, depth, mask, _ = dataset.get_random_rgbd_mask_pose()
-            img_tensor = dataset.rgb_image_to_tensor(rgb)
-            res = dcn.forward_single_image_tensor(img_tensor)  # [H, W, D]
-
-            mask_tensor = to_tensor(mask).cuda()
-            entire_image_stats, mask_image_stats = compute_descriptor_statistics(res, mask_tensor)
-
-
-            # handles the case of an empty mask
-            if mask_image_stats is None:
-                logging.info("Mask was empty, skipping")
-                continue
-
-
-            update_stats(stats['entire_image'], entire_image_stats)
-            update_stats(stats['mask_image'], mask_image_stats)
-
-
-        for key, val in stats.iteritems():
-            val['mean'] = 1.0/num_images * val['mean']
-            for field in val:
-                val[field] = val[field].tolist()
+        stats = compute_descriptor_statistics(dcn, dataset, num_images=num_images, **kwargs).to_dict()
 
         if save_to_file:
             if filename is None:
@@ -2311,7 +2473,10 @@ class DenseCorrespondenceEvaluation(object):
                                   compute_descriptor_statistics=True, 
                                   cross_scene=True,
                                   dataset=None,
-                                  iteration=None):
+                                  iteration=None,
+                                  seed=0,
+                                  store_dir=None,
+                                  recompute=False):
         """
         Runs all the quantitative evaluations on the model folder
         Creates a folder model_folder/analysis that stores the information.
@@ -2322,12 +2487,59 @@ class DenseCorrespondenceEvaluation(object):
         2. compute quantitative eval csv files
         3. make quantitative plots, save as a png for easy viewing
 
+        The results are cached, only the steps that aren't in the store are computed,
+        see run_evaluation_on_network_checkpoints()
 
         :param model_folder:
         :type model_folder:
         :return:
         :rtype:
         """
+        DenseCorrespondenceEvaluation.run_evaluation_on_network_checkpoints(model_folder, iterations=[iteration],
+            num_image_pairs=num_image_pairs, num_matches_per_image_pair=num_matches_per_image_pair,
+            save_folder_name=save_folder_name, compute_descriptor_statistics=compute_descriptor_statistics,
+            cross_scene=cross_scene, dataset=dataset, seed=seed, store_dir=store_dir, recompute=recompute)
+
+    @staticmethod
+    def run_evaluation_on_network_checkpoints(model_folder, iterations=None, num_image_pairs=100,
+                                              num_matches_per_image_pair=100,
+                                              save_folder_name="analysis",
+                                              compute_descriptor_statistics=True,
+                                              cross_scene=True,
+                                              dataset=None,
+                                              seed=0,
+                                              store_dir=None,
+                                              recompute=False,
+                                              max_networks_in_memory=4):
+        """
+        Runs the evaluations of run_evaluation_on_network() on several checkpoints of a model
+        in one job. The checkpoints are evaluated in groups of max_networks_in_memory, the
+        train and test evaluations load the images and find the matches once per group.
+
+        Every result is kept in an EvaluationStore, keyed by the model identifier, checkpoint
+        iteration, kind of evaluation, seed and a hash of the evaluation config. Results that
+        are in the store aren't computed again, so re-running only makes the plots, and an
+        interrupted run resumes where it stopped.
+
+        With a single checkpoint the outputs go to model_folder/save_folder_name, like
+        run_evaluation_on_network(), with several to a subfolder per iteration.
+
+        :param model_folder:
+        :type model_folder: str
+        :param iterations: checkpoint iterations, None stands for the latest one
+        :type iterations: list
+        :param seed: sampling seed of the image pairs, also seeds the descriptor statistics and
+            the cross scene and across object evaluations
+        :type seed: int
+        :param store_dir: defaults to model_folder/save_folder_name/evaluation_store
+        :type store_dir: str
+        :param recompute: ignore and overwrite the results in the store
+        :type recompute: bool
+        :param max_networks_in_memory: number of checkpoints that are loaded at the same time
+        :type max_networks_in_memory: int
+        :return:
+        :rtype:
+        """
 
         utils.reset_random_seed()
 
@@ -2335,76 +2547,172 @@ class DenseCorrespondenceEvaluation(object):
 
         model_folder = utils.convert_data_relative_path_to_absolute_path(model_folder, assert_path_exists=True)
 
-        # save it to a csv file
-        output_dir = os.path.join(model_folder, save_folder_name)
-        train_output_dir = os.path.join(output_dir, "train")
-        test_output_dir = os.path.join(output_dir, "test")
-        cross_scene_output_dir = os.path.join(output_dir, "cross_scene")
+        if iterations is None:
+            iterations = [None]
+        iterations = [utils.get_model_param_file_from_directory(model_folder, iteration=iteration)[2]
+                      for iteration in iterations]
 
-        # create the necessary directories
-        for dir in [output_dir, train_output_dir, test_output_dir, cross_scene_output_dir]:
-            if not os.path.isdir(dir):
-                os.makedirs(dir)
+        analysis_dir = os.path.join(model_folder, save_folder_name)
+        if store_dir is None:
+            store_dir = os.path.join(analysis_dir, "evaluation_store")
+        store = EvaluationStore(store_dir)
+        model_identifier = get_model_identifier(model_folder)
 
+        if dataset is None:
+            dataset_config = utils.getDictFromYamlFilename(os.path.join(model_folder, 'dataset.yaml'))
+            dataset = SpartanDataset(config_expanded=dataset_config)
 
-        dcn = DenseCorrespondenceNetwork.from_model_folder(model_folder, iteration=iteration)
-        dcn.eval()
+        # kind --> iteration --> key
+        keys = dict()
 
-        if dataset is None:
-            dataset = dcn.load_training_dataset()
+        def add_keys(kind, spec):
+            keys[kind] = dict()
+            for iteration in iterations:
+                key = make_key(model_identifier, iteration, kind, seed, spec)
+                if recompute:
+                    store.clear(key)
+                keys[kind][iteration] = key
 
-        # compute dataset statistics
         if compute_descriptor_statistics:
-            logging.info("Computing descriptor statistics on dataset")
-            DCE.compute_descriptor_statistics_on_dataset(dcn, dataset, num_images=100, save_to_file=True)
+            add_keys("descriptor_statistics", {'dataset': dataset.config, 'num_images': 100})
 
+        # the pairs are drawn from utils.RandomStreams, not from the global state like
+        # in stores written before, so those aren't resumed
+        spec = {'dataset': dataset.config, 'num_image_pairs': num_image_pairs,
+                'num_matches_per_image_pair': num_matches_per_image_pair, 'pair_sampling': 'random_streams'}
+        add_keys("train", spec)
+        add_keys("test", spec)
 
-        # evaluate on training data and on test data
-        logging.info("Evaluating network on train data")
-        dataset.set_train_mode()
-        pd_dataframe_list, df = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
-                                                     num_matches_per_image_pair=num_matches_per_image_pair)
+        if cross_scene:
+            labeled_data_files = [utils.convert_data_relative_path_to_absolute_path(path, assert_path_exists=True)
+                                  for path in DCE.get_cross_scene_data_paths(dataset)]
+            add_keys("cross_scene", {'dataset': dataset.config, 'labeled_data_files': labeled_data_files})
 
-        train_csv = os.path.join(train_output_dir, "data.csv")
-        df.to_csv(train_csv)
+        # only do across object analysis if have multiple single objects
+        across_object = dataset.get_number_of_unique_single_objects() > 1
+        if across_object:
+            add_keys("across_object", {'dataset': dataset.config, 'num_image_pairs': 25})
+
+        def evaluate_cached(kind, dcns, evaluate):
+            for iteration, dcn in dcns.iteritems():
+                key = keys[kind][iteration]
+                if not store.is_complete(key):
+                    logging.info("Evaluating network on %s data, iteration %d" %(kind, iteration))
+                    store.write_dataframe(key, evaluate(dcn))
+                    store.mark_complete(key)
+
+        # only the checkpoints with missing results are loaded, at most max_networks_in_memory
+        # at a time. The train and test image pairs are loaded once per group
+        missing_iterations = [iteration for iteration in iterations
+                              if not all(store.is_complete(keys[kind][iteration]) for kind in keys)]
+        for group_start in xrange(0, len(missing_iterations), max_networks_in_memory):
+            dcns = dict()
+            for iteration in missing_iterations[group_start:group_start + max_networks_in_memory]:
+                dcns[iteration] = DenseCorrespondenceNetwork.from_model_folder(model_folder, iteration=iteration)
+                dcns[iteration].eval()
+
+            # compute dataset statistics
+            if compute_descriptor_statistics:
+                for iteration, dcn in dcns.iteritems():
+                    key = keys["descriptor_statistics"][iteration]
+                    if not store.is_complete(key):
+                        logging.info("Computing descriptor statistics on dataset, iteration %d" %(iteration))
+                        stats = DCE.compute_descriptor_statistics_on_dataset(dcn, dataset, num_images=100,
+                            save_to_file=False, checkpoint_file=store.get_filename(key, "checkpoint.npz"), seed=seed)
+                        store.write_yaml(key, stats)
+                        store.mark_complete(key)
+
+            # evaluate on training data and on test data
+            logging.info("Evaluating network on train data")
+            dataset.set_train_mode()
+            DCE.evaluate_network_checkpoints(dcns, dataset, store, keys["train"], num_image_pairs=num_image_pairs,
+                                             num_matches_per_image_pair=num_matches_per_image_pair, seed=seed)
 
-        logging.info("Evaluating network on test data")
-        dataset.set_test_mode()
-        pd_dataframe_list, df = DCE.evaluate_network(dcn, dataset, num_image_pairs=num_image_pairs,
-                                                     num_matches_per_image_pair=num_matches_per_image_pair)
+            logging.info("Evaluating network on test data")
+            dataset.set_test_mode()
+            DCE.evaluate_network_checkpoints(dcns, dataset, store, keys["test"], num_image_pairs=num_image_pairs,
+                                             num_matches_per_image_pair=num_matches_per_image_pair, seed=seed)
+
+            if cross_scene:
+                evaluate_cached("cross_scene", dcns,
+                    lambda dcn: DCE.evaluate_network_cross_scene(dcn=dcn, dataset=dataset, save=False, seed=seed))
 
-        test_csv = os.path.join(test_output_dir, "data.csv")
-        df.to_csv(test_csv)
+            if across_object:
+                evaluate_cached("across_object", dcns,
+                    lambda dcn: DCE.evaluate_network_across_objects(dcn=dcn, dataset=dataset, num_image_pairs=25,
+                                                                    seed=seed))
 
+            # free the networks before loading the next group
+            del dcns
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
+        if compute_descriptor_statistics:
+            # the model folder holds the statistics of the latest checkpoint
+            stats = store.read_yaml(keys["descriptor_statistics"][max(iterations)])
+            utils.saveToYaml(stats, os.path.join(model_folder, 'descriptor_statistics.yaml'))
+
+        def read_dataframes(kind):
+            return {iteration: store.read_dataframe(keys[kind][iteration]) for iteration in iterations}
+
+        train_dfs = read_dataframes("train")
+        test_dfs = read_dataframes("test")
         if cross_scene:
-            logging.info("Evaluating network on cross scene data")
-            df = DCE.evaluate_network_cross_scene(dcn=dcn, dataset=dataset, save=False)
-            cross_scene_csv = os.path.join(cross_scene_output_dir, "data.csv")
-            df.to_csv(cross_scene_csv)
+            cross_scene_dfs = read_dataframes("cross_scene")
+        if across_object:
+            across_object_dfs = read_dataframes("across_object")
+
 
         logging.info("Making plots")
         DCEP = DenseCorrespondenceEvaluationPlotter
-        fig_axes = DCEP.run_on_single_dataframe(train_csv, label="train", save=False)
-        fig_axes = DCEP.run_on_single_dataframe(test_csv, label="test", save=False, previous_fig_axes=fig_axes)
-        if cross_scene:
-            fig_axes = DCEP.run_on_single_dataframe(cross_scene_csv, label="cross_scene", save=False,
-                                                    previous_fig_axes=fig_axes)
+        for iteration in iterations:
+            if len(iterations) == 1:
+                output_dir = analysis_dir
+            else:
+                output_dir = os.path.join(analysis_dir, utils.getPaddedString(iteration, width=6))
 
-        fig, _ = fig_axes        
-        save_fig_file = os.path.join(output_dir, "quant_plots.png")
-        fig.savefig(save_fig_file)
+            # save it to a csv file
+            train_output_dir = os.path.join(output_dir, "train")
+            test_output_dir = os.path.join(output_dir, "test")
+            cross_scene_output_dir = os.path.join(output_dir, "cross_scene")
 
-        # only do across object analysis if have multiple single objects
-        if dataset.get_number_of_unique_single_objects() > 1:
-            across_object_output_dir = os.path.join(output_dir, "across_object")
-            if not os.path.isdir(across_object_output_dir):
-                os.makedirs(across_object_output_dir)
-            logging.info("Evaluating network on across object data")
-            df = DCE.evaluate_network_across_objects(dcn=dcn, dataset=dataset)
-            across_object_csv = os.path.join(across_object_output_dir, "data.csv")
-            df.to_csv(across_object_csv)
-            DCEP.run_on_single_dataframe_across_objects(across_object_csv, label="across_object", save=True)
+            # create the necessary directories
+            for dir in [output_dir, train_output_dir, test_output_dir, cross_scene_output_dir]:
+                if not os.path.isdir(dir):
+                    os.makedirs(dir)
+
+            train_csv = os.path.join(train_output_dir, "data.csv")
+            train_dfs[iteration].to_csv(train_csv)
+            write_result_summary(train_dfs[iteration], train_csv)
+
+            test_csv = os.path.join(test_output_dir, "data.csv")
+            test_dfs[iteration].to_csv(test_csv)
+            write_result_summary(test_dfs[iteration], test_csv)
+
+            if cross_scene:
+                cross_scene_csv = os.path.join(cross_scene_output_dir, "data.csv")
+                cross_scene_dfs[iteration].to_csv(cross_scene_csv)
+                write_result_summary(cross_scene_dfs[iteration], cross_scene_csv)
+
+            fig_axes = DCEP.run_on_single_dataframe(train_csv, label="train", save=False)
+            fig_axes = DCEP.run_on_single_dataframe(test_csv, label="test", save=False, previous_fig_axes=fig_axes)
+            if cross_scene:
+                fig_axes = DCEP.run_on_single_dataframe(cross_scene_csv, label="cross_scene", save=False,
+                                                        previous_fig_axes=fig_axes)
+
+            fig, _ = fig_axes
+            save_fig_file = os.path.join(output_dir, "quant_plots.png")
+            fig.savefig(save_fig_file)
+            plt.close(fig)
+
+            if across_object:
+                across_object_output_dir = os.path.join(output_dir, "across_object")
+                if not os.path.isdir(across_object_output_dir):
+                    os.makedirs(across_object_output_dir)
+                across_object_csv = os.path.join(across_object_output_dir, "data.csv")
+                across_object_dfs[iteration].to_csv(across_object_csv)
+                write_result_summary(across_object_dfs[iteration], across_object_csv)
+                DCEP.run_on_single_dataframe_across_objects(across_object_csv, label="across_object", save=True)
 
 
         logging.info("Finished running evaluation on network")
@@ -2457,163 +2765,43 @@ class DenseCorrespondenceEvaluation(object):
 
             save_filename = os.path.join(output_dir, 'data.csv')
             df.to_csv(save_filename)
+            write_result_summary(df, save_filename)
 
         logging.info("Finished running cross scene keypoint evaluation")
         return df
 
 
     @staticmethod
-    def make_2d_cluster_plot(dcn, dataset, plot_background=False):
+    def make_2d_cluster_plot(dcn, dataset, plot_background=False, num_images_per_object=20,
+                             num_samples_per_image=100, method="pca"):
         """
         This function randomly samples many points off of different objects and the background,
         and makes an object-labeled scatter plot of where these descriptors are.
-        """
 
-        print "Checking to make sure this is a 2D or 3D descriptor"
-        print "If you'd like you could add projection methods for higher dimension descriptors"
-        assert ((dcn.descriptor_dimension == 2) or (dcn.descriptor_dimension == 3))
+        2D descriptors are plotted as they are, 3D descriptors in three plots: xy, yz, xz.
+        Higher dimensional descriptors are projected to 2D with method, see
+        descriptor_embedding.project_descriptors(). For point files and separability
+        metrics, see descriptor_embedding.run_embedding_analysis()
+        """
+        samples = sample_descriptors(dcn, dataset, num_images_per_object=num_images_per_object,
+                                     num_foreground_samples_per_image=num_samples_per_image, seed=19680801)
+        descriptors = samples['descriptors']
+        labels = samples['labels']
+        label_names = samples['label_names']
 
         if dcn.descriptor_dimension == 3:
-            use_3d = True
-            d = 3
             print "This descriptor_dimension is 3d"
             print "I'm going to make 3 plots for you: xy, yz, xz"
+            projections = [(np.arange(len(descriptors)), descriptors[:, dims]) for dims in [[0, 1], [1, 2], [0, 2]]]
         else:
-            use_3d = False
-            d = 2
-
-        # randomly grab object ID, and scene
-
-        # Fixing random state for reproducibility
-        np.random.seed(19680801)
-
-        descriptors_known_objects_samples = dict()
-        if use_3d:
-            descriptors_known_objects_samples_xy = dict()
-            descriptors_known_objects_samples_yz = dict()
-            descriptors_known_objects_samples_xz = dict()
-
-        descriptors_background_samples = np.zeros((0,d))
-
-        if use_3d:
-            descriptors_background_samples_xy = np.zeros((0,2))
-            descriptors_background_samples_yz = np.zeros((0,2))
-            descriptors_background_samples_xz = np.zeros((0,2))
-
-        num_objects = dataset.get_number_of_unique_single_objects()
-        num_samples_per_image = 100
-
-        for i in range(100):
-            object_id, object_id_int = dataset.get_random_object_id_and_int()
-
-            scene_name = dataset.get_random_single_object_scene_name(object_id)
-            img_idx = dataset.get_random_image_index(scene_name)
-            rgb = dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_idx)
-            mask = dataset.get_mask_image_from_scene_name_and_idx(scene_name, img_idx)
-
-            mask_torch = torch.from_numpy(np.asarray(mask)).long()
-            mask_inv = 1 - mask_torch
-
-            object_uv_samples     = correspondence_finder.random_sample_from_masked_image_torch(mask_torch, num_samples_per_image)
-            background_uv_samples = correspondence_finder.random_sample_from_masked_image_torch(mask_inv, num_samples_per_image/num_objects)
-
-            object_u_samples = object_uv_samples[0].numpy()
-            object_v_samples = object_uv_samples[1].numpy()
-
-            background_u_samples = background_uv_samples[0].numpy()
-            background_v_samples = background_uv_samples[1].numpy()
-
-            # This snippet will plot where the samples are coming from in the image
-            # plt.scatter(object_u_samples, object_v_samples, c="g", alpha=0.5, label="object")
-            # plt.scatter(background_u_samples, background_v_samples, c="k", alpha=0.5, label="background")
-            # plt.legend()
-            # plt.show()
-
-            img_tensor = dataset.rgb_image_to_tensor(rgb)
-            res = dcn.forward_single_image_tensor(img_tensor)  # [H, W, D]
-            res = res.data.cpu().numpy()
-
-            descriptors_object = np.zeros((len(object_u_samples),d))
-            for j in range(len(object_u_samples)):
-                descriptors_object[j,:] = res[object_v_samples[j], object_u_samples[j], :]
-            if use_3d:
-                descriptors_object_xy = np.zeros((len(object_u_samples),2))
-                descriptors_object_yz = np.zeros((len(object_u_samples),2))
-                descriptors_object_xz = np.zeros((len(object_u_samples),2))
-                for j in range(len(object_u_samples)):
-                    descriptors_object_xy[j,:] = res[object_v_samples[j], object_u_samples[j], 0:2]
-                    descriptors_object_yz[j,:] = res[object_v_samples[j], object_u_samples[j], 1:3]
-                    descriptors_object_xz[j,:] = res[object_v_samples[j], object_u_samples[j], 0::2]
-
-            descriptors_background = np.zeros((len(background_u_samples),d))
-            for j in range(len(background_u_samples)):
-                descriptors_background[j,:] = res[background_v_samples[j], background_u_samples[j], :]
-            if use_3d:
-                descriptors_background_xy = np.zeros((len(background_u_samples),2))
-                descriptors_background_yz = np.zeros((len(background_u_samples),2))
-                descriptors_background_xz = np.zeros((len(background_u_samples),2))
-                for j in range(len(background_u_samples)):
-                    descriptors_background_xy[j,:] = res[background_v_samples[j], background_u_samples[j], 0:2]
-                    descriptors_background_yz[j,:] = res[background_v_samples[j], background_u_samples[j], 1:3]
-                    descriptors_background_xz[j,:] = res[background_v_samples[j], background_u_samples[j], 0::2]
-
-
-            # This snippet will plot the descriptors just from this image
-            # plt.scatter(descriptors_object[:,0], descriptors_object[:,1], c="g", alpha=0.5, label=object_id)
-            # plt.scatter(descriptors_background[:,0], descriptors_background[:,1], c="k", alpha=0.5, label="background")
-            # plt.legend()
-            # plt.show()
-
-            if object_id not in descriptors_known_objects_samples:
-                descriptors_known_objects_samples[object_id] = descriptors_object
-                if use_3d:
-                    descriptors_known_objects_samples_xy[object_id] = descriptors_object_xy
-                    descriptors_known_objects_samples_yz[object_id] = descriptors_object_yz
-                    descriptors_known_objects_samples_xz[object_id] = descriptors_object_xz
-            else:
-                descriptors_known_objects_samples[object_id] = np.vstack((descriptors_known_objects_samples[object_id], descriptors_object))
-                if use_3d:
-                    descriptors_known_objects_samples_xy[object_id] = np.vstack((descriptors_known_objects_samples_xy[object_id], descriptors_object_xy))
-                    descriptors_known_objects_samples_yz[object_id] = np.vstack((descriptors_known_objects_samples_yz[object_id], descriptors_object_yz))
-                    descriptors_known_objects_samples_xz[object_id] = np.vstack((descriptors_known_objects_samples_xz[object_id], descriptors_object_xz))
+            projections = [project_descriptors(descriptors, method=method, num_components=2)]
 
-            descriptors_background_samples = np.vstack((descriptors_background_samples, descriptors_background))
-            if use_3d:
-                descriptors_background_samples_xy = np.vstack((descriptors_background_samples_xy, descriptors_background_xy))
-                descriptors_background_samples_yz = np.vstack((descriptors_background_samples_yz, descriptors_background_yz))
-                descriptors_background_samples_xz = np.vstack((descriptors_background_samples_xz, descriptors_background_xz))
-
-
-
-        print "ALL"
-        if not use_3d:
-            for key, value in descriptors_known_objects_samples.iteritems():
-                plt.scatter(value[:,0], value[:,1], alpha=0.5, label=key)
-
-            if plot_background:
-                plt.scatter(descriptors_background_samples[:,0], descriptors_background_samples[:,1], alpha=0.5, label="background")
-            plt.legend()
-            plt.show()
-        
-        if use_3d:
-            for key, value in descriptors_known_objects_samples_xy.iteritems():
-                plt.scatter(value[:,0], value[:,1], alpha=0.5, label=key)
-            if plot_background:
-                plt.scatter(descriptors_background_samples_xy[:,0], descriptors_background_samples_xy[:,1], alpha=0.5, label="background")
-            plt.legend()
-            plt.show()
-
-            for key, value in descriptors_known_objects_samples_yz.iteritems():
-                plt.scatter(value[:,0], value[:,1], alpha=0.5, label=key)
-            if plot_background:
-                plt.scatter(descriptors_background_samples_yz[:,0], descriptors_background_samples_yz[:,1], alpha=0.5, label="background")
-            plt.legend()
-            plt.show()
-
-            for key, value in descriptors_known_objects_samples_xz.iteritems():
-                plt.scatter(value[:,0], value[:,1], alpha=0.5, label=key)
-            if plot_background:
-                plt.scatter(descriptors_background_samples_xz[:,0], descriptors_background_samples_xz[:,1], alpha=0.5, label="background")
+        for idx, points in projections:
+            for label, name in enumerate(label_names):
+                if name == BACKGROUND_LABEL_NAME and not plot_background:
+                    continue
+                value = points[labels[idx] == label]
+                plt.scatter(value[:,0], value[:,1], alpha=0.5, label=name)
             plt.legend()
             plt.show()
 
@@ -2725,6 +2913,25 @@ class DenseCorrespondenceEvaluationPlotter(object):
         ax.set_ylabel('Fraction of pixel samples from images')
         return plot
 
+    @staticmethod
+    def make_across_object_confusion_plot(ax, summary):
+        """
+        :param ax: axis of a matplotlib plot to plot on
+        :param summary: see DenseCorrespondenceEvaluation.evaluate_network_across_objects_batched()
+        :type summary: dict
+        :return:
+        :rtype:
+        """
+        object_ids = summary['object_ids']
+        plot = ax.imshow(np.asarray(summary['confusion_matrix']), vmin=0, vmax=1, cmap='viridis')
+        ax.set_xticks(range(len(object_ids)))
+        ax.set_yticks(range(len(object_ids)))
+        ax.set_xticklabels(object_ids, rotation=90)
+        ax.set_yticklabels(object_ids)
+        ax.set_xlabel('Object of nearest neighbor')
+        ax.set_ylabel('Object of sample')
+        return plot
+
     @staticmethod
     def make_descriptor_accuracy_plot(ax, df, label=None, num_bins=100, masked=False):
         """
@@ -2862,6 +3069,95 @@ class DenseCorrespondenceEvaluationPlotter(object):
         area_above_curve = b * np.sum((1-cumhist))
         return area_above_curve
 
+    # (metric, x axis scale factor, x axis label, masked x axis label) of each row of the plots
+    # run_on_summaries() makes, the masked metric goes in the second column
+    SUMMARY_PLOTS = [('pixel_match_error_l2', 800, 'Pixel match error (fraction of image), L2 (pixel distance)',
+                      'Pixel match error (masked), L2 (pixel distance)'),
+                     ('norm_diff_pred_3d', 0.01, '3D match error, L2 (cm)', '3D match error (masked), L2 (cm)'),
+                     ('norm_diff_descriptor_ground_truth', 1, 'Descriptor match error, L2', None),
+                     ('fraction_pixels_closer_than_ground_truth', 1, 'Fraction false positives',
+                      'Fraction false positives (masked)'),
+                     ('average_l2_distance_for_false_positives', 1, 'Average l2 pixel distance for false positives',
+                      'Average l2 pixel distance for false positives (masked)')]
+
+    @staticmethod
+    def make_cdf_plot_from_summary(ax, metric_summary, label=None, x_axis_scale_factor=1):
+        """
+        Plots the empirical CDF of a metric from its summary, the same plot as
+        make_cdf_plot() on the data
+        :param ax: axis of a matplotlib plot to plot on
+        :param metric_summary: see metric_summary.summarize_metric()
+        :type metric_summary: dict
+        :return:
+        :rtype:
+        """
+        if metric_summary.get('count', 0) == 0:
+            return None
+        x_axis, cumhist = cdf(metric_summary)
+        return ax.plot(x_axis / x_axis_scale_factor, cumhist, label=label)
+
+    @staticmethod
+    def run_on_summaries(summaries, output_dir=None, save=True, previous_fig_axes=None):
+        """
+        Overlays the CDF plots of run_on_single_dataframe() for many runs, made from their
+        summaries instead of their per match results, and tabulates the areas above the curves.
+
+        Usage:
+            summaries = metric_summary.load_summaries({'net_a': 'net_a/analysis/train/data.csv', ...})
+            fig_axes, aac_table = DCEP.run_on_summaries(summaries, save=False)
+
+        :param summaries: label --> summary, see metric_summary.load_summaries()
+        :type summaries: dict
+        :param output_dir: where quant_plots.png and area_above_curve.csv are saved
+        :type output_dir: str
+        :return: [fig, axes], and the area above the curve of every metric of every run
+        :rtype: list, pandas.DataFrame
+        """
+        DCEP = DenseCorrespondenceEvaluationPlotter
+
+        if save and (output_dir is None):
+            raise ValueError("You must pass in an output directory")
+
+        use_masked_plots = any('pixel_match_error_l2_masked' in summary['metrics']
+                               for summary in summaries.itervalues())
+
+        if previous_fig_axes is None:
+            N = len(DCEP.SUMMARY_PLOTS)
+            if use_masked_plots:
+                fig, axes = plt.subplots(nrows=N, ncols=2, figsize=(15,N*5))
+            else:
+                fig, axes = plt.subplots(N, figsize=(10,N*5))
+        else:
+            [fig, axes] = previous_fig_axes
+
+        metrics = []
+        for row, (metric, x_axis_scale_factor, xlabel, masked_xlabel) in enumerate(DCEP.SUMMARY_PLOTS):
+            columns = [(metric, xlabel)]
+            if use_masked_plots and (masked_xlabel is not None):
+                columns.append((metric + '_masked', masked_xlabel))
+
+            for column, (column_metric, column_xlabel) in enumerate(columns):
+                ax = axes[row, column] if use_masked_plots else axes[row]
+                for label, summary in sorted(summaries.iteritems()):
+                    if column_metric in summary['metrics']:
+                        DCEP.make_cdf_plot_from_summary(ax, summary['metrics'][column_metric], label=label,
+                                                        x_axis_scale_factor=x_axis_scale_factor)
+                ax.set_xlabel(column_xlabel)
+                ax.set_ylabel('Fraction of images')
+                metrics.append(column_metric)
+
+        (axes[0, 0] if use_masked_plots else axes[0]).legend()
+
+        aac_table = make_statistics_table(summaries, metrics=metrics, statistic='area_above_curve')
+
+        if save:
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            fig.savefig(os.path.join(output_dir, "quant_plots.png"))
+            aac_table.to_csv(os.path.join(output_dir, "area_above_curve.csv"))
+
+        return [fig, axes], aac_table
+
     @staticmethod
     def run_on_single_dataframe(path_to_df_csv, label=None, output_dir=None, save=True, previous_fig_axes=None, dataframe=None):
         """
@@ -2884,7 +3180,8 @@ class DenseCorrespondenceEvaluationPlotter(object):
 
         :param dataframe: The pandas dataframe, object
         :type dataframe:
-        :param path_to_df_csv: full path to csv file
+        :param path_to_df_csv: full path to csv file, or to a .parquet or .arrow file
+        written by evaluate_network(), which is memory mapped
         :type path_to_df_csv: string
         :param label: name that will show up labeling this line in the legend
         :type label: string
@@ -2898,7 +3195,7 @@ class DenseCorrespondenceEvaluationPlotter(object):
         if dataframe is None:
             path_to_csv = utils.convert_data_relative_path_to_absolute_path(path_to_df_csv,
                 assert_path_exists=True)
-            df = pd.read_csv(path_to_csv, index_col=0, parse_dates=True)
+            df = read_result_table(path_to_csv)
             if output_dir is None:
                 output_dir = os.path.dirname(path_to_csv)
         else:
@@ -2992,7 +3289,7 @@ class DenseCorrespondenceEvaluationPlotter(object):
         if output_dir is None:
             output_dir = os.path.dirname(path_to_csv)
 
-        df = pd.read_csv(path_to_csv, index_col=0, parse_dates=True)
+        df = read_result_table(path_to_csv)
 
         if previous_fig_axes==None:
             N = 1
@@ -0,0 +1,202 @@
+import os
+import json
+import shutil
+import hashlib
+
+import pandas as pd
+
+import dense_correspondence_manipulation.utils.utils as utils
+from dense_correspondence.evaluation.result_table import open_result_writer, read_result_table
+
+"""
+Cache of evaluation results, so that re-running an evaluation only computes what is missing.
+
+Results are keyed by
+
+    (model identifier, checkpoint iteration, evaluation kind, sampling seed, config hash)
+
+where the config hash is a hash of everything else the result depends on: the dataset
+config, the number of image pairs and so on, see make_key(). Each key has a directory
+
+    <store_dir>/<model identifier>/<iteration>/<kind>/seed_<seed>_<config hash>/
+
+holding spec.yaml (what the hash was computed from), the results, and complete.yaml
+once they are final. Evaluations over image pairs write a part file per image pair
+with write_pair(), so an interrupted evaluation resumes at the first missing pair,
+and finish_pairs() combines the parts into a single file.
+"""
+
+SPEC_FILENAME = "spec.yaml"
+COMPLETE_FILENAME = "complete.yaml"
+RESULT_FILENAME = "data.csv"
+STATISTICS_FILENAME = "data.yaml"
+PARTS_DIRNAME = "pairs"
+PAIR_FILENAME_FORMAT = "pair_%06d.csv"
+
+
+def hash_config(config):
+    """
+    :param config: a dict of yaml types
+    :type config: dict
+    :return: hex digest that doesn't depend on the order of the keys
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str)).hexdigest()
+
+
+def get_model_identifier(model_folder):
+    """
+    :return: the id in identifier.yaml of the model folder, or the name of the folder
+    if it doesn't have one
+    :rtype: str
+    """
+    identifier_file = os.path.join(model_folder, 'identifier.yaml')
+    if os.path.exists(identifier_file):
+        return str(utils.getDictFromYamlFilename(identifier_file)['id'])
+    return os.path.basename(os.path.normpath(model_folder))
+
+
+def make_key(model_identifier, iteration, kind, seed, spec):
+    """
+    :param model_identifier: see get_model_identifier()
+    :type model_identifier: str
+    :param iteration: checkpoint iteration
+    :type iteration: int
+    :param kind: name of the evaluation, e.g. "train" or "cross_scene"
+    :type kind: str
+    :param seed: sampling seed
+    :type seed: int
+    :param spec: everything else the result depends on
+    :type spec: dict
+    :return: the key
+    :rtype: dict
+    """
+    key = dict()
+    key['model_identifier'] = model_identifier
+    key['iteration'] = int(iteration)
+    key['kind'] = kind
+    key['seed'] = int(seed)
+    key['config_hash'] = hash_config(spec)
+    key['spec'] = spec
+    return key
+
+
+def pair_seed(seed, pair_idx):
+    """
+    Seed of a single image pair, so that the pairs don't depend on the pairs
+    evaluated before them and can be skipped when they are in the store
+    :rtype: int
+    """
+    return (seed * 1000003 + pair_idx) % (2 ** 32)
+
+
+class EvaluationStore(object):
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+
+    @property
+    def store_dir(self):
+        return self._store_dir
+
+    def key_dir(self, key):
+        return os.path.join(self._store_dir, key['model_identifier'], utils.getPaddedString(key['iteration'], width=6),
+                            key['kind'], "seed_%d_%s" %(key['seed'], key['config_hash'][:12]))
+
+    def get_filename(self, key, filename):
+        """
+        Full path of a file in the directory of the key, the directory is created
+        :rtype: str
+        """
+        key_dir = self.key_dir(key)
+        if not os.path.isdir(key_dir):
+            os.makedirs(key_dir)
+            utils.saveToYaml(key, os.path.join(key_dir, SPEC_FILENAME))
+        return os.path.join(key_dir, filename)
+
+    def is_complete(self, key):
+        return os.path.exists(os.path.join(self.key_dir(key), COMPLETE_FILENAME))
+
+    def mark_complete(self, key):
+        utils.saveToYaml({'complete': True}, self.get_filename(key, COMPLETE_FILENAME))
+
+    def clear(self, key):
+        """
+        Deletes the results of the key
+        """
+        key_dir = self.key_dir(key)
+        if os.path.isdir(key_dir):
+            shutil.rmtree(key_dir)
+
+    def write_dataframe(self, key, df):
+        filename = self.get_filename(key, RESULT_FILENAME)
+        tmp_filename = filename + ".tmp"
+        df.to_csv(tmp_filename)
+        os.rename(tmp_filename, filename)
+
+    def read_dataframe(self, key):
+        """
+        :rtype: pandas.DataFrame
+        """
+        return read_result_table(os.path.join(self.key_dir(key), RESULT_FILENAME))
+
+    def write_yaml(self, key, d):
+        utils.saveToYaml(d, self.get_filename(key, STATISTICS_FILENAME))
+
+    def read_yaml(self, key):
+        return utils.getDictFromYamlFilename(os.path.join(self.key_dir(key), STATISTICS_FILENAME))
+
+    def _parts_dir(self, key):
+        return os.path.join(self.key_dir(key), PARTS_DIRNAME)
+
+    def finished_pairs(self, key):
+        """
+        :return: indices of the image pairs written with write_pair()
+        :rtype: set of int
+        """
+        parts_dir = self._parts_dir(key)
+        if not os.path.isdir(parts_dir):
+            return set()
+        return {int(f[len("pair_"):-len(".csv")]) for f in os.listdir(parts_dir)
+                if f.startswith("pair_") and f.endswith(".csv")}
+
+    def write_pair(self, key, pair_idx, results):
+        """
+        :param pair_idx:
+        :type pair_idx: int
+        :param results: rows of the image pair, can be empty
+        :type results: ResultTable
+        """
+        parts_dir = self.get_filename(key, PARTS_DIRNAME)
+        if not os.path.isdir(parts_dir):
+            os.makedirs(parts_dir)
+
+        # the part only shows up under its final name once it is written completely
+        filename = os.path.join(parts_dir, PAIR_FILENAME_FORMAT %(pair_idx))
+        tmp_filename = os.path.join(parts_dir, "tmp_" + PAIR_FILENAME_FORMAT %(pair_idx))
+        writer = open_result_writer(tmp_filename, results.schema)
+        if len(results) > 0:
+            writer.write(results.to_dataframe())
+        writer.close()
+        os.rename(tmp_filename, filename)
+
+    def finish_pairs(self, key):
+        """
+        Combines the parts into a single file, in order of the image pairs, and marks
+        the key complete
+        :return: the combined rows
+        :rtype: pandas.DataFrame
+        """
+        parts_dir = self._parts_dir(key)
+        df_list = []
+        for pair_idx in sorted(self.finished_pairs(key)):
+            filename = os.path.join(parts_dir, PAIR_FILENAME_FORMAT %(pair_idx))
+            # image pairs without matches have an empty part
+            if os.path.getsize(filename) > 0:
+                df_list.append(read_result_table(filename))
+
+        df = pd.concat(df_list, ignore_index=True) if len(df_list) > 0 else pd.DataFrame()
+        self.write_dataframe(key, df)
+        self.mark_complete(key)
+        shutil.rmtree(parts_dir)
+        return df
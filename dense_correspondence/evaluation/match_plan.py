@@ -0,0 +1,349 @@
+import numpy as np
+import torch
+
+from dense_correspondence_manipulation.utils.constants import DEPTH_IM_SCALE
+from dense_correspondence.evaluation.result_table import ResultTable
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
+
+"""
+Frame-deduplicated evaluation of annotated matches.
+
+The cross scene, cross instance and keypoint evaluations used to go through the
+annotated image pairs one by one, loading both images and running the network on them
+for every pair, and matching one pixel at a time. A MatchPlan collects all the matches
+first, then
+
+    1. loads every frame once and runs the network on the frames in batches, keeping
+       only the descriptor and depth at the query pixels of each frame, plus the full
+       descriptor images of up to max_cached_frames frames that are searched
+    2. for each searched frame, computes the distances of all of its queries at once
+
+and gathers the statistics of compute_descriptor_match_statistics() in one array per column.
+"""
+
+MAX_DEPTH = 10.0
+
+# columns computed by compute_match_statistics_batch(), the others come with the matches
+FLOAT_COLUMNS = ['norm_diff_descriptor',
+                 'norm_diff_descriptor_masked',
+                 'norm_diff_descriptor_ground_truth',
+                 'norm_diff_ground_truth_3d',
+                 'norm_diff_pred_3d',
+                 'norm_diff_pred_3d_masked',
+                 'pixel_match_error_l2',
+                 'pixel_match_error_l2_masked',
+                 'pixel_match_error_l1',
+                 'fraction_pixels_closer_than_ground_truth',
+                 'fraction_pixels_closer_than_ground_truth_masked',
+                 'average_l2_distance_for_false_positives',
+                 'average_l2_distance_for_false_positives_masked']
+
+BOOL_COLUMNS = ['is_valid', 'is_valid_masked']
+
+
+def is_depth_valid(depth):
+    """
+    Vectorized DenseCorrespondenceEvaluation.is_depth_valid()
+    :param depth: depth in meters
+    :type depth: numpy.ndarray
+    :rtype: numpy.ndarray of bool
+    """
+    return (depth > 0) & (depth < MAX_DEPTH)
+
+
+def compute_3d_positions(uv, depth, camera_matrix, camera_to_world):
+    """
+    Vectorized DenseCorrespondenceEvaluation.compute_3d_position()
+    :param uv: [N, 2] pixels in (u, v) order
+    :type uv: numpy.ndarray
+    :param depth: [N] depth in meters
+    :type depth: numpy.ndarray
+    :param camera_matrix: 3 x 3 camera intrinsics
+    :type camera_matrix: numpy.ndarray
+    :param camera_to_world: [4, 4] or [N, 4, 4]
+    :type camera_to_world: numpy.ndarray
+    :return: [N, 3] positions in world frame
+    :rtype: numpy.ndarray
+    """
+    uv_1 = np.concatenate([np.asarray(uv, dtype=np.float64), np.ones([len(uv), 1])], axis=1)
+    pos_in_camera_frame = uv_1.dot(np.linalg.inv(camera_matrix).T) * depth[:, None]
+    pos_homogeneous = np.concatenate([pos_in_camera_frame, np.ones([len(uv), 1])], axis=1)
+
+    camera_to_world = np.asarray(camera_to_world)
+    if camera_to_world.ndim == 2:
+        return pos_homogeneous.dot(camera_to_world.T)[:, :3]
+    return np.einsum('nij,nj->ni', camera_to_world, pos_homogeneous)[:, :3]
+
+
+def compute_match_statistics_batch(des_a, uv_a, depth_a, pose_a, uv_b, res_b, depth_b, mask_b, pose_b,
+                                   camera_matrix):
+    """
+    Batched DenseCorrespondenceEvaluation.compute_descriptor_match_statistics() for Q
+    queries that all search the same image b
+    :param des_a: [Q, D] descriptors of the queries
+    :type des_a: numpy.ndarray
+    :param uv_a: [Q, 2] query pixels in their images
+    :type uv_a: numpy.ndarray
+    :param depth_a: [Q] depth of the query pixels, in meters
+    :type depth_a: numpy.ndarray
+    :param pose_a: [Q, 4, 4] camera to world of the images of the queries
+    :type pose_a: numpy.ndarray
+    :param uv_b: [Q, 2] ground truth pixels in image b
+    :type uv_b: numpy.ndarray
+    :param res_b: [H, W, D] descriptor image b
+    :type res_b: numpy.ndarray
+    :param depth_b: [H, W] depth image b, as stored (see DEPTH_IM_SCALE)
+    :type depth_b: numpy.ndarray
+    :param mask_b: [H, W] mask of image b
+    :type mask_b: numpy.ndarray
+    :param pose_b: 4 x 4 camera to world of image b
+    :type pose_b: numpy.ndarray
+    :return: column name --> [Q] array, see FLOAT_COLUMNS and BOOL_COLUMNS
+    :rtype: dict
+    """
+    height, width, descriptor_dimension = res_b.shape
+    num_queries = len(des_a)
+    queries = np.arange(num_queries)
+
+    norm_diffs = np.sqrt(squared_distances(np.asarray(des_a, dtype=np.float64),
+                                           res_b.reshape(-1, descriptor_dimension).astype(np.float64)))  # [Q, H*W]
+
+    mask_flat = np.asarray(mask_b).ravel() > 0
+    masked_norm_diffs = norm_diffs + (~mask_flat) * 1e6
+
+    best_idx = np.argmin(norm_diffs, axis=1)
+    best_idx_masked = np.argmin(masked_norm_diffs, axis=1)
+    uv_b_pred = np.stack([best_idx % width, best_idx // width], axis=1)
+    uv_b_pred_masked = np.stack([best_idx_masked % width, best_idx_masked // width], axis=1)
+
+    uv_b = np.asarray(uv_b)
+    ground_truth_idx = uv_b[:, 1] * width + uv_b[:, 0]
+    norm_diff_descriptor_ground_truth = norm_diffs[queries, ground_truth_idx]
+
+    columns = dict()
+    columns['norm_diff_descriptor'] = norm_diffs[queries, best_idx]
+    columns['norm_diff_descriptor_masked'] = masked_norm_diffs[queries, best_idx_masked]
+    columns['norm_diff_descriptor_ground_truth'] = norm_diff_descriptor_ground_truth
+
+    columns['pixel_match_error_l2'] = np.linalg.norm(uv_b - uv_b_pred, axis=1)
+    columns['pixel_match_error_l2_masked'] = np.linalg.norm(uv_b - uv_b_pred_masked, axis=1)
+    columns['pixel_match_error_l1'] = np.sum(np.abs(uv_b - uv_b_pred), axis=1)
+
+    # pixels that are closer in descriptor space than the ground truth match, and their
+    # pixel distance to the ground truth match
+    u_grid, v_grid = np.meshgrid(np.arange(width), np.arange(height))
+    pixel_distances = np.sqrt((u_grid.ravel()[None, :] - uv_b[:, 0:1]) ** 2
+                              + (v_grid.ravel()[None, :] - uv_b[:, 1:2]) ** 2)
+
+    for suffix, diffs, num_pixels in [("", norm_diffs, height * width),
+                                      ("_masked", masked_norm_diffs, np.count_nonzero(mask_flat))]:
+        closer = diffs < norm_diff_descriptor_ground_truth[:, None]
+        num_closer = np.sum(closer, axis=1)
+        columns['fraction_pixels_closer_than_ground_truth' + suffix] = num_closer * 1.0 / num_pixels
+        columns['average_l2_distance_for_false_positives' + suffix] = \
+            np.sum(pixel_distances * closer, axis=1) / np.maximum(num_closer, 1)
+
+    # depth images are indexed (v, u)
+    uv_b_depth = depth_b[uv_b[:, 1], uv_b[:, 0]] / DEPTH_IM_SCALE
+    uv_b_pred_depth = depth_b[uv_b_pred[:, 1], uv_b_pred[:, 0]] / DEPTH_IM_SCALE
+    uv_b_pred_depth_masked = depth_b[uv_b_pred_masked[:, 1], uv_b_pred_masked[:, 0]] / DEPTH_IM_SCALE
+
+    is_valid_ground_truth = is_depth_valid(uv_b_depth)
+    columns['is_valid'] = is_depth_valid(uv_b_pred_depth)
+    columns['is_valid_masked'] = is_depth_valid(uv_b_pred_depth_masked)
+
+    uv_a_pos = compute_3d_positions(uv_a, depth_a, camera_matrix, pose_a)
+    uv_b_pos = compute_3d_positions(uv_b, uv_b_depth, camera_matrix, pose_b)
+    uv_b_pred_pos = compute_3d_positions(uv_b_pred, uv_b_pred_depth, camera_matrix, pose_b)
+    uv_b_pred_pos_masked = compute_3d_positions(uv_b_pred_masked, uv_b_pred_depth_masked, camera_matrix, pose_b)
+
+    columns['norm_diff_ground_truth_3d'] = np.where(is_valid_ground_truth,
+                                                    np.linalg.norm(uv_b_pos - uv_a_pos, axis=1), np.nan)
+    columns['norm_diff_pred_3d'] = np.where(is_valid_ground_truth & columns['is_valid'],
+                                            np.linalg.norm(uv_b_pos - uv_b_pred_pos, axis=1), np.nan)
+    columns['norm_diff_pred_3d_masked'] = np.where(is_valid_ground_truth & columns['is_valid_masked'],
+                                                   np.linalg.norm(uv_b_pos - uv_b_pred_pos_masked, axis=1), np.nan)
+    return columns
+
+
+class MatchPlan(object):
+    """
+    Annotated matches between frames, evaluated with evaluate(). A frame is a
+    (scene_name, img_idx) tuple
+    """
+
+    def __init__(self):
+        self._matches = []
+        self._summary = dict()
+
+    def __len__(self):
+        return len(self._matches)
+
+    @property
+    def frames(self):
+        """
+        :return: all frames of the matches, each once
+        :rtype: list
+        """
+        frames = set()
+        for match in self._matches:
+            frames.add(match['frame_a'])
+            frames.add(match['frame_b'])
+        return sorted(frames)
+
+    def add_match(self, frame_a, uv_a, frame_b, uv_b, columns):
+        """
+        :param frame_a: frame of the query pixel
+        :type frame_a: tuple
+        :param uv_a: query pixel
+        :type uv_a: tuple
+        :param frame_b: frame that is searched
+        :type frame_b: tuple
+        :param uv_b: ground truth match of the query pixel in frame_b
+        :type uv_b: tuple
+        :param columns: values of the remaining columns of the row, e.g. scene_name,
+        img_a_idx, img_b_idx. All matches of a plan must set the same columns
+        :type columns: dict
+        """
+        match = dict()
+        match['frame_a'] = frame_a
+        match['uv_a'] = uv_a
+        match['frame_b'] = frame_b
+        match['uv_b'] = uv_b
+        match['columns'] = columns
+        self._matches.append(match)
+
+    def summary(self):
+        """
+        :return: number of frames loaded, and of those run through the network, by the last evaluate()
+        :rtype: dict
+        """
+        return self._summary
+
+    @staticmethod
+    def _forward_frames(dcn, dataset, frames, batch_size):
+        """
+        Generator of (frame, depth, mask, pose, res), runs the network on batch_size frames at a time
+        """
+        for start in xrange(0, len(frames), batch_size):
+            batch = []
+            for scene_name, img_idx in frames[start:start + batch_size]:
+                rgb, depth, mask, pose = dataset.get_rgbd_mask_pose(scene_name, img_idx)
+                batch.append((rgb, np.asarray(depth), np.asarray(mask), pose))
+
+            img_tensor = torch.stack([dataset.rgb_image_to_tensor(rgb) for rgb, _, _, _ in batch]).to(dcn.device)
+            with torch.no_grad():
+                res = dcn.forward(img_tensor)
+
+            # [N, D, H, W] --> [N, H, W, D]
+            res = res.permute(0, 2, 3, 1).cpu().numpy()
+
+            for i, (frame, (_, depth, mask, pose)) in enumerate(zip(frames[start:start + batch_size], batch)):
+                yield frame, depth, mask, pose, res[i]
+
+    def evaluate(self, dcn, dataset, schema, camera_matrix=None, batch_size=8, max_cached_frames=32,
+                 max_queries_per_batch=64, descriptor_images=None):
+        """
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param schema: schema of the rows, e.g. DCNEvaluationPandaTemplate.schema()
+        :type schema: list
+        :param camera_matrix: defaults to the camera intrinsics of the dataset
+        :type camera_matrix: numpy.ndarray
+        :param batch_size: number of frames per forward pass
+        :type batch_size: int
+        :param max_cached_frames: number of searched frames whose descriptor images are kept
+        from the first pass, the others are run through the network again in the second pass
+        :type max_cached_frames: int
+        :param max_queries_per_batch: number of queries per distance computation, bounds
+        the memory of the [queries, H*W] distance matrix
+        :type max_queries_per_batch: int
+        :param descriptor_images: (optional) frame --> precomputed descriptor image [H, W, D]
+        :type descriptor_images: dict
+        :return: a row per match, in the order they were added
+        :rtype: ResultTable
+        """
+        results = ResultTable(schema)
+        self._summary = {'num_matches': len(self._matches), 'num_frames_loaded': 0, 'num_frames_inferred': 0}
+        if len(self._matches) == 0:
+            return results
+
+        if descriptor_images is None:
+            descriptor_images = dict()
+
+        if camera_matrix is None:
+            camera_matrix = dataset.get_camera_intrinsics(self._matches[0]['frame_a'][0]).K
+
+        num_matches = len(self._matches)
+        matches_by_frame_a = dict()
+        matches_by_frame_b = dict()
+        for i, match in enumerate(self._matches):
+            matches_by_frame_a.setdefault(match['frame_a'], []).append(i)
+            matches_by_frame_b.setdefault(match['frame_b'], []).append(i)
+
+        uv_a = np.array([match['uv_a'] for match in self._matches], dtype=np.int64)
+        uv_b = np.array([match['uv_b'] for match in self._matches], dtype=np.int64)
+        des_a = None
+        depth_a = np.zeros(num_matches)
+        pose_a = np.zeros([num_matches, 4, 4])
+
+        def frame_data(frames):
+            """
+            (frame, depth, mask, pose, res) of the frames, with the precomputed descriptor
+            images where there are some
+            """
+            to_forward = [frame for frame in frames if frame not in descriptor_images]
+            for frame in frames:
+                if frame in descriptor_images:
+                    _, depth, mask, pose = dataset.get_rgbd_mask_pose(frame[0], frame[1])
+                    self._summary['num_frames_loaded'] += 1
+                    yield frame, np.asarray(depth), np.asarray(mask), pose, descriptor_images[frame]
+
+            for item in MatchPlan._forward_frames(dcn, dataset, to_forward, batch_size):
+                self._summary['num_frames_loaded'] += 1
+                self._summary['num_frames_inferred'] += 1
+                yield item
+
+        # first pass: descriptors and depths at the query pixels
+        cache = dict()
+        for frame, depth, mask, pose, res in frame_data(self.frames):
+            if des_a is None:
+                des_a = np.zeros([num_matches, res.shape[2]], dtype=res.dtype)
+
+            idxs = matches_by_frame_a.get(frame, [])
+            if len(idxs) > 0:
+                des_a[idxs] = res[uv_a[idxs, 1], uv_a[idxs, 0]]
+                depth_a[idxs] = depth[uv_a[idxs, 1], uv_a[idxs, 0]] / DEPTH_IM_SCALE
+                pose_a[idxs] = pose
+
+            if (frame in matches_by_frame_b) and (len(cache) < max_cached_frames):
+                cache[frame] = (depth, mask, pose, res)
+
+        # second pass: search every frame b for all of its queries
+        columns = {column: np.zeros(num_matches) for column in FLOAT_COLUMNS}
+        columns.update({column: np.zeros(num_matches, dtype=bool) for column in BOOL_COLUMNS})
+
+        def searched_frames():
+            for frame, data in cache.iteritems():
+                yield (frame,) + data
+            uncached = sorted(frame for frame in matches_by_frame_b if frame not in cache)
+            for item in frame_data(uncached):
+                yield item
+
+        for frame_b, depth_b, mask_b, pose_b, res_b in searched_frames():
+            idxs = np.array(matches_by_frame_b[frame_b])
+            for start in xrange(0, len(idxs), max_queries_per_batch):
+                batch = idxs[start:start + max_queries_per_batch]
+                batch_columns = compute_match_statistics_batch(des_a[batch], uv_a[batch], depth_a[batch],
+                                                               pose_a[batch], uv_b[batch], res_b, depth_b, mask_b,
+                                                               pose_b, camera_matrix)
+                for column, values in batch_columns.iteritems():
+                    columns[column][batch] = values
+
+        for column in self._matches[0]['columns']:
+            columns[column] = [match['columns'][column] for match in self._matches]
+
+        results.append(columns)
+        return results
@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.stats as ss
+
+import dense_correspondence_manipulation.utils.utils as utils
+
+"""
+Compact summaries of evaluation results, for comparing many runs without re-reading
+their per-match files.
+
+For each metric column, summarize_dataframe() keeps
+
+    - count, number of nans, min, max, mean
+    - the histogram of scipy.stats.cumfreq(values, num_bins): num_bins fixed width
+      bins from lower_limit, the bins DenseCorrespondenceEvaluationPlotter.make_cdf_plot()
+      and compute_area_above_curve() use, so the CDF plots and areas above the curve
+      made from a summary are the same as the ones made from the data
+    - a quantile sketch: the quantiles at QUANTILE_LEVELS
+
+nans are dropped before summarizing. The summary of <dir>/data.csv is written to
+<dir>/data_summary.yaml, see write_result_summary().
+
+Usage:
+    summaries = load_summaries({'net_a': 'net_a/analysis/train/data_summary.yaml', ...})
+    table = rank_runs(summaries, 'norm_diff_pred_3d', statistic='area_above_curve')
+"""
+
+SUMMARY_FILENAME_SUFFIX = "_summary.yaml"
+DEFAULT_NUM_BINS = 100
+QUANTILE_LEVELS = np.linspace(0, 1, 101)
+
+# columns summarized when they are in the results, masked and unmasked
+SUMMARY_COLUMNS = ['pixel_match_error_l2',
+                   'pixel_match_error_l2_masked',
+                   'pixel_match_error_l1',
+                   'norm_diff_descriptor',
+                   'norm_diff_descriptor_masked',
+                   'norm_diff_descriptor_ground_truth',
+                   'norm_diff_pred_3d',
+                   'norm_diff_pred_3d_masked',
+                   'fraction_pixels_closer_than_ground_truth',
+                   'fraction_pixels_closer_than_ground_truth_masked',
+                   'average_l2_distance_for_false_positives',
+                   'average_l2_distance_for_false_positives_masked',
+                   'norm_diff_descriptor_best_match']
+
+STATISTICS = ['area_above_curve', 'mean', 'median', 'quantile_90', 'quantile_95']
+
+
+def summarize_metric(values, num_bins=DEFAULT_NUM_BINS):
+    """
+    :param values: values of one metric, nans are dropped
+    :type values: numpy.ndarray or pandas.Series
+    :return: yaml friendly summary, see the module docstring
+    :rtype: dict
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = values[~np.isnan(values)]
+
+    d = dict()
+    d['count'] = int(len(finite))
+    d['num_nan'] = int(len(values) - len(finite))
+    if len(finite) == 0:
+        return d
+
+    cumhist, lower_limit, bin_size, _ = ss.cumfreq(finite, num_bins)
+    d['min'] = float(np.min(finite))
+    d['max'] = float(np.max(finite))
+    d['mean'] = float(np.mean(finite))
+    d['lower_limit'] = float(lower_limit)
+    d['bin_size'] = float(bin_size)
+    d['histogram'] = np.diff(np.concatenate([[0], cumhist])).astype(np.int64).tolist()
+    d['quantile_levels'] = QUANTILE_LEVELS.tolist()
+    d['quantiles'] = np.percentile(finite, 100 * QUANTILE_LEVELS).tolist()
+    return d
+
+
+def summarize_dataframe(df, num_bins=DEFAULT_NUM_BINS, columns=None):
+    """
+    :param df: evaluation results
+    :type df: pandas.DataFrame
+    :param columns: columns to summarize, defaults to the SUMMARY_COLUMNS in df
+    :type columns: list of str
+    :return: dict with num_rows and metrics, column --> summarize_metric()
+    :rtype: dict
+    """
+    if columns is None:
+        columns = [column for column in SUMMARY_COLUMNS if column in df]
+
+    summary = dict()
+    summary['num_rows'] = int(len(df))
+    summary['metrics'] = {column: summarize_metric(df[column], num_bins=num_bins) for column in columns}
+    return summary
+
+
+def get_summary_filename(data_file):
+    """
+    :return: <dir>/data_summary.yaml for <dir>/data.csv
+    :rtype: str
+    """
+    return os.path.splitext(data_file)[0] + SUMMARY_FILENAME_SUFFIX
+
+
+def write_result_summary(df, data_file, num_bins=DEFAULT_NUM_BINS):
+    """
+    Writes the summary of the results in data_file next to it
+    :return: the summary filename
+    :rtype: str
+    """
+    filename = get_summary_filename(data_file)
+    utils.saveToYaml(summarize_dataframe(df, num_bins=num_bins), filename)
+    return filename
+
+
+def load_summary(filename):
+    """
+    :param filename: summary yaml, or a result file that has a summary next to it
+    :type filename: str
+    :rtype: dict
+    """
+    if not filename.endswith(SUMMARY_FILENAME_SUFFIX):
+        filename = get_summary_filename(filename)
+    return utils.getDictFromYamlFilename(filename)
+
+
+def load_summaries(filenames):
+    """
+    :param filenames: label --> filename, see load_summary()
+    :type filenames: dict
+    :return: label --> summary
+    :rtype: dict
+    """
+    return {label: load_summary(filename) for label, filename in filenames.iteritems()}
+
+
+def cdf(metric_summary):
+    """
+    The empirical CDF at the upper bin edges, as DenseCorrespondenceEvaluationPlotter.make_cdf_plot()
+    plots it
+    :return: x_axis, cumulative fraction
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    histogram = np.asarray(metric_summary['histogram'], dtype=np.float64)
+    cumhist = np.cumsum(histogram) / metric_summary['count']
+    x_axis = metric_summary['lower_limit'] + metric_summary['bin_size'] * np.arange(len(histogram))
+    return x_axis, cumhist
+
+
+def area_above_curve(metric_summary):
+    """
+    Same as DenseCorrespondenceEvaluationPlotter.compute_area_above_curve()
+    :rtype: float
+    """
+    _, cumhist = cdf(metric_summary)
+    return float(metric_summary['bin_size'] * np.sum(1 - cumhist))
+
+
+def quantile(metric_summary, level):
+    """
+    Quantile interpolated from the quantile sketch
+    :rtype: float
+    """
+    return float(np.interp(level, metric_summary['quantile_levels'], metric_summary['quantiles']))
+
+
+def get_statistic(metric_summary, statistic):
+    """
+    :param statistic: one of STATISTICS, or quantile_<percent>
+    :type statistic: str
+    :rtype: float
+    """
+    if metric_summary.get('count', 0) == 0:
+        return np.nan
+    if statistic == 'area_above_curve':
+        return area_above_curve(metric_summary)
+    if statistic == 'mean':
+        return metric_summary['mean']
+    if statistic == 'median':
+        return quantile(metric_summary, 0.5)
+    if statistic.startswith('quantile_'):
+        return quantile(metric_summary, float(statistic[len('quantile_'):]) / 100.0)
+    raise ValueError("statistic must be one of %s or quantile_<percent>, not %s" %(STATISTICS, statistic))
+
+
+def make_statistics_table(summaries, metrics=None, statistic='area_above_curve'):
+    """
+    :param summaries: label --> summary
+    :type summaries: dict
+    :param metrics: defaults to all metrics of the summaries
+    :type metrics: list of str
+    :return: a row per run, a column per metric
+    :rtype: pandas.DataFrame
+    """
+    if metrics is None:
+        metrics = sorted(set(m for summary in summaries.itervalues() for m in summary['metrics']))
+
+    rows = dict()
+    for label, summary in summaries.iteritems():
+        rows[label] = {metric: get_statistic(summary['metrics'][metric], statistic)
+                       for metric in metrics if metric in summary['metrics']}
+    return pd.DataFrame.from_dict(rows, orient='index').reindex(columns=metrics).sort_index()
+
+
+def rank_runs(summaries, metric, statistic='area_above_curve', ascending=True):
+    """
+    Ranks runs by a statistic of one metric. All metrics in SUMMARY_COLUMNS are errors,
+    so lower is better
+    :param summaries: label --> summary
+    :type summaries: dict
+    :return: runs sorted by the statistic, with columns statistic, count and rank
+    :rtype: pandas.DataFrame
+    """
+    rows = dict()
+    for label, summary in summaries.iteritems():
+        metric_summary = summary['metrics'].get(metric, {'count': 0})
+        rows[label] = {statistic: get_statistic(metric_summary, statistic), 'count': metric_summary['count']}
+
+    df = pd.DataFrame.from_dict(rows, orient='index').sort_values(statistic, ascending=ascending)
+    df['rank'] = np.arange(1, len(df) + 1)
+    return df
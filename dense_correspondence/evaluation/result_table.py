@@ -0,0 +1,311 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+"""
+Columnar accumulator for evaluation results.
+
+The evaluation used to make a one-row pandas.DataFrame per match and pd.concat them
+all at the end. ResultTable keeps one preallocated numpy buffer per column instead,
+which grows geometrically, and takes single rows or whole batches of rows.
+
+The table can stream to a file: every flush_rows rows the buffered rows are written
+out and dropped. Supported formats, by file extension:
+    .csv        same layout as DataFrame.to_csv(), for compatibility
+    .parquet    needs pyarrow
+    .arrow      Arrow IPC file, needs pyarrow. read_result_table() memory maps it
+
+Usage:
+    table = ResultTable(DCNEvaluationPandaTemplate.schema())
+    table.append_row(pd_template.row)
+    table.append({'norm_diff_descriptor': diffs, 'scene_name': scene_names, ...})
+    df = table.to_dataframe()
+"""
+
+COLUMN_DTYPES = {'float64': np.float64, 'int64': np.int64, 'bool': np.bool_, 'str': object}
+
+# values of columns that aren't set. int64 and bool columns have no missing value
+MISSING_VALUES = {'float64': np.nan, 'str': None}
+
+WRITER_FORMATS = [".csv", ".parquet", ".arrow"]
+
+
+def make_schema(columns, dtypes=None):
+    """
+    :param columns: column names, in order
+    :type columns: list of str
+    :param dtypes: column name --> one of COLUMN_DTYPES, columns that aren't in it are float64
+    :type dtypes: dict
+    :return: list of (column name, dtype)
+    :rtype: list
+    """
+    if dtypes is None:
+        dtypes = dict()
+
+    for column, dtype in dtypes.iteritems():
+        if column not in columns:
+            raise ValueError("%s has a dtype but isn't a column" %(column))
+        if dtype not in COLUMN_DTYPES:
+            raise ValueError("dtype of %s must be one of %s, not %s" %(column, COLUMN_DTYPES.keys(), dtype))
+
+    return [(column, dtypes.get(column, 'float64')) for column in columns]
+
+
+class ResultTable(object):
+
+    def __init__(self, schema, initial_capacity=1024, writer=None, flush_rows=None):
+        """
+        :param schema: see make_schema()
+        :type schema: list
+        :param initial_capacity: number of rows the buffers are allocated with
+        :type initial_capacity: int
+        :param writer: (optional) rows are streamed to it, see open_result_writer()
+        :param flush_rows: with a writer, the buffered rows are written out once there are this many
+        :type flush_rows: int
+        """
+        self._schema = schema
+        self._dtypes = dict(schema)
+        self._columns = [column for column, _ in schema]
+        self._capacity = max(initial_capacity, 1)
+        self._num_rows = 0
+        self._buffers = {column: np.empty(self._capacity, dtype=COLUMN_DTYPES[dtype]) for column, dtype in schema}
+
+        self._writer = writer
+        self._flush_rows = flush_rows
+        self._num_rows_written = 0
+
+    @property
+    def schema(self):
+        return self._schema
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def num_rows_written(self):
+        return self._num_rows_written
+
+    def __len__(self):
+        """
+        :return: number of buffered rows, rows that were flushed to the writer aren't counted
+        :rtype: int
+        """
+        return self._num_rows
+
+    def _reserve(self, num_rows):
+        if num_rows <= self._capacity:
+            return
+
+        capacity = self._capacity
+        while capacity < num_rows:
+            capacity *= 2
+
+        for column, dtype in self._schema:
+            buffer = np.empty(capacity, dtype=COLUMN_DTYPES[dtype])
+            buffer[:self._num_rows] = self._buffers[column][:self._num_rows]
+            self._buffers[column] = buffer
+
+        self._capacity = capacity
+
+    def append(self, columns):
+        """
+        Appends a batch of rows
+        :param columns: column name --> array of values, all the same length. Columns that
+        are left out are missing, see MISSING_VALUES
+        :type columns: dict
+        :return:
+        :rtype: None
+        """
+        num_rows = None
+        for column, values in columns.iteritems():
+            if column not in self._dtypes:
+                raise KeyError("%s is not in the schema" %(column))
+            length = np.size(values)
+            if num_rows is None:
+                num_rows = length
+            elif length != num_rows:
+                raise ValueError("column %s has %d values, expected %d" %(column, length, num_rows))
+
+        if not num_rows:
+            return
+
+        start = self._num_rows
+        self._reserve(start + num_rows)
+        for column, dtype in self._schema:
+            buffer = self._buffers[column]
+            if column in columns:
+                buffer[start:start + num_rows] = np.asarray(columns[column]).reshape(-1)
+            elif dtype in MISSING_VALUES:
+                buffer[start:start + num_rows] = MISSING_VALUES[dtype]
+            else:
+                raise ValueError("column %s of dtype %s has no missing value and must be set" %(column, dtype))
+
+        self._num_rows += num_rows
+
+        if (self._writer is not None) and (self._flush_rows is not None) and (self._num_rows >= self._flush_rows):
+            self.flush()
+
+    def append_row(self, row):
+        """
+        :param row: column name --> value
+        :type row: dict
+        :return:
+        :rtype: None
+        """
+        self.append({column: [value] for column, value in row.iteritems()})
+
+    def extend(self, other):
+        """
+        Appends the buffered rows of another table with the same schema
+        :type other: ResultTable
+        """
+        if other.schema != self._schema:
+            raise ValueError("tables have different schemas")
+        self.append(other.to_columns())
+
+    def to_columns(self):
+        """
+        :return: column name --> numpy array of the buffered rows, these are views
+        :rtype: dict
+        """
+        return {column: self._buffers[column][:self._num_rows] for column in self._columns}
+
+    def to_dataframe(self):
+        """
+        :return: the buffered rows
+        :rtype: pandas.DataFrame
+        """
+        columns = self.to_columns()
+        return pd.DataFrame({column: columns[column] for column in self._columns}, columns=self._columns)
+
+    def flush(self):
+        """
+        Writes the buffered rows to the writer and drops them
+        """
+        if (self._writer is None) or (self._num_rows == 0):
+            return
+
+        self._writer.write(self.to_dataframe(), index_start=self._num_rows_written)
+        self._num_rows_written += self._num_rows
+        self._num_rows = 0
+
+    def close(self):
+        """
+        Flushes and closes the writer, if there is one
+        """
+        if self._writer is None:
+            return
+        self.flush()
+        self._writer.close()
+        self._writer = None
+
+
+class CsvResultWriter(object):
+
+    def __init__(self, filename, schema):
+        self._filename = filename
+        self._header_written = False
+
+    def write(self, df, index_start=0):
+        df.index = np.arange(index_start, index_start + len(df))
+        df.to_csv(self._filename, mode='a' if self._header_written else 'w', header=not self._header_written)
+        self._header_written = True
+
+    def close(self):
+        if not self._header_written:
+            open(self._filename, 'w').close()
+
+
+def arrow_schema(schema):
+    types = {'float64': pa.float64(), 'int64': pa.int64(), 'bool': pa.bool_(), 'str': pa.string()}
+    return pa.schema([pa.field(column, types[dtype]) for column, dtype in schema])
+
+
+class ParquetResultWriter(object):
+    """
+    Each flush is a row group
+    """
+
+    def __init__(self, filename, schema):
+        self._schema = arrow_schema(schema)
+        self._writer = pq.ParquetWriter(filename, self._schema)
+
+    def write(self, df, index_start=0):
+        self._writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+
+
+class ArrowResultWriter(object):
+    """
+    Each flush is a record batch of an Arrow IPC file
+    """
+
+    def __init__(self, filename, schema):
+        self._schema = arrow_schema(schema)
+        self._sink = pa.OSFile(filename, 'wb')
+        self._writer = pa.RecordBatchFileWriter(self._sink, self._schema)
+
+    def write(self, df, index_start=0):
+        self._writer.write_batch(pa.RecordBatch.from_pandas(df, schema=self._schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+        self._sink.close()
+
+
+def open_result_writer(filename, schema):
+    """
+    :param filename: the extension picks the format, one of WRITER_FORMATS
+    :type filename: str
+    :param schema: see make_schema()
+    :type schema: list
+    :return: a writer for ResultTable
+    """
+    extension = os.path.splitext(filename)[1]
+    if extension not in WRITER_FORMATS:
+        raise ValueError("extension of %s must be one of %s" %(filename, WRITER_FORMATS))
+
+    if extension == ".csv":
+        return CsvResultWriter(filename, schema)
+
+    if pa is None:
+        raise ValueError("writing %s files needs pyarrow, which isn't installed" %(extension))
+
+    if extension == ".parquet":
+        return ParquetResultWriter(filename, schema)
+    return ArrowResultWriter(filename, schema)
+
+
+def read_result_table(filename, memory_map=True):
+    """
+    Reads a file written by a ResultTable, or a csv written by DataFrame.to_csv()
+    :param filename:
+    :type filename: str
+    :param memory_map: memory map .arrow and .parquet files instead of reading them
+    :type memory_map: bool
+    :return:
+    :rtype: pandas.DataFrame
+    """
+    extension = os.path.splitext(filename)[1]
+    if extension not in [".parquet", ".arrow"]:
+        return pd.read_csv(filename, index_col=0, parse_dates=True)
+
+    if pa is None:
+        raise ValueError("reading %s files needs pyarrow, which isn't installed" %(extension))
+
+    if extension == ".parquet":
+        return pq.read_table(filename, memory_map=memory_map).to_pandas()
+
+    source = pa.memory_map(filename, 'r') if memory_map else pa.OSFile(filename, 'rb')
+    return pa.RecordBatchFileReader(source).read_all().to_pandas()
@@ -0,0 +1,316 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import time
+import logging
+import argparse
+import multiprocessing
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from dense_correspondence.dataset.dense_correspondence_dataset_masked import ImageType
+from dense_correspondence.evaluation.match_plan import compute_3d_positions, is_depth_valid
+from dense_correspondence.network.coarse_to_fine_matcher import squared_distances
+from dense_correspondence_manipulation.utils.constants import DEPTH_IM_SCALE
+
+"""
+Cached SIFT baseline.
+
+DenseCorrespondenceEvaluation.single_image_pair_sift_analysis() used to compute the
+SIFT keypoints of both images of every pair it evaluated, and match them with
+cv2.BFMatcher one match at a time in python. Since the baseline doesn't change, the
+keypoints are now extracted once per frame and kept in a SiftFeatureStore:
+
+    <store_dir>/<scene_name>.npz
+
+holding, for all extracted frames of the scene, the keypoints (position, size, angle,
+response, octave) and descriptors concatenated, with offsets[i]:offsets[i+1] the
+keypoints of img_idxs[i]. OpenCV SIFT descriptor entries are integers in [0, 255],
+so they are stored as uint8 without loss.
+
+Whole scenes are extracted with a process pool, see extract_scene_features(), before
+any pair is evaluated, see DenseCorrespondenceEvaluation.evaluate_sift_baseline(). Pairs
+are matched with one distance matrix and the ratio test on its two smallest entries per
+row, and the 3D statistics of all matches are computed at once.
+
+Usage:
+    python sift_baseline.py --dataset_config config/dense_correspondence/dataset/composite/caterpillar_only_9.yaml \
+        --store_dir /tmp/sift_features --num_workers 8
+"""
+
+SCENE_FILENAME_FORMAT = "%s.npz"
+RATIO_TEST_THRESHOLD = 0.75
+
+
+def compute_sift_features(rgb, mask=None):
+    """
+    SIFT keypoints and descriptors of an image, the same as
+    DenseCorrespondenceEvaluation.compute_sift_keypoints() but as arrays
+    :param rgb: [H, W, 3] or grayscale [H, W]
+    :type rgb: numpy.ndarray
+    :param mask: (optional) keypoints are only detected where it is nonzero
+    :type mask: numpy.ndarray
+    :return: keypoints [N, 6] (u, v, size, angle, response, octave), descriptors [N, 128] uint8
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    if len(rgb.shape) > 2:
+        gray = cv2.cvtColor(rgb, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = rgb
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=np.uint8)
+
+    sift = cv2.xfeatures2d.SIFT_create()
+    kp = sift.detect(gray, mask)
+    kp, des = sift.compute(gray, kp)
+    if des is None or len(kp) == 0:
+        return np.zeros([0, 6], dtype=np.float32), np.zeros([0, 128], dtype=np.uint8)
+
+    keypoints = np.array([[k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave] for k in kp], dtype=np.float32)
+    return keypoints, np.clip(np.round(des), 0, 255).astype(np.uint8)
+
+
+def keypoints_to_cv2(keypoints):
+    """
+    :param keypoints: [N, 6], see compute_sift_features()
+    :type keypoints: numpy.ndarray
+    :return: list of cv2.KeyPoint, e.g. for cv2.drawMatchesKnn
+    :rtype: list
+    """
+    return [cv2.KeyPoint(float(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), int(k[5]))
+            for k in keypoints]
+
+
+def _extract_features_from_files(item):
+    """
+    Process pool worker, takes filenames so that the dataset doesn't need to be pickled
+    """
+    img_idx, rgb_filename, mask_filename = item
+    rgb = np.array(Image.open(rgb_filename).convert('RGB'))
+    mask = np.asarray(Image.open(mask_filename))
+    keypoints, descriptors = compute_sift_features(rgb, mask)
+    return img_idx, keypoints, descriptors
+
+
+class SiftFeatureStore(object):
+    """
+    SIFT keypoints and descriptors per frame, a file per scene
+    """
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        # scene_name --> {img_idx: (keypoints, descriptors)}
+        self._scenes = dict()
+
+    @property
+    def store_dir(self):
+        return self._store_dir
+
+    def _scene_filename(self, scene_name):
+        return os.path.join(self._store_dir, SCENE_FILENAME_FORMAT %(scene_name))
+
+    def _load_scene(self, scene_name):
+        if scene_name in self._scenes:
+            return self._scenes[scene_name]
+
+        frames = dict()
+        filename = self._scene_filename(scene_name)
+        if os.path.exists(filename):
+            data = np.load(filename)
+            offsets = data['offsets']
+            for i, img_idx in enumerate(data['img_idxs']):
+                frames[int(img_idx)] = (data['keypoints'][offsets[i]:offsets[i + 1]],
+                                        data['descriptors'][offsets[i]:offsets[i + 1]])
+        self._scenes[scene_name] = frames
+        return frames
+
+    def _save_scene(self, scene_name):
+        frames = self._scenes[scene_name]
+        img_idxs = sorted(frames.keys())
+        lengths = [len(frames[img_idx][0]) for img_idx in img_idxs]
+
+        d = dict()
+        d['img_idxs'] = np.array(img_idxs, dtype=np.int64)
+        d['offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        d['keypoints'] = np.concatenate([frames[i][0] for i in img_idxs] + [np.zeros([0, 6], dtype=np.float32)])
+        d['descriptors'] = np.concatenate([frames[i][1] for i in img_idxs] + [np.zeros([0, 128], dtype=np.uint8)])
+
+        # the file only shows up under its final name once it is written completely
+        filename = self._scene_filename(scene_name)
+        tmp_filename = filename + ".tmp.npz"
+        np.savez(tmp_filename, **d)
+        os.rename(tmp_filename, filename)
+
+    def has_features(self, scene_name, img_idx):
+        return int(img_idx) in self._load_scene(scene_name)
+
+    def get_features(self, scene_name, img_idx):
+        """
+        :return: keypoints, descriptors, see compute_sift_features()
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        frames = self._load_scene(scene_name)
+        if int(img_idx) not in frames:
+            raise KeyError("no SIFT features for %s %d, run extract_scene_features()" %(scene_name, img_idx))
+        return frames[int(img_idx)]
+
+    def add_features(self, scene_name, features, save=True):
+        """
+        :param features: list of (img_idx, keypoints, descriptors)
+        :type features: list
+        """
+        frames = self._load_scene(scene_name)
+        for img_idx, keypoints, descriptors in features:
+            frames[int(img_idx)] = (keypoints, descriptors)
+        if save:
+            self._save_scene(scene_name)
+
+
+def extract_scene_features(dataset, store, scene_name, img_idxs=None, num_workers=None, chunksize=8):
+    """
+    Extracts the SIFT features of the frames of a scene that aren't in the store yet
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param store:
+    :type store: SiftFeatureStore
+    :param scene_name:
+    :type scene_name: str
+    :param img_idxs: frames to extract, defaults to all frames of the scene
+    :type img_idxs: list of int
+    :param num_workers: number of processes, defaults to the number of cpus
+    :type num_workers: int
+    :return: number of frames extracted
+    :rtype: int
+    """
+    if img_idxs is None:
+        img_idxs = sorted(dataset.get_pose_data(scene_name).keys())
+
+    items = [(img_idx, dataset.get_image_filename(scene_name, img_idx, ImageType.RGB),
+              dataset.get_image_filename(scene_name, img_idx, ImageType.MASK))
+             for img_idx in img_idxs if not store.has_features(scene_name, img_idx)]
+    if len(items) == 0:
+        return 0
+
+    start_time = time.time()
+    if num_workers == 1 or len(items) == 1:
+        features = [_extract_features_from_files(item) for item in items]
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            features = pool.map(_extract_features_from_files, items, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    store.add_features(scene_name, features)
+    logging.info("extracted SIFT features of %d frames of %s in %.1f s" %(len(items), scene_name,
+                                                                         time.time() - start_time))
+    return len(items)
+
+
+def match_features(des_a, des_b, ratio=RATIO_TEST_THRESHOLD, block_size=1024):
+    """
+    Brute force matching with the ratio test, the same matches as cv2.BFMatcher().knnMatch(k=2)
+    followed by m.distance < ratio * n.distance
+    :param des_a: [N_a, 128]
+    :type des_a: numpy.ndarray
+    :param des_b: [N_b, 128]
+    :type des_b: numpy.ndarray
+    :param ratio:
+    :type ratio: float
+    :param block_size: number of rows of the distance matrix computed at once
+    :type block_size: int
+    :return: indices into des_a, indices into des_b, and the distances of the matches
+    :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+    """
+    if len(des_a) == 0 or len(des_b) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    des_a = des_a.astype(np.float32)
+    des_b = des_b.astype(np.float32)
+
+    idx_a_list, idx_b_list, distance_list = [], [], []
+    for start in xrange(0, len(des_a), block_size):
+        squared_diffs = squared_distances(des_a[start:start + block_size], des_b)
+        rows = np.arange(len(squared_diffs))
+
+        # two smallest entries of each row
+        two_best = np.argpartition(squared_diffs, 1, axis=1)[:, :2]
+        best = np.where(squared_diffs[rows, two_best[:, 0]] <= squared_diffs[rows, two_best[:, 1]],
+                        two_best[:, 0], two_best[:, 1])
+        second = np.where(best == two_best[:, 0], two_best[:, 1], two_best[:, 0])
+
+        best_distance = np.sqrt(squared_diffs[rows, best])
+        good = best_distance < ratio * np.sqrt(squared_diffs[rows, second])
+        idx_a_list.append(start + rows[good])
+        idx_b_list.append(best[good])
+        distance_list.append(best_distance[good])
+
+    return np.concatenate(idx_a_list), np.concatenate(idx_b_list), np.concatenate(distance_list)
+
+
+def sift_match_statistics(uv_a, uv_b, depth_a, depth_b, pose_a, pose_b, camera_matrix):
+    """
+    Vectorized DenseCorrespondenceEvaluation.compute_single_sift_match_statistics()
+    :param uv_a: [N, 2] keypoint positions in image a
+    :type uv_a: numpy.ndarray
+    :param uv_b: [N, 2] positions of the matched keypoints in image b
+    :type uv_b: numpy.ndarray
+    :param depth_a: depth image a, as stored (see DEPTH_IM_SCALE)
+    :type depth_a: numpy.ndarray
+    :param depth_b: depth image b
+    :type depth_b: numpy.ndarray
+    :return: column name --> [N] array, is_valid and norm_diff_pred_3d, which is nan
+    when is_valid is False
+    :rtype: dict
+    """
+    image_height, image_width = depth_a.shape[0], depth_a.shape[1]
+
+    def clip_pixel_to_image_size_and_round(uv):
+        uv = np.round(np.asarray(uv, dtype=np.float64)).astype(np.int64)
+        return np.stack([np.minimum(uv[:, 0], image_width - 1), np.minimum(uv[:, 1], image_height - 1)], axis=1)
+
+    uv_a = clip_pixel_to_image_size_and_round(uv_a)
+    uv_b = clip_pixel_to_image_size_and_round(uv_b)
+    uv_a_depth = depth_a[uv_a[:, 1], uv_a[:, 0]] / DEPTH_IM_SCALE
+    uv_b_depth = depth_b[uv_b[:, 1], uv_b[:, 0]] / DEPTH_IM_SCALE
+
+    kp_a_3d = compute_3d_positions(uv_a, uv_a_depth, camera_matrix, pose_a)
+    kp_b_3d = compute_3d_positions(uv_b, uv_b_depth, camera_matrix, pose_b)
+
+    columns = dict()
+    columns['is_valid'] = is_depth_valid(uv_b_depth)
+    columns['norm_diff_pred_3d'] = np.where(columns['is_valid'], np.linalg.norm(kp_b_3d - kp_a_3d, axis=1), np.nan)
+    return columns
+
+
+if __name__ == "__main__":
+    from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_config", type=str, required=True,
+                        help="full path or path relative to the dense correspondence source dir")
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--scene_name", type=str, default=None, help="defaults to all scenes of the dataset")
+    parser.add_argument("--mode", type=str, default="test", choices=["train", "test"])
+    parser.add_argument("--num_workers", type=int, default=None, help="defaults to the number of cpus")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dataset_config_file = args.dataset_config
+    if not os.path.isabs(dataset_config_file):
+        dataset_config_file = os.path.join(utils.getDenseCorrespondenceSourceDir(), dataset_config_file)
+    dataset = SpartanDataset(mode=args.mode, config=utils.getDictFromYamlFilename(dataset_config_file))
+
+    scene_names = [args.scene_name] if args.scene_name is not None else sorted(dataset.get_scene_list())
+    store = SiftFeatureStore(args.store_dir)
+    for scene_name in scene_names:
+        num_frames = extract_scene_features(dataset, store, scene_name, num_workers=args.num_workers)
+        print "%s: extracted %d frames" %(scene_name, num_frames)
@@ -9,33 +9,55 @@ import shutil
 import dense_correspondence_manipulation.utils.utils as utils
 utils.add_dense_correspondence_to_python_path()
 from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+from dense_correspondence.evaluation.result_table import ResultTable, make_schema
 
 class PandaDataFrameWrapper(object):
     """
-    A simple wrapper for a PandaSeries that protects from read/write errors
+    A simple wrapper for a single result row that protects from read/write errors.
+
+    Subclasses list their columns in columns, and the dtype of the columns that
+    aren't float64 in dtypes. Rows are collected in a ResultTable, see schema()
     """
 
+    dtypes = dict()
+
     def __init__(self, columns):
-        data = [np.nan] * len(columns)
         self._columns = columns
-        self._df = pd.DataFrame(data=[data], columns=columns)
+        self._row = dict()
+
+    @classmethod
+    def schema(cls):
+        """
+        :return: the schema of a ResultTable for rows of this template
+        :rtype: list
+        """
+        return make_schema(cls.columns, cls.dtypes)
 
     def set_value(self, key, value):
         if key not in self._columns:
             raise KeyError("%s is not in the index" %(key))
 
-        self._df[key] = value
+        self._row[key] = value
 
     def get_value(self, key):
-        return self._df[key]
+        return self._row.get(key, np.nan)
 
     @property
-    def dataframe(self):
-        return self._df
+    def row(self):
+        """
+        :return: column name --> value of the columns that were set
+        :rtype: dict
+        """
+        return self._row
 
-    @dataframe.setter
-    def dataframe(self, value):
-        self._series = value
+    @property
+    def dataframe(self):
+        """
+        A one-row DataFrame, columns that weren't set are NaN. Prefer collecting
+        rows in a ResultTable over concatenating these
+        """
+        data = [self._row.get(column, np.nan) for column in self._columns]
+        return pd.DataFrame(data=[data], columns=self._columns)
 
 
 
@@ -48,6 +70,11 @@ class KeypointAnnotationsPandasTemplate(PandaDataFrameWrapper):
                'v'
                ]
 
+    dtypes = {'scene_name': 'str',
+              'image_idx': 'int64',
+              'keypoint_name': 'str',
+              'object_id': 'str'}
+
     def __init__(self):
         PandaDataFrameWrapper.__init__(self, KeypointAnnotationsPandasTemplate.columns)
 
@@ -85,7 +112,7 @@ class KeypointAnnotationsPandasTemplate(PandaDataFrameWrapper):
         :rtype:
         """
 
-        pd_dataframe_list = []
+        results = ResultTable(KeypointAnnotationsPandasTemplate.schema())
 
         for d in keypoint_annotations:
             for keypoint, keypoint_data in d['keypoints'].iteritems():
@@ -97,10 +124,10 @@ class KeypointAnnotationsPandasTemplate(PandaDataFrameWrapper):
                 dft.set_value('u', keypoint_data['u'])
                 dft.set_value('v', keypoint_data['v'])
 
-                pd_dataframe_list.append(dft.dataframe)
+                results.append_row(dft.row)
 
 
-        df = pd.concat(pd_dataframe_list)
+        df = results.to_dataframe()
 
         return df
 
@@ -9,13 +9,17 @@ def get_loss(pixelwise_contrastive_loss, match_type,
               matches_a,     matches_b,
               masked_non_matches_a, masked_non_matches_b,
               background_non_matches_a, background_non_matches_b,
-              blind_non_matches_a, blind_non_matches_b):
+              blind_non_matches_a, blind_non_matches_b, reduce_hard_negatives=None):
     """
     This function serves the purpose of:
     - parsing the different types of SpartanDatasetDataType...
     - parsing different types of matches / non matches..
     - into different pixelwise contrastive loss functions
 
+    :param reduce_hard_negatives: (optional) maps the local hard negative counts to the counts
+        to normalize by, see synchronize_hard_negatives()
+    :type reduce_hard_negatives: function
+
     :return args: loss, match_loss, masked_non_match_loss, \
                 background_non_match_loss, blind_non_match_loss
     :rtypes: each pytorch Variables
@@ -30,19 +34,22 @@ def get_loss(pixelwise_contrastive_loss, match_type,
                                             matches_a,    matches_b,
                                             masked_non_matches_a, masked_non_matches_b,
                                             background_non_matches_a, background_non_matches_b,
-                                            blind_non_matches_a, blind_non_matches_b)
+                                            blind_non_matches_a, blind_non_matches_b,
+                                            reduce_hard_negatives=reduce_hard_negatives)
 
     if (match_type == SpartanDatasetDataType.SINGLE_OBJECT_ACROSS_SCENE).all():
         if verbose:
             print "applying SINGLE_OBJECT_ACROSS_SCENE loss"
         return get_same_object_across_scene_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred,
-                                            blind_non_matches_a, blind_non_matches_b)
+                                            blind_non_matches_a, blind_non_matches_b,
+                                            reduce_hard_negatives=reduce_hard_negatives)
 
     if (match_type == SpartanDatasetDataType.DIFFERENT_OBJECT).all():
         if verbose:
             print "applying DIFFERENT_OBJECT loss"
         return get_different_object_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred,
-                                            blind_non_matches_a, blind_non_matches_b)
+                                            blind_non_matches_a, blind_non_matches_b,
+                                            reduce_hard_negatives=reduce_hard_negatives)
 
 
     if (match_type == SpartanDatasetDataType.MULTI_OBJECT).all():
@@ -52,7 +59,8 @@ def get_loss(pixelwise_contrastive_loss, match_type,
                                             matches_a,    matches_b,
                                             masked_non_matches_a, masked_non_matches_b,
                                             background_non_matches_a, background_non_matches_b,
-                                            blind_non_matches_a, blind_non_matches_b)
+                                            blind_non_matches_a, blind_non_matches_b,
+                                            reduce_hard_negatives=reduce_hard_negatives)
 
     if (match_type == SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT).all():
         if verbose:
@@ -61,7 +69,8 @@ def get_loss(pixelwise_contrastive_loss, match_type,
                                             matches_a,    matches_b,
                                             masked_non_matches_a, masked_non_matches_b,
                                             background_non_matches_a, background_non_matches_b,
-                                            blind_non_matches_a, blind_non_matches_b)
+                                            blind_non_matches_a, blind_non_matches_b,
+                                            reduce_hard_negatives=reduce_hard_negatives)
 
     else:
         raise ValueError("Should only have above scenes?")
@@ -71,7 +80,7 @@ def get_within_scene_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred
                                         matches_a,    matches_b,
                                         masked_non_matches_a, masked_non_matches_b,
                                         background_non_matches_a, background_non_matches_b,
-                                        blind_non_matches_a, blind_non_matches_b):
+                                        blind_non_matches_a, blind_non_matches_b, reduce_hard_negatives=None):
     """
     Simple wrapper for pixelwise_contrastive_loss functions.  Args and return args documented above in get_loss()
     """
@@ -106,6 +115,10 @@ def get_within_scene_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred
         
 
 
+    num_masked_hard_negatives, num_background_hard_negatives, num_blind_hard_negatives = \
+        synchronize_hard_negatives(pcl, [num_masked_hard_negatives, num_background_hard_negatives,
+                                         num_blind_hard_negatives], reduce_hard_negatives)
+
     total_num_hard_negatives = num_masked_hard_negatives + num_background_hard_negatives
     total_num_hard_negatives = max(total_num_hard_negatives, 1)
 
@@ -166,13 +179,14 @@ def get_within_scene_loss_triplet(pixelwise_contrastive_loss, image_a_pred, imag
     return total_loss, zero_loss(), zero_loss(), zero_loss(), zero_loss()
 
 def get_different_object_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred,
-                              blind_non_matches_a, blind_non_matches_b):
+                              blind_non_matches_a, blind_non_matches_b, reduce_hard_negatives=None):
     """
     Simple wrapper for pixelwise_contrastive_loss functions.  Args and return args documented above in get_loss()
     """
 
     scale_by_hard_negatives = pixelwise_contrastive_loss.config["scale_by_hard_negatives_DIFFERENT_OBJECT"]
     blind_non_match_loss = zero_loss()
+    num_hard_negatives = 0
     if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         M_descriptor = pixelwise_contrastive_loss.config["M_background"]
 
@@ -180,7 +194,12 @@ def get_different_object_loss(pixelwise_contrastive_loss, image_a_pred, image_b_
             pixelwise_contrastive_loss.non_match_loss_descriptor_only(image_a_pred, image_b_pred,
                                                                     blind_non_matches_a, blind_non_matches_b,
                                                                     M_descriptor=M_descriptor)
-        
+
+    # outside the if statement, every rank needs to call this
+    _, _, num_hard_negatives = synchronize_hard_negatives(pixelwise_contrastive_loss, [0, 0, num_hard_negatives],
+                                                          reduce_hard_negatives)
+
+    if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         if scale_by_hard_negatives:
             scale_factor = max(num_hard_negatives, 1)
         else:
@@ -191,17 +210,21 @@ def get_different_object_loss(pixelwise_contrastive_loss, image_a_pred, image_b_
     return loss, zero_loss(), zero_loss(), zero_loss(), blind_non_match_loss
 
 def get_same_object_across_scene_loss(pixelwise_contrastive_loss, image_a_pred, image_b_pred,
-                              blind_non_matches_a, blind_non_matches_b):
+                              blind_non_matches_a, blind_non_matches_b, reduce_hard_negatives=None):
     """
     Simple wrapper for pixelwise_contrastive_loss functions.  Args and return args documented above in get_loss()
     """
+    pcl = pixelwise_contrastive_loss
     blind_non_match_loss = zero_loss()
+    num_hard_negatives = 0
     if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         blind_non_match_loss, num_hard_negatives =\
             pixelwise_contrastive_loss.non_match_loss_descriptor_only(image_a_pred, image_b_pred,
                                                                     blind_non_matches_a, blind_non_matches_b,
                                                                     M_descriptor=pcl._config["M_masked"], invert=True)
 
+    _, _, num_hard_negatives = synchronize_hard_negatives(pcl, [0, 0, num_hard_negatives], reduce_hard_negatives)
+
     if pixelwise_contrastive_loss._config["scale_by_hard_negatives"]:
         scale_factor = max(num_hard_negatives, 1)
     else:
@@ -211,8 +234,53 @@ def get_same_object_across_scene_loss(pixelwise_contrastive_loss, image_a_pred,
     blind_non_match_loss_scaled = 1.0/scale_factor * blind_non_match_loss
     return loss, zero_loss(), zero_loss(), zero_loss(), blind_non_match_loss
 
+def synchronize_hard_negatives(pixelwise_contrastive_loss, num_hard_negatives, reduce_hard_negatives=None):
+    """
+    In data-parallel training each rank normalizes its non-match losses by its own
+    number of hard negatives. DistributedDataParallel then averages the gradients.
+    Normalizing by the mean number of hard negatives over the ranks instead makes the
+    averaged gradient the same as normalizing the non-match loss of the combined batch
+    by the total number of hard negatives.
+
+    The training passes the reduction across the ranks in, e.g.
+    distributed.mean_over_ranks(), so the loss functions don't depend on torch.distributed.
+    Does nothing unless it is given and sync_hard_negatives_across_ranks is set in the loss
+    function config. Every rank must call this exactly once per loss computation,
+    whichever data type it got, otherwise the collectives don't match up.
+
+    :param num_hard_negatives: list of the local hard negative counts
+    :type num_hard_negatives: list
+    :param reduce_hard_negatives: list of local counts --> list of counts to normalize by
+    :type reduce_hard_negatives: function
+    :return: list of the hard negative counts to normalize by
+    :rtype: list
+    """
+    config = pixelwise_contrastive_loss.config
+    if not (('sync_hard_negatives_across_ranks' in config) and config['sync_hard_negatives_across_ranks']):
+        return num_hard_negatives
+
+    if reduce_hard_negatives is None:
+        return num_hard_negatives
+
+    return reduce_hard_negatives(num_hard_negatives)
+
+# zero loss tensors keyed by device, see zero_loss()
+_ZERO_LOSS_CACHE = dict()
+
 def zero_loss():
-    return Variable(torch.FloatTensor([0]).cuda())
+    """
+    Returns a zero loss on the current cuda device, or on the cpu if there is no
+    cuda. The tensor is cached so that we don't do a host --> device copy every time,
+    don't modify it in place.
+    """
+    if torch.cuda.is_available():
+        device = torch.device("cuda", torch.cuda.current_device())
+    else:
+        device = torch.device("cpu")
+
+    if device not in _ZERO_LOSS_CACHE:
+        _ZERO_LOSS_CACHE[device] = Variable(torch.FloatTensor([0]).to(device))
+    return _ZERO_LOSS_CACHE[device]
 
 def is_zero_loss(loss):
     return loss.item() < 1e-20
@@ -16,6 +16,9 @@ class PixelwiseContrastiveLoss(object):
 
         self._debug = False
 
+        # (name, device) --> index buffer reused across steps, see _get_index_buffer()
+        self._index_buffers = dict()
+
     @property
     def debug(self):
         return self._debug
@@ -32,6 +35,24 @@ class PixelwiseContrastiveLoss(object):
     def debug_data(self):
         return self._debug_data
 
+    def _get_index_buffer(self, name, shape, device):
+        """
+        Returns a LongTensor of the given shape on the device. The storage is reused
+        across calls with the same name and only grows, so that the index tensors of
+        the loss aren't reallocated every step. The contents are overwritten by the
+        next call, don't keep a reference.
+        """
+        key = (name, device)
+        numel = 1
+        for x in shape:
+            numel *= x
+
+        buf = self._index_buffers.get(key)
+        if (buf is None) or (buf.numel() < numel):
+            buf = torch.empty(numel, dtype=torch.long, device=device)
+            self._index_buffers[key] = buf
+        return buf[:numel].view(*shape)
+
     def get_loss_matched_and_non_matched_with_l2(self, image_a_pred, image_b_pred, matches_a, matches_b, non_matches_a, non_matches_b,
                  M_descriptor=None, M_pixel=None, non_match_loss_weight=1.0, use_l2_pixel_loss=None):
         """
@@ -318,12 +339,21 @@ class PixelwiseContrastiveLoss(object):
         if M_pixel is None:
             M_pixel = self._config['M_pixel']
 
-        num_non_matches_per_match = len(non_matches_b)/len(matches_b)
+        num_matches = len(matches_b)
+        num_non_matches_per_match = len(non_matches_b)/num_matches
+        num_non_matches = num_matches * num_non_matches_per_match
+        device = matches_b.device
 
-        ground_truth_pixels_for_non_matches_b = torch.t(matches_b.repeat(num_non_matches_per_match,1)).contiguous().view(-1,1)
+        # the match of each non-match, written into a reused buffer instead of repeat + transpose
+        ground_truth_pixels_for_non_matches_b = self._get_index_buffer("ground_truth_pixels",
+                                                                       [num_matches, num_non_matches_per_match], device)
+        ground_truth_pixels_for_non_matches_b.copy_(matches_b.unsqueeze(1).expand(num_matches, num_non_matches_per_match))
+        ground_truth_pixels_for_non_matches_b = ground_truth_pixels_for_non_matches_b.view(-1,1)
 
-        ground_truth_u_v_b = self.flattened_pixel_locations_to_u_v(ground_truth_pixels_for_non_matches_b)
-        sampled_u_v_b      = self.flattened_pixel_locations_to_u_v(non_matches_b.unsqueeze(1))
+        ground_truth_u_v_b = self.flattened_pixel_locations_to_u_v(ground_truth_pixels_for_non_matches_b,
+            out=self._get_index_buffer("ground_truth_u_v", [num_non_matches, 2], device))
+        sampled_u_v_b      = self.flattened_pixel_locations_to_u_v(non_matches_b.unsqueeze(1),
+            out=self._get_index_buffer("sampled_u_v", [num_non_matches, 2], device))
 
         # each element is always within [0,1], you have 1 if you are at least M_pixel away in
         # L2 norm in pixel space
@@ -335,18 +365,24 @@ class PixelwiseContrastiveLoss(object):
         
 
     
-    def flattened_pixel_locations_to_u_v(self, flat_pixel_locations):
+    def flattened_pixel_locations_to_u_v(self, flat_pixel_locations, out=None):
         """
         :param flat_pixel_locations: A torch.LongTensor of shape torch.Shape([n,1]) where each element
          is a flattened pixel index, i.e. some integer between 0 and 307,200 for a 640x480 image
 
         :type flat_pixel_locations: torch.LongTensor
 
+        :param out: (optional) LongTensor of shape (n,2) to write the result to
+
         :return A torch.LongTensor of shape (n,2) where the first column is the u coordinates of
         the pixel and the second column is the v coordinate
 
         """
-        u_v_pixel_locations = flat_pixel_locations.repeat(1,2)
+        if out is None:
+            u_v_pixel_locations = flat_pixel_locations.repeat(1,2)
+        else:
+            u_v_pixel_locations = out
+            u_v_pixel_locations.copy_(flat_pixel_locations.expand(-1,2))
         u_v_pixel_locations[:,0] = u_v_pixel_locations[:,0]%self.image_width 
         u_v_pixel_locations[:,1] = u_v_pixel_locations[:,1]/self.image_width
         return u_v_pixel_locations
@@ -0,0 +1,171 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import time
+import random
+import argparse
+
+import numpy as np
+
+from dense_correspondence_manipulation.utils.constants import DEPTH_IM_SCALE
+import dense_correspondence.correspondence_tools.correspondence_finder as correspondence_finder
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.network.keypoint_tracker import KeypointTracker
+
+"""
+Benchmarks KeypointTracker against a global find_best_match_for_descriptor per
+keypoint per frame, on a recorded scene.
+
+Keypoints are sampled on the object mask of the first frame, their reference
+descriptors are taken from that frame. The ground truth location of each keypoint in
+the later frames comes from the depth images and camera poses, keypoints that are
+occluded in a frame are left out of the accuracy numbers.
+
+The time of the network forward pass is the same for both methods and is reported
+separately.
+
+Usage:
+    python benchmark_keypoint_tracker.py --model_folder trained_models/caterpillar_3 --scene_name 2018-04-16-14-25-19
+"""
+
+# depth differences larger than this mean the keypoint is occluded
+OCCLUSION_MARGIN = 0.01 # meters
+
+
+def sample_keypoints(depth, mask, num_keypoints):
+    """
+    :return: pixels on the object with valid depth, shape [K, 2] in (u,v) = (right, down)
+    :rtype: numpy.ndarray
+    """
+    valid = np.logical_and(mask > 0, depth > 0)
+    rows, cols = correspondence_finder.random_sample_from_masked_image(valid, num_keypoints)
+    return np.stack([cols, rows], axis=1)
+
+
+def get_ground_truth(world_points, depth, pose, K):
+    """
+    Projects the keypoints into a frame
+    :param world_points: [K, 3]
+    :return: uv [K, 2], visible [K] bool
+    :rtype: tuple
+    """
+    height, width = depth.shape
+    uv = np.zeros([len(world_points), 2])
+    visible = np.zeros(len(world_points), dtype=bool)
+    world_to_camera = np.linalg.inv(pose)
+
+    for i, world_pos in enumerate(world_points):
+        uv[i] = correspondence_finder.pinhole_projection_world_to_image(world_pos, K, camera_to_world=pose)
+        u, v = int(round(uv[i, 0])), int(round(uv[i, 1]))
+        if not ((0 <= u < width) and (0 <= v < height)):
+            continue
+
+        z = world_to_camera.dot(np.append(world_pos, 1))[2]
+        z_observed = depth[v, u] / DEPTH_IM_SCALE
+        visible[i] = (z_observed > 0) and (abs(z - z_observed) < OCCLUSION_MARGIN)
+
+    return uv, visible
+
+
+def run_benchmark(dcn, dataset, scene_name, num_keypoints=10, num_frames=200, **kwargs):
+    """
+    :param kwargs: passed to KeypointTracker
+    :return: dict of results
+    :rtype: dict
+    """
+    random.seed(0)
+    image_idxs = sorted(dataset.get_pose_data(scene_name).keys())[:num_frames]
+    K = dataset.get_camera_intrinsics(scene_name).K
+
+    def forward(img_idx):
+        rgb, depth, mask, pose = dataset.get_rgbd_mask_pose(scene_name, img_idx)
+        start = time.time()
+        res = dcn.forward_single_image_tensor(dataset.rgb_image_to_tensor(rgb)).data.cpu().numpy()
+        return res, np.asarray(depth), np.asarray(mask), pose, time.time() - start
+
+    res, depth, mask, pose, _ = forward(image_idxs[0])
+    keypoints_uv = sample_keypoints(depth, mask, num_keypoints)
+    descriptors = res[keypoints_uv[:, 1], keypoints_uv[:, 0]]
+    world_points = np.array([correspondence_finder.pinhole_projection_image_to_world_coordinates(
+        uv, depth[uv[1], uv[0]] / DEPTH_IM_SCALE, K, pose) for uv in keypoints_uv])
+
+    tracker = KeypointTracker(descriptors, **kwargs)
+
+    forward_times, tracker_times, global_times = [], [], []
+    tracker_errors, global_errors = [], []
+    num_tracked, num_visible = 0, 0
+
+    for img_idx in image_idxs[1:]:
+        res, depth, mask, pose, forward_time = forward(img_idx)
+        forward_times.append(forward_time)
+        gt_uv, visible = get_ground_truth(world_points, depth, pose, K)
+
+        start = time.time()
+        result = tracker.update(res)
+        tracker_times.append(time.time() - start)
+
+        start = time.time()
+        global_uv = np.array([DenseCorrespondenceNetwork.find_best_match_for_descriptor(descriptor, res)[0]
+                              for descriptor in descriptors])
+        global_times.append(time.time() - start)
+
+        tracker_errors.extend(np.linalg.norm(result['uv'][visible] - gt_uv[visible], axis=1))
+        global_errors.extend(np.linalg.norm(global_uv[visible] - gt_uv[visible], axis=1))
+        num_tracked += np.sum(result['tracked'][visible])
+        num_visible += np.sum(visible)
+
+    def error_stats(errors):
+        errors = np.array(errors)
+        if len(errors) == 0:
+            return dict()
+        return {'median_pixel_error': float(np.median(errors)),
+                'fraction_within_10_pixels': float(np.mean(errors < 10))}
+
+    d = dict()
+    d['num_frames'] = len(image_idxs) - 1
+    d['num_keypoints'] = len(descriptors)
+    d['forward_time'] = float(np.median(forward_times))
+    d['tracker'] = error_stats(tracker_errors)
+    d['tracker']['search_time'] = float(np.median(tracker_times))
+    d['tracker']['tracked_fraction'] = float(num_tracked) / max(num_visible, 1)
+    d['tracker'].update(tracker.summary())
+    d['global'] = error_stats(global_errors)
+    d['global']['search_time'] = float(np.median(global_times))
+    d['speedup'] = d['global']['search_time'] / d['tracker']['search_time']
+    return d
+
+
+def print_results(d):
+    print "%d keypoints, %d frames, forward pass %.4f s" %(d['num_keypoints'], d['num_frames'], d['forward_time'])
+    print "%-10s%16s%16s%20s" %("method", "search s", "median error", "within 10 pixels")
+    for method in ['tracker', 'global']:
+        r = d[method]
+        print "%-10s%16.5f%16.2f%20.3f" %(method, r['search_time'], r.get('median_pixel_error', np.nan),
+                                          r.get('fraction_within_10_pixels', np.nan))
+    print "tracker speedup %.1fx, global search fraction %.3f, tracked fraction %.3f" \
+          %(d['speedup'], d['tracker']['global_search_fraction'], d['tracker']['tracked_fraction'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--scene_name", type=str, required=True)
+    parser.add_argument("--num_keypoints", type=int, default=10)
+    parser.add_argument("--num_frames", type=int, default=200)
+    parser.add_argument("--window_size", type=int, default=41)
+    parser.add_argument("--max_descriptor_distance", type=float, default=0.5)
+    parser.add_argument("--ratio_test_threshold", type=float, default=0.9)
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder)
+    dcn.eval()
+    dataset = dcn.load_training_dataset()
+
+    results = run_benchmark(dcn, dataset, args.scene_name, num_keypoints=args.num_keypoints,
+                            num_frames=args.num_frames, window_size=args.window_size,
+                            max_descriptor_distance=args.max_descriptor_distance,
+                            ratio_test_threshold=args.ratio_test_threshold)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
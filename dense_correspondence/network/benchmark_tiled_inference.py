@@ -0,0 +1,139 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+"""
+Benchmarks the latency and peak memory of TiledInference against the image resolution,
+see tiled_inference.py.
+
+Uses a randomly initialized network and random images, so no trained model is needed.
+Each (resolution, mode) pair runs in its own process, so that the peak memory numbers
+are independent. On the GPU peak memory is torch.cuda.max_memory_allocated, on the
+CPU it is the peak RSS of the process.
+
+Usage:
+    python benchmark_tiled_inference.py --resolutions 480x640 960x1280 1080x1920 --max_memory_mb 1024
+"""
+
+DC_SOURCE_DIR = utils.getDenseCorrespondenceSourceDir()
+TRAINING_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training', 'training.yaml')
+
+RESOLUTIONS = ["240x320", "480x640", "960x1280", "1080x1920"]
+
+BYTES_PER_MB = 1024.0 * 1024.0
+
+
+def get_modes(max_memory_mb):
+    """
+    :return: dict of mode name --> TiledInference kwargs
+    :rtype: dict
+    """
+    return {'full': dict(),
+            'tiled': {'max_memory_mb': max_memory_mb},
+            'half_resolution': {'scale': 0.5},
+            'tiled_stride_4': {'max_memory_mb': max_memory_mb, 'output_stride': 4}}
+
+
+def benchmark_mode(image_shape, tiled_inference_kwargs, num_iterations, result_queue):
+    """
+    Runs in a separate process
+    """
+    # imports are here so that nothing touches CUDA before the fork
+    import torch
+    from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+    from dense_correspondence.network.tiled_inference import TiledInference
+    from dense_correspondence.training.memory_management import get_peak_rss_mb
+
+    train_config = utils.getDictFromYamlFilename(TRAINING_CONFIG_FILE)
+    dcn = DenseCorrespondenceNetwork.from_config(train_config['dense_correspondence_network'],
+                                                 load_stored_params=False)
+    dcn.eval()
+    cuda = (dcn.device.type == "cuda")
+
+    tiled = TiledInference(dcn, **tiled_inference_kwargs)
+    img_tensor = torch.rand(3, image_shape[0], image_shape[1])
+
+    # warm up, also estimates the memory per pixel
+    tiled.forward_image_tensor(img_tensor)
+    if cuda:
+        torch.cuda.synchronize()
+        if hasattr(torch.cuda, 'reset_max_memory_allocated'):
+            torch.cuda.reset_max_memory_allocated()
+
+    latencies = []
+    for i in xrange(num_iterations):
+        start = time.time()
+        tiled.forward_image_tensor(img_tensor)
+        if cuda:
+            torch.cuda.synchronize()
+        latencies.append(time.time() - start)
+
+    d = dict()
+    d['latency_median'] = float(np.median(latencies))
+    d['megapixels_per_second'] = image_shape[0] * image_shape[1] / 1e6 / d['latency_median']
+    if cuda:
+        d['peak_memory_mb'] = torch.cuda.max_memory_allocated() / BYTES_PER_MB
+    else:
+        d['peak_memory_mb'] = get_peak_rss_mb()
+
+    result_queue.put(d)
+
+
+def run_benchmark(resolutions=RESOLUTIONS, max_memory_mb=1024, num_iterations=5):
+    """
+    :param resolutions: list of "HxW" strings
+    :type resolutions: list of str
+    :return: dict of resolution --> mode --> stats
+    :rtype: dict
+    """
+    modes = get_modes(max_memory_mb)
+
+    results = dict()
+    for resolution in resolutions:
+        image_shape = [int(x) for x in resolution.split("x")]
+        results[resolution] = dict()
+        for mode, kwargs in sorted(modes.iteritems()):
+            print "benchmarking %s, %s" %(resolution, mode)
+            result_queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=benchmark_mode,
+                                        args=(image_shape, kwargs, num_iterations, result_queue))
+            p.start()
+            p.join()
+
+            if p.exitcode != 0:
+                # e.g. out of memory without tiling
+                print "%s, %s failed with exit code %d" %(resolution, mode, p.exitcode)
+                continue
+
+            results[resolution][mode] = result_queue.get()
+
+    return results
+
+
+def print_results(results):
+    print "%-12s%-18s%16s%16s%16s" %("resolution", "mode", "latency s", "MP/s", "memory MB")
+    for resolution in sorted(results.keys(), key=lambda x: [int(y) for y in x.split("x")]):
+        for mode, d in sorted(results[resolution].iteritems()):
+            print "%-12s%-18s%16.4f%16.2f%16.1f" %(resolution, mode, d['latency_median'],
+                                                   d['megapixels_per_second'], d['peak_memory_mb'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolutions", type=str, nargs='+', default=RESOLUTIONS, help="HxW")
+    parser.add_argument("--max_memory_mb", type=float, default=1024)
+    parser.add_argument("--num_iterations", type=int, default=5)
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    results = run_benchmark(resolutions=args.resolutions, max_memory_mb=args.max_memory_mb,
+                            num_iterations=args.num_iterations)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
@@ -0,0 +1,193 @@
+import numpy as np
+
+"""
+Coarse-to-fine matching of descriptors against a descriptor image.
+
+DenseCorrespondenceNetwork.find_best_match_for_descriptor() compares a query against
+every pixel, O(H*W*D) per query. CoarseToFineMatcher builds a pyramid of the
+descriptor image by average pooling, finds the num_candidates best matches of each
+query at the coarsest level, and then searches only small windows around those
+candidates at full resolution. The queries are matched together, each step is a
+single batched distance computation.
+
+Usage:
+    matcher = CoarseToFineMatcher(res_b) # res_b is [H, W, D]
+    best_match_uv, best_match_diff = matcher.find_best_match(uv_a, res_a)
+"""
+
+
+def build_descriptor_pyramid(res, num_levels=3, normalize=True):
+    """
+    Builds a pyramid of descriptor images, each level is average pooled by a factor
+    of 2 from the one before it. Odd rows and columns at the border are dropped.
+    :param res: descriptor image, shape [H, W, D]
+    :type res: numpy.ndarray
+    :param num_levels: number of levels, including the full resolution one
+    :type num_levels: int
+    :param normalize: renormalize the pooled descriptors to unit norm, use this
+    if the network normalizes its descriptors
+    :type normalize: bool
+    :return: list of descriptor images, level 0 is res
+    :rtype: list of numpy.ndarray
+    """
+    pyramid = [res]
+    for level in xrange(1, num_levels):
+        prev = pyramid[-1]
+        height, width, descriptor_dimension = prev.shape
+        height, width = height // 2, width // 2
+        if min(height, width) == 0:
+            break
+
+        pooled = prev[:2 * height, :2 * width].reshape(height, 2, width, 2, descriptor_dimension).mean(axis=(1, 3))
+        if normalize:
+            pooled = pooled / np.maximum(np.linalg.norm(pooled, axis=2, keepdims=True), 1e-12)
+        pyramid.append(pooled)
+
+    return pyramid
+
+
+def squared_distances(descriptors, res_flat):
+    """
+    :param descriptors: [Q, D]
+    :param res_flat: [N, D]
+    :return: squared distances, shape [Q, N]
+    :rtype: numpy.ndarray
+    """
+    squared_diffs = np.sum(np.square(descriptors), axis=1)[:, None] - 2 * descriptors.dot(res_flat.T) \
+                    + np.sum(np.square(res_flat), axis=1)[None, :]
+    return np.maximum(squared_diffs, 0)
+
+
+class CoarseToFineMatcher(object):
+
+    def __init__(self, res, num_levels=3, num_candidates=4, window_radius=None, normalize=True,
+                 max_queries_per_batch=256):
+        """
+        :param res: the descriptor image that is searched, shape [H, W, D]
+        :type res: numpy.ndarray
+        :param num_levels: number of pyramid levels, the candidates are found at the coarsest
+        :type num_levels: int
+        :param num_candidates: number of coarse candidates refined per query
+        :type num_candidates: int
+        :param window_radius: radius of the full resolution window around each candidate.
+        Defaults to the size of a coarse pixel at full resolution
+        :type window_radius: int
+        :param normalize: see build_descriptor_pyramid()
+        :type normalize: bool
+        :param max_queries_per_batch: bounds the memory of the refinement step
+        :type max_queries_per_batch: int
+        """
+        self._res = np.asarray(res, dtype=np.float32)
+        self._pyramid = build_descriptor_pyramid(self._res, num_levels=num_levels, normalize=normalize)
+        self._scale = 2 ** (len(self._pyramid) - 1)
+
+        coarse = self._pyramid[-1]
+        self._coarse_shape = coarse.shape[:2]
+        self._coarse_flat = coarse.reshape(-1, coarse.shape[2])
+        self._num_candidates = min(num_candidates, self._coarse_flat.shape[0])
+
+        if window_radius is None:
+            window_radius = self._scale
+        self._window_radius = window_radius
+        self._max_queries_per_batch = max_queries_per_batch
+
+    @property
+    def pyramid(self):
+        return self._pyramid
+
+    def _coarse_candidates(self, descriptors):
+        """
+        :return: centers of the candidates at full resolution, (row, column), shape [Q, C, 2]
+        :rtype: numpy.ndarray
+        """
+        squared_diffs = squared_distances(descriptors, self._coarse_flat)
+        if self._num_candidates < squared_diffs.shape[1]:
+            candidate_idxs = np.argpartition(squared_diffs, self._num_candidates - 1, axis=1)[:, :self._num_candidates]
+        else:
+            candidate_idxs = np.tile(np.arange(squared_diffs.shape[1]), (len(descriptors), 1))
+
+        rows, cols = np.unravel_index(candidate_idxs, self._coarse_shape)
+        return np.stack([rows, cols], axis=2) * self._scale + self._scale // 2
+
+    def _refine(self, descriptors, centers):
+        """
+        Exhaustive search in the full resolution windows around the candidates
+        :param descriptors: [Q, D]
+        :param centers: [Q, C, 2], see _coarse_candidates()
+        :return: best_match_uv [Q, 2], best_match_diff [Q]
+        :rtype: tuple
+        """
+        height, width, _ = self._res.shape
+        num_queries, num_candidates, _ = centers.shape
+        window_height = min(2 * self._window_radius + 1, height)
+        window_width = min(2 * self._window_radius + 1, width)
+
+        # windows are shifted at the image border so that they all have the same size
+        row_origin = np.clip(centers[:, :, 0] - window_height // 2, 0, height - window_height)
+        col_origin = np.clip(centers[:, :, 1] - window_width // 2, 0, width - window_width)
+        rows = row_origin[:, :, None] + np.arange(window_height)
+        cols = col_origin[:, :, None] + np.arange(window_width)
+
+        windows = self._res[rows[:, :, :, None], cols[:, :, None, :]] # [Q, C, h, w, D]
+        squared_diffs = np.sum(np.square(windows - descriptors[:, None, None, None, :]), axis=4)
+
+        flattened = squared_diffs.reshape(num_queries, -1)
+        best_idx = np.argmin(flattened, axis=1)
+        candidate, window_row, window_col = np.unravel_index(best_idx, (num_candidates, window_height, window_width))
+
+        query_idxs = np.arange(num_queries)
+        best_match_uv = np.stack([col_origin[query_idxs, candidate] + window_col,
+                                  row_origin[query_idxs, candidate] + window_row], axis=1)
+        best_match_diff = np.sqrt(flattened[query_idxs, best_idx])
+        return best_match_uv, best_match_diff
+
+    def find_best_match_for_descriptors(self, descriptors):
+        """
+        :param descriptors: query descriptors, shape [Q, D]
+        :type descriptors: numpy.ndarray
+        :return: best_match_uv [Q, 2] in (u,v) = (right, down), best_match_diff [Q]
+        :rtype: tuple
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32).reshape(-1, self._res.shape[2])
+        best_match_uv = np.zeros([len(descriptors), 2], dtype=np.int64)
+        best_match_diff = np.zeros(len(descriptors), dtype=np.float32)
+
+        for start in xrange(0, len(descriptors), self._max_queries_per_batch):
+            batch = descriptors[start:start + self._max_queries_per_batch]
+            centers = self._coarse_candidates(batch)
+            uv, diff = self._refine(batch, centers)
+            best_match_uv[start:start + len(batch)] = uv
+            best_match_diff[start:start + len(batch)] = diff
+
+        return best_match_uv, best_match_diff
+
+    def find_best_match_for_descriptor(self, descriptor):
+        """
+        Same as DenseCorrespondenceNetwork.find_best_match_for_descriptor(), without the norm_diffs
+        :param descriptor: shape [D]
+        :type descriptor: numpy.ndarray
+        :return: (best_match_uv, best_match_diff)
+        :rtype: tuple
+        """
+        best_match_uv, best_match_diff = self.find_best_match_for_descriptors(descriptor[None, :])
+        return (best_match_uv[0, 0], best_match_uv[0, 1]), best_match_diff[0]
+
+    def find_best_match(self, pixel_a, res_a):
+        """
+        Same as DenseCorrespondenceNetwork.find_best_match(pixel_a, res_a, res_b), without
+        the norm_diffs. res_b is the descriptor image the matcher was built with
+        :param pixel_a: (u,v) pixel in image a, or a list of them
+        :type pixel_a: tuple or list of tuples
+        :param res_a: descriptor image a, shape [H, W, D]
+        :type res_a: numpy.ndarray
+        :return: (best_match_uv, best_match_diff), for a list of pixels these are arrays
+        of shape [Q, 2] and [Q]
+        :rtype: tuple
+        """
+        uv_a = np.asarray(pixel_a)
+        if uv_a.ndim == 1:
+            descriptor = res_a[uv_a[1], uv_a[0]]
+            return self.find_best_match_for_descriptor(descriptor)
+
+        descriptors = res_a[uv_a[:, 1], uv_a[:, 0]]
+        return self.find_best_match_for_descriptors(descriptors)
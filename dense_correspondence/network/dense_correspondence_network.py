@@ -12,10 +12,77 @@ from PIL import Image
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torchvision import transforms
 import pytorch_segmentation_detection.models.resnet_dilated as resnet_dilated
 from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+import dense_correspondence.network.mixed_precision as mixed_precision_utils
+
+
+
+# the stages of the Resnet backbones
+RESNET_STAGE_NAMES = ("layer1", "layer2", "layer3", "layer4")
+
+# an int8 model is stored next to its float32 params, e.g. 003500.pth --> 003500_int8.pt
+QUANTIZED_PARAM_FILE_SUFFIX = "_int8.pt"
+
+
+def get_quantized_param_file(model_param_file):
+    """
+    Returns the filename of the int8 model that goes with a float32 param file
+    :param model_param_file: e.g. /path/to/003500.pth
+    :type model_param_file: str
+    :return: e.g. /path/to/003500_int8.pt
+    :rtype: str
+    """
+    return os.path.splitext(model_param_file)[0] + QUANTIZED_PARAM_FILE_SUFFIX
+
+
+def checkpointed_forward(module, forward):
+    """
+    Wraps a forward function so that it runs with torch.utils.checkpoint when gradients
+    are being computed, and normally otherwise (e.g. in eval under torch.no_grad()).
+
+    The recomputation in the backward pass doesn't update the batch norm running
+    statistics of the module, so they are updated once per forward pass like without
+    checkpointing.
+    :param module: the module whose forward is wrapped
+    :type module: nn.Module
+    :param forward: bound forward method of the module
+    :type forward:
+    :return:
+    :rtype:
+    """
+    def f(*inputs):
+        if not (torch.is_grad_enabled() and any(x.requires_grad for x in inputs)):
+            return forward(*inputs)
+
+        calls = [0]
+
+        def run(*args):
+            calls[0] += 1
+            if calls[0] == 1:
+                return forward(*args)
+
+            # the recomputation
+            batch_norm_layers = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+                                 and m.training and m.track_running_stats]
+            saved = [(m.momentum, getattr(m, 'num_batches_tracked', None)) for m in batch_norm_layers]
+            for m in batch_norm_layers:
+                m.momentum = 0.0
+                if m.num_batches_tracked is not None:
+                    m.num_batches_tracked = m.num_batches_tracked.clone()
+            try:
+                return forward(*args)
+            finally:
+                for m, (momentum, num_batches_tracked) in zip(batch_norm_layers, saved):
+                    m.momentum = momentum
+                    if num_batches_tracked is not None:
+                        m.num_batches_tracked = num_batches_tracked
+
+        return torch.utils.checkpoint.checkpoint(run, *inputs)
 
+    return f
 
 
 class DenseCorrespondenceNetwork(nn.Module):
@@ -57,6 +124,11 @@ class DenseCorrespondenceNetwork(nn.Module):
         self._normalize = normalize
         self._constructed_from_model_folder = False
 
+        self._mixed_precision = False
+        self._channels_last = False
+        self._activation_checkpointing = False
+        self._quantized = False
+
 
     @property
     def fcn(self):
@@ -153,6 +225,113 @@ class DenseCorrespondenceNetwork(nn.Module):
 
         return self._descriptor_image_stats
 
+    @property
+    def mixed_precision(self):
+        return self._mixed_precision
+
+    @property
+    def channels_last(self):
+        return self._channels_last
+
+    def set_precision(self, mixed_precision=False, channels_last=False):
+        """
+        Sets whether the backbone runs in mixed precision (float16 on the GPU, bfloat16
+        on the CPU) and whether it uses the channels last memory layout.
+
+        The output descriptors, and their normalization, are always float32.
+        Both options fall back to the default behavior if this version of pytorch
+        doesn't support them on the device the network is on.
+
+        :param mixed_precision:
+        :type mixed_precision: bool
+        :param channels_last:
+        :type channels_last: bool
+        :return:
+        :rtype: None
+        """
+        mixed_precision_utils.warn_if_unavailable(mixed_precision, channels_last,
+                                                  cuda=(self.device.type == "cuda"))
+        self._mixed_precision = mixed_precision
+        self._channels_last = channels_last
+
+        if channels_last:
+            self._fcn = mixed_precision_utils.to_channels_last(self._fcn)
+        else:
+            self._fcn = mixed_precision_utils.to_contiguous_format(self._fcn)
+
+    @property
+    def activation_checkpointing(self):
+        return self._activation_checkpointing
+
+    def set_activation_checkpointing(self, enabled=True, stage_names=RESNET_STAGE_NAMES):
+        """
+        Turns on activation checkpointing of the backbone stages. The activations inside
+        each stage are not stored during the forward pass, they are recomputed during the
+        backward pass. This trades compute for memory.
+
+        Stages are found by name, e.g. layer1, ..., layer4 of the Resnet backbones.
+        The state dict is not changed.
+
+        The batch norm running statistics are only updated in the forward pass, not in the
+        recomputation, see checkpointed_forward().
+
+        :param enabled:
+        :type enabled: bool
+        :param stage_names: names of the submodules to checkpoint
+        :type stage_names: tuple of str
+        :return: number of stages that are checkpointed
+        :rtype: int
+        """
+        num_stages = 0
+        for module in self._fcn.modules():
+            for name in stage_names:
+                stage = getattr(module, name, None)
+                if not isinstance(stage, nn.Module):
+                    continue
+
+                if enabled:
+                    stage.forward = checkpointed_forward(stage, type(stage).forward.__get__(stage))
+                elif 'forward' in stage.__dict__:
+                    del stage.forward
+
+                num_stages += 1
+
+        if enabled and num_stages == 0:
+            logging.warning("no stages named %s found in the backbone, activation checkpointing has no effect" %(str(stage_names)))
+
+        self._activation_checkpointing = enabled
+        return num_stages
+
+    @property
+    def quantized(self):
+        return self._quantized
+
+    def set_quantized_fcn(self, fcn):
+        """
+        Replaces the backbone with an int8 quantized one, see quantization.py.
+        Quantized backbones only run on the CPU, so this moves the network to the CPU.
+        :param fcn: TorchScript module of the quantized backbone
+        :type fcn: torch.jit.ScriptModule
+        :return:
+        :rtype: None
+        """
+        self.cpu()
+        self._fcn = fcn
+        self._quantized = True
+        self._mixed_precision = False
+        self._channels_last = False
+
+    @property
+    def device(self):
+        """
+        The device the network runs on
+        :return:
+        :rtype: torch.device
+        """
+        if self._quantized:
+            return torch.device("cpu")
+        return next(self._fcn.parameters()).device
+
     @property
     def constructed_from_model_folder(self):
         """
@@ -252,7 +431,14 @@ class DenseCorrespondenceNetwork(nn.Module):
         :rtype:
         """
 
-        res = self.fcn(img_tensor)
+        if self._channels_last:
+            img_tensor = mixed_precision_utils.to_channels_last(img_tensor)
+
+        with mixed_precision_utils.autocast(cuda=img_tensor.is_cuda, enabled=self._mixed_precision):
+            res = self.fcn(img_tensor)
+
+        # descriptors and their normalization are always float32
+        res = res.float().contiguous()
         if self._normalize:
             #print "normalizing descriptor norm"
             norm = torch.norm(res, 2, 1) # [N,1,H,W]
@@ -282,8 +468,8 @@ class DenseCorrespondenceNetwork(nn.Module):
         # transform to shape [1,3,H,W]
         img_tensor = img_tensor.unsqueeze(0)
 
-        # make sure it's on the GPU
-        img_tensor = torch.tensor(img_tensor, device=torch.device("cuda"))
+        # make sure it's on the same device as the network
+        img_tensor = torch.tensor(img_tensor, device=self.device)
 
 
         res = self.forward(img_tensor) # shape [1,D,H,W]
@@ -312,22 +498,28 @@ class DenseCorrespondenceNetwork(nn.Module):
         :rtype:
         """
 
-        W = self._image_width
-        H = self._image_height
+        # the network is fully convolutional, use the size of the images that were passed in
+        H, W = image_pred.shape[2], image_pred.shape[3]
         image_pred = image_pred.view(N, self.descriptor_dimension, W * H)
         image_pred = image_pred.permute(0, 2, 1)
         return image_pred
 
-    def clip_pixel_to_image_size_and_round(self, uv):
+    def clip_pixel_to_image_size_and_round(self, uv, image_shape=None):
         """
         Clips pixel to image coordinates and converts to int
         :param uv:
         :type uv:
+        :param image_shape: [H, W] of the image, defaults to the image shape of the network
+        :type image_shape: list
         :return:
         :rtype:
         """
-        u = min(int(round(uv[0])), self._image_width - 1)
-        v = min(int(round(uv[1])), self._image_height - 1)
+        if image_shape is None:
+            image_shape = self.image_shape
+
+        image_height, image_width = image_shape
+        u = min(int(round(uv[0])), image_width - 1)
+        v = min(int(round(uv[1])), image_height - 1)
         return [u, v]
 
     def load_training_dataset(self):
@@ -432,14 +624,15 @@ class DenseCorrespondenceNetwork(nn.Module):
                 logging.info("loading params with the new style failed, falling back to dcn.fcn.load_state_dict")
                 dcn.fcn.load_state_dict(torch.load(model_param_file))
 
-        dcn.cuda()
+        if torch.cuda.is_available():
+            dcn.cuda()
         dcn.train()
         dcn.config = config
         return dcn
 
     @staticmethod
     def from_model_folder(model_folder, load_stored_params=True, model_param_file=None,
-        iteration=None):
+        iteration=None, quantized=False):
         """
         Loads a DenseCorrespondenceNetwork from a model folder
         :param model_folder: the path to the folder where the model is stored. This direction contains
@@ -449,6 +642,9 @@ class DenseCorrespondenceNetwork(nn.Module):
             - training.yaml
 
         :type model_folder:
+        :param quantized: if True loads the int8 model 003500_int8.pt made by quantization.py
+        instead of the float32 params. The network then runs on the CPU.
+        :type quantized: bool
         :return: a DenseCorrespondenceNetwork objecc t
         :rtype:
         """
@@ -472,9 +668,16 @@ class DenseCorrespondenceNetwork(nn.Module):
 
 
         dcn = DenseCorrespondenceNetwork.from_config(config,
-                                                     load_stored_params=load_stored_params,
+                                                     load_stored_params=(load_stored_params and not quantized),
                                                      model_param_file=model_param_file)
 
+        if quantized:
+            quantized_param_file = get_quantized_param_file(model_param_file)
+            if not os.path.exists(quantized_param_file):
+                raise ValueError("%s doesn't exist, run quantization.py first" %(quantized_param_file))
+            dcn.set_quantized_fcn(torch.jit.load(quantized_param_file, map_location="cpu"))
+            dcn.config["model_param_filename_tail"] = os.path.split(quantized_param_file)[1]
+
 
         # whether or not network was constructed from model folder
         dcn.constructed_from_model_folder = from_model_folder
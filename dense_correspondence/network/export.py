@@ -0,0 +1,241 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import copy
+import logging
+import argparse
+
+import numpy as np
+import yaml
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import dense_correspondence_manipulation.utils.constants as constants
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.network.inference_artifact import TORCHSCRIPT_FILENAME, ONNX_FILENAME, \
+    METADATA_FILENAME
+
+"""
+Exports a trained DenseCorrespondenceNetwork to a self-contained inference artifact,
+see inference_artifact.py for the loader.
+
+The artifact takes RGB images in [0, 1], i.e. the output of transforms.ToTensor(),
+and outputs descriptor images [N, D, H, W]. The image normalization is folded into
+the first convolution and the descriptor normalization (the `normalize` option of the
+network) is part of the exported graph, so neither has to be done in python.
+
+The artifact is a directory with
+    - model.pt: TorchScript
+    - model.onnx: ONNX, if requested
+    - metadata.yaml: descriptor dimension, image shape, descriptor_image_stats, ...
+
+Usage:
+    python export.py --model_folder trained_models/caterpillar_3 --output_dir exported/caterpillar_3
+"""
+
+EXPORT_FORMATS = ["torchscript", "onnx"]
+
+
+class FoldedInputConv(nn.Module):
+    """
+    A convolution with the input normalization (x - mean) / std_dev folded into it.
+
+    Folding changes what the zero padding means, the original convolution pads the
+    normalized image with zeros, i.e. the raw image with the mean. That only affects
+    the outputs at the image border and doesn't depend on the image, so it is corrected
+    with a constant border_correction for the image shape the artifact is exported for.
+    """
+
+    def __init__(self, conv, image_mean, image_std_dev, image_shape):
+        """
+        :param conv: the first convolution of the network
+        :type conv: nn.Conv2d
+        :param image_mean: per channel mean
+        :type image_mean: list of float
+        :param image_std_dev: per channel std dev
+        :type image_std_dev: list of float
+        :param image_shape: [H, W]
+        :type image_shape: list
+        """
+        super(FoldedInputConv, self).__init__()
+
+        mean = torch.FloatTensor(image_mean).view(1, -1, 1, 1)
+        std_dev = torch.FloatTensor(image_std_dev).view(1, -1, 1, 1)
+
+        weight = conv.weight.data.float()
+        bias = conv.bias.data.float() if conv.bias is not None else torch.zeros(weight.shape[0])
+
+        self.conv = copy.deepcopy(conv)
+        self.conv.weight.data = weight / std_dev
+        self.conv.bias = nn.Parameter(bias - (weight * mean / std_dev).sum(dim=(1, 2, 3)))
+
+        # the original convolution of an all mean image is just its bias, everywhere
+        with torch.no_grad():
+            mean_image = mean.expand(1, -1, image_shape[0], image_shape[1])
+            folded = self.conv(mean_image)
+            border_correction = bias.view(1, -1, 1, 1) - folded
+
+        self.register_buffer("border_correction", border_correction)
+
+    def forward(self, x):
+        return self.conv(x) + self.border_correction
+
+
+class ExportedDescriptorNetwork(nn.Module):
+    """
+    The module that gets exported. Takes images in [0, 1] and returns descriptor images
+    """
+
+    def __init__(self, dcn, image_mean=constants.DEFAULT_IMAGE_MEAN,
+                 image_std_dev=constants.DEFAULT_IMAGE_STD_DEV):
+        """
+        :param dcn: network to export, it is not modified
+        :type dcn: DenseCorrespondenceNetwork
+        :param image_mean: mean of the input normalization
+        :type image_mean: list of float
+        :param image_std_dev: std dev of the input normalization
+        :type image_std_dev: list of float
+        """
+        super(ExportedDescriptorNetwork, self).__init__()
+        self.fcn = copy.deepcopy(dcn.fcn).float().cpu().eval()
+        self._normalize = dcn._normalize
+
+        name, conv = ExportedDescriptorNetwork.find_input_conv(self.fcn)
+        folded_conv = FoldedInputConv(conv, image_mean, image_std_dev, dcn.image_shape)
+        ExportedDescriptorNetwork.replace_module(self.fcn, name, folded_conv)
+
+    @staticmethod
+    def find_input_conv(fcn):
+        """
+        Returns the first convolution of the network
+        :return: (name, conv)
+        :rtype: tuple
+        """
+        for name, module in fcn.named_modules():
+            if isinstance(module, nn.Conv2d):
+                if module.in_channels != 3:
+                    raise ValueError("the first convolution %s has %d input channels, expected 3" %(name, module.in_channels))
+                return name, module
+
+        raise ValueError("the network has no convolutions")
+
+    @staticmethod
+    def replace_module(root, name, module):
+        """
+        Replaces the submodule with the given dotted name
+        """
+        path = name.split(".")
+        parent = root
+        for child_name in path[:-1]:
+            parent = getattr(parent, child_name)
+        setattr(parent, path[-1], module)
+
+    def forward(self, img_tensor):
+        """
+        :param img_tensor: RGB images in [0, 1], shape [N, 3, H, W]
+        :type img_tensor: torch.Tensor
+        :return: descriptor images, shape [N, D, H, W]
+        :rtype: torch.Tensor
+        """
+        res = self.fcn(img_tensor)
+        if self._normalize:
+            res = F.normalize(res, p=2, dim=1)
+        return res
+
+
+def get_metadata(dcn, image_mean, image_std_dev):
+    """
+    Returns the metadata stored with the artifact
+    :type dcn: DenseCorrespondenceNetwork
+    :return:
+    :rtype: dict
+    """
+    d = dict()
+    d['descriptor_dimension'] = dcn.descriptor_dimension
+    d['image_height'], d['image_width'] = dcn.image_shape
+    d['image_mean'] = [float(x) for x in image_mean]
+    d['image_std_dev'] = [float(x) for x in image_std_dev]
+    d['normalize'] = bool(dcn._normalize)
+    d['unique_identifier'] = dcn.unique_identifier
+    d['torch_version'] = torch.__version__
+
+    d['descriptor_image_stats'] = None
+    if 'path_to_network_params_folder' in dcn.config:
+        descriptor_stats_file = os.path.join(utils.convert_to_absolute_path(dcn.path_to_network_params_folder),
+                                             "descriptor_statistics.yaml")
+        if os.path.exists(descriptor_stats_file):
+            d['descriptor_image_stats'] = dcn.descriptor_image_stats
+        else:
+            logging.warning("%s doesn't exist, exporting without descriptor_image_stats" %(descriptor_stats_file))
+
+    return d
+
+
+def export_network(dcn, output_dir, formats=("torchscript",), image_mean=constants.DEFAULT_IMAGE_MEAN,
+                   image_std_dev=constants.DEFAULT_IMAGE_STD_DEV):
+    """
+    Exports a network to output_dir.
+
+    Checks that the exported module matches the original network on a random image,
+    the max abs difference is saved in the metadata.
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param output_dir:
+    :type output_dir: str
+    :param formats: subset of EXPORT_FORMATS
+    :type formats: list of str
+    :return: metadata
+    :rtype: dict
+    """
+    for export_format in formats:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError("export format must be one of %s, not %s" %(EXPORT_FORMATS, export_format))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    exported = ExportedDescriptorNetwork(dcn, image_mean=image_mean, image_std_dev=image_std_dev)
+    image_height, image_width = dcn.image_shape
+    example_input = torch.rand(1, 3, image_height, image_width)
+
+    metadata = get_metadata(dcn, image_mean, image_std_dev)
+
+    # compare with the original network run on a normalized image
+    reference = copy.deepcopy(dcn).float().cpu().eval()
+    mean = torch.FloatTensor(image_mean).view(1, -1, 1, 1)
+    std_dev = torch.FloatTensor(image_std_dev).view(1, -1, 1, 1)
+    with torch.no_grad():
+        expected = reference.forward((example_input - mean) / std_dev)
+        actual = exported(example_input)
+    metadata['max_abs_error'] = float((expected - actual).abs().max())
+    logging.info("max abs difference between the exported and the original network: %.2e" %(metadata['max_abs_error']))
+
+    metadata['formats'] = list(formats)
+
+    if "torchscript" in formats:
+        with torch.no_grad():
+            traced = torch.jit.trace(exported, example_input)
+        traced.save(os.path.join(output_dir, TORCHSCRIPT_FILENAME))
+
+    if "onnx" in formats:
+        torch.onnx.export(exported, example_input, os.path.join(output_dir, ONNX_FILENAME),
+                          input_names=["image"], output_names=["descriptors"])
+
+    utils.saveToYaml(metadata, os.path.join(output_dir, METADATA_FILENAME))
+    logging.info("exported network to %s" %(output_dir))
+    return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--iteration", type=int, default=None, help="defaults to the latest one")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--format", type=str, nargs='+', default=["torchscript"], choices=EXPORT_FORMATS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dcn = DenseCorrespondenceNetwork.from_model_folder(args.model_folder, iteration=args.iteration)
+    dcn.eval()
+    export_network(dcn, args.output_dir, formats=args.format)
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import yaml
+import torch
+
+"""
+Loads an inference artifact written by export.py.
+
+This module only imports torch, numpy and yaml, so loading an artifact doesn't pull
+in the dataset, training or evaluation code. The artifact takes RGB images in [0, 1]
+and does the image and descriptor normalization itself.
+
+Usage:
+    artifact = DescriptorArtifact.load("exported/caterpillar_3")
+    res = artifact.forward_single_rgb_image(rgb) # rgb is a [H, W, 3] uint8 numpy array, res is [H, W, D]
+"""
+
+TORCHSCRIPT_FILENAME = "model.pt"
+ONNX_FILENAME = "model.onnx"
+METADATA_FILENAME = "metadata.yaml"
+
+
+class DescriptorArtifact(object):
+
+    def __init__(self, module, metadata, device):
+        """
+        Use DescriptorArtifact.load()
+        :param module: the TorchScript module
+        :type module: torch.jit.ScriptModule
+        :param metadata: contents of metadata.yaml
+        :type metadata: dict
+        :param device:
+        :type device: torch.device
+        """
+        self._module = module
+        self._metadata = metadata
+        self._device = device
+
+    @staticmethod
+    def load(artifact_dir, device=None):
+        """
+        Loads an exported network
+        :param artifact_dir: directory written by export.py
+        :type artifact_dir: str
+        :param device: defaults to cuda if available
+        :type device: torch.device
+        :return:
+        :rtype: DescriptorArtifact
+        """
+        if device is None:
+            device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+        torchscript_file = os.path.join(artifact_dir, TORCHSCRIPT_FILENAME)
+        if not os.path.exists(torchscript_file):
+            raise ValueError("%s doesn't exist, was the network exported with the torchscript format?" %(torchscript_file))
+
+        with open(os.path.join(artifact_dir, METADATA_FILENAME), 'r') as f:
+            metadata = yaml.safe_load(f)
+
+        module = torch.jit.load(torchscript_file, map_location=device)
+        module.eval()
+        return DescriptorArtifact(module, metadata, device)
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def descriptor_dimension(self):
+        return self._metadata['descriptor_dimension']
+
+    @property
+    def image_shape(self):
+        return [self._metadata['image_height'], self._metadata['image_width']]
+
+    @property
+    def descriptor_image_stats(self):
+        return self._metadata['descriptor_image_stats']
+
+    def forward(self, img_tensor):
+        """
+        :param img_tensor: RGB images in [0, 1], shape [N, 3, H, W]. H, W must
+        be the image shape the network was exported with
+        :type img_tensor: torch.Tensor
+        :return: descriptor images, shape [N, D, H, W]
+        :rtype: torch.Tensor
+        """
+        with torch.no_grad():
+            return self._module(img_tensor.to(self._device))
+
+    def forward_single_rgb_image(self, rgb):
+        """
+        :param rgb: RGB image, shape [H, W, 3]
+        :type rgb: numpy.ndarray of dtype uint8
+        :return: descriptor image, shape [H, W, D]
+        :rtype: numpy.ndarray
+        """
+        img_tensor = torch.from_numpy(np.ascontiguousarray(rgb)).to(self._device)
+        img_tensor = img_tensor.permute(2, 0, 1).unsqueeze(0).float() / 255.0
+        res = self.forward(img_tensor)
+        return res.squeeze(0).permute(1, 2, 0).cpu().numpy()
@@ -0,0 +1,600 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import io
+import json
+import time
+import errno
+import socket
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+import SocketServer
+
+import numpy as np
+import torch
+
+"""
+A long-running local service that computes dense descriptors for several loaded
+networks, and a client for it.
+
+Every consumer used to load its own DenseCorrespondenceNetwork and run
+forward_single_image_tensor one image at a time. The service holds the networks once
+and batches the concurrent requests for each network. A batch is run as soon as it
+is full or the oldest request in it has waited max_latency_ms.
+
+The service listens on a unix socket. Each connection is handled by its own thread,
+the forward passes of a network run on a single worker thread. Descriptors are
+returned either as a file in /dev/shm that the client memory maps ("shared_memory"),
+or as a compressed .npz in the response ("compressed").
+
+Start the service:
+    python inference_service.py --model caterpillar=trained_models/caterpillar_3 --max_batch_size 8
+
+Use it in place of a DenseCorrespondenceNetwork:
+    dcn = InferenceClient(model_name="caterpillar")
+    res = dcn.forward_single_image_tensor(img_tensor) # [H, W, D]
+"""
+
+DEFAULT_SOCKET_PATH = "/tmp/dense_correspondence_inference.sock"
+SHARED_MEMORY_DIR = "/dev/shm"
+TRANSPORTS = ["shared_memory", "compressed"]
+
+# header length and payload length, both uint32
+MESSAGE_PREFIX = struct.Struct("!II")
+
+
+def default_transport():
+    if os.path.isdir(SHARED_MEMORY_DIR):
+        return "shared_memory"
+    return "compressed"
+
+
+def _recv_exactly(sock, num_bytes):
+    """
+    Reads exactly num_bytes from the socket, returns None if the connection was closed
+    """
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    offset = 0
+    while offset < num_bytes:
+        n = sock.recv_into(view[offset:], num_bytes - offset)
+        if n == 0:
+            return None
+        offset += n
+    return buf
+
+
+def send_message(sock, header, payload=b""):
+    """
+    Sends a message, a json header followed by a binary payload
+    :param header:
+    :type header: dict
+    :param payload:
+    :type payload: str
+    :return:
+    :rtype: None
+    """
+    header_bytes = json.dumps(header).encode("utf-8")
+    sock.sendall(MESSAGE_PREFIX.pack(len(header_bytes), len(payload)) + header_bytes)
+    if len(payload) > 0:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """
+    Receives a message sent by send_message()
+    :return: (header, payload), or (None, None) if the connection was closed
+    :rtype: tuple
+    """
+    prefix = _recv_exactly(sock, MESSAGE_PREFIX.size)
+    if prefix is None:
+        return None, None
+
+    header_length, payload_length = MESSAGE_PREFIX.unpack(bytes(prefix))
+    header_bytes = _recv_exactly(sock, header_length)
+    payload = _recv_exactly(sock, payload_length) if payload_length > 0 else bytearray()
+    if (header_bytes is None) or (payload is None):
+        return None, None
+
+    return json.loads(bytes(header_bytes).decode("utf-8")), payload
+
+
+def encode_array(array, transport):
+    """
+    Encodes a numpy array for a response
+    :return: (header fields, payload)
+    :rtype: tuple
+    """
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    header = {'transport': transport, 'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+    if transport == "shared_memory":
+        fd, filename = tempfile.mkstemp(prefix="dc_descriptors_", suffix=".bin", dir=SHARED_MEMORY_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                array.tofile(f)
+        except Exception:
+            os.unlink(filename)
+            raise
+        header['filename'] = filename
+        return header, b""
+
+    f = io.BytesIO()
+    np.savez_compressed(f, descriptors=array)
+    return header, f.getvalue()
+
+
+def decode_array(header, payload):
+    """
+    Decodes an array encoded with encode_array()
+    :return:
+    :rtype: numpy.ndarray
+    """
+    shape = tuple(header['shape'])
+    dtype = np.dtype(header['dtype'])
+
+    if header['transport'] == "shared_memory":
+        filename = header['filename']
+        # copy on write, so that torch.from_numpy gets a writeable array. The mapping
+        # stays valid after the file is unlinked
+        try:
+            return np.memmap(filename, dtype=dtype, mode='c', shape=shape)
+        finally:
+            os.unlink(filename)
+
+    return np.load(io.BytesIO(bytes(payload)))['descriptors']
+
+
+class _PendingRequest(object):
+    """
+    A single image waiting to be batched
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.received_time = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ModelMetrics(object):
+    """
+    Latency and throughput of a single model
+    """
+
+    def __init__(self, window=1000):
+        """
+        :param window: number of recent requests used for the latency percentiles
+        :type window: int
+        """
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._latencies = collections.deque(maxlen=window)
+        self._num_requests = 0
+        self._num_batches = 0
+        self._forward_time = 0.0
+
+    def record_batch(self, requests, forward_time):
+        now = time.time()
+        with self._lock:
+            self._num_batches += 1
+            self._num_requests += len(requests)
+            self._forward_time += forward_time
+            for request in requests:
+                self._latencies.append(now - request.received_time)
+
+    def summary(self):
+        """
+        :return: dict of metric name --> value
+        :rtype: dict
+        """
+        with self._lock:
+            d = dict()
+            elapsed = time.time() - self._start_time
+            d['num_requests'] = self._num_requests
+            d['num_batches'] = self._num_batches
+            d['mean_batch_size'] = self._num_requests / float(max(self._num_batches, 1))
+            d['requests_per_second'] = self._num_requests / max(elapsed, 1e-6)
+            d['forward_time_per_image'] = self._forward_time / max(self._num_requests, 1)
+
+            if len(self._latencies) > 0:
+                latencies = np.array(self._latencies)
+                d['latency_mean'] = float(np.mean(latencies))
+                d['latency_median'] = float(np.median(latencies))
+                d['latency_95th_percentile'] = float(np.percentile(latencies, 95))
+
+            return d
+
+
+class ModelWorker(object):
+    """
+    Owns a single network and runs batched forward passes on its own thread
+    """
+
+    def __init__(self, dcn, max_batch_size=8, max_latency_ms=5.0):
+        """
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param max_batch_size:
+        :type max_batch_size: int
+        :param max_latency_ms: how long the oldest request waits for the batch to fill up
+        :type max_latency_ms: float
+        """
+        self._dcn = dcn
+        self._dcn.eval()
+        self._device = dcn.device
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency_ms / 1000.0
+
+        self._pending = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self.metrics = ModelMetrics()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def forward(self, image):
+        """
+        Computes the descriptors of a single normalized image, blocks until done.
+        Called from the connection threads.
+        :param image: normalized image, shape [3, H, W]
+        :type image: numpy.ndarray
+        :return: descriptors, shape [H, W, D]
+        :rtype: numpy.ndarray
+        """
+        request = _PendingRequest(image)
+        with self._condition:
+            if self._stopped:
+                raise ValueError("the model worker has stopped")
+            self._pending.append(request)
+            self._condition.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise ValueError(request.error)
+        return request.result
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        """
+        Waits for the first request, then for more requests of the same image shape
+        until the batch is full or the first request has waited max_latency
+        :return: list of _PendingRequest, None if stopped
+        :rtype: list
+        """
+        with self._condition:
+            while (len(self._pending) == 0) and not self._stopped:
+                self._condition.wait()
+
+            if self._stopped:
+                return None
+
+            shape = self._pending[0].image.shape
+            deadline = self._pending[0].received_time + self._max_latency
+            while not self._stopped:
+                num_same_shape = len([r for r in self._pending if r.image.shape == shape])
+                remaining = deadline - time.time()
+                if (num_same_shape >= self._max_batch_size) or (remaining <= 0):
+                    break
+                self._condition.wait(remaining)
+
+            batch = [r for r in self._pending if r.image.shape == shape][:self._max_batch_size]
+            self._pending = [r for r in self._pending if r not in batch]
+            return batch
+
+    def _fail_pending(self, requests, error):
+        """
+        Stops accepting requests and replies to the given requests and to all the
+        pending ones with an error, so that no client waits forever
+        """
+        with self._condition:
+            self._stopped = True
+            requests = list(requests) + self._pending
+            self._pending = []
+
+        for request in requests:
+            if not request.done.is_set():
+                request.error = error
+                request.done.set()
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+
+                start = time.time()
+                try:
+                    img_tensor = torch.from_numpy(np.stack([r.image for r in batch])).to(self._device)
+                    with torch.no_grad():
+                        res = self._dcn.forward(img_tensor) # [N, D, H, W]
+                    res = res.permute(0, 2, 3, 1).cpu().numpy() # [N, H, W, D]
+
+                    for i, request in enumerate(batch):
+                        request.result = res[i]
+                except Exception as e:
+                    logging.exception("forward pass failed")
+                    for request in batch:
+                        request.error = str(e)
+
+                self.metrics.record_batch(batch, time.time() - start)
+                for request in batch:
+                    request.done.set()
+                batch = []
+        except Exception:
+            logging.exception("model worker failed")
+        finally:
+            self._fail_pending(batch or [], "the model worker has stopped")
+
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Handles all the requests of one client connection
+    """
+
+    def handle(self):
+        while True:
+            header, payload = recv_message(self.request)
+            if header is None:
+                return
+
+            try:
+                response_header, response_payload = self.server.service.handle_request(header, payload)
+            except Exception as e:
+                logging.exception("request failed")
+                response_header, response_payload = {'error': str(e)}, b""
+
+            try:
+                send_message(self.request, response_header, response_payload)
+            except Exception:
+                # the client never gets the shared memory file, so it can't unlink it
+                if 'filename' in response_header:
+                    os.unlink(response_header['filename'])
+                raise
+
+
+class _ThreadedUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class DescriptorInferenceService(object):
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, max_batch_size=8, max_latency_ms=5.0):
+        """
+        :param socket_path: path of the unix socket to listen on
+        :type socket_path: str
+        :param max_batch_size:
+        :type max_batch_size: int
+        :param max_latency_ms:
+        :type max_latency_ms: float
+        """
+        self._socket_path = socket_path
+        self._max_batch_size = max_batch_size
+        self._max_latency_ms = max_latency_ms
+        self._workers = dict()
+        self._server = None
+
+    def add_model(self, name, model_folder, iteration=None):
+        """
+        Loads a network and starts its worker
+        :param name: name the clients use to refer to this model
+        :type name: str
+        :param model_folder: passed to DenseCorrespondenceNetwork.from_model_folder()
+        :type model_folder: str
+        :return:
+        :rtype: None
+        """
+        from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+
+        if name in self._workers:
+            raise ValueError("model %s is already loaded" %(name))
+
+        dcn = DenseCorrespondenceNetwork.from_model_folder(model_folder, iteration=iteration)
+        self.add_network(name, dcn)
+        logging.info("loaded model %s from %s" %(name, model_folder))
+
+    def add_network(self, name, dcn):
+        """
+        Serves an already constructed network
+        :type dcn: DenseCorrespondenceNetwork
+        """
+        self._workers[name] = ModelWorker(dcn, max_batch_size=self._max_batch_size,
+                                          max_latency_ms=self._max_latency_ms)
+
+    def handle_request(self, header, payload):
+        """
+        Handles one request, called from the connection threads
+        :return: (response header, response payload)
+        :rtype: tuple
+        """
+        request_type = header['type']
+
+        if request_type == "list_models":
+            return {'models': sorted(self._workers.keys())}, b""
+
+        if request_type == "metrics":
+            metrics = dict()
+            for name, worker in self._workers.iteritems():
+                metrics[name] = worker.metrics.summary()
+            return {'metrics': metrics}, b""
+
+        if request_type != "forward":
+            raise ValueError("unknown request type %s" %(request_type))
+
+        name = header['model']
+        if name not in self._workers:
+            raise ValueError("unknown model %s, the loaded models are %s" %(name, sorted(self._workers.keys())))
+
+        transport = header['transport']
+        if transport not in TRANSPORTS:
+            raise ValueError("transport must be one of %s, not %s" %(TRANSPORTS, transport))
+
+        image = np.frombuffer(bytes(payload), dtype=np.float32).reshape(header['shape'])
+        res = self._workers[name].forward(image)
+        return encode_array(res, transport)
+
+    def serve_forever(self):
+        """
+        Listens on the unix socket until interrupted
+        """
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+        self._server = _ThreadedUnixServer(self._socket_path, _RequestHandler)
+        self._server.service = self
+        logging.info("inference service listening on %s" %(self._socket_path))
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for worker in self._workers.values():
+            worker.stop()
+
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+
+class InferenceClient(object):
+    """
+    Client for DescriptorInferenceService. forward_single_image_tensor() can be used in place
+    of DenseCorrespondenceNetwork.forward_single_image_tensor(), except that the result is
+    on the CPU. A client can be shared between threads.
+    """
+
+    def __init__(self, model_name, socket_path=DEFAULT_SOCKET_PATH, transport=None):
+        """
+        :param model_name: name of a model loaded by the service
+        :type model_name: str
+        :param socket_path:
+        :type socket_path: str
+        :param transport: one of TRANSPORTS, defaults to shared_memory if /dev/shm exists
+        :type transport: str
+        """
+        if transport is None:
+            transport = default_transport()
+
+        if transport not in TRANSPORTS:
+            raise ValueError("transport must be one of %s, not %s" %(TRANSPORTS, transport))
+
+        self._model_name = model_name
+        self._socket_path = socket_path
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(self._socket_path)
+        except socket.error as e:
+            self._sock = None
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise ValueError("no inference service is running on %s" %(self._socket_path))
+            raise
+
+    def _request(self, header, payload=b""):
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+
+            send_message(self._sock, header, payload)
+            response_header, response_payload = recv_message(self._sock)
+
+        if response_header is None:
+            self.close()
+            raise ValueError("the inference service closed the connection")
+
+        if 'error' in response_header:
+            raise ValueError(response_header['error'])
+
+        return response_header, response_payload
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+    def list_models(self):
+        header, _ = self._request({'type': "list_models"})
+        return header['models']
+
+    def metrics(self):
+        """
+        Returns the latency and throughput metrics of every model
+        :return: dict of model name --> metrics
+        :rtype: dict
+        """
+        header, _ = self._request({'type': "metrics"})
+        return header['metrics']
+
+    def forward_single_image_numpy(self, image):
+        """
+        :param image: normalized image, shape [3, H, W]
+        :type image: numpy.ndarray
+        :return: descriptors, shape [H, W, D]
+        :rtype: numpy.ndarray
+        """
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        header = {'type': "forward", 'model': self._model_name, 'transport': self._transport,
+                  'shape': list(image.shape)}
+        response_header, response_payload = self._request(header, image.tobytes())
+        return decode_array(response_header, response_payload)
+
+    def forward_single_image_tensor(self, img_tensor):
+        """
+        Same as DenseCorrespondenceNetwork.forward_single_image_tensor()
+
+        Assumes the image has already been normalized (i.e. subtract mean, divide by std dev)
+
+        :param img_tensor: torch.FloatTensor with shape [3,H,W]
+        :type img_tensor:
+        :return: torch.FloatTensor with shape [H, W, D], on the CPU
+        :rtype:
+        """
+        assert len(img_tensor.shape) == 3
+        image = img_tensor.detach().cpu().numpy()
+        return torch.from_numpy(self.forward_single_image_numpy(image))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, action='append', required=True,
+                        help="name=model_folder, can be given multiple times")
+    parser.add_argument("--socket_path", type=str, default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_latency_ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = DescriptorInferenceService(socket_path=args.socket_path, max_batch_size=args.max_batch_size,
+                                         max_latency_ms=args.max_latency_ms)
+
+    for model in args.model:
+        if "=" not in model:
+            raise ValueError("models must be given as name=model_folder, not %s" %(model))
+        name, model_folder = model.split("=", 1)
+        service.add_model(name, model_folder)
+
+    service.serve_forever()
@@ -0,0 +1,226 @@
+import numpy as np
+
+import dense_correspondence_manipulation.utils.utils as utils
+
+"""
+Tracks a set of reference descriptors across a stream of descriptor images.
+
+DenseCorrespondenceNetwork.find_best_match_for_descriptor() searches the whole image
+for each keypoint. KeypointTracker keeps the last location of each keypoint and first
+searches a window around it. A keypoint falls back to a search over the whole image
+only if the local match isn't confident, i.e. its descriptor distance is above
+max_descriptor_distance or it fails the ratio test. The distances of all keypoints
+are computed together, for the local and for the global search.
+
+Usage:
+    tracker = KeypointTracker.from_clicked_points(["clicked_point.yaml"], "caterpillar_3")
+    for res in descriptor_images: # [H, W, D]
+        result = tracker.update(res)
+        uv = result['uv'][result['tracked']]
+"""
+
+
+class KeypointTracker(object):
+
+    def __init__(self, descriptors, window_size=41, max_descriptor_distance=0.5, ratio_test_threshold=0.9,
+                 ratio_test_exclusion_radius=5):
+        """
+        :param descriptors: reference descriptors, shape [K, D]
+        :type descriptors: numpy.ndarray
+        :param window_size: side length in pixels of the local search window
+        :type window_size: int
+        :param max_descriptor_distance: matches further than this from the reference
+        descriptor are not confident
+        :type max_descriptor_distance: float
+        :param ratio_test_threshold: matches whose distance is more than this fraction of the
+        second best distance are not confident
+        :type ratio_test_threshold: float
+        :param ratio_test_exclusion_radius: pixels within this distance of the best match
+        are not considered for the second best match, since they are always similar
+        :type ratio_test_exclusion_radius: int
+        """
+        self._descriptors = np.asarray(descriptors, dtype=np.float32)
+        if self._descriptors.ndim != 2:
+            raise ValueError("descriptors must have shape [K, D], not %s" %(list(self._descriptors.shape)))
+
+        self._window_size = window_size
+        self._max_descriptor_distance = max_descriptor_distance
+        self._ratio_test_threshold = ratio_test_threshold
+        self._ratio_test_exclusion_radius = ratio_test_exclusion_radius
+        self.reset()
+
+    @staticmethod
+    def from_clicked_points(filenames, network_name, **kwargs):
+        """
+        Makes a tracker for the points saved by the live heatmap visualization
+        :param filenames: clicked_point.yaml files, one per keypoint
+        :type filenames: list of str
+        :param network_name:
+        :type network_name: str
+        :param kwargs: passed to KeypointTracker
+        :return:
+        :rtype: KeypointTracker
+        """
+        descriptors = []
+        for filename in filenames:
+            d = utils.getDictFromYamlFilename(filename)
+            if network_name not in d:
+                raise ValueError("%s doesn't have a point for network %s" %(filename, network_name))
+            descriptors.append(d[network_name]['source'])
+
+        return KeypointTracker(np.array(descriptors), **kwargs)
+
+    @property
+    def num_keypoints(self):
+        return self._descriptors.shape[0]
+
+    @property
+    def uv(self):
+        """
+        :return: last confident location of each keypoint, (u,v) = (right, down)
+        :rtype: numpy.ndarray of shape [K, 2]
+        """
+        return self._uv
+
+    @property
+    def tracked(self):
+        return self._tracked
+
+    def reset(self):
+        """
+        Forgets the keypoint locations, the next update does a global search
+        """
+        self._uv = np.zeros([self.num_keypoints, 2], dtype=np.int64)
+        self._tracked = np.zeros(self.num_keypoints, dtype=bool)
+        self._num_updates = 0
+        self._num_global_searches = 0
+
+    def summary(self):
+        """
+        :return: dict with the number of updates and the fraction of keypoint
+        updates that needed a global search
+        :rtype: dict
+        """
+        d = dict()
+        d['num_updates'] = self._num_updates
+        d['global_search_fraction'] = self._num_global_searches / float(max(self._num_updates * self.num_keypoints, 1))
+        return d
+
+    def _best_matches(self, norm_diffs):
+        """
+        Finds the best match in each distance map, and the second best match outside of
+        ratio_test_exclusion_radius around it
+        :param norm_diffs: descriptor distances, shape [K, h, w]
+        :type norm_diffs: numpy.ndarray
+        :return: best_match_rc [K, 2] (row, column), best_match_diff [K], ratio [K]
+        :rtype: tuple
+        """
+        num_maps, height, width = norm_diffs.shape
+        flattened = norm_diffs.reshape(num_maps, -1)
+        best_idx = np.argmin(flattened, axis=1)
+        best_diff = flattened[np.arange(num_maps), best_idx]
+        best_row, best_col = np.unravel_index(best_idx, (height, width))
+
+        r = self._ratio_test_exclusion_radius
+        rows = np.arange(height)[None, :, None]
+        cols = np.arange(width)[None, None, :]
+        excluded = (np.abs(rows - best_row[:, None, None]) <= r) & (np.abs(cols - best_col[:, None, None]) <= r)
+        second_diff = np.where(excluded, np.inf, norm_diffs).reshape(num_maps, -1).min(axis=1)
+
+        # if there is nothing outside the exclusion radius the ratio test passes
+        ratio = best_diff / np.maximum(second_diff, 1e-12)
+        return np.stack([best_row, best_col], axis=1), best_diff, ratio
+
+    def _confident(self, best_diff, ratio):
+        return (best_diff <= self._max_descriptor_distance) & (ratio <= self._ratio_test_threshold)
+
+    def _local_search(self, res, keypoint_idxs):
+        """
+        Searches the windows around the last locations of keypoint_idxs
+        :return: uv [N, 2], best_diff [N], ratio [N]
+        :rtype: tuple
+        """
+        height, width, _ = res.shape
+        window_height = min(self._window_size, height)
+        window_width = min(self._window_size, width)
+
+        # windows are shifted at the image border so that they all have the same size
+        uv = self._uv[keypoint_idxs]
+        row_origin = np.clip(uv[:, 1] - window_height // 2, 0, height - window_height)
+        col_origin = np.clip(uv[:, 0] - window_width // 2, 0, width - window_width)
+
+        rows = row_origin[:, None] + np.arange(window_height)[None, :]
+        cols = col_origin[:, None] + np.arange(window_width)[None, :]
+        windows = res[rows[:, :, None], cols[:, None, :]] # [N, h, w, D]
+
+        descriptors = self._descriptors[keypoint_idxs]
+        norm_diffs = np.sqrt(np.sum(np.square(windows - descriptors[:, None, None, :]), axis=3))
+
+        best_rc, best_diff, ratio = self._best_matches(norm_diffs)
+        best_uv = np.stack([col_origin + best_rc[:, 1], row_origin + best_rc[:, 0]], axis=1)
+        return best_uv, best_diff, ratio
+
+    def _global_search(self, res, keypoint_idxs):
+        """
+        Searches the whole descriptor image for keypoint_idxs
+        :return: uv [N, 2], best_diff [N], ratio [N]
+        :rtype: tuple
+        """
+        height, width, descriptor_dimension = res.shape
+        res_flat = res.reshape(-1, descriptor_dimension)
+        descriptors = self._descriptors[keypoint_idxs]
+
+        # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, a single matrix multiplication for all keypoints
+        squared_diffs = np.sum(np.square(res_flat), axis=1)[:, None] - 2 * res_flat.dot(descriptors.T) \
+                        + np.sum(np.square(descriptors), axis=1)[None, :]
+        norm_diffs = np.sqrt(np.maximum(squared_diffs, 0)).T.reshape(-1, height, width)
+
+        best_rc, best_diff, ratio = self._best_matches(norm_diffs)
+        best_uv = np.stack([best_rc[:, 1], best_rc[:, 0]], axis=1)
+        return best_uv, best_diff, ratio
+
+    def update(self, res):
+        """
+        Finds the keypoints in the next descriptor image
+        :param res: descriptor image, shape [H, W, D]
+        :type res: numpy.ndarray
+        :return: dict with
+            uv: [K, 2] best match of each keypoint, (u,v) = (right, down)
+            descriptor_distance: [K]
+            ratio: [K] ratio test value
+            tracked: [K] bool, whether the match is confident
+            global_search: [K] bool, whether the keypoint needed a global search
+        :rtype: dict
+        """
+        res = np.asarray(res, dtype=np.float32)
+        num_keypoints = self.num_keypoints
+
+        uv = np.array(self._uv)
+        best_diff = np.full(num_keypoints, np.inf, dtype=np.float32)
+        ratio = np.full(num_keypoints, np.inf, dtype=np.float32)
+        global_search = np.logical_not(self._tracked)
+
+        local_idxs = np.nonzero(self._tracked)[0]
+        if len(local_idxs) > 0:
+            uv[local_idxs], best_diff[local_idxs], ratio[local_idxs] = self._local_search(res, local_idxs)
+            global_search[local_idxs] = np.logical_not(self._confident(best_diff[local_idxs], ratio[local_idxs]))
+
+        global_idxs = np.nonzero(global_search)[0]
+        if len(global_idxs) > 0:
+            uv[global_idxs], best_diff[global_idxs], ratio[global_idxs] = self._global_search(res, global_idxs)
+
+        tracked = self._confident(best_diff, ratio)
+
+        # keypoints that are lost keep their last confident location
+        self._uv[tracked] = uv[tracked]
+        self._tracked = tracked
+        self._num_updates += 1
+        self._num_global_searches += len(global_idxs)
+
+        d = dict()
+        d['uv'] = uv
+        d['descriptor_distance'] = best_diff
+        d['ratio'] = ratio
+        d['tracked'] = tracked
+        d['global_search'] = global_search
+        return d
@@ -0,0 +1,166 @@
+import logging
+
+import torch
+
+"""
+Helpers for running DenseCorrespondenceNetwork with mixed precision and a
+channels last memory layout.
+
+Autocast and channels last need a newer version of pytorch than the one in
+our docker image. When they aren't available these helpers log a warning and
+fall back to float32 and the default memory layout.
+"""
+
+
+class NullContext(object):
+    """
+    Context manager that does nothing, used when autocast is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def cuda_autocast_available():
+    return hasattr(torch, 'cuda') and hasattr(torch.cuda, 'amp') and hasattr(torch.cuda.amp, 'autocast')
+
+
+def cpu_autocast_available():
+    return hasattr(torch, 'cpu') and hasattr(torch.cpu, 'amp') and hasattr(torch.cpu.amp, 'autocast')
+
+
+def channels_last_available():
+    return hasattr(torch, 'channels_last')
+
+
+def autocast_available(cuda=True):
+    """
+    Returns True if autocast is supported for this device type
+    :param cuda: whether the device is a GPU
+    :type cuda: bool
+    :return:
+    :rtype: bool
+    """
+    if cuda:
+        return cuda_autocast_available()
+    else:
+        return cpu_autocast_available()
+
+
+def autocast(cuda=True, enabled=True):
+    """
+    Returns a context manager that runs the enclosed ops in mixed precision.
+    Uses float16 on the GPU and bfloat16 on the CPU.
+    :param cuda: whether the inputs are on the GPU
+    :type cuda: bool
+    :param enabled: if False returns a context manager that does nothing
+    :type enabled: bool
+    :return:
+    :rtype:
+    """
+    if not enabled or not autocast_available(cuda):
+        return NullContext()
+
+    if cuda:
+        return torch.cuda.amp.autocast()
+    else:
+        return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+
+
+def to_channels_last(x):
+    """
+    Converts a 4D tensor or an nn.Module to the channels last memory layout.
+    Returns x unchanged if channels last isn't supported
+    """
+    if not channels_last_available():
+        return x
+
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=torch.channels_last)
+
+    if x.dim() != 4:
+        return x
+
+    return x.contiguous(memory_format=torch.channels_last)
+
+
+def to_contiguous_format(x):
+    """
+    Converts a 4D tensor or an nn.Module back to the default memory layout, undoes
+    to_channels_last(). Returns x unchanged if channels last isn't supported
+    """
+    if not channels_last_available():
+        return x
+
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=torch.contiguous_format)
+
+    return x.contiguous()
+
+
+class GradScaler(object):
+    """
+    Thin wrapper around torch.cuda.amp.GradScaler. Loss scaling is needed for float16
+    so that small gradients don't underflow. If disabled, or not available, it
+    is a no-op with the same interface.
+
+    Usage:
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    """
+
+    def __init__(self, enabled=True):
+        self._scaler = None
+        if enabled and hasattr(torch.cuda, 'amp') and hasattr(torch.cuda.amp, 'GradScaler'):
+            self._scaler = torch.cuda.amp.GradScaler()
+
+    @property
+    def enabled(self):
+        return self._scaler is not None
+
+    def scale(self, loss):
+        if self._scaler is None:
+            return loss
+        return self._scaler.scale(loss)
+
+    def unscale_(self, optimizer):
+        if self._scaler is not None:
+            self._scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        if self._scaler is None:
+            optimizer.step()
+        else:
+            self._scaler.step(optimizer)
+
+    def update(self):
+        if self._scaler is not None:
+            self._scaler.update()
+
+    def state_dict(self):
+        if self._scaler is None:
+            return dict()
+        return self._scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        if self._scaler is not None and len(state_dict) > 0:
+            self._scaler.load_state_dict(state_dict)
+
+
+def warn_if_unavailable(mixed_precision, channels_last, cuda=True):
+    """
+    Logs a warning for each requested feature that this version of pytorch doesn't support
+    :param cuda: whether the network runs on the GPU
+    :type cuda: bool
+    """
+    if mixed_precision and not autocast_available(cuda):
+        logging.warning("mixed precision requested but %s autocast is not available in torch %s, "
+                        "using float32" %("GPU" if cuda else "CPU", torch.__version__))
+
+    if channels_last and not channels_last_available():
+        logging.warning("channels last requested but it is not available in torch %s, "
+                        "using the default memory layout" %(torch.__version__))
@@ -0,0 +1,341 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import copy
+import time
+import logging
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import dense_correspondence.network.mixed_precision as mixed_precision_utils
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork, \
+    get_quantized_param_file
+
+"""
+Post-training static int8 quantization of the DenseCorrespondenceNetwork backbone
+for CPU inference.
+
+The Resnet backbone is quantized in eager mode: it is wrapped in a QuantStub/DeQuantStub
+pair, the conv/bn/relu sequences are fused, and the residual blocks are rebuilt so that
+their additions go through nn.quantized.FloatFunctional. The activation ranges are
+calibrated on frames sampled from the dataset the network was trained on. The int8
+backbone is saved as TorchScript next to the float32 params, e.g.
+003500.pth --> 003500_int8.pt, and is loaded with
+
+    DenseCorrespondenceNetwork.from_model_folder(model_folder, quantized=True)
+
+Running this script also writes quantization_report.yaml to the model folder. It
+compares the evaluate_network metrics of the int8 and float32 networks, and their
+CPU latency and throughput.
+
+Needs torch >= 1.3, torch 1.4 is the last version with python 2 wheels.
+
+Usage:
+    python quantization.py --model_folder trained_models/caterpillar_3 --num_calibration_images 100
+"""
+
+QUANTIZATION_BACKENDS = ["fbgemm", "qnnpack"] # fbgemm is for x86, qnnpack for ARM
+
+QUANTIZATION_REPORT_FILENAME = "quantization_report.yaml"
+
+RESNET_LAYER_NAMES = ["layer1", "layer2", "layer3", "layer4"]
+
+
+def quantization_available():
+    return hasattr(torch, 'quantization') and hasattr(torch.quantization, 'QuantStub') \
+        and hasattr(torch.nn, 'quantized') and hasattr(torch.nn.quantized, 'FloatFunctional')
+
+
+def sample_calibration_images(dataset, num_images=100):
+    """
+    Samples normalized RGB images from random scenes of the dataset
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_images:
+    :type num_images: int
+    :return: list of torch.FloatTensor with shape [3, H, W]
+    :rtype: list
+    """
+    utils.reset_random_seed()
+
+    images = []
+    for i in xrange(num_images):
+        scene_name = dataset.get_random_scene_name()
+        img_idx = dataset.get_random_image_index(scene_name)
+        rgb = dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_idx)
+        images.append(dataset.rgb_image_to_tensor(rgb))
+
+    return images
+
+
+class QuantizableBasicBlock(nn.Module):
+    """
+    Resnet BasicBlock with the residual addition done by a FloatFunctional.
+    Shares the conv, bn and downsample modules of the original block.
+    """
+
+    def __init__(self, block):
+        super(QuantizableBasicBlock, self).__init__()
+        self.conv1 = block.conv1
+        self.bn1 = block.bn1
+        self.relu1 = nn.ReLU()
+        self.conv2 = block.conv2
+        self.bn2 = block.bn2
+        self.downsample = block.downsample
+        self.skip_add = nn.quantized.FloatFunctional()
+        self.relu_out = nn.ReLU()
+
+    def forward(self, x):
+        residual = x if self.downsample is None else self.downsample(x)
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+        return self.relu_out(self.skip_add.add(out, residual))
+
+    def fuse_lists(self):
+        return [["conv1", "bn1", "relu1"], ["conv2", "bn2"]]
+
+
+class QuantizableBottleneck(nn.Module):
+    """
+    Resnet Bottleneck with the residual addition done by a FloatFunctional.
+    Shares the conv, bn and downsample modules of the original block.
+    """
+
+    def __init__(self, block):
+        super(QuantizableBottleneck, self).__init__()
+        self.conv1 = block.conv1
+        self.bn1 = block.bn1
+        self.relu1 = nn.ReLU()
+        self.conv2 = block.conv2
+        self.bn2 = block.bn2
+        self.relu2 = nn.ReLU()
+        self.conv3 = block.conv3
+        self.bn3 = block.bn3
+        self.downsample = block.downsample
+        self.skip_add = nn.quantized.FloatFunctional()
+        self.relu_out = nn.ReLU()
+
+    def forward(self, x):
+        residual = x if self.downsample is None else self.downsample(x)
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.relu2(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+        return self.relu_out(self.skip_add.add(out, residual))
+
+    def fuse_lists(self):
+        return [["conv1", "bn1", "relu1"], ["conv2", "bn2", "relu2"], ["conv3", "bn3"]]
+
+
+class QuantizableResnet(nn.Module):
+    """
+    Eager mode quantizable version of the Resnet*_8s backbones of
+    pytorch_segmentation_detection.models.resnet_dilated.
+
+    The int8 part ends at the 1x1 conv that outputs the descriptors, the bilinear
+    upsampling back to the input size runs in float32.
+    """
+
+    def __init__(self, fcn):
+        super(QuantizableResnet, self).__init__()
+        resnet = get_resnet(fcn)
+        self.quant = torch.quantization.QuantStub()
+        self.conv1 = resnet.conv1
+        self.bn1 = resnet.bn1
+        self.relu = resnet.relu
+        self.maxpool = resnet.maxpool
+        for layer_name in RESNET_LAYER_NAMES:
+            layer = getattr(resnet, layer_name)
+            blocks = [QuantizableBottleneck(block) if hasattr(block, 'conv3') else QuantizableBasicBlock(block)
+                      for block in layer]
+            setattr(self, layer_name, nn.Sequential(*blocks))
+        self.fc = resnet.fc
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        input_spatial_dim = x.size()[2:]
+        x = self.quant(x)
+        x = self.maxpool(self.relu(self.bn1(self.conv1(x))))
+        x = self.layer1(x)
+        x = self.layer2(x)
+        x = self.layer3(x)
+        x = self.layer4(x)
+        x = self.dequant(self.fc(x))
+        # same as the nn.functional.upsample_bilinear of resnet_dilated
+        return nn.functional.interpolate(x, size=input_spatial_dim, mode='bilinear', align_corners=True)
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [["conv1", "bn1", "relu"]], inplace=True)
+        for layer_name in RESNET_LAYER_NAMES:
+            for block in getattr(self, layer_name):
+                modules_to_fuse = block.fuse_lists()
+                if block.downsample is not None:
+                    modules_to_fuse.append(["downsample.0", "downsample.1"])
+                torch.quantization.fuse_modules(block, modules_to_fuse, inplace=True)
+
+
+def get_resnet(fcn):
+    """
+    Finds the torchvision style resnet inside a Resnet*_8s backbone
+    :param fcn: the backbone, see DenseCorrespondenceNetwork.get_fcn()
+    :type fcn: nn.Module
+    :return:
+    :rtype: nn.Module
+    """
+    for module in [fcn] + list(fcn.children()):
+        if all(hasattr(module, name) for name in RESNET_LAYER_NAMES + ["conv1", "bn1", "fc"]):
+            return module
+
+    raise ValueError("only Resnet backbones can be quantized, not %s" %(type(fcn).__name__))
+
+
+def quantize_backbone(dcn, calibration_images, backend="fbgemm"):
+    """
+    Makes an int8 copy of the backbone of dcn, dcn is not modified
+    :param dcn:
+    :type dcn: DenseCorrespondenceNetwork
+    :param calibration_images: normalized images, see sample_calibration_images()
+    :type calibration_images: list of torch.FloatTensor
+    :param backend: one of QUANTIZATION_BACKENDS
+    :type backend: str
+    :return: the quantized backbone
+    :rtype: QuantizableResnet
+    """
+    if not quantization_available():
+        raise ValueError("post-training quantization needs torch >= 1.3, this is torch %s" %(torch.__version__))
+
+    if backend not in QUANTIZATION_BACKENDS:
+        raise ValueError("backend must be one of %s, not %s" %(QUANTIZATION_BACKENDS, backend))
+
+    torch.backends.quantized.engine = backend
+    fcn = copy.deepcopy(dcn.fcn).float().cpu()
+    fcn = mixed_precision_utils.to_contiguous_format(fcn)
+
+    model = QuantizableResnet(fcn).eval()
+    model.fuse_model()
+    model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(model, inplace=True)
+
+    logging.info("calibrating on %d images" %(len(calibration_images)))
+    with torch.no_grad():
+        for img_tensor in calibration_images:
+            model(img_tensor.unsqueeze(0))
+
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+def save_quantized_backbone(quantized_fcn, model_param_file, image_shape):
+    """
+    Saves the quantized backbone as TorchScript next to the float32 params
+    :param model_param_file: the float32 param file, e.g. /path/to/003500.pth
+    :type model_param_file: str
+    :param image_shape: [H, W]
+    :type image_shape: list
+    :return: the filename of the int8 model
+    :rtype: str
+    """
+    example_input = torch.zeros(1, 3, image_shape[0], image_shape[1])
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized_fcn, example_input)
+
+    quantized_param_file = get_quantized_param_file(model_param_file)
+    torch.jit.save(traced, quantized_param_file)
+    logging.info("saved int8 model to %s" %(quantized_param_file))
+    return quantized_param_file
+
+
+def measure_latency(dcn, num_iterations=20, num_warmup_iterations=3, batch_size=1):
+    """
+    Measures the latency of dcn.forward on random images, on whatever device dcn is on
+    :type dcn: DenseCorrespondenceNetwork
+    :return: dict with latency_mean, latency_median (seconds per batch) and images_per_second
+    :rtype: dict
+    """
+    image_height, image_width = dcn.image_shape
+    img_tensor = torch.rand(batch_size, 3, image_height, image_width).to(dcn.device)
+    cuda = (dcn.device.type == "cuda")
+
+    latencies = []
+    with torch.no_grad():
+        for i in xrange(num_warmup_iterations + num_iterations):
+            start = time.time()
+            dcn.forward(img_tensor)
+            if cuda:
+                torch.cuda.synchronize()
+            if i >= num_warmup_iterations:
+                latencies.append(time.time() - start)
+
+    d = dict()
+    d['batch_size'] = batch_size
+    d['latency_mean'] = float(np.mean(latencies))
+    d['latency_median'] = float(np.median(latencies))
+    d['images_per_second'] = batch_size / d['latency_median']
+    return d
+
+
+def quantize_model_folder(model_folder, iteration=None, num_calibration_images=100, backend="fbgemm",
+                          num_image_pairs=25, num_matches_per_image_pair=100, num_latency_iterations=20):
+    """
+    Quantizes a trained network, saves it to the model folder and writes the
+    quantization report
+    :return: the report
+    :rtype: dict
+    """
+    from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation
+
+    model_param_file, _, _ = utils.get_model_param_file_from_directory(utils.convert_to_absolute_path(model_folder),
+                                                                       iteration=iteration)
+    dcn_float = DenseCorrespondenceNetwork.from_model_folder(model_folder, model_param_file=model_param_file)
+    dcn_float.eval()
+
+    dataset = dcn_float.load_training_dataset()
+    calibration_images = sample_calibration_images(dataset, num_images=num_calibration_images)
+    quantized_fcn = quantize_backbone(dcn_float, calibration_images, backend=backend)
+    save_quantized_backbone(quantized_fcn, model_param_file, dcn_float.image_shape)
+
+    # load it back the way users will
+    dcn_quantized = DenseCorrespondenceNetwork.from_model_folder(model_folder, model_param_file=model_param_file,
+                                                                 quantized=True)
+    dcn_quantized.eval()
+
+    report = dict()
+    report['model_param_file'] = model_param_file
+    report['backend'] = backend
+    report['num_calibration_images'] = num_calibration_images
+    report['accuracy'] = DenseCorrespondenceEvaluation.compare_quantized_network(
+        dcn_float, dcn_quantized, dataset, num_image_pairs=num_image_pairs,
+        num_matches_per_image_pair=num_matches_per_image_pair)
+
+    # the float32 network is timed on the CPU too, since that is where the int8 one runs
+    dcn_float.cpu()
+    report['latency'] = {'float32': measure_latency(dcn_float, num_iterations=num_latency_iterations),
+                         'int8': measure_latency(dcn_quantized, num_iterations=num_latency_iterations)}
+    report['speedup'] = report['latency']['float32']['latency_median'] / report['latency']['int8']['latency_median']
+    report['num_threads'] = torch.get_num_threads()
+
+    report_file = os.path.join(utils.convert_to_absolute_path(model_folder), QUANTIZATION_REPORT_FILENAME)
+    utils.saveToYaml(report, report_file)
+    logging.info("int8 is %.2fx faster than float32 on the CPU, report saved to %s" %(report['speedup'], report_file))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_folder", type=str, required=True)
+    parser.add_argument("--iteration", type=int, default=None, help="defaults to the latest one")
+    parser.add_argument("--num_calibration_images", type=int, default=100)
+    parser.add_argument("--backend", type=str, default="fbgemm", choices=QUANTIZATION_BACKENDS)
+    parser.add_argument("--num_image_pairs", type=int, default=25)
+    parser.add_argument("--num_threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    quantize_model_folder(args.model_folder, iteration=args.iteration,
+                          num_calibration_images=args.num_calibration_images, backend=args.backend,
+                          num_image_pairs=args.num_image_pairs)
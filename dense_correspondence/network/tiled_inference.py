@@ -0,0 +1,326 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import math
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+"""
+Descriptor inference on images of any size.
+
+DenseCorrespondenceNetwork is fully convolutional, but running it on a large frame
+at once can run out of memory. TiledInference splits the image into overlapping
+tiles that fit under a memory cap and blends the tile outputs with weights that
+ramp down towards the tile edges, so there are no seams.
+
+The image can also be resized before inference (scale=0.5 is a cheap half-resolution
+mode) and the descriptors can be kept only every output_stride pixels. The result is a
+DescriptorImage, whose lookups take and return pixel coordinates of the original image.
+
+Usage:
+    tiled = TiledInference(dcn, scale=0.5, max_memory_mb=1024)
+    descriptor_image_a = tiled.forward_image_tensor(dataset.rgb_image_to_tensor(rgb_a))
+    descriptor_image_b = tiled.forward_image_tensor(dataset.rgb_image_to_tensor(rgb_b))
+    best_match_uv, best_match_diff, _ = descriptor_image_a.find_best_match(uv_a, descriptor_image_b)
+"""
+
+BYTES_PER_MB = 1024.0 * 1024.0
+
+# peak memory of a forward pass is a few times the largest single activation
+ACTIVATION_MEMORY_FACTOR = 3.0
+
+
+class DescriptorImage(object):
+    """
+    Descriptors computed on a resized and/or strided grid, along with the mapping
+    between grid cells and pixels of the original image.
+    """
+
+    def __init__(self, res, image_shape, scaled_image_shape, output_stride=1):
+        """
+        :param res: descriptors, shape [H_out, W_out, D]
+        :type res: numpy.ndarray
+        :param image_shape: [H, W] of the original image
+        :type image_shape: list
+        :param scaled_image_shape: [H, W] of the image the network was run on
+        :type scaled_image_shape: list
+        :param output_stride: descriptors are kept every output_stride pixels of the scaled image
+        :type output_stride: int
+        """
+        self._res = res
+        self._image_shape = list(image_shape)
+        self._output_stride = output_stride
+
+        # original image pixels per scaled image pixel
+        self._pixel_scale_u = float(image_shape[1]) / scaled_image_shape[1]
+        self._pixel_scale_v = float(image_shape[0]) / scaled_image_shape[0]
+
+    @property
+    def res(self):
+        return self._res
+
+    @property
+    def image_shape(self):
+        return self._image_shape
+
+    @property
+    def grid_shape(self):
+        return list(self._res.shape[:2])
+
+    def image_uv_to_grid_uv(self, uv):
+        """
+        Returns the grid cell closest to a pixel of the original image
+        :param uv: (u, v) pixel of the original image
+        :type uv: tuple
+        :return: [u, v] grid cell
+        :rtype: list
+        """
+        # pixel centers are at +0.5
+        u = ((uv[0] + 0.5) / self._pixel_scale_u - 0.5) / self._output_stride
+        v = ((uv[1] + 0.5) / self._pixel_scale_v - 0.5) / self._output_stride
+
+        grid_height, grid_width = self.grid_shape
+        u = min(max(int(round(u)), 0), grid_width - 1)
+        v = min(max(int(round(v)), 0), grid_height - 1)
+        return [u, v]
+
+    def grid_uv_to_image_uv(self, uv):
+        """
+        Returns the pixel of the original image at the center of a grid cell
+        :param uv: [u, v] grid cell
+        :type uv: tuple
+        :return: [u, v] pixel of the original image
+        :rtype: list
+        """
+        u = (uv[0] * self._output_stride + 0.5) * self._pixel_scale_u - 0.5
+        v = (uv[1] * self._output_stride + 0.5) * self._pixel_scale_v - 0.5
+
+        image_height, image_width = self._image_shape
+        u = min(max(int(round(u)), 0), image_width - 1)
+        v = min(max(int(round(v)), 0), image_height - 1)
+        return [u, v]
+
+    def descriptor_at(self, uv):
+        """
+        :param uv: (u, v) pixel of the original image
+        :type uv: tuple
+        :return: descriptor, shape [D]
+        :rtype: numpy.ndarray
+        """
+        u, v = self.image_uv_to_grid_uv(uv)
+        return self._res[v, u]
+
+    def find_best_match_for_descriptor(self, descriptor):
+        """
+        Same as DenseCorrespondenceNetwork.find_best_match_for_descriptor but the
+        best match is in pixel coordinates of the original image
+        :return: (best_match_uv, best_match_diff, norm_diffs). norm_diffs is on the grid
+        :rtype: tuple
+        """
+        norm_diffs = np.sqrt(np.sum(np.square(self._res - descriptor), axis=2))
+
+        best_match_flattened_idx = np.argmin(norm_diffs)
+        best_match_xy = np.unravel_index(best_match_flattened_idx, norm_diffs.shape)
+        best_match_diff = norm_diffs[best_match_xy]
+
+        best_match_uv = self.grid_uv_to_image_uv((best_match_xy[1], best_match_xy[0]))
+        return best_match_uv, best_match_diff, norm_diffs
+
+    def find_best_match(self, uv_a, descriptor_image_b):
+        """
+        Finds the best match in image b of a pixel of this image
+        :param uv_a: (u, v) pixel of this image
+        :type uv_a: tuple
+        :param descriptor_image_b:
+        :type descriptor_image_b: DescriptorImage
+        :return: (best_match_uv, best_match_diff, norm_diffs), best_match_uv is a pixel of image b
+        :rtype: tuple
+        """
+        return descriptor_image_b.find_best_match_for_descriptor(self.descriptor_at(uv_a))
+
+
+class TiledInference(object):
+
+    def __init__(self, dcn, scale=1.0, output_stride=1, tile_shape=None, overlap=32, max_memory_mb=None):
+        """
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :param scale: the image is resized by this factor before inference
+        :type scale: float
+        :param output_stride: only keep the descriptors every output_stride pixels
+        :type output_stride: int
+        :param tile_shape: [H, W] of the tiles. If None the image is only tiled when
+        it doesn't fit under max_memory_mb
+        :type tile_shape: list
+        :param overlap: pixels of overlap between neighboring tiles
+        :type overlap: int
+        :param max_memory_mb: cap on the memory of a single forward pass, None for no cap
+        :type max_memory_mb: float
+        """
+        if output_stride < 1:
+            raise ValueError("output_stride must be at least 1, not %d" %(output_stride))
+
+        if (tile_shape is not None) and (min(tile_shape) <= 2 * overlap):
+            raise ValueError("tiles of shape %s are too small for an overlap of %d" %(tile_shape, overlap))
+
+        self._dcn = dcn
+        self._scale = scale
+        self._output_stride = int(output_stride)
+        self._tile_shape = tile_shape
+        self._overlap = overlap
+        self._max_memory_mb = max_memory_mb
+        self._bytes_per_pixel = None
+
+    @staticmethod
+    def estimate_bytes_per_pixel(dcn, image_shape=(120, 160)):
+        """
+        Estimates the peak memory per input pixel of a forward pass from the largest
+        activation of the network on a small image
+        :type dcn: DenseCorrespondenceNetwork
+        :return:
+        :rtype: float
+        """
+        activation_bytes = []
+
+        def hook(module, inputs, output):
+            if isinstance(output, torch.Tensor):
+                activation_bytes.append(output.numel() * output.element_size())
+
+        handles = [m.register_forward_hook(hook) for m in dcn.fcn.modules()
+                   if len(list(m.children())) == 0]
+
+        img_tensor = torch.zeros(1, 3, image_shape[0], image_shape[1], device=dcn.device)
+        with torch.no_grad():
+            dcn.forward(img_tensor)
+
+        for handle in handles:
+            handle.remove()
+
+        # e.g. a TorchScript backbone doesn't run the hooks
+        if len(activation_bytes) == 0:
+            raise ValueError("couldn't measure the activations of the network, set tile_shape instead")
+
+        num_pixels = image_shape[0] * image_shape[1]
+        return ACTIVATION_MEMORY_FACTOR * max(activation_bytes) / float(num_pixels)
+
+    def get_tile_shape(self, image_shape):
+        """
+        Returns the tile shape for an image of the given (scaled) shape
+        :param image_shape: [H, W]
+        :type image_shape: list
+        :return: [H, W] of the tiles
+        :rtype: list
+        """
+        image_height, image_width = image_shape
+
+        if self._tile_shape is not None:
+            return [min(self._tile_shape[0], image_height), min(self._tile_shape[1], image_width)]
+
+        if self._max_memory_mb is None:
+            return [image_height, image_width]
+
+        if self._bytes_per_pixel is None:
+            self._bytes_per_pixel = TiledInference.estimate_bytes_per_pixel(self._dcn)
+
+        max_pixels = self._max_memory_mb * BYTES_PER_MB / self._bytes_per_pixel
+        if image_height * image_width <= max_pixels:
+            return [image_height, image_width]
+
+        # square tiles, multiples of 8 to match the output stride of the backbone
+        side = int(math.sqrt(max_pixels)) // 8 * 8
+        if side <= 2 * self._overlap:
+            raise ValueError("max_memory_mb = %.1f is too small for tiles with an overlap of %d"
+                             %(self._max_memory_mb, self._overlap))
+
+        return [min(side, image_height), min(side, image_width)]
+
+    @staticmethod
+    def get_tile_origins(length, tile_length, overlap):
+        """
+        Returns the start of each tile along one dimension. The last tile ends at the
+        end of the image.
+        :return:
+        :rtype: list of int
+        """
+        if length <= tile_length:
+            return [0]
+
+        step = tile_length - overlap
+        origins = range(0, length - tile_length + 1, step)
+        if origins[-1] + tile_length < length:
+            origins.append(length - tile_length)
+        return origins
+
+    @staticmethod
+    def get_blend_weights(tile_length, overlap):
+        """
+        Weights that ramp linearly from the tile edges over the overlap
+        :return: shape [tile_length]
+        :rtype: torch.Tensor
+        """
+        idx = torch.arange(tile_length).float()
+        weights = torch.min(torch.min(idx + 1, tile_length - idx), torch.full_like(idx, overlap + 1))
+        return weights / (overlap + 1)
+
+    def forward_image_tensor(self, img_tensor):
+        """
+        Computes the descriptors of an image of any size
+        :param img_tensor: normalized image, shape [3, H, W]
+        :type img_tensor: torch.Tensor
+        :return:
+        :rtype: DescriptorImage
+        """
+        assert len(img_tensor.shape) == 3
+        image_shape = [img_tensor.shape[1], img_tensor.shape[2]]
+        s = self._output_stride
+
+        img_tensor = img_tensor.unsqueeze(0).to(self._dcn.device)
+        if self._scale != 1.0:
+            img_tensor = F.interpolate(img_tensor, scale_factor=self._scale, mode='bilinear', align_corners=False)
+
+        scaled_height, scaled_width = img_tensor.shape[2], img_tensor.shape[3]
+        tile_height, tile_width = self.get_tile_shape([scaled_height, scaled_width])
+
+        tile_origins_v = TiledInference.get_tile_origins(scaled_height, tile_height, self._overlap)
+        tile_origins_u = TiledInference.get_tile_origins(scaled_width, tile_width, self._overlap)
+        logging.debug("%d x %d tiles of shape %d x %d" %(len(tile_origins_v), len(tile_origins_u),
+                                                         tile_height, tile_width))
+
+        grid_height = (scaled_height + s - 1) // s
+        grid_width = (scaled_width + s - 1) // s
+        D = self._dcn.descriptor_dimension
+        device = img_tensor.device
+
+        res = torch.zeros(D, grid_height, grid_width, device=device)
+        total_weight = torch.zeros(1, grid_height, grid_width, device=device)
+
+        weights = torch.ger(TiledInference.get_blend_weights(tile_height, self._overlap),
+                            TiledInference.get_blend_weights(tile_width, self._overlap)).to(device)
+
+        with torch.no_grad():
+            for v0 in tile_origins_v:
+                for u0 in tile_origins_u:
+                    tile = img_tensor[:, :, v0:v0 + tile_height, u0:u0 + tile_width]
+                    tile_res = self._dcn.forward(tile)[0] # [D, tile_height, tile_width]
+
+                    # the first pixel of the tile that lies on the output grid
+                    dv = (-v0) % s
+                    du = (-u0) % s
+                    tile_res = tile_res[:, dv::s, du::s]
+                    tile_weights = weights[dv::s, du::s].unsqueeze(0)
+
+                    gv = (v0 + dv) // s
+                    gu = (u0 + du) // s
+                    h, w = tile_res.shape[1], tile_res.shape[2]
+                    res[:, gv:gv + h, gu:gu + w] += tile_res * tile_weights
+                    total_weight[:, gv:gv + h, gu:gu + w] += tile_weights
+
+        res = res / total_weight
+        if self._dcn._normalize:
+            # blending doesn't preserve the unit norm
+            res = F.normalize(res, p=2, dim=0)
+
+        res = res.permute(1, 2, 0).cpu().numpy()
+        return DescriptorImage(res, image_shape, [scaled_height, scaled_width], output_stride=s)
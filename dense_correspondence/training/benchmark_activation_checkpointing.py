@@ -0,0 +1,155 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset, SpartanDatasetDataType
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.loss_functions.pixelwise_contrastive_loss import PixelwiseContrastiveLoss
+import dense_correspondence.loss_functions.loss_composer as loss_composer
+
+"""
+Reports the peak GPU memory vs step time tradeoff of activation checkpointing
+for each backbone.
+
+Uses random images and random matches, so no dataset is needed. A step is a
+forward and backward pass on a single image pair, i.e. one micro-batch when
+using gradient accumulation. Memory doesn't depend on gradient_accumulation_steps,
+the time per optimizer step is gradient_accumulation_steps times the step time.
+
+Usage:
+    python benchmark_activation_checkpointing.py --num_steps 20
+"""
+
+DC_SOURCE_DIR = utils.getDenseCorrespondenceSourceDir()
+TRAINING_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training', 'training.yaml')
+
+BACKBONES = ["Resnet34_8s", "Resnet50_8s", "Resnet101_8s"]
+
+BYTES_PER_MB = 1024.0 * 1024.0
+
+
+def make_random_batch(image_height, image_width, num_matches=1000, num_non_matches_per_match=150):
+    """
+    Makes a random image pair along with matches and non-matches in the format
+    returned by the SpartanDataset DataLoader, already on the GPU
+    """
+    SD = SpartanDataset
+    num_pixels = image_height * image_width
+    num_non_matches = num_matches * num_non_matches_per_match
+
+    img_a = torch.rand(1, 3, image_height, image_width).cuda()
+    img_b = torch.rand(1, 3, image_height, image_width).cuda()
+
+    matches_a = torch.randint(0, num_pixels, (num_matches,)).long().cuda()
+    matches_b = torch.randint(0, num_pixels, (num_matches,)).long().cuda()
+    masked_non_matches_a = torch.randint(0, num_pixels, (num_non_matches,)).long().cuda()
+    masked_non_matches_b = torch.randint(0, num_pixels, (num_non_matches,)).long().cuda()
+    background_non_matches_a = torch.randint(0, num_pixels, (num_non_matches,)).long().cuda()
+    background_non_matches_b = torch.randint(0, num_pixels, (num_non_matches,)).long().cuda()
+
+    blind_non_matches_a = SD.empty_tensor().cuda()
+    blind_non_matches_b = SD.empty_tensor().cuda()
+
+    match_type = torch.LongTensor([SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE])
+
+    return match_type, img_a, img_b, matches_a, matches_b, masked_non_matches_a, masked_non_matches_b, \
+           background_non_matches_a, background_non_matches_b, blind_non_matches_a, blind_non_matches_b
+
+
+def benchmark_backbone(train_config, resnet_name, activation_checkpointing, num_steps=20, num_warmup_steps=3):
+    """
+    Runs num_steps training steps and measures peak memory and step time
+    :return: dict with peak_memory_mb and step_time_mean
+    :rtype: dict
+    """
+    network_config = copy.deepcopy(train_config['dense_correspondence_network'])
+    network_config['backbone'] = {'model_class': 'Resnet', 'resnet_name': resnet_name}
+
+    dcn = DenseCorrespondenceNetwork.from_config(network_config, load_stored_params=False)
+    dcn.set_activation_checkpointing(activation_checkpointing)
+    dcn.train()
+
+    optimizer = torch.optim.Adam(dcn.parameters(), lr=1e-4)
+    pcl = PixelwiseContrastiveLoss(image_shape=dcn.image_shape, config=train_config['loss_function'])
+
+    image_height, image_width = dcn.image_shape
+    batch = make_random_batch(image_height, image_width,
+                              num_non_matches_per_match=train_config['training']['num_non_matches_per_match'])
+    match_type, img_a, img_b = batch[0:3]
+
+    torch.cuda.synchronize()
+    torch.cuda.empty_cache()
+    if hasattr(torch.cuda, 'reset_max_memory_allocated'):
+        torch.cuda.reset_max_memory_allocated()
+
+    step_times = []
+    for i in xrange(num_warmup_steps + num_steps):
+        start = time.time()
+        optimizer.zero_grad()
+
+        image_a_pred = dcn.process_network_output(dcn.forward(img_a), 1)
+        image_b_pred = dcn.process_network_output(dcn.forward(img_b), 1)
+
+        loss, _, _, _, _ = loss_composer.get_loss(pcl, match_type, image_a_pred, image_b_pred, *batch[3:])
+        loss.backward()
+        optimizer.step()
+
+        torch.cuda.synchronize()
+        if i >= num_warmup_steps:
+            step_times.append(time.time() - start)
+
+    d = dict()
+    d['peak_memory_mb'] = torch.cuda.max_memory_allocated() / BYTES_PER_MB
+    d['step_time_mean'] = float(np.mean(step_times))
+
+    del dcn, optimizer, image_a_pred, image_b_pred, loss
+    torch.cuda.empty_cache()
+    return d
+
+
+def run_benchmark(num_steps=20, backbones=BACKBONES):
+    """
+    :return: dict of backbone --> {'no_checkpointing': stats, 'checkpointing': stats}
+    :rtype: dict
+    """
+    train_config = utils.getDictFromYamlFilename(TRAINING_CONFIG_FILE)
+
+    results = dict()
+    for resnet_name in backbones:
+        results[resnet_name] = dict()
+        for activation_checkpointing in [False, True]:
+            key = "checkpointing" if activation_checkpointing else "no_checkpointing"
+            print "benchmarking %s, %s" %(resnet_name, key)
+            results[resnet_name][key] = benchmark_backbone(train_config, resnet_name, activation_checkpointing,
+                                                           num_steps=num_steps)
+    return results
+
+
+def print_results(results):
+    print "%-15s%18s%18s%18s%18s" %("backbone", "memory MB", "memory MB (ckpt)", "step time s", "step time s (ckpt)")
+    for resnet_name, d in sorted(results.iteritems()):
+        print "%-15s%18.1f%18.1f%18.4f%18.4f" %(resnet_name,
+                                                d['no_checkpointing']['peak_memory_mb'],
+                                                d['checkpointing']['peak_memory_mb'],
+                                                d['no_checkpointing']['step_time_mean'],
+                                                d['checkpointing']['step_time_mean'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_steps", type=int, default=20)
+    parser.add_argument("--backbones", type=str, nargs='+', default=BACKBONES)
+    parser.add_argument("--output_file", type=str, default=None, help="(optional) yaml file to save the results to")
+    args = parser.parse_args()
+
+    results = run_benchmark(num_steps=args.num_steps, backbones=args.backbones)
+    print_results(results)
+
+    if args.output_file is not None:
+        utils.saveToYaml(results, args.output_file)
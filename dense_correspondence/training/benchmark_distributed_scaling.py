@@ -0,0 +1,109 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import copy
+import logging
+import argparse
+
+"""
+Benchmarks the throughput of data-parallel training for different numbers
+of ranks, see distributed.py.
+
+For each world size a short training run is launched with
+DenseCorrespondenceTraining.run_distributed(). Throughput is computed from
+the median step time that rank 0 writes to memory_stats.yaml. Each rank
+processes batch_size * gradient_accumulation_steps image pairs per step.
+
+Usage:
+    python benchmark_distributed_scaling.py --world_sizes 1 2 4 8 --num_iterations 200
+"""
+
+DC_SOURCE_DIR = utils.getDenseCorrespondenceSourceDir()
+DATASET_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'dataset', 'composite',
+                                   'caterpillar_only.yaml')
+TRAINING_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training', 'training.yaml')
+
+LOGGING_DIR = "trained_models/benchmarks"
+
+WORLD_SIZES = [1, 2, 4, 8]
+
+
+def run_benchmark(num_iterations, world_sizes=WORLD_SIZES, backend="gloo",
+                  dataset_config_file=DATASET_CONFIG_FILE):
+    """
+    Trains once per world size and returns the throughput of each run
+    :return: dict of world_size --> stats
+    :rtype: dict
+    """
+    # imports are here so that nothing touches CUDA before the fork
+    from dense_correspondence.training.training import DenseCorrespondenceTraining
+    from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+
+    train_config = utils.getDictFromYamlFilename(TRAINING_CONFIG_FILE)
+    train_config['training']['num_iterations'] = num_iterations
+    train_config['training']['compute_test_loss'] = False
+    train_config['training']['save_rate'] = num_iterations + 1 # only save at the end
+    train_config['training']['logging_dir'] = LOGGING_DIR
+
+    batch_size = train_config['training']['batch_size']
+    gradient_accumulation_steps = 1
+    if 'gradient_accumulation_steps' in train_config['training']:
+        gradient_accumulation_steps = train_config['training']['gradient_accumulation_steps']
+
+    dataset = SpartanDataset(config=utils.getDictFromYamlFilename(dataset_config_file))
+
+    results = dict()
+    for world_size in world_sizes:
+        logging.info("benchmarking world size %d" %(world_size))
+        config = copy.deepcopy(train_config)
+        logging_dir_name = "distributed_scaling_%d" %(world_size)
+        config['training']['logging_dir_name'] = logging_dir_name
+        config['training']['distributed'] = {'enabled': True,
+                                             'world_size': world_size,
+                                             'backend': backend,
+                                             'init_method': "tcp://127.0.0.1:%d" %(23456 + world_size),
+                                             'learning_rate_scaling': 'linear'}
+
+        DenseCorrespondenceTraining.run_distributed(config, dataset=dataset)
+
+        memory_stats_file = os.path.join(utils.convert_data_relative_path_to_absolute_path(LOGGING_DIR),
+                                         logging_dir_name, 'memory_stats.yaml')
+        memory_stats = utils.getDictFromYamlFilename(memory_stats_file)
+
+        d = dict()
+        d['step_time_median'] = memory_stats['step_time_median']
+        d['samples_per_second'] = world_size * batch_size * gradient_accumulation_steps / d['step_time_median']
+        results[world_size] = d
+
+    # scaling efficiency relative to the smallest world size
+    base_world_size = min(results.keys())
+    base_samples_per_second = results[base_world_size]['samples_per_second']
+    for world_size, d in results.iteritems():
+        ideal = base_samples_per_second * world_size / base_world_size
+        d['scaling_efficiency'] = d['samples_per_second'] / ideal
+
+    return results
+
+
+def print_results(results):
+    print "%-12s%20s%20s%20s" %("world size", "step time s", "samples/s", "efficiency")
+    for world_size, d in sorted(results.iteritems()):
+        print "%-12d%20.4f%20.2f%20.2f" %(world_size, d['step_time_median'], d['samples_per_second'],
+                                          d['scaling_efficiency'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_iterations", type=int, default=200)
+    parser.add_argument("--world_sizes", type=int, nargs='+', default=WORLD_SIZES)
+    parser.add_argument("--backend", type=str, default="gloo")
+    parser.add_argument("--dataset_config_file", type=str, default=DATASET_CONFIG_FILE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = run_benchmark(args.num_iterations, world_sizes=args.world_sizes, backend=args.backend,
+                            dataset_config_file=args.dataset_config_file)
+
+    utils.saveToYaml(results, os.path.join(utils.convert_data_relative_path_to_absolute_path(LOGGING_DIR),
+                                           'distributed_scaling_benchmark.yaml'))
+    print_results(results)
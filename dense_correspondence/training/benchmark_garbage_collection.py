@@ -0,0 +1,102 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import copy
+import logging
+import argparse
+import multiprocessing
+
+"""
+Benchmarks step time and peak RSS of the training loop for the different
+garbage collection modes, see memory_management.py.
+
+Each mode is trained in its own process so that the RSS numbers are independent.
+The RSS of the DataLoader workers, where the collate path runs, is reported separately
+from that of the training process.
+The results are read from the memory_stats.yaml file that training writes.
+
+Usage:
+    python benchmark_garbage_collection.py --num_iterations 10000
+"""
+
+DC_SOURCE_DIR = utils.getDenseCorrespondenceSourceDir()
+DATASET_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'dataset', 'composite',
+                                   'caterpillar_only.yaml')
+TRAINING_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training', 'training.yaml')
+
+LOGGING_DIR = "trained_models/benchmarks"
+
+MODES = ["full", "generation_0"]
+
+
+def train_with_garbage_collect_mode(mode, train_config, dataset_config_file):
+    """
+    Trains a network with the given garbage_collect_mode. Runs in a separate process.
+    """
+    # imports are here so that nothing touches CUDA before the fork
+    from dense_correspondence.training.training import DenseCorrespondenceTraining
+    from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+
+    logging.basicConfig(level=logging.INFO)
+    dataset = SpartanDataset(config=utils.getDictFromYamlFilename(dataset_config_file))
+
+    train_config = copy.deepcopy(train_config)
+    train_config['training']['garbage_collect_mode'] = mode
+
+    train = DenseCorrespondenceTraining(dataset=dataset, config=train_config)
+    train.run()
+
+
+def run_benchmark(num_iterations, garbage_collect_rate=1, dataset_config_file=DATASET_CONFIG_FILE):
+    """
+    Trains once per garbage collect mode and returns the memory stats of each run
+    :return: dict of mode --> memory_stats
+    :rtype: dict
+    """
+    train_config = utils.getDictFromYamlFilename(TRAINING_CONFIG_FILE)
+    train_config['training']['num_iterations'] = num_iterations
+    train_config['training']['garbage_collect_rate'] = garbage_collect_rate
+    train_config['training']['compute_test_loss'] = False
+    train_config['training']['save_rate'] = num_iterations + 1 # only save at the end
+    train_config['training']['logging_dir'] = LOGGING_DIR
+
+    results = dict()
+    for mode in MODES:
+        logging_dir_name = "garbage_collection_%s" %(mode)
+        train_config['training']['logging_dir_name'] = logging_dir_name
+
+        p = multiprocessing.Process(target=train_with_garbage_collect_mode,
+                                    args=(mode, train_config, dataset_config_file))
+        p.start()
+        p.join()
+
+        memory_stats_file = os.path.join(utils.convert_data_relative_path_to_absolute_path(LOGGING_DIR),
+                                         logging_dir_name, 'memory_stats.yaml')
+        results[mode] = utils.getDictFromYamlFilename(memory_stats_file)
+
+    return results
+
+
+def print_results(results):
+    fields = ['step_time_mean', 'step_time_median', 'step_time_95th_percentile', 'gc_time_total',
+              'peak_rss_mb', 'children_max_rss_mb', 'children_peak_rss_mb', 'num_full_collections']
+
+    print "%-15s" %("mode") + "".join(["%28s" %(field) for field in fields])
+    for mode in MODES:
+        d = results[mode]
+        print "%-15s" %(mode) + "".join(["%28.4f" %(d[field]) for field in fields])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_iterations", type=int, default=10000)
+    parser.add_argument("--garbage_collect_rate", type=int, default=1)
+    parser.add_argument("--dataset_config_file", type=str, default=DATASET_CONFIG_FILE)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.num_iterations, garbage_collect_rate=args.garbage_collect_rate,
+                            dataset_config_file=args.dataset_config_file)
+
+    utils.saveToYaml(results, os.path.join(utils.convert_data_relative_path_to_absolute_path(LOGGING_DIR),
+                                           'garbage_collection_benchmark.yaml'))
+    print_results(results)
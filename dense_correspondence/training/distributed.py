@@ -0,0 +1,203 @@
+# system
+import logging
+import multiprocessing
+
+# torch
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+# dense correspondence
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+
+"""
+Helpers for multi-process data-parallel training with torch.distributed.
+
+Each rank is a separate process. With CUDA each rank uses one GPU, without
+CUDA the ranks run on the CPU with the gloo backend.
+"""
+
+LEARNING_RATE_SCALING_RULES = ["none", "linear", "sqrt"]
+
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if not is_initialized():
+        return 0
+    return dist.get_rank()
+
+
+def get_world_size():
+    if not is_initialized():
+        return 1
+    return dist.get_world_size()
+
+
+def is_main_process():
+    """
+    Only the main process (rank 0) writes logs, checkpoints and configs
+    """
+    return get_rank() == 0
+
+
+def get_device(rank=None):
+    """
+    Returns the device this rank should use. With CUDA the ranks are assigned
+    round robin to the visible GPUs
+    :return:
+    :rtype: torch.device
+    """
+    if not torch.cuda.is_available():
+        return torch.device("cpu")
+
+    if rank is None:
+        rank = get_rank()
+    return torch.device("cuda", rank % torch.cuda.device_count())
+
+
+def init_process_group(rank, world_size, backend="gloo", init_method="tcp://127.0.0.1:23456"):
+    """
+    Initializes torch.distributed for this process and sets the default cuda device
+    :param rank:
+    :type rank: int
+    :param world_size:
+    :type world_size: int
+    :param backend: "gloo" works on both CPU and GPU
+    :type backend: str
+    :param init_method: url used by the ranks to find each other
+    :type init_method: str
+    :return:
+    :rtype: None
+    """
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+
+    device = get_device(rank)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+
+    logging.info("initialized rank %d of %d, backend %s, device %s" %(rank, world_size, backend, device))
+
+
+def scale_learning_rate(learning_rate, world_size, rule="linear"):
+    """
+    Scales the learning rate with the number of ranks. The effective batch size
+    is world_size times larger than for a single process.
+        - linear: learning_rate * world_size
+        - sqrt: learning_rate * sqrt(world_size)
+        - none: learning_rate
+    :return:
+    :rtype: float
+    """
+    if rule not in LEARNING_RATE_SCALING_RULES:
+        raise ValueError("learning rate scaling rule must be one of %s, not %s" %(LEARNING_RATE_SCALING_RULES, rule))
+
+    if rule == "linear":
+        return learning_rate * world_size
+    elif rule == "sqrt":
+        return learning_rate * world_size ** 0.5
+    else:
+        return learning_rate
+
+
+def all_reduce_sum(values):
+    """
+    Sums a list of numbers across all ranks. Every rank must call this
+    the same number of times, in the same order.
+    :param values: list of numbers
+    :type values: list
+    :return: list of floats
+    :rtype: list
+    """
+    if not is_initialized():
+        return [float(x) for x in values]
+
+    # the values are host numbers anyway, gloo reduces cpu tensors but nccl needs cuda tensors
+    t = torch.DoubleTensor([float(x) for x in values])
+    if dist.get_backend() == "nccl":
+        t = t.cuda()
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+
+def min_over_ranks(value):
+    """
+    Minimum of a number over all ranks. Every rank must call this
+    :param value:
+    :type value: int
+    :return:
+    :rtype: int
+    """
+    if not is_initialized():
+        return value
+
+    t = torch.DoubleTensor([float(value)])
+    if dist.get_backend() == "nccl":
+        t = t.cuda()
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return int(t.item())
+
+
+def mean_over_ranks(values):
+    """
+    Averages a list of numbers over all ranks, see all_reduce_sum()
+    :param values: list of numbers
+    :type values: list
+    :return: list of floats
+    :rtype: list
+    """
+    world_size = get_world_size()
+    return [x / world_size for x in all_reduce_sum(values)]
+
+
+def any_rank(flag):
+    """
+    Returns True if flag is True on any rank
+    :param flag:
+    :type flag: bool
+    :return:
+    :rtype: bool
+    """
+    return all_reduce_sum([1 if flag else 0])[0] > 0
+
+
+class ImagePairForward(nn.Module):
+    """
+    Runs both images of a pair through the network in a single call.
+    DistributedDataParallel expects one forward call per backward pass.
+    """
+
+    def __init__(self, dcn):
+        super(ImagePairForward, self).__init__()
+        self.dcn = dcn
+
+    def forward(self, img_a, img_b):
+        return self.dcn.forward(img_a), self.dcn.forward(img_b)
+
+
+def launch(train_function, world_size, args=()):
+    """
+    Starts world_size processes and runs train_function(rank, world_size, *args) in each.
+    Waits for all of them to finish
+    :param train_function: function that calls init_process_group and trains, must be picklable
+    :type train_function:
+    :param world_size:
+    :type world_size: int
+    :return:
+    :rtype: None
+    """
+    processes = []
+    for rank in xrange(world_size):
+        p = multiprocessing.Process(target=train_function, args=(rank, world_size) + tuple(args))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+    for rank, p in enumerate(processes):
+        if p.exitcode != 0:
+            raise ValueError("rank %d exited with code %d" %(rank, p.exitcode))
@@ -0,0 +1,255 @@
+# system
+import os
+import gc
+import time
+import logging
+import resource
+
+import numpy as np
+
+# torch
+import torch
+
+# dense correspondence
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+
+
+GARBAGE_COLLECT_MODES = ["full", "generation_0"]
+
+BYTES_PER_MB = 1024.0 * 1024.0
+
+
+def _read_rss_mb(pid="self"):
+    with open("/proc/%s/statm" %(pid), 'r') as f:
+        rss_pages = int(f.read().split()[1])
+    return rss_pages * resource.getpagesize() / BYTES_PER_MB
+
+
+def get_rss_mb():
+    """
+    Returns the current resident set size of this process in MB.
+    Uses /proc/self/statm, falls back to the peak RSS if that isn't available.
+    :return:
+    :rtype: float
+    """
+    try:
+        return _read_rss_mb()
+    except (IOError, ValueError, IndexError):
+        return get_peak_rss_mb()
+
+
+def get_child_pids():
+    """
+    Returns the pids of the running child processes of this process, e.g. the
+    DataLoader workers. Empty if /proc isn't available
+    :return:
+    :rtype: list of int
+    """
+    pid = os.getpid()
+    child_pids = []
+    try:
+        proc_entries = os.listdir("/proc")
+    except OSError:
+        return child_pids
+
+    for entry in proc_entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" %(entry), 'r') as f:
+                stat = f.read()
+            # the command name is in parentheses and can contain spaces
+            ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        except (IOError, ValueError, IndexError):
+            continue # the process exited
+        if ppid == pid:
+            child_pids.append(int(entry))
+
+    return child_pids
+
+
+def get_children_rss_mb():
+    """
+    Returns the summed current resident set size of the running child processes in MB.
+    The collate path of the DataLoader runs in the worker processes, so their memory
+    isn't in get_rss_mb()
+    :return:
+    :rtype: float
+    """
+    rss = 0.0
+    for pid in get_child_pids():
+        try:
+            rss += _read_rss_mb(pid)
+        except (IOError, ValueError, IndexError):
+            pass # the process exited
+    return rss
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB
+    :return:
+    :rtype: float
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_children_peak_rss_mb():
+    """
+    Returns the peak resident set size of the largest child process that has exited
+    and been waited for, e.g. the DataLoader workers of finished epochs, in MB
+    :return:
+    :rtype: float
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+class TrainingMemoryManager(object):
+    """
+    Decides when to run garbage collection in the training loop and keeps
+    track of memory telemetry.
+
+    garbage_collect_mode
+        - "full": gc.collect() every garbage_collect_rate iterations. This is the old behavior.
+        - "generation_0": collect only the youngest generation every garbage_collect_rate
+           iterations, which is cheap. A full collection is only run if the RSS has grown
+           by more than garbage_collect_rss_growth_mb since the last full collection.
+    """
+
+    def __init__(self, garbage_collect_mode="generation_0", garbage_collect_rate=1,
+                 rss_growth_threshold_mb=512):
+        """
+        :param garbage_collect_mode: one of GARBAGE_COLLECT_MODES
+        :type garbage_collect_mode: str
+        :param garbage_collect_rate: collect every this many iterations
+        :type garbage_collect_rate: int
+        :param rss_growth_threshold_mb: RSS growth that triggers a full collection in "generation_0" mode
+        :type rss_growth_threshold_mb: float
+        """
+        if garbage_collect_mode not in GARBAGE_COLLECT_MODES:
+            raise ValueError("garbage_collect_mode must be one of %s, not %s" %(GARBAGE_COLLECT_MODES, garbage_collect_mode))
+
+        self._mode = garbage_collect_mode
+        self._rate = max(1, int(garbage_collect_rate))
+        self._rss_growth_threshold_mb = rss_growth_threshold_mb
+
+        self._rss_at_last_full_collection = get_rss_mb()
+        self._num_full_collections = 0
+        self._num_generation_0_collections = 0
+        self._gc_time = 0.0
+        self._step_times = []
+        self._last_step_time = None
+        self._max_children_rss = 0.0
+
+    @staticmethod
+    def from_training_config(training_config):
+        """
+        Constructs a TrainingMemoryManager from the 'training' section of training.yaml
+        :param training_config:
+        :type training_config: dict
+        :return:
+        :rtype: TrainingMemoryManager
+        """
+        mode = "generation_0"
+        if 'garbage_collect_mode' in training_config:
+            mode = training_config['garbage_collect_mode']
+
+        rss_growth_threshold_mb = 512
+        if 'garbage_collect_rss_growth_mb' in training_config:
+            rss_growth_threshold_mb = training_config['garbage_collect_rss_growth_mb']
+
+        return TrainingMemoryManager(garbage_collect_mode=mode,
+                                     garbage_collect_rate=training_config['garbage_collect_rate'],
+                                     rss_growth_threshold_mb=rss_growth_threshold_mb)
+
+    def step(self, iteration):
+        """
+        Call once per training iteration. Runs garbage collection if needed.
+
+        The step time telemetry is the wall time between consecutive calls, so it
+        includes data loading and garbage collection.
+        :param iteration: training iteration
+        :type iteration: int
+        :return:
+        :rtype: None
+        """
+        now = time.time()
+        if self._last_step_time is not None:
+            self._step_times.append(now - self._last_step_time)
+        self._last_step_time = now
+
+        if iteration % self._rate != 0:
+            return
+
+        gc_start = time.time()
+        if self._mode == "full":
+            self._full_collection()
+        else:
+            gc.collect(0)
+            self._num_generation_0_collections += 1
+
+            rss = get_rss_mb()
+            if (rss - self._rss_at_last_full_collection) > self._rss_growth_threshold_mb:
+                logging.info("RSS grew to %.1f MB, running full garbage collection" %(rss))
+                self._full_collection()
+
+        gc_elapsed = time.time() - gc_start
+        self._gc_time += gc_elapsed
+        logging.debug("garbage collection took %.3f seconds" %(gc_elapsed))
+
+    def _full_collection(self):
+        gc.collect()
+        self._num_full_collections += 1
+        self._rss_at_last_full_collection = get_rss_mb()
+
+    def telemetry(self):
+        """
+        Returns the current memory telemetry. The children are the DataLoader worker
+        processes. children_max_rss_mb is the largest summed RSS of the running children
+        seen by telemetry() so far, children_peak_rss_mb the peak RSS of the largest
+        child that has exited.
+        :return:
+        :rtype: dict
+        """
+        d = dict()
+        d['rss_mb'] = get_rss_mb()
+        d['peak_rss_mb'] = get_peak_rss_mb()
+        d['children_rss_mb'] = get_children_rss_mb()
+        self._max_children_rss = max(self._max_children_rss, d['children_rss_mb'])
+        d['children_max_rss_mb'] = self._max_children_rss
+        d['children_peak_rss_mb'] = get_children_peak_rss_mb()
+        d['total_rss_mb'] = d['rss_mb'] + d['children_rss_mb']
+        if torch.cuda.is_available():
+            d['cuda_memory_allocated_mb'] = torch.cuda.memory_allocated() / BYTES_PER_MB
+            d['cuda_max_memory_allocated_mb'] = torch.cuda.max_memory_allocated() / BYTES_PER_MB
+        return d
+
+    def summary(self):
+        """
+        Returns the memory telemetry along with garbage collection and step time statistics
+        :return:
+        :rtype: dict
+        """
+        d = self.telemetry()
+        d['garbage_collect_mode'] = self._mode
+        d['garbage_collect_rate'] = self._rate
+        d['num_full_collections'] = self._num_full_collections
+        d['num_generation_0_collections'] = self._num_generation_0_collections
+        d['gc_time_total'] = self._gc_time
+        d['num_steps'] = len(self._step_times)
+
+        if len(self._step_times) > 0:
+            step_times = np.array(self._step_times)
+            d['step_time_mean'] = float(np.mean(step_times))
+            d['step_time_median'] = float(np.median(step_times))
+            d['step_time_95th_percentile'] = float(np.percentile(step_times, 95))
+
+        return d
+
+    def save(self, filename):
+        """
+        Saves summary() to a yaml file
+        """
+        utils.saveToYaml(self.summary(), filename)
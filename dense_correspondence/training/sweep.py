@@ -0,0 +1,512 @@
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+import os
+import csv
+import copy
+import math
+import time
+import random
+import Queue
+import logging
+import argparse
+import itertools
+import traceback
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+"""
+Runs a hyperparameter sweep over training configs on a process pool.
+
+A sweep is a base training config plus a grid or random space of parameter values,
+see config/dense_correspondence/training/sweep.yaml. Each run trains in its own
+forked process with its own slice of the CPUs and a limited number of threads.
+
+The dataset, including its pose data and an optional FrameCache of the image files,
+is loaded once in the parent process and shared read-only with all the runs.
+
+Runs report their training loss every logging_rate iterations. A run whose loss
+is clearly worse than the median of the other runs at the same iteration is
+stopped early. When the sweep is finished a summary table is written to
+summary.csv and summary.yaml in the sweep directory.
+
+Usage:
+    python sweep.py --sweep_config_file sweep.yaml
+"""
+
+DC_SOURCE_DIR = utils.getDenseCorrespondenceSourceDir()
+SWEEP_CONFIG_FILE = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training', 'sweep.yaml')
+
+SWEEP_MODES = ["grid", "random"]
+DISTRIBUTIONS = ["uniform", "log_uniform", "int_uniform"]
+
+
+def set_config_value(config, key, value):
+    """
+    Sets a value in a nested config dict
+    :param key: path into the config separated by dots, e.g. "loss_function.M_masked"
+    :type key: str
+    :return:
+    :rtype: None
+    """
+    path = key.split(".")
+    d = config
+    for name in path[:-1]:
+        if name not in d:
+            raise ValueError("config has no key %s" %(key))
+        d = d[name]
+
+    d[path[-1]] = value
+
+
+def get_available_cpus():
+    """
+    Returns the list of CPUs this process is allowed to run on
+    :return:
+    :rtype: list of int
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return range(multiprocessing.cpu_count())
+
+
+def set_cpu_affinity(cpus):
+    """
+    Restricts the current process to the given CPUs
+    :param cpus:
+    :type cpus: list of int
+    :return:
+    :rtype: None
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+
+    cpu_list = ",".join([str(x) for x in cpus])
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(["taskset", "-p", "-c", cpu_list, str(os.getpid())], stdout=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        logging.warning("failed to set the CPU affinity to %s" %(cpu_list))
+
+
+def set_num_threads(num_threads):
+    """
+    Limits the number of threads torch uses for its CPU ops.
+
+    Environment variables like OMP_NUM_THREADS are no use here, the runs are forked
+    after numpy and torch have read them. The BLAS thread pools of numpy keep the
+    size they got in the parent, but they only run on the CPUs of the run, see
+    set_cpu_affinity().
+    :param num_threads:
+    :type num_threads: int
+    :return:
+    :rtype: None
+    """
+    import torch
+
+    torch.set_num_threads(num_threads)
+
+
+class ParameterSweep(object):
+    """
+    The parameter space of a sweep
+    """
+
+    def __init__(self, parameters):
+        """
+        :param parameters: dict of config key --> list of values or a distribution dict
+        :type parameters: dict
+        """
+        for key, space in parameters.iteritems():
+            if isinstance(space, dict):
+                if ('distribution' not in space) or (space['distribution'] not in DISTRIBUTIONS):
+                    raise ValueError("distribution of %s must be one of %s" %(key, DISTRIBUTIONS))
+            elif not isinstance(space, list):
+                raise ValueError("values of %s must be a list or a distribution dict" %(key))
+
+        self._parameters = parameters
+        self._keys = sorted(parameters.keys())
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def grid(self):
+        """
+        Returns every combination of the parameter values
+        :return: list of dicts of config key --> value
+        :rtype: list
+        """
+        for key in self._keys:
+            if not isinstance(self._parameters[key], list):
+                raise ValueError("grid sweeps need a list of values for %s" %(key))
+
+        value_lists = [self._parameters[key] for key in self._keys]
+        return [dict(zip(self._keys, values)) for values in itertools.product(*value_lists)]
+
+    def sample(self, num_runs, seed=0):
+        """
+        Samples random parameter values
+        :param num_runs: number of samples
+        :type num_runs: int
+        :return: list of dicts of config key --> value
+        :rtype: list
+        """
+        rng = random.Random(seed)
+        assignments = []
+        for i in xrange(num_runs):
+            d = dict()
+            for key in self._keys:
+                d[key] = ParameterSweep._sample_value(rng, self._parameters[key])
+            assignments.append(d)
+
+        return assignments
+
+    @staticmethod
+    def _sample_value(rng, space):
+        if isinstance(space, list):
+            return rng.choice(space)
+
+        low = space['low']
+        high = space['high']
+        distribution = space['distribution']
+        if distribution == "uniform":
+            return rng.uniform(low, high)
+        elif distribution == "log_uniform":
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            return rng.randint(low, high)
+
+    @staticmethod
+    def make_run_name(index, assignment):
+        """
+        Makes a readable name for a run, e.g. "003_M_masked_0.5_descriptor_dimension_3"
+        """
+        name = utils.getPaddedString(index, width=3)
+        for key in sorted(assignment.keys()):
+            value = assignment[key]
+            if isinstance(value, float):
+                value = "%.3g" %(value)
+            name += "_%s_%s" %(key.split(".")[-1], value)
+        return name
+
+
+class MedianStoppingRule(object):
+    """
+    Stops a run if its loss at an iteration is more than (1 + margin) times the
+    median loss of the other runs at that iteration.
+    """
+
+    def __init__(self, grace_iterations=500, min_runs=3, margin=0.1):
+        """
+        :param grace_iterations: runs are never stopped before this iteration
+        :type grace_iterations: int
+        :param min_runs: number of other runs that must have reached the iteration
+        :type min_runs: int
+        :param margin: how much worse than the median a run must be to be stopped
+        :type margin: float
+        """
+        self._grace_iterations = grace_iterations
+        self._min_runs = min_runs
+        self._margin = margin
+
+        # run name --> dict of iteration --> loss
+        self._history = dict()
+
+    @staticmethod
+    def from_config(early_stopping_config):
+        return MedianStoppingRule(grace_iterations=early_stopping_config['grace_iterations'],
+                                  min_runs=early_stopping_config['min_runs'],
+                                  margin=early_stopping_config['margin'])
+
+    def report(self, run_name, iteration, loss):
+        """
+        Records the loss of a run, returns True if the run should be stopped
+        :return:
+        :rtype: bool
+        """
+        if run_name not in self._history:
+            self._history[run_name] = dict()
+        self._history[run_name][iteration] = loss
+
+        if iteration < self._grace_iterations:
+            return False
+
+        other_losses = [history[iteration] for name, history in self._history.iteritems()
+                        if (name != run_name) and (iteration in history)]
+
+        if len(other_losses) < self._min_runs:
+            return False
+
+        return loss > (1.0 + self._margin) * np.median(other_losses)
+
+
+def _run_trial(run_name, config, dataset, cpus, num_threads, cpu_only, loss_window,
+               progress_queue, stop_event):
+    """
+    Trains a single run of the sweep. Runs in a forked process.
+    """
+    if cpu_only:
+        # the parent never initializes CUDA, so this takes effect
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    set_cpu_affinity(cpus)
+    set_num_threads(num_threads)
+
+    # imported here so that nothing touches CUDA before the fork
+    from dense_correspondence.training.training import DenseCorrespondenceTraining
+
+    def callback(iteration, logging_dict):
+        losses = logging_dict['train']['loss'][-loss_window:]
+        if len(losses) > 0:
+            progress_queue.put(("progress", run_name, iteration, float(np.mean(losses))))
+        return stop_event.is_set()
+
+    try:
+        train = DenseCorrespondenceTraining(config=config, dataset=dataset)
+        train.set_iteration_callback(callback)
+        train.run()
+    except Exception:
+        progress_queue.put(("failed", run_name, traceback.format_exc()))
+        raise
+
+
+class SweepRunner(object):
+
+    def __init__(self, sweep_config, training_config, dataset, logging_dir):
+        """
+        :param sweep_config: the 'sweep' section of sweep.yaml
+        :type sweep_config: dict
+        :param training_config: base training config that the parameters are applied to
+        :type training_config: dict
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param logging_dir: runs are saved to logging_dir/<sweep name>/<run name>
+        :type logging_dir: str
+        """
+        if sweep_config['mode'] not in SWEEP_MODES:
+            raise ValueError("sweep mode must be one of %s, not %s" %(SWEEP_MODES, sweep_config['mode']))
+
+        self._sweep_config = sweep_config
+        self._training_config = training_config
+        self._dataset = dataset
+        self._parameter_sweep = ParameterSweep(sweep_config['parameters'])
+
+        self._logging_dir = logging_dir
+        self._sweep_dir = os.path.join(utils.convert_data_relative_path_to_absolute_path(logging_dir),
+                                       sweep_config['name'])
+
+        self._stopping_rule = None
+        early_stopping_config = sweep_config['early_stopping']
+        if early_stopping_config['enabled']:
+            self._stopping_rule = MedianStoppingRule.from_config(early_stopping_config)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Constructs a SweepRunner from sweep.yaml, loads the dataset and builds the frame cache
+        :param config: dict from sweep.yaml
+        :type config: dict
+        :return:
+        :rtype: SweepRunner
+        """
+        from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+        from dense_correspondence.dataset.frame_cache import FrameCache
+
+        dataset_config_file = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'dataset',
+                                           config['dataset_config_file'])
+        training_config_file = os.path.join(DC_SOURCE_DIR, 'config', 'dense_correspondence', 'training',
+                                            config['training_config_file'])
+
+        training_config = utils.getDictFromYamlFilename(training_config_file)
+        dataset = SpartanDataset(config=utils.getDictFromYamlFilename(dataset_config_file))
+
+        # loaded once here, the runs share it
+        dataset.load_all_pose_data()
+
+        frame_cache_size_mb = config['sweep']['frame_cache_size_mb']
+        if frame_cache_size_mb > 0:
+            dataset.frame_cache = FrameCache.build(dataset, max_size_mb=frame_cache_size_mb)
+
+        return SweepRunner(config['sweep'], training_config, dataset, config['logging_dir'])
+
+    def make_runs(self):
+        """
+        Makes the training config of every run
+        :return: list of (run_name, assignment, config)
+        :rtype: list
+        """
+        if self._sweep_config['mode'] == "grid":
+            assignments = self._parameter_sweep.grid()
+        else:
+            assignments = self._parameter_sweep.sample(self._sweep_config['num_random_runs'],
+                                                       seed=self._sweep_config['seed'])
+
+        runs = []
+        for index, assignment in enumerate(assignments):
+            run_name = ParameterSweep.make_run_name(index, assignment)
+            config = copy.deepcopy(self._training_config)
+            for key, value in assignment.iteritems():
+                set_config_value(config, key, value)
+
+            config['training']['num_iterations'] = self._sweep_config['num_iterations']
+            config['training']['num_workers'] = self._sweep_config['num_workers_per_run']
+            config['training']['logging_dir'] = os.path.join(self._logging_dir, self._sweep_config['name'])
+            config['training']['logging_dir_name'] = run_name
+            runs.append((run_name, assignment, config))
+
+        return runs
+
+    def _make_cpu_slots(self):
+        """
+        Splits the available CPUs into num_parallel_runs contiguous slices
+        :return: list of lists of CPUs
+        :rtype: list
+        """
+        cpus = get_available_cpus()
+        num_slots = self._sweep_config['num_parallel_runs']
+        if num_slots > len(cpus):
+            raise ValueError("num_parallel_runs = %d is more than the %d available CPUs" %(num_slots, len(cpus)))
+
+        return [[int(cpu) for cpu in x] for x in np.array_split(cpus, num_slots)]
+
+    def run(self, poll_interval=1.0):
+        """
+        Runs the sweep and writes the summary
+        :return: dict of run name --> result
+        :rtype: dict
+        """
+        runs = self.make_runs()
+        cpu_slots = self._make_cpu_slots()
+        threads_per_run = self._sweep_config['threads_per_run']
+        loss_window = self._sweep_config['early_stopping']['window']
+
+        logging.info("sweep %s has %d runs, %d at a time" %(self._sweep_config['name'], len(runs),
+                                                              len(cpu_slots)))
+
+        results = dict()
+        for run_name, assignment, _ in runs:
+            results[run_name] = {'parameters': assignment, 'status': "pending", 'iteration': 0,
+                                 'loss': None, 'wall_time': None}
+
+        progress_queue = multiprocessing.Queue()
+        pending = list(runs)
+        free_slots = range(len(cpu_slots))
+        running = dict() # run name --> (slot, process, stop_event, start_time)
+
+        while (len(pending) > 0) or (len(running) > 0):
+            while (len(pending) > 0) and (len(free_slots) > 0):
+                run_name, _, config = pending.pop(0)
+                slot = free_slots.pop(0)
+                cpus = cpu_slots[slot]
+                num_threads = threads_per_run if threads_per_run > 0 else len(cpus)
+
+                stop_event = multiprocessing.Event()
+                p = multiprocessing.Process(target=_run_trial,
+                                            args=(run_name, config, self._dataset, cpus, num_threads,
+                                                  self._sweep_config['cpu_only'], loss_window,
+                                                  progress_queue, stop_event))
+                p.start()
+                logging.info("started run %s on CPUs %s" %(run_name, cpus))
+                running[run_name] = (slot, p, stop_event, time.time())
+                results[run_name]['status'] = "running"
+
+            self._process_messages(progress_queue, results, running, timeout=poll_interval)
+
+            for run_name in list(running.keys()):
+                slot, p, stop_event, start_time = running[run_name]
+                if p.is_alive():
+                    continue
+
+                p.join()
+                del running[run_name]
+                free_slots.append(slot)
+
+                result = results[run_name]
+                result['wall_time'] = time.time() - start_time
+                if p.exitcode != 0:
+                    result['status'] = "failed"
+                elif stop_event.is_set():
+                    result['status'] = "stopped"
+                else:
+                    result['status'] = "finished"
+                logging.info("run %s %s after %.1f seconds" %(run_name, result['status'], result['wall_time']))
+
+        # progress that was sent right before a run exited
+        self._process_messages(progress_queue, results, running, timeout=0)
+
+        self.save_summary(results)
+        return results
+
+    def _process_messages(self, progress_queue, results, running, timeout=1.0):
+        """
+        Handles the progress messages of the runs and applies early stopping
+        """
+        block = timeout > 0
+        while True:
+            try:
+                message = progress_queue.get(block=block, timeout=timeout if block else None)
+            except Queue.Empty:
+                return
+
+            # only wait for the first message
+            block = False
+
+            if message[0] == "failed":
+                _, run_name, error = message
+                logging.error("run %s failed:\n%s" %(run_name, error))
+                continue
+
+            _, run_name, iteration, loss = message
+            results[run_name]['iteration'] = iteration
+            results[run_name]['loss'] = loss
+
+            if (self._stopping_rule is not None) and self._stopping_rule.report(run_name, iteration, loss):
+                if run_name in running:
+                    logging.info("stopping run %s at iteration %d, loss %.4f" %(run_name, iteration, loss))
+                    running[run_name][2].set()
+
+    def save_summary(self, results):
+        """
+        Writes summary.yaml and summary.csv to the sweep directory and prints the table.
+        Runs are sorted by their last reported loss.
+        :return:
+        :rtype: None
+        """
+        if not os.path.isdir(self._sweep_dir):
+            os.makedirs(self._sweep_dir)
+
+        utils.saveToYaml(results, os.path.join(self._sweep_dir, 'summary.yaml'))
+
+        def sort_key(run_name):
+            loss = results[run_name]['loss']
+            return (loss is None, loss)
+
+        keys = self._parameter_sweep.keys
+        header = ["run_name"] + keys + ["status", "iteration", "loss", "wall_time"]
+        rows = []
+        for run_name in sorted(results.keys(), key=sort_key):
+            result = results[run_name]
+            rows.append([run_name] + [result['parameters'][key] for key in keys] +
+                        [result['status'], result['iteration'], result['loss'], result['wall_time']])
+
+        with open(os.path.join(self._sweep_dir, 'summary.csv'), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+        print "\t".join(header)
+        for row in rows:
+            print "\t".join([str(x) for x in row])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep_config_file", type=str, default=SWEEP_CONFIG_FILE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sweep_runner = SweepRunner.from_config(utils.getDictFromYamlFilename(args.sweep_config_file))
+    sweep_runner.run()
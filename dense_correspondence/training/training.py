@@ -37,10 +37,15 @@ from pytorch_segmentation_detection.transforms import (ComposeJoint,
 
 from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset, SpartanDatasetDataType
 from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+import dense_correspondence.network.mixed_precision as mixed_precision_utils
 
 from dense_correspondence.loss_functions.pixelwise_contrastive_loss import PixelwiseContrastiveLoss
 import dense_correspondence.loss_functions.loss_composer as loss_composer
 from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation
+from dense_correspondence.training.training_metrics import TrainingMetricsBuffer
+from dense_correspondence.training.memory_management import TrainingMemoryManager
+from dense_correspondence.training.validation_watcher import ValidationWatcher, TRAINING_FINISHED_FILENAME
+import dense_correspondence.training.distributed as distributed
 
 
 class DenseCorrespondenceTraining(object):
@@ -55,6 +60,8 @@ class DenseCorrespondenceTraining(object):
 
         self._dcn = None
         self._optimizer = None
+        self._iteration_callback = None
+        self._validation_process = None
 
     def setup(self):
         """
@@ -64,7 +71,10 @@ class DenseCorrespondenceTraining(object):
         """
         self.load_dataset()
         self.setup_logging_dir()
-        self.setup_tensorboard()
+
+        self._tensorboard_logger = None
+        if distributed.is_main_process():
+            self.setup_tensorboard()
 
 
     @property
@@ -93,6 +103,13 @@ class DenseCorrespondenceTraining(object):
         self._dataset.load_all_pose_data()
         self._dataset.set_parameters_from_training_config(self._config)
 
+        # each rank trains on its own subset of the scenes
+        self._dataset.shard_scenes(distributed.get_rank(), distributed.get_world_size())
+
+        # and draws its own samples
+        if (self._dataset.random_seed is not None) and (distributed.get_world_size() > 1):
+            self._dataset.set_random_seed(utils.derive_seed(self._dataset.random_seed, distributed.get_rank()))
+
         self._data_loader = torch.utils.data.DataLoader(self._dataset, batch_size=batch_size,
                                           shuffle=True, num_workers=num_workers, drop_last=True)
 
@@ -127,8 +144,41 @@ class DenseCorrespondenceTraining(object):
         :rtype: DenseCorrespondenceNetwork
         """
 
-        return DenseCorrespondenceNetwork.from_config(self._config['dense_correspondence_network'],
-                                                      load_stored_params=False)
+        dcn = DenseCorrespondenceNetwork.from_config(self._config['dense_correspondence_network'],
+                                                     load_stored_params=False)
+        self._configure_network(dcn)
+        return dcn
+
+    def _configure_network(self, dcn):
+        """
+        Applies the mixed_precision, channels_last and activation_checkpointing
+        settings from the training config
+        :param dcn:
+        :type dcn: DenseCorrespondenceNetwork
+        :return:
+        :rtype: None
+        """
+        training_config = self._config['training']
+        use_mixed_precision = ('mixed_precision' in training_config) and training_config['mixed_precision']
+        channels_last = ('channels_last' in training_config) and training_config['channels_last']
+        dcn.set_precision(mixed_precision=use_mixed_precision, channels_last=channels_last)
+
+        if ('activation_checkpointing' in training_config) and training_config['activation_checkpointing']:
+            dcn.set_activation_checkpointing(True)
+
+    def set_iteration_callback(self, callback):
+        """
+        Sets a function that is called every logging_rate iterations as
+        callback(iteration, logging_dict). If it returns True training stops early,
+        e.g. for early stopping in a parameter sweep.
+
+        Only called on rank 0, logging_dict must not be modified.
+        :param callback:
+        :type callback: function
+        :return:
+        :rtype: None
+        """
+        self._iteration_callback = callback
 
     def _construct_optimizer(self, parameters):
         """
@@ -141,9 +191,29 @@ class DenseCorrespondenceTraining(object):
 
         learning_rate = float(self._config['training']['learning_rate'])
         weight_decay = float(self._config['training']['weight_decay'])
+
+        world_size = distributed.get_world_size()
+        if world_size > 1:
+            rule = self._get_distributed_config()['learning_rate_scaling']
+            learning_rate = distributed.scale_learning_rate(learning_rate, world_size, rule=rule)
+            logging.info("scaled learning rate to %.2e for %d ranks (%s)" %(learning_rate, world_size, rule))
+
         optimizer = optim.Adam(parameters, lr=learning_rate, weight_decay=weight_decay)
         return optimizer
 
+    def _get_distributed_config(self):
+        """
+        Returns the 'distributed' section of the training config, filling in defaults
+        :return:
+        :rtype: dict
+        """
+        d = {'enabled': False, 'world_size': 1, 'backend': 'gloo',
+             'init_method': 'tcp://127.0.0.1:23456', 'learning_rate_scaling': 'linear'}
+
+        if 'distributed' in self._config['training']:
+            d.update(self._config['training']['distributed'])
+        return d
+
     def _get_current_loss(self, logging_dict):
         """
         Gets the current loss for both test and train
@@ -202,12 +272,13 @@ class DenseCorrespondenceTraining(object):
 
 
         self._dcn = self.build_network()
-        self._dcn.load_state_dict(torch.load(model_param_file))
-        self._dcn.cuda()
+        device = distributed.get_device()
+        self._dcn.load_state_dict(torch.load(model_param_file, map_location=device))
+        self._dcn.to(device)
         self._dcn.train()
 
         self._optimizer = self._construct_optimizer(self._dcn.parameters())
-        self._optimizer.load_state_dict(torch.load(optim_param_file))
+        self._optimizer.load_state_dict(torch.load(optim_param_file, map_location=device))
 
         return iteration
 
@@ -231,13 +302,48 @@ class DenseCorrespondenceTraining(object):
         :return:
         :rtype:
         """
+        self.setup()
+        self.save_configs()
 
-        start_iteration = copy.copy(loss_current_iteration)
+        # validation runs in a separate process so that training never pauses for it
+        if self._config["training"]["compute_test_loss"] and distributed.is_main_process():
+            self._validation_process = ValidationWatcher.launch(self._logging_dir)
 
-        DCE = DenseCorrespondenceEvaluation
+        # after a normal exit the watcher validates the last checkpoint and exits by itself
+        finished = False
+        try:
+            self._train(loss_current_iteration=loss_current_iteration, use_pretrained=use_pretrained)
+            finished = True
+        finally:
+            if not finished:
+                self._stop_validation_process()
 
-        self.setup()
-        self.save_configs()
+    def _stop_validation_process(self, timeout=5.0):
+        """
+        Terminates the validation watcher, if training didn't finish it would wait
+        for training_finished.yaml forever
+        :param timeout: seconds to wait before killing it
+        :type timeout: float
+        """
+        process = self._validation_process
+        if (process is None) or (process.poll() is not None):
+            return
+
+        logging.info("training didn't finish, stopping the validation watcher")
+        process.terminate()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+        process.kill()
+        process.wait()
+
+    def _train(self, loss_current_iteration=0, use_pretrained=False):
+        """
+        The training loop, see run()
+        """
+        start_iteration = copy.copy(loss_current_iteration)
 
         if not use_pretrained:
             # create new network and optimizer
@@ -250,23 +356,38 @@ class DenseCorrespondenceTraining(object):
             if (self._optimizer is None):
                 raise ValueError("you must set self._optimizer if use_pretrained=True")
 
-        # make sure network is using cuda and is in train mode
+        # make sure network is on this rank's device and is in train mode
+        device = distributed.get_device()
         dcn = self._dcn
-        dcn.cuda()
+        dcn.to(device)
         dcn.train()
 
+        # DistributedDataParallel averages the gradients across ranks in the backward pass.
+        # It needs a single forward call per backward, so both images go through pair_forward
+        world_size = distributed.get_world_size()
+        pair_forward = distributed.ImagePairForward(dcn)
+        if world_size > 1:
+            device_ids = [device.index] if device.type == "cuda" else None
+            pair_forward = torch.nn.parallel.DistributedDataParallel(pair_forward, device_ids=device_ids)
+
+        # normalizes the non-match losses by the hard negatives of all ranks, see
+        # loss_composer.synchronize_hard_negatives()
+        reduce_hard_negatives = distributed.mean_over_ranks if world_size > 1 else None
+
         optimizer = self._optimizer
         batch_size = self._data_loader.batch_size
 
+        # loss scaling so that float16 gradients don't underflow, no-op if not using mixed precision
+        grad_scaler = mixed_precision_utils.GradScaler(enabled=dcn.mixed_precision)
+
         pixelwise_contrastive_loss = PixelwiseContrastiveLoss(image_shape=dcn.image_shape, config=self._config['loss_function'])
         pixelwise_contrastive_loss.debug = True
 
-        loss = match_loss = non_match_loss = 0
-
         max_num_iterations = self._config['training']['num_iterations'] + start_iteration
         logging_rate = self._config['training']['logging_rate']
         save_rate = self._config['training']['save_rate']
         compute_test_loss_rate = self._config['training']['compute_test_loss_rate']
+        compute_test_loss = self._config["training"]["compute_test_loss"]
 
         # logging
         self._logging_dict = dict()
@@ -280,6 +401,22 @@ class DenseCorrespondenceTraining(object):
         self._logging_dict['test'] = {"iteration": [], "loss": [], "match_loss": [],
                                            "non_match_loss": []}
 
+        metrics_flush_rate = 20
+        if 'metrics_flush_rate' in self._config['training']:
+            metrics_flush_rate = self._config['training']['metrics_flush_rate']
+
+        # only rank 0 logs
+        metrics = TrainingMetricsBuffer(self._tensorboard_logger, self._logging_dict,
+                                        flush_rate=metrics_flush_rate, enabled=distributed.is_main_process())
+
+        memory_manager = TrainingMemoryManager.from_training_config(self._config['training'])
+        memory_stats_file = os.path.join(self._logging_dir, 'memory_stats.yaml')
+
+        gradient_accumulation_steps = 1
+        if 'gradient_accumulation_steps' in self._config['training']:
+            gradient_accumulation_steps = self._config['training']['gradient_accumulation_steps']
+        micro_batch = 0
+
         # save network before starting
         if not use_pretrained:
             self.save_network(dcn, optimizer, 0)
@@ -288,10 +425,25 @@ class DenseCorrespondenceTraining(object):
         # TPV = TrainingProgressVisualizer()
 
         for epoch in range(50):  # loop over the dataset multiple times
+            self._dataset.set_epoch(epoch)
+
+            # the shards can have different numbers of batches, all ranks have to run the
+            # same number of steps, otherwise the ones that finish first leave the others
+            # waiting in the gradient all-reduce
+            num_batches = len(self._data_loader)
+            if world_size > 1:
+                num_batches = distributed.min_over_ranks(num_batches)
 
             for i, data in enumerate(self._data_loader, 0):
-                loss_current_iteration += 1
-                start_iter = time.time()
+                if i >= num_batches:
+                    break
+
+                # an iteration is one optimizer step, i.e. gradient_accumulation_steps micro-batches
+                if micro_batch == 0:
+                    loss_current_iteration += 1
+                    start_iter = time.time()
+                    optimizer.zero_grad()
+                    self.adjust_learning_rate(optimizer, loss_current_iteration)
 
                 match_type, \
                 img_a, img_b, \
@@ -301,121 +453,96 @@ class DenseCorrespondenceTraining(object):
                 blind_non_matches_a, blind_non_matches_b, \
                 metadata = data
 
-                if (match_type == -1).all():
+                empty_data = bool((match_type == -1).all())
+                if empty_data and (world_size == 1):
                     print "\n empty data, continuing \n"
                     continue
-
-
-                data_type = metadata["type"][0]
                 
-                img_a = Variable(img_a.cuda(), requires_grad=False)
-                img_b = Variable(img_b.cuda(), requires_grad=False)
-
-                matches_a = Variable(matches_a.cuda().squeeze(0), requires_grad=False)
-                matches_b = Variable(matches_b.cuda().squeeze(0), requires_grad=False)
-                masked_non_matches_a = Variable(masked_non_matches_a.cuda().squeeze(0), requires_grad=False)
-                masked_non_matches_b = Variable(masked_non_matches_b.cuda().squeeze(0), requires_grad=False)
-
-                background_non_matches_a = Variable(background_non_matches_a.cuda().squeeze(0), requires_grad=False)
-                background_non_matches_b = Variable(background_non_matches_b.cuda().squeeze(0), requires_grad=False)
-
-                blind_non_matches_a = Variable(blind_non_matches_a.cuda().squeeze(0), requires_grad=False)
-                blind_non_matches_b = Variable(blind_non_matches_b.cuda().squeeze(0), requires_grad=False)
-
-                optimizer.zero_grad()
-                self.adjust_learning_rate(optimizer, loss_current_iteration)
-
-                # run both images through the network
-                image_a_pred = dcn.forward(img_a)
-                image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
-
-                image_b_pred = dcn.forward(img_b)
-                image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
-
-                # get loss
-                loss, match_loss, masked_non_match_loss, \
-                background_non_match_loss, blind_non_match_loss = loss_composer.get_loss(pixelwise_contrastive_loss, match_type,
-                                                                                image_a_pred, image_b_pred,
-                                                                                matches_a,     matches_b,
-                                                                                masked_non_matches_a, masked_non_matches_b,
-                                                                                background_non_matches_a, background_non_matches_b,
-                                                                                blind_non_matches_a, blind_non_matches_b)
+                img_a = Variable(img_a.to(device), requires_grad=False)
+                img_b = Variable(img_b.to(device), requires_grad=False)
+
+                matches_a = Variable(matches_a.to(device).squeeze(0), requires_grad=False)
+                matches_b = Variable(matches_b.to(device).squeeze(0), requires_grad=False)
+                masked_non_matches_a = Variable(masked_non_matches_a.to(device).squeeze(0), requires_grad=False)
+                masked_non_matches_b = Variable(masked_non_matches_b.to(device).squeeze(0), requires_grad=False)
+
+                background_non_matches_a = Variable(background_non_matches_a.to(device).squeeze(0), requires_grad=False)
+                background_non_matches_b = Variable(background_non_matches_b.to(device).squeeze(0), requires_grad=False)
+
+                blind_non_matches_a = Variable(blind_non_matches_a.to(device).squeeze(0), requires_grad=False)
+                blind_non_matches_b = Variable(blind_non_matches_b.to(device).squeeze(0), requires_grad=False)
+
+                # only all-reduce the gradients on the last micro-batch of the optimizer step
+                sync_context = mixed_precision_utils.NullContext()
+                if (world_size > 1) and (micro_batch < gradient_accumulation_steps - 1) \
+                        and hasattr(pair_forward, 'no_sync'):
+                    sync_context = pair_forward.no_sync()
+
+                with sync_context:
+                    # run both images through the network
+                    image_a_pred, image_b_pred = pair_forward(img_a, img_b)
+                    image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
+                    image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
+
+                    if empty_data:
+                        # the other ranks can't tell, so instead of skipping the step this rank
+                        # takes part in the hard negative reduction and the gradient all-reduce
+                        # with a zero gradient
+                        loss_composer.synchronize_hard_negatives(pixelwise_contrastive_loss, [0, 0, 0],
+                                                                 reduce_hard_negatives)
+                        grad_scaler.scale(0.0 * (image_a_pred.sum() + image_b_pred.sum())).backward()
+                    else:
+                        # get loss
+                        loss, match_loss, masked_non_match_loss, \
+                        background_non_match_loss, blind_non_match_loss = loss_composer.get_loss(pixelwise_contrastive_loss, match_type,
+                                                                                        image_a_pred, image_b_pred,
+                                                                                        matches_a,     matches_b,
+                                                                                        masked_non_matches_a, masked_non_matches_b,
+                                                                                        background_non_matches_a, background_non_matches_b,
+                                                                                        blind_non_matches_a, blind_non_matches_b,
+                                                                                        reduce_hard_negatives=reduce_hard_negatives)
                 
 
-                loss.backward()
-                optimizer.step()
-
-                #if i % 10 == 0:
-                # TPV.update(self._dataset, dcn, loss_current_iteration, now_training_object_id=metadata["object_id"])
-
-                elapsed = time.time() - start_iter
-
-                def update_plots(loss, match_loss, masked_non_match_loss, background_non_match_loss, blind_non_match_loss):
-                    """
-                    Updates the tensorboard plots with current loss function information
-                    :return:
-                    :rtype:
-                    """
-
-
-
+                        # The accumulated gradient is the mean over the micro-batches of their losses.
+                        # Each micro-batch normalizes its non-match losses by its own number of hard
+                        # negatives (scale_by_hard_negatives), so this is a mean of per micro-batch
+                        # ratios, not the total non-match loss over the total number of hard negatives
+                        # that a single large batch would give. The counts of later micro-batches aren't
+                        # known yet when a micro-batch runs its backward pass. Unlike the ranks, see
+                        # loss_composer.synchronize_hard_negatives(), micro-batches aren't combined.
+                        grad_scaler.scale(loss / gradient_accumulation_steps).backward()
+
+                if not empty_data:
+                    # buffered on the device, moved to the host every metrics_flush_rate iterations
+                    data_type = metadata["type"][0]
                     learning_rate = DenseCorrespondenceTraining.get_learning_rate(optimizer)
-                    self._logging_dict['train']['learning_rate'].append(learning_rate)
-                    self._tensorboard_logger.log_value("learning rate", learning_rate, loss_current_iteration)
-
-
-                    # Don't update any plots if the entry corresponding to that term
-                    # is a zero loss
-                    if not loss_composer.is_zero_loss(match_loss):
-                        self._logging_dict['train']['match_loss'].append(match_loss.item())
-                        self._tensorboard_logger.log_value("train match loss", match_loss.item(), loss_current_iteration)
-
-                    if not loss_composer.is_zero_loss(masked_non_match_loss):
-                        self._logging_dict['train']['masked_non_match_loss'].append(masked_non_match_loss.item())
-
-                        self._tensorboard_logger.log_value("train masked non match loss", masked_non_match_loss.item(), loss_current_iteration)
-
-                    if not loss_composer.is_zero_loss(background_non_match_loss):
-                        self._logging_dict['train']['background_non_match_loss'].append(background_non_match_loss.item())
-                        self._tensorboard_logger.log_value("train background non match loss", background_non_match_loss.item(), loss_current_iteration)
-
-                    if not loss_composer.is_zero_loss(blind_non_match_loss):
-
-                        if data_type == SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE:
-                            self._tensorboard_logger.log_value("train blind SINGLE_OBJECT_WITHIN_SCENE", blind_non_match_loss.item(), loss_current_iteration)
-
-                        if data_type == SpartanDatasetDataType.DIFFERENT_OBJECT:
-                            self._tensorboard_logger.log_value("train blind DIFFERENT_OBJECT", blind_non_match_loss.item(), loss_current_iteration)
-
+                    metrics.record(loss_current_iteration, data_type, learning_rate, loss, match_loss,
+                                   masked_non_match_loss, background_non_match_loss, blind_non_match_loss)
 
-                    # loss is never zero
-                    if data_type == SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE:
-                        self._tensorboard_logger.log_value("train loss SINGLE_OBJECT_WITHIN_SCENE", loss.item(), loss_current_iteration)
-
-                    elif data_type == SpartanDatasetDataType.DIFFERENT_OBJECT:
-                        self._tensorboard_logger.log_value("train loss DIFFERENT_OBJECT", loss.item(), loss_current_iteration)
+                    del loss, match_loss, masked_non_match_loss, background_non_match_loss, blind_non_match_loss
 
-                    elif data_type == SpartanDatasetDataType.SINGLE_OBJECT_ACROSS_SCENE:
-                        self._tensorboard_logger.log_value("train loss SINGLE_OBJECT_ACROSS_SCENE", loss.item(), loss_current_iteration)
+                # free the activations of this micro-batch before running the next one
+                del image_a_pred, image_b_pred
 
-                    elif data_type == SpartanDatasetDataType.MULTI_OBJECT:
-                        self._tensorboard_logger.log_value("train loss MULTI_OBJECT", loss.item(), loss_current_iteration)
-                    
-                    elif data_type == SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT:
-                        self._tensorboard_logger.log_value("train loss SYNTHETIC_MULTI_OBJECT", loss.item(), loss_current_iteration)
-                    else:
-                        raise ValueError("unknown data type")
+                micro_batch += 1
+                if micro_batch < gradient_accumulation_steps:
+                    continue
 
+                micro_batch = 0
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+                metrics.end_step()
 
-                    if data_type == SpartanDatasetDataType.DIFFERENT_OBJECT:
-                        self._tensorboard_logger.log_value("train different object", loss.item(), loss_current_iteration)
+                #if i % 10 == 0:
+                # TPV.update(self._dataset, dcn, loss_current_iteration, now_training_object_id=metadata["object_id"])
 
-                update_plots(loss, match_loss, masked_non_match_loss, background_non_match_loss, blind_non_match_loss)
+                elapsed = time.time() - start_iter
 
                 if loss_current_iteration % save_rate == 0:
+                    metrics.flush(block=True)
                     self.save_network(dcn, optimizer, loss_current_iteration, logging_dict=self._logging_dict)
 
-                if loss_current_iteration % logging_rate == 0:
+                if (loss_current_iteration % logging_rate == 0) and distributed.is_main_process():
                     logging.info("Training on iteration %d of %d" %(loss_current_iteration, max_num_iterations))
 
                     logging.info("single iteration took %.3f seconds" %(elapsed))
@@ -423,38 +550,44 @@ class DenseCorrespondenceTraining(object):
                     percent_complete = loss_current_iteration * 100.0/(max_num_iterations - start_iteration)
                     logging.info("Training is %d percent complete\n" %(percent_complete))
 
+                    memory_telemetry = memory_manager.telemetry()
+                    metrics.log_values(memory_telemetry, loss_current_iteration)
+                    logging.info("RSS %.1f MB, DataLoader workers %.1f MB" %(memory_telemetry['rss_mb'],
+                                                                             memory_telemetry['children_rss_mb']))
 
-                # don't compute the test loss on the first few times through the loop
-                if self._config["training"]["compute_test_loss"] and (loss_current_iteration % compute_test_loss_rate == 0) and loss_current_iteration > 5:
-                    logging.info("Computing test loss")
 
-                    # delete the loss, match_loss, non_match_loss variables so that
-                    # pytorch can use that GPU memory
-                    del loss, match_loss, masked_non_match_loss, background_non_match_loss, blind_non_match_loss
-                    gc.collect()
-
-                    dcn.eval()
-                    test_loss, test_match_loss, test_non_match_loss = DCE.compute_loss_on_dataset(dcn,
-                                                                                                  self._data_loader_test, self._config['loss_function'], num_iterations=self._config['training']['test_loss_num_iterations'])
+                # the test loss is computed by the validation watcher process, all we need
+                # to do is write a checkpoint for it
+                if compute_test_loss and (loss_current_iteration % compute_test_loss_rate == 0) \
+                        and (loss_current_iteration % save_rate != 0):
+                    metrics.flush(block=True)
+                    self.save_network(dcn, optimizer, loss_current_iteration, logging_dict=self._logging_dict)
 
-                    # delete these variables so we can free GPU memory
-                    del test_loss, test_match_loss, test_non_match_loss
+                stop_early = False
+                if (self._iteration_callback is not None) and (loss_current_iteration % logging_rate == 0):
+                    if distributed.is_main_process():
+                        metrics.flush(block=True)
+                        with metrics.lock:
+                            stop_early = self._iteration_callback(loss_current_iteration, self._logging_dict)
 
-                    # make sure to set the network back to train mode
-                    dcn.train()
+                    stop_early = distributed.any_rank(bool(stop_early))
+                    if stop_early:
+                        logging.info("Stopping early at iteration %d" %(loss_current_iteration))
 
-                if loss_current_iteration % self._config['training']['garbage_collect_rate'] == 0:
-                    logging.debug("running garbage collection")
-                    gc_start = time.time()
-                    gc.collect()
-                    gc_elapsed = time.time() - gc_start
-                    logging.debug("garbage collection took %.2d seconds" %(gc_elapsed))
+                memory_manager.step(loss_current_iteration)
 
-                if loss_current_iteration > max_num_iterations:
-                    logging.info("Finished testing after %d iterations" % (max_num_iterations))
+                if (loss_current_iteration > max_num_iterations) or stop_early:
+                    logging.info("Finished testing after %d iterations" % (loss_current_iteration))
+                    metrics.close()
                     self.save_network(dcn, optimizer, loss_current_iteration, logging_dict=self._logging_dict)
+                    self.save_memory_stats(memory_manager, memory_stats_file)
+                    self.save_training_finished(loss_current_iteration)
                     return
 
+        metrics.close()
+        self.save_memory_stats(memory_manager, memory_stats_file)
+        self.save_training_finished(loss_current_iteration)
+
 
     def setup_logging_dir(self):
         """
@@ -475,14 +608,19 @@ class DenseCorrespondenceTraining(object):
 
         print "logging_dir:", self._logging_dir
 
+        # make the tensorboard log directory
+        self._tensorboard_log_dir = os.path.join(self._logging_dir, "tensorboard")
+
+        # only rank 0 writes to the logging dir
+        if not distributed.is_main_process():
+            return self._logging_dir
+
         if os.path.isdir(self._logging_dir):
             shutil.rmtree(self._logging_dir)
 
         if not os.path.isdir(self._logging_dir):
             os.makedirs(self._logging_dir)
 
-        # make the tensorboard log directory
-        self._tensorboard_log_dir = os.path.join(self._logging_dir, "tensorboard")
         if not os.path.isdir(self._tensorboard_log_dir):
             os.makedirs(self._tensorboard_log_dir)
 
@@ -504,6 +642,8 @@ class DenseCorrespondenceTraining(object):
         :return:
         :rtype: None
         """
+        if not distributed.is_main_process():
+            return
 
         network_param_file = os.path.join(self._logging_dir, utils.getPaddedString(iteration, width=6) + ".pth")
         optimizer_param_file = network_param_file + ".opt"
@@ -528,6 +668,9 @@ class DenseCorrespondenceTraining(object):
         :return:
         :rtype: None
         """
+        if not distributed.is_main_process():
+            return
+
         training_params_file = os.path.join(self._logging_dir, 'training.yaml')
         utils.saveToYaml(self._config, training_params_file)
 
@@ -541,6 +684,28 @@ class DenseCorrespondenceTraining(object):
         utils.saveToYaml(identifier_dict, identifier_file)
 
 
+    def save_training_finished(self, iteration):
+        """
+        Writes a file to the logging directory signalling that training is done.
+        The validation watcher exits once it sees this file.
+        :return:
+        :rtype: None
+        """
+        if not distributed.is_main_process():
+            return
+
+        training_finished_file = os.path.join(self._logging_dir, TRAINING_FINISHED_FILENAME)
+        utils.saveToYaml({'iteration': iteration}, training_finished_file)
+
+    def save_memory_stats(self, memory_manager, memory_stats_file):
+        """
+        Saves the memory telemetry, only on rank 0
+        :return:
+        :rtype: None
+        """
+        if distributed.is_main_process():
+            memory_manager.save(memory_stats_file)
+
     def adjust_learning_rate(self, optimizer, iteration):
         """
         Adjusts the learning rate according to the schedule
@@ -594,8 +759,45 @@ class DenseCorrespondenceTraining(object):
         config = utils.getDictFromYamlFilename(config_file)
         return config
 
+    @staticmethod
+    def run_distributed(config, dataset=None):
+        """
+        Trains with one process per rank using the 'distributed' section of the training
+        config. Blocks until all ranks have finished.
+
+        The dataset is constructed before forking and copied into each rank,
+        each rank then trains on a subset of its scenes, see SpartanDataset.shard_scenes()
+        :param config: training config
+        :type config: dict
+        :param dataset:
+        :type dataset: SpartanDataset
+        :return:
+        :rtype: None
+        """
+        train = DenseCorrespondenceTraining(config=config)
+        distributed_config = train._get_distributed_config()
+        world_size = distributed_config['world_size']
+
+        if not distributed_config['enabled'] or world_size == 1:
+            DenseCorrespondenceTraining(config=config, dataset=dataset).run()
+            return
+
+        distributed.launch(_run_distributed_rank, world_size, args=(config, dataset))
+
     @staticmethod
     def make_default():
         dataset = SpartanDataset.make_default_caterpillar()
         return DenseCorrespondenceTraining(dataset=dataset)
 
+
+def _run_distributed_rank(rank, world_size, config, dataset):
+    """
+    Entry point of each rank for DenseCorrespondenceTraining.run_distributed()
+    """
+    logging.basicConfig(level=logging.INFO)
+    distributed_config = DenseCorrespondenceTraining(config=config)._get_distributed_config()
+    distributed.init_process_group(rank, world_size, backend=distributed_config['backend'],
+                                   init_method=distributed_config['init_method'])
+
+    train = DenseCorrespondenceTraining(config=config, dataset=dataset)
+    train.run()
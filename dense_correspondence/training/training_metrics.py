@@ -0,0 +1,304 @@
+# system
+import logging
+import threading
+import Queue
+
+import numpy as np
+
+# torch
+import torch
+
+# dense correspondence
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+from dense_correspondence.dataset.spartan_dataset_masked import SpartanDatasetDataType
+
+
+# order of the loss terms inside a single buffered row
+LOSS_FIELDS = ["loss", "match_loss", "masked_non_match_loss", "background_non_match_loss",
+               "blind_non_match_loss"]
+
+# same threshold as loss_composer.is_zero_loss
+ZERO_LOSS_THRESHOLD = 1e-20
+
+
+def get_data_type_names():
+    """
+    Returns a dict mapping the integer SpartanDatasetDataType values to their names,
+    e.g. {0: "SINGLE_OBJECT_WITHIN_SCENE", ...}
+    :return:
+    :rtype: dict
+    """
+    d = dict()
+    for name, val in vars(SpartanDatasetDataType).iteritems():
+        if name.isupper():
+            d[val] = name
+    return d
+
+
+class TrainingMetricsBuffer(object):
+    """
+    Buffers the per-iteration loss terms of the training loop as on-device tensors
+    and only moves them to the host every `flush_rate` iterations.
+
+    Calling .item() on each loss term every iteration forces a device sync. Instead
+    record() just stores a detached [5] tensor per iteration. flush() stacks the
+    window, does a single device to host copy and hands the numpy array to a
+    background thread which writes to tensorboard and to the logging dict.
+
+    With gradient accumulation an iteration (optimizer step) has several micro-batches.
+    record() is called for each of them and end_step() once the step is done, which
+    buffers a single row per iteration: the mean of each loss term over the
+    micro-batches where it isn't zero.
+
+    Tensorboard receives the mean of each loss term over the window, logged at the
+    last iteration of the window. The logging dict receives the per-iteration values.
+    As before, zero loss terms are not logged. The per data type breakdown is over
+    micro-batches, since the micro-batches of an iteration can have different types.
+
+    Usage:
+        metrics = TrainingMetricsBuffer(tensorboard_logger, logging_dict, flush_rate=20)
+        metrics.record(iteration, data_type, learning_rate, loss, match_loss, ...) # every micro-batch
+        metrics.end_step() # after the optimizer step
+        metrics.flush(block=True) # before reading logging_dict
+        metrics.close()
+    """
+
+    def __init__(self, tensorboard_logger, logging_dict, flush_rate=20, enabled=True):
+        """
+        :param tensorboard_logger: tensorboard_logger.Logger object
+        :type tensorboard_logger:
+        :param logging_dict: the DenseCorrespondenceTraining logging dict, must have a 'train' key
+        :type logging_dict: dict
+        :param flush_rate: number of iterations (not micro-batches) to buffer before moving values to the host
+        :type flush_rate: int
+        :param enabled: if False all methods are no-ops, e.g. for ranks other than
+        rank 0 in distributed training
+        :type enabled: bool
+        """
+        self._enabled = enabled
+        self._tensorboard_logger = tensorboard_logger
+        self._logging_dict = logging_dict
+        self._flush_rate = max(1, int(flush_rate))
+        self._data_type_names = get_data_type_names()
+
+        # one row per iteration
+        self._loss_rows = []
+        self._iterations = []
+        self._learning_rates = []
+
+        # one row per micro-batch, for the per data type breakdown
+        self._micro_batch_rows = []
+        self._data_types = []
+
+        # micro-batches of the current iteration, see end_step()
+        self._step_rows = []
+        self._step_iteration = None
+        self._step_learning_rate = None
+
+        # the writer thread appends to logging_dict, this lock guards it
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(maxsize=4)
+        self._thread = None
+        if enabled:
+            self._thread = threading.Thread(target=self._writer_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def lock(self):
+        """
+        Lock which must be held when reading the logging dict while
+        the writer thread is running
+        """
+        return self._lock
+
+    def record(self, iteration, data_type, learning_rate, loss, match_loss, masked_non_match_loss,
+               background_non_match_loss, blind_non_match_loss):
+        """
+        Records the loss terms of a single micro-batch of the current iteration. Doesn't
+        sync with the device.
+
+        :param iteration: training iteration
+        :type iteration: int
+        :param data_type: SpartanDatasetDataType, can be an int or a (cpu) tensor
+        :type data_type:
+        :param learning_rate: current learning rate
+        :type learning_rate: float
+        :param loss: the loss terms returned by loss_composer.get_loss
+        :type loss: torch.Variable
+        :return:
+        :rtype: None
+        """
+        if not self._enabled:
+            return
+
+        data_type = int(data_type) # data_type comes from the DataLoader, it is on the cpu
+        if data_type not in self._data_type_names:
+            raise ValueError("unknown data type")
+
+        if (self._step_iteration is not None) and (iteration != self._step_iteration):
+            self.end_step()
+
+        terms = [loss, match_loss, masked_non_match_loss, background_non_match_loss, blind_non_match_loss]
+        row = torch.cat([t.detach().view(-1)[0:1] for t in terms])
+
+        self._step_rows.append(row)
+        self._step_iteration = iteration
+        self._step_learning_rate = learning_rate
+
+        self._micro_batch_rows.append(row)
+        self._data_types.append(data_type)
+
+    def end_step(self):
+        """
+        Buffers the row of the current iteration: the mean of each loss term over the
+        micro-batches where it isn't zero. Doesn't sync with the device.
+        :return:
+        :rtype: None
+        """
+        if (not self._enabled) or (len(self._step_rows) == 0):
+            return
+
+        rows = torch.stack(self._step_rows)
+        nonzero = (rows > ZERO_LOSS_THRESHOLD).type(rows.dtype)
+        row = (rows * nonzero).sum(0) / nonzero.sum(0).clamp(min=1)
+
+        self._loss_rows.append(row)
+        self._iterations.append(self._step_iteration)
+        self._learning_rates.append(self._step_learning_rate)
+
+        self._step_rows = []
+        self._step_iteration = None
+        self._step_learning_rate = None
+
+        if len(self._loss_rows) >= self._flush_rate:
+            self.flush()
+
+    def flush(self, block=False):
+        """
+        Moves the buffered values to the host and queues them for writing. Ends the
+        current iteration, see end_step().
+        :param block: if True waits until everything that is queued has been written
+        :type block: bool
+        :return:
+        :rtype: None
+        """
+        if not self._enabled:
+            return
+
+        # end_step() flushes when the window is full
+        if len(self._step_rows) > 0:
+            self.end_step()
+
+        if len(self._loss_rows) > 0:
+            # single device --> host copy for the whole window
+            num_iterations = len(self._loss_rows)
+            rows = torch.stack(self._loss_rows + self._micro_batch_rows).cpu().numpy()
+            window = (rows[:num_iterations], np.array(self._iterations), np.array(self._learning_rates),
+                      rows[num_iterations:], np.array(self._data_types))
+
+            self._loss_rows = []
+            self._iterations = []
+            self._learning_rates = []
+            self._micro_batch_rows = []
+            self._data_types = []
+
+            self._queue.put(("window", window))
+
+        if block:
+            self._queue.join()
+
+    def log_values(self, values, iteration):
+        """
+        Logs a dict of scalars to tensorboard from the writer thread, e.g. memory telemetry.
+        These are host values so this doesn't sync with the device.
+        :param values: dict of name --> float
+        :type values: dict
+        :param iteration:
+        :type iteration: int
+        :return:
+        :rtype: None
+        """
+        if self._enabled:
+            self._queue.put(("values", (dict(values), iteration)))
+
+    def close(self):
+        """
+        Flushes everything and stops the writer thread
+        :return:
+        :rtype: None
+        """
+        if not self._enabled:
+            return
+
+        self.flush(block=True)
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                item_type, data = item
+                if item_type == "window":
+                    self._write_window(*data)
+                else:
+                    self._write_values(*data)
+            except Exception:
+                logging.exception("failed to write training metrics")
+            finally:
+                self._queue.task_done()
+
+    def _write_values(self, values, iteration):
+        for name, val in values.iteritems():
+            self._tensorboard_logger.log_value(name, float(val), iteration)
+
+    def _write_window(self, losses, iterations, learning_rates, micro_batch_losses, data_types):
+        """
+        Writes a single window of values to the logging dict and tensorboard.
+        Runs on the writer thread.
+
+        losses, iterations and learning_rates have a row per iteration, micro_batch_losses
+        and data_types a row per micro-batch
+        """
+        train_log = self._logging_dict['train']
+        log_iteration = int(iterations[-1])
+        nonzero = losses > ZERO_LOSS_THRESHOLD
+
+        with self._lock:
+            train_log['iteration'].extend(iterations.tolist())
+            train_log['loss'].extend(losses[:, 0].tolist())
+            train_log['learning_rate'].extend(learning_rates.tolist())
+
+            for j in xrange(1, len(LOSS_FIELDS)):
+                train_log[LOSS_FIELDS[j]].extend(losses[nonzero[:, j], j].tolist())
+
+            different_object = (data_types == SpartanDatasetDataType.DIFFERENT_OBJECT)
+            train_log['different_object_non_match_loss'].extend(micro_batch_losses[different_object, 0].tolist())
+
+        def log_mean(name, vals):
+            if len(vals) > 0:
+                self._tensorboard_logger.log_value(name, float(np.mean(vals)), log_iteration)
+
+        # tensorboard_logger.Logger only wants a single writer at a time, that is this thread
+        self._tensorboard_logger.log_value("learning rate", float(learning_rates[-1]), log_iteration)
+        log_mean("train match loss", losses[nonzero[:, 1], 1])
+        log_mean("train masked non match loss", losses[nonzero[:, 2], 2])
+        log_mean("train background non match loss", losses[nonzero[:, 3], 3])
+
+        # per data type breakdown
+        micro_batch_nonzero = micro_batch_losses > ZERO_LOSS_THRESHOLD
+        for data_type, name in self._data_type_names.iteritems():
+            idx = (data_types == data_type)
+            if not np.any(idx):
+                continue
+
+            # loss is never zero
+            log_mean("train loss " + name, micro_batch_losses[idx, 0])
+            log_mean("train blind " + name, micro_batch_losses[idx & micro_batch_nonzero[:, 4], 4])
+
+        log_mean("train different object", micro_batch_losses[data_types == SpartanDatasetDataType.DIFFERENT_OBJECT, 0])
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# system
+import os
+import sys
+import errno
+import gc
+import fnmatch
+import logging
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+# torch
+import torch
+
+import tensorboard_logger
+
+# dense correspondence
+import dense_correspondence_manipulation.utils.utils as utils
+utils.add_dense_correspondence_to_python_path()
+from dense_correspondence.dataset.spartan_dataset_masked import SpartanDataset
+from dense_correspondence.network.dense_correspondence_network import DenseCorrespondenceNetwork
+from dense_correspondence.evaluation.evaluation import DenseCorrespondenceEvaluation
+
+
+"""
+Watches the logging directory of a training run and validates every checkpoint
+that training writes. Runs as a separate process so that training never pauses
+to compute the test loss.
+
+Usage:
+    python validation_watcher.py --logging_dir <path to logging dir> [--parent_pid <pid of training>]
+
+DenseCorrespondenceTraining launches this automatically if compute_test_loss is True,
+with its own pid as parent_pid. The watcher exits once training has finished, or once
+the parent process is gone, e.g. when training crashed or was killed.
+The watcher uses the same GPUs as training unless CUDA_VISIBLE_DEVICES is set
+differently for it.
+"""
+
+# written by DenseCorrespondenceTraining when it has saved the final checkpoint
+TRAINING_FINISHED_FILENAME = "training_finished.yaml"
+
+VALIDATION_FILENAME = "validation.yaml"
+
+
+class ValidationWatcher(object):
+
+    def __init__(self, logging_dir, poll_interval=30, parent_pid=None):
+        """
+        :param logging_dir: logging dir of the training run, must contain training.yaml and dataset.yaml
+        :type logging_dir: str
+        :param poll_interval: seconds to wait between checking for new checkpoints
+        :type poll_interval: float
+        :param parent_pid: (optional) pid of the training process, the watcher exits when it is gone
+        :type parent_pid: int
+        """
+        self._logging_dir = utils.convert_to_absolute_path(logging_dir)
+        self._poll_interval = poll_interval
+        self._parent_pid = parent_pid
+
+        self._config = utils.getDictFromYamlFilename(os.path.join(self._logging_dir, 'training.yaml'))
+        self._dataset_config = utils.getDictFromYamlFilename(os.path.join(self._logging_dir, 'dataset.yaml'))
+
+        training_config = self._config['training']
+        self._test_loss_num_iterations = training_config['test_loss_num_iterations']
+
+        self._num_image_pairs = 10
+        if 'validation_num_image_pairs' in training_config:
+            self._num_image_pairs = training_config['validation_num_image_pairs']
+
+        self._num_matches_per_image_pair = 50
+        if 'validation_num_matches_per_image_pair' in training_config:
+            self._num_matches_per_image_pair = training_config['validation_num_matches_per_image_pair']
+
+        self._load_dataset()
+        self._load_validation_log()
+
+        tensorboard_log_dir = os.path.join(self._logging_dir, "tensorboard", "validation")
+        if not os.path.isdir(tensorboard_log_dir):
+            os.makedirs(tensorboard_log_dir)
+        self._tensorboard_logger = tensorboard_logger.Logger(tensorboard_log_dir)
+
+    def _load_dataset(self):
+        """
+        Constructs the test dataset and DataLoader the same way
+        DenseCorrespondenceTraining does
+        """
+        self._dataset_test = SpartanDataset(mode="test", config=self._dataset_config)
+        self._dataset_test.load_all_pose_data()
+        self._dataset_test.set_parameters_from_training_config(self._config)
+
+        batch_size = self._config['training']['batch_size']
+        self._data_loader_test = torch.utils.data.DataLoader(self._dataset_test, batch_size=batch_size,
+                                                             shuffle=True, num_workers=2, drop_last=True)
+
+    def _load_validation_log(self):
+        """
+        Loads validation.yaml if it exists so that the watcher can be restarted
+        without re-validating checkpoints
+        """
+        self._validation_log_file = os.path.join(self._logging_dir, VALIDATION_FILENAME)
+        if os.path.isfile(self._validation_log_file):
+            self._validation_log = utils.getDictFromYamlFilename(self._validation_log_file)
+        else:
+            self._validation_log = {"iteration": [], "loss": [], "match_loss": [], "non_match_loss": [],
+                                    "pixel_match_error_l2_median": [],
+                                    "norm_diff_pred_3d_median": [],
+                                    "fraction_pixels_closer_than_ground_truth_mean": []}
+
+    @property
+    def training_finished(self):
+        return os.path.isfile(os.path.join(self._logging_dir, TRAINING_FINISHED_FILENAME))
+
+    @property
+    def parent_alive(self):
+        """
+        False once the training process is gone, always True without a parent_pid
+        """
+        if self._parent_pid is None:
+            return True
+
+        try:
+            os.kill(self._parent_pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def find_new_checkpoints(self):
+        """
+        Finds checkpoints that have been completely written but not validated yet.
+        A checkpoint is complete once its .pth.opt file exists, since
+        DenseCorrespondenceTraining.save_network writes it after the .pth file
+        :return: list of (iteration, model_param_file) sorted by iteration
+        :rtype: list
+        """
+        files = os.listdir(self._logging_dir)
+        done = set(self._validation_log["iteration"])
+
+        checkpoints = []
+        for model_param_file in fnmatch.filter(files, '*.pth'):
+            iteration = int(model_param_file.split(".")[0])
+            if iteration == 0 or iteration in done:
+                continue
+
+            if (model_param_file + ".opt") not in files:
+                continue
+
+            checkpoints.append((iteration, os.path.join(self._logging_dir, model_param_file)))
+
+        return sorted(checkpoints)
+
+    def validate_checkpoint(self, iteration, model_param_file):
+        """
+        Computes the test loss and runs a small quantitative evaluation
+        on a single checkpoint
+        :return: dict of validation results
+        :rtype: dict
+        """
+        DCE = DenseCorrespondenceEvaluation
+
+        start_time = time.time()
+        dcn = DenseCorrespondenceNetwork.from_model_folder(self._logging_dir, model_param_file=model_param_file)
+        dcn.eval()
+
+        d = dict()
+        d['iteration'] = iteration
+
+        test_loss, test_match_loss, test_non_match_loss = DCE.compute_loss_on_dataset(dcn,
+                                                                                      self._data_loader_test,
+                                                                                      self._config['loss_function'],
+                                                                                      num_iterations=self._test_loss_num_iterations)
+        d['loss'] = float(test_loss)
+        d['match_loss'] = float(test_match_loss)
+        d['non_match_loss'] = float(test_non_match_loss)
+
+        with torch.no_grad():
+            _, df = DCE.evaluate_network(dcn, self._dataset_test, num_image_pairs=self._num_image_pairs,
+                                         num_matches_per_image_pair=self._num_matches_per_image_pair)
+
+        d['pixel_match_error_l2_median'] = float(np.median(df['pixel_match_error_l2']))
+        d['norm_diff_pred_3d_median'] = float(np.median(df['norm_diff_pred_3d']))
+        d['fraction_pixels_closer_than_ground_truth_mean'] = float(np.mean(df['fraction_pixels_closer_than_ground_truth']))
+
+        del dcn
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        logging.info("validating iteration %d took %.2f seconds" %(iteration, time.time() - start_time))
+        return d
+
+    def log_validation_results(self, d):
+        """
+        Writes the results of validate_checkpoint to tensorboard and validation.yaml
+        """
+        iteration = d['iteration']
+        for key, val in d.iteritems():
+            self._validation_log[key].append(val)
+
+        self._tensorboard_logger.log_value("test loss", d['loss'], iteration)
+        self._tensorboard_logger.log_value("test match loss", d['match_loss'], iteration)
+        self._tensorboard_logger.log_value("test non match loss", d['non_match_loss'], iteration)
+        self._tensorboard_logger.log_value("test pixel match error l2 median", d['pixel_match_error_l2_median'], iteration)
+        self._tensorboard_logger.log_value("test norm diff pred 3d median", d['norm_diff_pred_3d_median'], iteration)
+        self._tensorboard_logger.log_value("test fraction pixels closer than ground truth", d['fraction_pixels_closer_than_ground_truth_mean'], iteration)
+
+        utils.saveToYaml(self._validation_log, self._validation_log_file)
+
+    def run(self):
+        """
+        Validates checkpoints as they appear. Returns once training has finished
+        and all checkpoints have been validated, or once the training process is gone
+        :return:
+        :rtype: None
+        """
+        while True:
+            # check this before listing the checkpoints so the final one isn't missed
+            finished = self.training_finished
+            checkpoints = self.find_new_checkpoints()
+
+            for iteration, model_param_file in checkpoints:
+                logging.info("validating checkpoint %s" %(model_param_file))
+                d = self.validate_checkpoint(iteration, model_param_file)
+                self.log_validation_results(d)
+
+            if finished:
+                logging.info("training finished, validation watcher exiting")
+                return
+
+            if not self.parent_alive:
+                logging.info("training process %d is gone, validation watcher exiting" %(self._parent_pid))
+                return
+
+            if len(checkpoints) == 0:
+                time.sleep(self._poll_interval)
+
+    @staticmethod
+    def launch(logging_dir):
+        """
+        Launches a ValidationWatcher in a separate process
+        :param logging_dir: logging dir of the training run
+        :type logging_dir: str
+        :return: the process
+        :rtype: subprocess.Popen
+        """
+        script = os.path.abspath(__file__)
+        if script.endswith(".pyc"):
+            script = script[:-1]
+
+        cmd = [sys.executable, script, "--logging_dir", logging_dir, "--parent_pid", str(os.getpid())]
+        logging.info("launching validation watcher: %s" %(" ".join(cmd)))
+        return subprocess.Popen(cmd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logging_dir", type=str, required=True,
+                        help="logging dir of the training run to validate")
+    parser.add_argument("--poll_interval", type=float, default=30,
+                        help="seconds between checks for new checkpoints")
+    parser.add_argument("--parent_pid", type=int, default=None,
+                        help="(optional) pid of the training process, exit when it is gone")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    watcher = ValidationWatcher(args.logging_dir, poll_interval=args.poll_interval, parent_pid=args.parent_pid)
+    watcher.run()
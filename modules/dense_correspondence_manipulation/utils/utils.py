@@ -10,6 +10,7 @@ import time
 import socket
 import getpass
 import fnmatch
+import hashlib
 import random
 import torch
 import datetime
@@ -329,11 +330,82 @@ def uv_to_flattened_pixel_locations(uv_tuple, image_width):
     flat_pixel_locations = uv_tuple[1]*image_width + uv_tuple[0]
     return flat_pixel_locations
 
-def reset_random_seed():
-    SEED = 1
-    random.seed(SEED)
-    np.random.seed(SEED)
-    torch.manual_seed(SEED)
+def reset_random_seed(seed=1):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def derive_seed(*keys):
+    """
+    Seed derived from a tuple of keys, for example (base_seed, epoch, index). Unlike
+    adding or multiplying the keys, different tuples give unrelated seeds
+    :param keys: ints or strings
+    :return: int in [0, 2**32)
+    :rtype: int
+    """
+    digest = hashlib.sha1(",".join(str(key) for key in keys)).hexdigest()
+    return int(digest[:8], 16)
+
+
+class RandomStreams(object):
+    """
+    The python, numpy and torch random generators used to draw one sample.
+
+    RandomStreams(seed) owns generators seeded from seed, so what is drawn from it
+    doesn't depend on the global random state, on other samples or on the process that
+    draws it. RandomStreams() draws from the global generators, see reset_random_seed().
+    """
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        if seed is None:
+            self.random = random
+            self.numpy = np.random
+            self.generator = None
+        else:
+            self.random = random.Random(derive_seed(seed, "random"))
+            self.numpy = np.random.RandomState(derive_seed(seed, "numpy"))
+            self.generator = torch.Generator()
+            self.generator.manual_seed(derive_seed(seed, "torch"))
+
+    def rand(self, *size):
+        """
+        Same as torch.rand(*size)
+        """
+        if self.generator is None:
+            return torch.rand(*size)
+        return torch.rand(*size, generator=self.generator)
+
+    def randn(self, *size):
+        """
+        Same as torch.randn(*size)
+        """
+        if self.generator is None:
+            return torch.randn(*size)
+        return torch.randn(*size, generator=self.generator)
+
+
+GLOBAL_RANDOM_STREAMS = RandomStreams()
+
+
+def get_random_streams(rng=None):
+    """
+    :param rng: None for the global generators
+    :type rng: RandomStreams
+    :rtype: RandomStreams
+    """
+    if rng is None:
+        return GLOBAL_RANDOM_STREAMS
+    return rng
+
+
+def sample_random_streams(base_seed, epoch, index):
+    """
+    Generators of the index-th sample of an epoch
+    :rtype: RandomStreams
+    """
+    return RandomStreams(derive_seed(base_seed, epoch, index))
 
 
 def load_rgb_image(rgb_filename):